@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Benchmarks for the rapidtide and happy hot paths, in airspeed velocity (asv) format.  From the top level directory:
+
+    asv run                           # benchmark the latest commit on master
+    asv continuous master HEAD        # compare the current branch against master
+    asv compare <commit1> <commit2>   # show the changes between two stored results
+
+Results are kept in .asv/results, one file per commit and machine.  Each stage has time_ and peakmem_ benchmarks,
+parameterized by dataset size and (where the stage supports it) number of processes.  Set RAPIDTIDE_BENCHMARK_SIZES
+(e.g. '10k,100k,500k') and RAPIDTIDE_BENCHMARK_NPROCS (e.g. '1,4,8') to choose the parameters, and
+RAPIDTIDE_BENCHMARK_DATA to choose where the synthetic datasets are cached.
+"""
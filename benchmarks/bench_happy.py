@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Timing and peak memory of happy's analytic phase projection on synthetic data.
+"""
+
+from __future__ import print_function, division
+
+import numpy as np
+
+from rapidtide.workflows.happy import phaseprojectslice
+
+from . import synthdata
+
+DESTPOINTS = 32
+CARDIACFREQ = 1.1
+CONGRIDBINS = 3.0
+
+
+class PhaseProjection(object):
+    params = synthdata.selectedsizes()
+    param_names = ['size']
+    timeout = 1800
+
+    def setup(self, sizename):
+        spaceshape, numtimepoints = synthdata.DATASETS[sizename]
+        fmri_data, delays, regressor = synthdata.getdataset(sizename)
+        self.slicesize = spaceshape[0] * spaceshape[1]
+        self.numslices = spaceshape[2]
+        self.fmri_data_byslice = np.array(fmri_data, dtype=np.float64).reshape(
+            (self.slicesize, self.numslices, numtimepoints))
+        self.demeandata_byslice = self.fmri_data_byslice - np.mean(self.fmri_data_byslice, axis=2)[:, :, None]
+
+        # cardiac phase at the acquisition time of every slice and timepoint (ascending slice order)
+        slicetimes = np.arange(numtimepoints)[None, :] * synthdata.TR + \
+                     (np.arange(self.numslices) * synthdata.TR / self.numslices)[:, None]
+        self.phasevals = np.mod(2.0 * np.pi * CARDIACFREQ * slicetimes, 2.0 * np.pi) - np.pi
+        self.outphases = np.linspace(-np.pi, np.pi, DESTPOINTS, endpoint=False)
+        self.proctrs = np.arange(numtimepoints)
+        self.validlocs = np.arange(self.slicesize)
+        outshape = (self.slicesize, self.numslices, DESTPOINTS)
+        self.weight_byslice = np.zeros(outshape, dtype=np.float64)
+        self.rawapp_byslice = np.zeros(outshape, dtype=np.float64)
+        self.cine_byslice = np.zeros(outshape, dtype=np.float64)
+
+    def _project(self):
+        for theslice in range(self.numslices):
+            phaseprojectslice(theslice,
+                              self.validlocs,
+                              self.phasevals,
+                              self.outphases,
+                              self.proctrs,
+                              self.demeandata_byslice,
+                              self.fmri_data_byslice,
+                              self.weight_byslice,
+                              self.rawapp_byslice,
+                              self.cine_byslice,
+                              CONGRIDBINS,
+                              'kaiser')
+
+    def time_phaseprojection(self, sizename):
+        self._project()
+
+    def peakmem_phaseprojection(self, sizename):
+        self._project()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Timing and peak memory of the lower level routines used throughout rapidtide and happy.
+"""
+
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.filter as tide_filt
+import rapidtide.glmpass as tide_glmpass
+import rapidtide.resample as tide_resample
+
+from . import synthdata
+
+NUMSHIFTS = 1000
+NUMCONFOUNDS = 12
+NUMGRIDPOINTS = 100000
+
+
+class kernelbenchmark(object):
+    params = synthdata.selectedsizes()
+    param_names = ['size']
+    timeout = 1800
+
+    def setup(self, sizename):
+        fmri_data, self.delays, regressor = synthdata.getdataset(sizename)
+        self.fmri_data = np.array(fmri_data, dtype=np.float64)
+        self.numvoxels, self.numtimepoints = self.fmri_data.shape
+        self.tr = synthdata.TR
+
+
+class TimeShift(kernelbenchmark):
+    def setup(self, sizename):
+        super(TimeShift, self).setup(sizename)
+        self.padtrs = int(synthdata.PADTIME / self.tr)
+        self.numshifts = min(NUMSHIFTS, self.numvoxels)
+
+    def time_timeshift(self, sizename):
+        for vox in range(self.numshifts):
+            tide_resample.timeshift(self.fmri_data[vox, :], self.delays[vox] / self.tr, self.padtrs)
+
+
+class Congrid(kernelbenchmark):
+    def setup(self, sizename):
+        super(Congrid, self).setup(sizename)
+        rng = np.random.RandomState(synthdata.SEED)
+        self.xaxis = np.linspace(-np.pi, np.pi, 32, endpoint=False)
+        self.locs = rng.uniform(-np.pi, np.pi, size=NUMGRIDPOINTS)
+        self.vals = rng.standard_normal(NUMGRIDPOINTS)
+
+    def time_congrid(self, sizename):
+        for i in range(1000):
+            tide_resample.congrid(self.xaxis, self.locs[i], self.vals[i], 3.0, kernel='kaiser', cyclic=True)
+
+    def time_congrid_batch(self, sizename):
+        tide_resample.congrid_batch(self.xaxis, self.locs, self.vals, 3.0, kernel='kaiser', cyclic=True)
+
+
+class NoncausalFilter(kernelbenchmark):
+    def setup(self, sizename):
+        super(NoncausalFilter, self).setup(sizename)
+        self.thefilter = tide_filt.noncausalfilter(filtertype='lfo')
+
+    def time_apply(self, sizename):
+        self.thefilter.apply(1.0 / self.tr, self.fmri_data)
+
+    def peakmem_apply(self, sizename):
+        self.thefilter.apply(1.0 / self.tr, self.fmri_data)
+
+
+class ConfoundGLM(kernelbenchmark):
+    number = 1
+    repeat = 1
+    warmup_time = 0.0
+
+    def setup(self, sizename):
+        super(ConfoundGLM, self).setup(sizename)
+        rng = np.random.RandomState(synthdata.SEED)
+        self.regressors = rng.standard_normal((NUMCONFOUNDS, self.numtimepoints))
+
+    def time_confoundglm(self, sizename):
+        tide_glmpass.confoundglm(self.fmri_data, self.regressors, showprogressbar=False)
+
+    def peakmem_confoundglm(self, sizename):
+        tide_glmpass.confoundglm(self.fmri_data, self.regressors, showprogressbar=False)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Timing and peak memory of the main rapidtide stages on synthetic data, for each dataset size and process count.
+"""
+
+from __future__ import print_function, division
+
+import os
+
+import numpy as np
+
+import rapidtide.corrfitx as tide_corrfit
+import rapidtide.corrpassx as tide_corrpass
+import rapidtide.filter as tide_filt
+import rapidtide.glmpass as tide_glmpass
+import rapidtide.helper_classes as tide_classes
+import rapidtide.miscmath as tide_math
+import rapidtide.nullcorrpassx as tide_nullcorr
+import rapidtide.refine as tide_refine
+import rapidtide.resample as tide_resample
+
+from . import synthdata
+
+OVERSAMPFACTOR = 2
+LAGMIN = -10.0
+LAGMAX = 10.0
+NUMESTREPS = 1000
+
+
+class pipelinesetup(object):
+    r"""Everything the stages need that rapidtideX would set up before the first pass.
+    """
+    def __init__(self, sizename):
+        fmri_data, self.delays, regressor = synthdata.getdataset(sizename)
+        self.fmri_data = np.array(fmri_data, dtype=np.float64)
+        self.numvoxels, self.numtimepoints = self.fmri_data.shape
+        self.tr = synthdata.TR
+        self.fmrifreq = 1.0 / self.tr
+        self.oversampfreq = OVERSAMPFACTOR * self.fmrifreq
+        self.initial_fmri_x = np.arange(self.numtimepoints) * self.tr
+        self.os_fmri_x = np.arange(self.numtimepoints * OVERSAMPFACTOR) * (self.tr / OVERSAMPFACTOR)
+        self.theprefilter = tide_filt.noncausalfilter(filtertype='lfo')
+        self.genlagtc = tide_resample.fastresampler(regressor[0], regressor[1], padvalue=synthdata.PADTIME)
+        self.resampref_y = self.genlagtc.yfromx(self.os_fmri_x)
+        self.referencetc = tide_math.corrnormalize(self.theprefilter.apply(self.oversampfreq, self.resampref_y),
+                                                   prewindow=True,
+                                                   detrendorder=3,
+                                                   windowfunc='hamming')
+
+        self.thecorrelator = tide_classes.correlator(Fs=self.oversampfreq,
+                                                     ncprefilter=self.theprefilter,
+                                                     detrendorder=3,
+                                                     windowfunc='hamming')
+        self.thecorrelator.setreftc(self.referencetc)
+        self.corrorigin = self.thecorrelator.corrorigin
+        corrtr = self.tr / OVERSAMPFACTOR
+        self.lagmininpts = int((-LAGMIN / corrtr) - 0.5)
+        self.lagmaxinpts = int((LAGMAX / corrtr) + 0.5)
+        self.thecorrelator.setlimits(self.lagmininpts, self.lagmaxinpts)
+        dummy, self.trimmedcorrscale, dummy = self.thecorrelator.getcorrelation()
+        self.thefitter = tide_classes.correlation_fitter(lagmin=LAGMIN,
+                                                         lagmax=LAGMAX,
+                                                         absmaxsigma=100.0,
+                                                         findmaxtype='gauss',
+                                                         refine=True,
+                                                         searchfrac=0.5)
+        self.thefitter.setcorrtimeaxis(self.trimmedcorrscale)
+
+    def correlationpass(self, corrout, meanval, nprocs=1):
+        return tide_corrpass.correlationpass(self.fmri_data,
+                                             self.referencetc,
+                                             self.thecorrelator,
+                                             self.initial_fmri_x,
+                                             self.os_fmri_x,
+                                             self.corrorigin,
+                                             self.lagmininpts,
+                                             self.lagmaxinpts,
+                                             corrout,
+                                             meanval,
+                                             nprocs=nprocs,
+                                             oversampfactor=OVERSAMPFACTOR,
+                                             showprogressbar=False)
+
+
+def getcorrout(thesetup, sizename):
+    r"""The correlation functions for a dataset, calculated (and cached) the first time they are needed.
+    """
+    thefilename = os.path.join(synthdata.datadir(),
+                               'synth_' + sizename + '_' + str(synthdata.SEED) + '_corrout.npy')
+    if not os.path.isfile(thefilename):
+        corrout = np.zeros((thesetup.numvoxels, len(thesetup.trimmedcorrscale)), dtype=np.float64)
+        thesetup.correlationpass(corrout, np.zeros(thesetup.numvoxels, dtype=np.float64))
+        np.save(thefilename + '.tmp.npy', corrout)
+        os.rename(thefilename + '.tmp.npy', thefilename)
+    return np.load(thefilename)
+
+
+class stagebenchmark(object):
+    params = (synthdata.selectedsizes(), synthdata.selectednprocs())
+    param_names = ['size', 'nprocs']
+    timeout = 3600
+    number = 1
+    repeat = 1
+    warmup_time = 0.0
+
+
+class CorrelationPass(stagebenchmark):
+    def setup(self, sizename, nprocs):
+        self.thesetup = pipelinesetup(sizename)
+        self.corrout = np.zeros((self.thesetup.numvoxels, len(self.thesetup.trimmedcorrscale)), dtype=np.float64)
+        self.meanval = np.zeros(self.thesetup.numvoxels, dtype=np.float64)
+
+    def time_correlationpass(self, sizename, nprocs):
+        self.thesetup.correlationpass(self.corrout, self.meanval, nprocs=nprocs)
+
+    def peakmem_correlationpass(self, sizename, nprocs):
+        self.thesetup.correlationpass(self.corrout, self.meanval, nprocs=nprocs)
+
+
+class FitCorr(stagebenchmark):
+    def setup(self, sizename, nprocs):
+        self.thesetup = pipelinesetup(sizename)
+        self.corrout = getcorrout(self.thesetup, sizename)
+        numvoxels = self.thesetup.numvoxels
+        corroutlen = len(self.thesetup.trimmedcorrscale)
+        self.lagtc = np.zeros(self.thesetup.fmri_data.shape, dtype=np.float64)
+        self.lagmask = np.zeros(numvoxels, dtype='uint16')
+        self.failimage = np.zeros(numvoxels, dtype='uint16')
+        self.lagtimes = np.zeros(numvoxels, dtype=np.float64)
+        self.lagstrengths = np.zeros(numvoxels, dtype=np.float64)
+        self.lagsigma = np.zeros(numvoxels, dtype=np.float64)
+        self.gaussout = np.zeros((numvoxels, corroutlen), dtype=np.float64)
+        self.windowout = np.zeros((numvoxels, corroutlen), dtype=np.float64)
+        self.R2 = np.zeros(numvoxels, dtype=np.float64)
+
+    def _fitcorr(self, nprocs):
+        return tide_corrfit.fitcorrx(self.thesetup.genlagtc,
+                                     self.thesetup.initial_fmri_x,
+                                     self.lagtc,
+                                     self.thesetup.trimmedcorrscale,
+                                     self.thesetup.thefitter,
+                                     self.corrout,
+                                     self.lagmask, self.failimage, self.lagtimes, self.lagstrengths, self.lagsigma,
+                                     self.gaussout, self.windowout, self.R2,
+                                     nprocs=nprocs,
+                                     showprogressbar=False)
+
+    def time_fitcorr(self, sizename, nprocs):
+        self._fitcorr(nprocs)
+
+    def peakmem_fitcorr(self, sizename, nprocs):
+        self._fitcorr(nprocs)
+
+    def track_delayerror(self, sizename, nprocs):
+        # the median absolute error (in seconds) of the fitted delays against the delay map used to make the data
+        self._fitcorr(nprocs)
+        thevalid = np.where(self.lagmask > 0)[0]
+        return float(np.median(np.fabs(self.lagtimes[thevalid] - self.thesetup.delays[thevalid])))
+    track_delayerror.unit = 'seconds'
+
+
+class NullDistribution(stagebenchmark):
+    def setup(self, sizename, nprocs):
+        self.thesetup = pipelinesetup(sizename)
+        self.rawtimecourse = tide_math.corrnormalize(self.thesetup.resampref_y, prewindow=False, detrendorder=3)
+
+    def _getnull(self, nprocs):
+        return tide_nullcorr.getNullDistributionDatax(self.rawtimecourse,
+                                                      self.thesetup.oversampfreq,
+                                                      self.thesetup.thecorrelator,
+                                                      self.thesetup.thefitter,
+                                                      numestreps=NUMESTREPS,
+                                                      nprocs=nprocs,
+                                                      showprogressbar=False)
+
+    def time_getnulldistributiondata(self, sizename, nprocs):
+        self._getnull(nprocs)
+
+    def peakmem_getnulldistributiondata(self, sizename, nprocs):
+        self._getnull(nprocs)
+
+
+class RefineRegressor(stagebenchmark):
+    def setup(self, sizename, nprocs):
+        self.thesetup = pipelinesetup(sizename)
+        numvoxels = self.thesetup.numvoxels
+        # use the true delays rather than fitting them, so this stage is measured on its own
+        self.lagtimes = 1.0 * self.thesetup.delays
+        self.lagstrengths = np.zeros(numvoxels, dtype=np.float64) + 0.8
+        self.lagsigma = np.zeros(numvoxels, dtype=np.float64) + 3.0
+        self.R2 = self.lagstrengths * self.lagstrengths
+        self.padtrs = int(synthdata.PADTIME / self.thesetup.tr)
+        self.shiftedtcs = np.zeros(self.thesetup.fmri_data.shape, dtype=np.float64)
+        self.weights = np.zeros(self.thesetup.fmri_data.shape, dtype=np.float64)
+        self.optiondict = {'ampthresh': 0.3,
+                           'lagminthresh': 0.5,
+                           'lagmaxthresh': 5.0,
+                           'sigmathresh': 100.0,
+                           'lagmaskside': 'both',
+                           'cleanrefined': False,
+                           'nprocs': nprocs,
+                           'mp_chunksize': 50000,
+                           'showprogressbar': False,
+                           'fmrifreq': self.thesetup.fmrifreq,
+                           'refineprenorm': 'mean',
+                           'refineweighting': 'R2',
+                           'refinetype': 'avg',
+                           'detrendorder': 3,
+                           'windowfunc': 'hamming',
+                           'offsettime': 0.0,
+                           'filterbeforePCA': True,
+                           'psdfilter': False,
+                           'dodispersioncalc': False,
+                           'estimatePCAdims': False,
+                           'outputname': os.path.join(synthdata.datadir(), 'refine')}
+
+    def _refine(self):
+        return tide_refine.refineregressor(self.thesetup.fmri_data,
+                                           self.thesetup.tr,
+                                           self.shiftedtcs,
+                                           self.weights,
+                                           1,
+                                           self.lagstrengths,
+                                           self.lagtimes,
+                                           self.lagsigma,
+                                           self.R2,
+                                           self.thesetup.theprefilter,
+                                           self.optiondict,
+                                           padtrs=self.padtrs)
+
+    def time_refineregressor(self, sizename, nprocs):
+        self._refine()
+
+    def peakmem_refineregressor(self, sizename, nprocs):
+        self._refine()
+
+
+class GLMPass(object):
+    # glmpass only runs in a single process
+    params = synthdata.selectedsizes()
+    param_names = ['size']
+    timeout = 3600
+    number = 1
+    repeat = 1
+    warmup_time = 0.0
+
+    def setup(self, sizename):
+        self.thesetup = pipelinesetup(sizename)
+        numvoxels = self.thesetup.numvoxels
+        self.lagtc = self.thesetup.genlagtc.yfromx(self.thesetup.initial_fmri_x[None, :]
+                                                   - self.thesetup.delays[:, None])
+        self.meanvalue = np.zeros(numvoxels, dtype=np.float64)
+        self.rvalue = np.zeros(numvoxels, dtype=np.float64)
+        self.r2value = np.zeros(numvoxels, dtype=np.float64)
+        self.fitcoff = np.zeros(numvoxels, dtype=np.float64)
+        self.fitNorm = np.zeros(numvoxels, dtype=np.float64)
+        self.datatoremove = np.zeros(self.thesetup.fmri_data.shape, dtype=np.float64)
+        self.filtereddata = np.zeros(self.thesetup.fmri_data.shape, dtype=np.float64)
+
+    def _glm(self):
+        return tide_glmpass.glmpass(self.thesetup.numvoxels,
+                                    self.thesetup.fmri_data,
+                                    None,
+                                    self.lagtc,
+                                    self.meanvalue,
+                                    self.rvalue,
+                                    self.r2value,
+                                    self.fitcoff,
+                                    self.fitNorm,
+                                    self.datatoremove,
+                                    self.filtereddata,
+                                    showprogressbar=False)
+
+    def time_glmpass(self, sizename):
+        self._glm()
+
+    def peakmem_glmpass(self, sizename):
+        self._glm()
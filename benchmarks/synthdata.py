@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Reproducible synthetic 4D datasets for the benchmarks.  Each dataset is a block of voxels with a smoothly varying,
+known delay map.  Every voxel timecourse is the same band limited (LFO) regressor, delayed by the voxel's delay,
+scaled to a few percent of the mean, plus gaussian noise - the same signal model as simdata.
+
+Datasets are generated once, from a fixed seed, and cached as .npy files in RAPIDTIDE_BENCHMARK_DATA (or a
+directory in the system temporary directory), so the benchmarks do not spend their time making data.
+"""
+
+from __future__ import print_function, division
+
+import os
+import tempfile
+
+import numpy as np
+
+import rapidtide.filter as tide_filt
+import rapidtide.miscmath as tide_math
+import rapidtide.resample as tide_resample
+
+# name: (spatial shape, number of timepoints)
+DATASETS = {'10k': ((25, 20, 20), 200),
+            '100k': ((50, 50, 40), 400),
+            '500k': ((100, 100, 50), 1200)}
+
+TR = 1.5
+MEANVALUE = 1000.0
+SIGNALPCT = 2.0
+NOISEPCT = 0.5
+LAGRANGE = 5.0
+PADTIME = 30.0
+REGRESSORFREQ = 12.5
+SEED = 20190521
+
+
+def selectedsizes(default='10k'):
+    r"""The dataset sizes to benchmark, from the comma separated list in RAPIDTIDE_BENCHMARK_SIZES
+    (e.g. '10k,100k,500k').  The larger datasets take a long time to process, so only 10k is used by default.
+    """
+    thesizes = os.environ.get('RAPIDTIDE_BENCHMARK_SIZES', default).split(',')
+    for thesize in thesizes:
+        if thesize not in DATASETS:
+            raise ValueError('unknown benchmark dataset size ' + thesize + ' - choose from ' +
+                             ', '.join(sorted(DATASETS.keys())))
+    return thesizes
+
+
+def selectednprocs(default='1,2'):
+    r"""The process counts to benchmark, from the comma separated list in RAPIDTIDE_BENCHMARK_NPROCS.
+    """
+    return [int(thenprocs) for thenprocs in os.environ.get('RAPIDTIDE_BENCHMARK_NPROCS', default).split(',')]
+
+
+def datadir():
+    thedir = os.environ.get('RAPIDTIDE_BENCHMARK_DATA',
+                            os.path.join(tempfile.gettempdir(), 'rapidtide_benchmarks'))
+    if not os.path.isdir(thedir):
+        os.makedirs(thedir)
+    return thedir
+
+
+def makeregressor(duration, samplerate=REGRESSORFREQ, seed=SEED):
+    r"""Band limited noise in the LFO band, starting PADTIME seconds before time 0.
+
+    Returns
+    -------
+    regressor_x, regressor_y : 1D float arrays
+    """
+    rng = np.random.RandomState(seed)
+    numpoints = int((duration + 2.0 * PADTIME) * samplerate)
+    lfofilter = tide_filt.noncausalfilter(filtertype='lfo')
+    regressor_y = tide_math.stdnormalize(lfofilter.apply(samplerate, rng.standard_normal(numpoints)))
+    regressor_x = np.arange(numpoints) / samplerate - PADTIME
+    return regressor_x, regressor_y
+
+
+def makedelaymap(spaceshape, lagrange=LAGRANGE):
+    r"""A smooth delay map spanning -lagrange to lagrange seconds, flattened to one value per voxel.
+    """
+    coords = np.meshgrid(*[np.linspace(0.0, 1.0, thedim) for thedim in spaceshape], indexing='ij')
+    delays = lagrange * np.sin(np.pi * (coords[0] - 0.5)) * np.cos(0.5 * np.pi * (coords[1] - 0.5))
+    if len(spaceshape) > 2:
+        delays += 0.25 * lagrange * np.cos(np.pi * coords[2])
+    return np.clip(delays, -lagrange, lagrange).reshape(-1)
+
+
+def makedataset(spaceshape, numtimepoints, tr=TR, seed=SEED, slabsize=10000):
+    r"""Generate a synthetic dataset.
+
+    Parameters
+    ----------
+    spaceshape : tuple of ints
+        The spatial dimensions
+    numtimepoints : int
+    tr : float, optional
+    seed : int, optional
+    slabsize : int, optional
+        Number of voxels generated at once (to limit the memory used).
+
+    Returns
+    -------
+    fmri_data : 2D float32 array
+        Voxels by timepoints
+    delays : 1D float array
+        The delay of every voxel, in seconds
+    regressor : 2D float array
+        The time axis and values of the undelayed regressor
+    """
+    numvoxels = int(np.prod(spaceshape))
+    regressor_x, regressor_y = makeregressor(numtimepoints * tr, seed=seed)
+    genlagtc = tide_resample.fastresampler(regressor_x, regressor_y, padvalue=PADTIME)
+    delays = makedelaymap(spaceshape)
+    timeaxis = np.arange(numtimepoints) * tr
+    rng = np.random.RandomState(seed + 1)
+    fmri_data = np.zeros((numvoxels, numtimepoints), dtype=np.float32)
+    for slabstart in range(0, numvoxels, slabsize):
+        slabend = min(slabstart + slabsize, numvoxels)
+        thesignal = genlagtc.yfromx(timeaxis[None, :] - delays[slabstart:slabend, None])
+        fmri_data[slabstart:slabend, :] = MEANVALUE * (1.0 + (SIGNALPCT / 100.0) * thesignal
+                                                       + (NOISEPCT / 100.0) * rng.standard_normal(thesignal.shape))
+    return fmri_data, delays, np.vstack((regressor_x, regressor_y))
+
+
+def getdataset(sizename):
+    r"""Load a standard dataset (generating and caching it the first time).  The data array is memory mapped.
+
+    Parameters
+    ----------
+    sizename : str
+        One of the keys of DATASETS
+
+    Returns
+    -------
+    fmri_data, delays, regressor : arrays
+        See makedataset
+    """
+    spaceshape, numtimepoints = DATASETS[sizename]
+    rootname = os.path.join(datadir(), 'synth_' + sizename + '_' + str(SEED))
+    thenames = [rootname + '_' + thesuffix + '.npy' for thesuffix in ['fmri', 'delays', 'regressor']]
+    if not all([os.path.isfile(thename) for thename in thenames]):
+        thearrays = makedataset(spaceshape, numtimepoints)
+        for thename, thearray in zip(thenames, thearrays):
+            # write to a temporary name first so an interrupted run does not leave a partial file
+            np.save(thename + '.tmp.npy', thearray)
+            os.rename(thename + '.tmp.npy', thename)
+    return (np.load(thenames[0], mmap_mode='r'),
+            np.load(thenames[1]),
+            np.load(thenames[2]))
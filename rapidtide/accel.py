@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Numba acceleration for rapidtide.  A small number of hot, loop based kernels are marked with the jitkernel
+decorator.  When numba is installed (and acceleration has not been turned off), each kernel is compiled in
+nopython mode with cache=True the first time it is used, so compiled code is kept on disk and reused by later runs
+and by worker processes.  Otherwise, the kernel's numpy fallback (or the function itself) is called.
+
+Acceleration can be turned off for debugging with disableaccel() (the --nonumba option), or by setting the
+RAPIDTIDE_NOJIT environment variable.  warmup() (the rapidtide-warmup program) compiles every kernel for float32
+and float64 data ahead of time, so that the on-disk cache is populated at install or container build time.
+"""
+
+from __future__ import print_function, division
+
+import os
+import time
+
+import rapidtide.lazyimport as tide_lazy
+
+# ---------------------------------------- Global settings -------------------------------------------
+numbaexists = tide_lazy.moduleexists('numba')
+useaccel = numbaexists and (os.environ.get('RAPIDTIDE_NOJIT') is None)
+jitkernels = []
+
+# the data types that warmup compiles each kernel for
+warmuptypes = ['float32', 'float64']
+
+
+def disableaccel():
+    r"""Turn off numba acceleration - all kernels run as plain python/numpy from now on.
+    """
+    global useaccel
+    useaccel = False
+
+
+def enableaccel():
+    r"""Turn numba acceleration back on (if numba is installed).
+    """
+    global useaccel
+    useaccel = numbaexists
+
+
+def accelenabled():
+    return useaccel
+
+
+class jitkernel(object):
+    r"""Decorator for a function that numba should compile.  The decorated function must be nopython compatible,
+    and can only call numpy and other compiled numba functions (not other jitkernels).
+
+    Parameters
+    ----------
+    signatures : list of str, optional
+        Numba argument signatures to compile ahead of time in warmup.  '{t}' is replaced by each of the warmup
+        data types, e.g. '({t}[::1], int64, int64, boolean)'.
+    fallback : function, optional
+        Called instead of the kernel when acceleration is off.  Use this when the loop based kernel would be
+        slow as pure python and a vectorized numpy version exists.  The two must give the same results.
+    """
+    def __init__(self, signatures=None, fallback=None):
+        if signatures is None:
+            signatures = []
+        self.signatures = signatures
+        self.fallback = fallback
+        self.pyfunc = None
+        self.compiled = None
+
+    def __call__(self, pyfunc):
+        self.pyfunc = pyfunc
+        if self.fallback is None:
+            self.fallback = pyfunc
+        jitkernels.append(self)
+        thekernel = self
+
+        def dispatch(*args):
+            if useaccel:
+                return thekernel.getcompiled()(*args)
+            return thekernel.fallback(*args)
+
+        dispatch.__name__ = pyfunc.__name__
+        dispatch.__doc__ = pyfunc.__doc__
+        dispatch.__module__ = pyfunc.__module__
+        dispatch.kernel = self
+        return dispatch
+
+    def getcompiled(self):
+        if self.compiled is None:
+            import numba
+            self.compiled = numba.njit(cache=True)(self.pyfunc)
+        return self.compiled
+
+    def name(self):
+        return self.pyfunc.__module__ + '.' + self.pyfunc.__name__
+
+
+def warmup(thetypes=None, verbose=True):
+    r"""Compile every kernel for each data type, filling the on-disk cache.
+
+    Parameters
+    ----------
+    thetypes : list of str, optional
+        The data types to compile for.  Default is float32 and float64.
+    verbose : bool, optional
+
+    Returns
+    -------
+    numcompiled : int
+        The number of signatures compiled (0 if numba is not available or acceleration is off)
+    """
+    if thetypes is None:
+        thetypes = warmuptypes
+
+    # make sure every module with kernels has been imported, so that they are all registered
+    import rapidtide.fit
+
+    if not useaccel:
+        if verbose:
+            if numbaexists:
+                print('numba acceleration is disabled - nothing to compile')
+            else:
+                print('numba is not installed - nothing to compile')
+        return 0
+
+    numcompiled = 0
+    for thekernel in jitkernels:
+        thedispatcher = thekernel.getcompiled()
+        thesigs = []
+        for thesig in thekernel.signatures:
+            if '{t}' in thesig:
+                thesigs += [thesig.format(t=thetype) for thetype in thetypes]
+            else:
+                thesigs.append(thesig)
+        for thesig in thesigs:
+            starttime = time.time()
+            thedispatcher.compile(thesig)
+            numcompiled += 1
+            if verbose:
+                print('compiled', thekernel.name(), thesig, 'in', '{:.2f}'.format(time.time() - starttime), 'seconds')
+    return numcompiled
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Checkpoints for long rapidtide runs.  After each major stage (reference prep, significance estimation, correlation,
+fitting, despeckling, refinement, and GLM filtering) the state needed to go on is saved: a small state file with the
+stage and pass that were completed, a hash of the inputs, the options, the random number generator state, the
+current regressor and the maps, and one .npy file for each large (voxels by time or voxels by lag) array that the
+following stages use.  A run started with --resume checks the hash, and skips everything up to the last completed
+stage.
+"""
+
+from __future__ import print_function, division
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+# ---------------------------------------- Global settings -------------------------------------------
+# the stages, in the order they are run in each pass
+stageorder = ['refprep', 'significance', 'correlation', 'fit', 'despeckle', 'refinement', 'glm']
+
+# options that may differ between the original and the resumed run, because they do not change the results
+runtimeoptions = ['nprocs', 'sharedmem', 'streamresults', 'memlimit', 'outofcore', 'scratchdir', 'slabsize',
+                  'mp_chunksize', 'showprogressbar', 'memprofile', 'telemetry', 'nonumba', 'checkpoint', 'resume',
+                  'cachedir', 'cachesize', 'fftthreads']
+
+# options that name input files - the contents of these files are part of the hash
+inputfileoptions = ['in_file', 'regressorfile', 'corrmaskname', 'globalmeanincludename', 'globalmeanexcludename',
+                    'refineincludename', 'refineexcludename', 'motionfilename', 'tmaskname', 'glmsourcefile',
+                    'extraprobefiles']
+
+hashblocksize = 2 ** 24
+
+
+def _findfile(thefilename):
+    # nifti files can be given without their extension
+    for thesuffix in ['', '.nii.gz', '.nii']:
+        if os.path.isfile(thefilename + thesuffix):
+            return thefilename + thesuffix
+    return None
+
+
+def hashfile(thefilename, thehasher, hashname=True):
+    r"""Add the name and the contents (if the file exists) of a file to a hash.
+
+    Parameters
+    ----------
+    thefilename : str
+        The file.  Nifti files can be given without their extension.
+    thehasher : hashlib hash object
+        The hash to update
+    hashname : bool, optional
+        If False, only hash the name if the file does not exist, so the same contents under another name give the
+        same hash.  Default is True.
+    """
+    thepath = _findfile(str(thefilename))
+    if hashname or (thepath is None):
+        thehasher.update(str(thefilename).encode('utf-8'))
+    if thepath is not None:
+        with open(thepath, 'rb') as thefile:
+            for theblock in iter(lambda: thefile.read(hashblocksize), b''):
+                thehasher.update(theblock)
+
+
+def hashinputs(optiondict):
+    r"""Make a hash of everything that determines the results of a run: the contents of the input files, and the
+    options (other than the runtimeoptions).
+
+    Parameters
+    ----------
+    optiondict : dict
+        The run options
+
+    Returns
+    -------
+    thehash : str
+    """
+    thehasher = hashlib.sha1()
+    for theoption in inputfileoptions:
+        thefilenames = optiondict.get(theoption, None)
+        if thefilenames is None:
+            continue
+        if not isinstance(thefilenames, (list, tuple)):
+            thefilenames = [thefilenames]
+        for thefilename in thefilenames:
+            hashfile(thefilename, thehasher)
+    for thekey in sorted(optiondict.keys()):
+        if thekey not in runtimeoptions:
+            thehasher.update((thekey + '=' + repr(optiondict[thekey])).encode('utf-8'))
+    return thehasher.hexdigest()
+
+
+def _tobytes(theobject):
+    return np.frombuffer(pickle.dumps(theobject, protocol=2), dtype=np.uint8)
+
+
+def _frombytes(thearray):
+    return pickle.loads(thearray.tobytes())
+
+
+class checkpointer:
+    def __init__(self, outputname, inputhash, passes, enabled=True):
+        r"""Save and restore the state of a run.
+
+        Parameters
+        ----------
+        outputname : str
+            The output file root.  The state is saved in outputname_checkpoint.npz, and the large arrays in
+            outputname_checkpoint_ARRAYNAME.npy.
+        inputhash : str
+            The hash of the inputs and options (see hashinputs)
+        passes : int
+            The number of passes in the run
+        enabled : bool, optional
+            If False, nothing is saved, and no stage is ever done
+        """
+        self.enabled = enabled
+        self.resumed = False
+        self.outputname = outputname
+        self.inputhash = inputhash
+        self.passes = passes
+        self.statefile = outputname + '_checkpoint.npz'
+        self.laststage = None
+        self.lastpass = 0
+        self.state = {}
+        self.arraynames = []
+        self.savedoptions = {}
+        self.plannedoptions = {}
+        self.rngstate = None
+
+    def _arrayfile(self, arrayname):
+        return self.outputname + '_checkpoint_' + arrayname + '.npy'
+
+    def _stagekey(self, stage, passnum):
+        if stage == 'refprep':
+            passnum = 0
+        elif stage == 'glm':
+            passnum = self.passes
+        return passnum, stageorder.index(stage)
+
+    def save(self, stage, passnum, optiondict, state=None, arrays=None, changed=None):
+        r"""Record that a stage has been completed.
+
+        Parameters
+        ----------
+        stage : str
+            One of stageorder
+        passnum : int
+            The pass the stage belongs to (ignored for refprep and glm)
+        optiondict : dict
+            The run options, as they are at the end of the stage
+        state : dict, optional
+            Small arrays and values (regressors, maps, thresholds) needed by the following stages
+        arrays : dict, optional
+            Large arrays needed by the following stages.  Each is saved in its own file.
+        changed : list of str, optional
+            The names of the arrays that have changed since the last checkpoint.  Only these (and any that have not
+            been saved yet) are written.  Default is to write all of them.
+        """
+        if not self.enabled:
+            return
+        if self.isdone(stage, passnum):
+            # resuming - this stage was skipped, and the checkpoint is already later than this
+            return
+        if state is None:
+            state = {}
+        if arrays is None:
+            arrays = {}
+        for arrayname, thearray in arrays.items():
+            if (changed is not None) and (arrayname not in changed) and (arrayname in self.arraynames):
+                continue
+            # write to a temporary file and rename it, so that an interruption never leaves a partial file
+            with open(self._arrayfile(arrayname) + '.tmp', 'wb') as thefile:
+                np.save(thefile, thearray)
+            os.replace(self._arrayfile(arrayname) + '.tmp', self._arrayfile(arrayname))
+        thestate = {'state_' + thekey: np.asarray(thevalue) for thekey, thevalue in state.items()
+                    if thevalue is not None}
+        with open(self.statefile + '.tmp', 'wb') as thefile:
+            np.savez(thefile,
+                     stage=np.asarray(stage),
+                     passnum=np.asarray(passnum),
+                     inputhash=np.asarray(self.inputhash),
+                     arraynames=np.asarray(sorted(arrays.keys()), dtype=str),
+                     optiondict=_tobytes(optiondict),
+                     plannedoptions=_tobytes(self.plannedoptions),
+                     rngstate=_tobytes(np.random.get_state()),
+                     **thestate)
+        os.replace(self.statefile + '.tmp', self.statefile)
+
+        # the large arrays from earlier stages are not needed any more
+        for arrayname in self.arraynames:
+            if arrayname not in arrays:
+                try:
+                    os.remove(self._arrayfile(arrayname))
+                except OSError:
+                    pass
+        self.laststage, self.lastpass = stage, passnum
+        self.arraynames = sorted(arrays.keys())
+
+    def load(self):
+        r"""Read the last checkpoint.
+
+        Returns
+        -------
+        status : str
+            'ok', 'missing' if there is no checkpoint, or 'mismatch' if it was made with different inputs or options
+        """
+        if not os.path.isfile(self.statefile):
+            return 'missing'
+        with np.load(self.statefile) as thedata:
+            if str(thedata['inputhash']) != self.inputhash:
+                return 'mismatch'
+            self.laststage = str(thedata['stage'])
+            self.lastpass = int(thedata['passnum'])
+            self.arraynames = [str(arrayname) for arrayname in thedata['arraynames']]
+            self.savedoptions = _frombytes(thedata['optiondict'])
+            self.plannedoptions = _frombytes(thedata['plannedoptions'])
+            self.rngstate = _frombytes(thedata['rngstate'])
+            self.state = {thekey[len('state_'):]: thedata[thekey] for thekey in thedata.files
+                          if thekey.startswith('state_')}
+        self.resumed = True
+        return 'ok'
+
+    def isdone(self, stage, passnum):
+        r"""Return True if the stage was completed before the last checkpoint.
+        """
+        if self.laststage is None:
+            return False
+        return self._stagekey(stage, passnum) <= self._stagekey(self.laststage, self.lastpass)
+
+    def setplannedoptions(self, optiondict, useroptions):
+        r"""Record the options (other than the runtimeoptions) that the memory planner changed, so they are saved
+        with each checkpoint.  When resuming, the changes made by the checkpointed run are put back instead, since
+        the planner's choices depend on the free memory, which may be different now.
+
+        Parameters
+        ----------
+        optiondict : dict
+            The run options after planning.  Changed in place when resuming.
+        useroptions : dict
+            The run options as they were given, before planning (the ones hashed with hashinputs)
+        """
+        plannedoptions = {thekey: thevalue for thekey, thevalue in optiondict.items()
+                          if (thekey not in runtimeoptions) and (thekey in useroptions)
+                          and (repr(thevalue) != repr(useroptions[thekey]))}
+        if self.resumed:
+            for thekey in plannedoptions:
+                optiondict[thekey] = useroptions[thekey]
+            optiondict.update(self.plannedoptions)
+        else:
+            self.plannedoptions = plannedoptions
+
+    def restoreoptions(self, optiondict):
+        r"""Put the options (other than the runtimeoptions) back the way they were at the checkpoint, and restore
+        the random number generator state.
+        """
+        for thekey, thevalue in self.savedoptions.items():
+            if thekey not in runtimeoptions:
+                optiondict[thekey] = thevalue
+        np.random.set_state(self.rngstate)
+
+    def getstate(self, thekey):
+        r"""Return a saved value (None if it was not saved).
+        """
+        return self.state.get(thekey, None)
+
+    def restorearray(self, arrayname, thearray, slabsize=10000):
+        r"""Copy a saved large array into thearray, a slab at a time (so thearray can be memory mapped).
+        """
+        thesaved = np.load(self._arrayfile(arrayname), mmap_mode='r')
+        if thesaved.shape != thearray.shape:
+            raise ValueError('checkpoint array ' + arrayname + ' has shape ' + str(thesaved.shape) +
+                             ', expected ' + str(thearray.shape))
+        for slabstart in range(0, thearray.shape[0], slabsize):
+            thearray[slabstart:slabstart + slabsize] = thesaved[slabstart:slabstart + slabsize]
+        del thesaved
+
+    def remove(self):
+        r"""Remove the checkpoint files (at the end of a successful run).
+        """
+        for thefilename in [self.statefile] + [self._arrayfile(arrayname) for arrayname in self.arraynames]:
+            try:
+                os.remove(thefilename)
+            except OSError:
+                pass
+        self.laststage, self.lastpass = None, 0
+        self.arraynames = []
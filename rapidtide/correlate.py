@@ -22,79 +22,32 @@
 from __future__ import print_function, division
 
 import numpy as np
-import scipy as sp
-from scipy import fftpack, signal
-from numpy.fft import rfftn, irfftn
-import pylab as pl
 import sys
-from sklearn.metrics import mutual_info_score, normalized_mutual_info_score, adjusted_mutual_info_score
+from collections import OrderedDict
 
+import rapidtide.lazyimport as tide_lazy
 import rapidtide.util as tide_util
+import rapidtide.fftbackend as tide_fft
 import rapidtide.resample as tide_resample
 import rapidtide.fit as tide_fit
 import rapidtide.miscmath as tide_math
 
+pl = tide_lazy.lazymodule('matplotlib.pyplot')
+pearsonr = tide_lazy.lazyname('scipy.stats', 'pearsonr')
+mutual_info_score = tide_lazy.lazyname('sklearn.metrics', 'mutual_info_score')
+
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder = 6
 MAXLINES = 10000000
 donotbeaggressive = True
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    from memory_profiler import profile
-
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
-
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-numbaexists = False
-
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
+memprofilerexists = tide_lazy.moduleexists('memory_profiler')
+profile = tide_lazy.lazyname('memory_profiler', 'profile')
 
+nibabelexists = tide_lazy.moduleexists('nibabel')
+nib = tide_lazy.lazymodule('nibabel')
 
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f, nopython=False)
-
-    return resdec
-
-
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f, nopython=False)
-
-    return resdec
-
-
-def disablenumba():
-    global donotusenumba
-    donotusenumba = True
 
 
 # --------------------------- Correlation functions -------------------------------------------------
@@ -167,7 +120,7 @@ def quickcorr(data1, data2, windowfunc='hamming'):
     -------
 
     """
-    thepcorr = sp.stats.stats.pearsonr(tide_math.corrnormalize(data1,
+    thepcorr = pearsonr(tide_math.corrnormalize(data1,
                                                                prewindow=True,
                                                                detrendorder=1,
                                                                windowfunc=windowfunc),
@@ -211,7 +164,7 @@ def shorttermcorr_1D(data1, data2, sampletime, windowtime, samplestep=1, prewind
                                            prewindow=prewindow,
                                            detrendorder=detrendorder,
                                            windowfunc=windowfunc)
-        thepcorr = sp.stats.stats.pearsonr(dataseg1, dataseg2)
+        thepcorr = pearsonr(dataseg1, dataseg2)
         times.append(i * sampletime)
         corrpertime.append(thepcorr[0])
         ppertime.append(thepcorr[1])
@@ -311,7 +264,7 @@ def delayedcorr(data1, data2, delayval, timestep):
     -------
 
     """
-    return sp.stats.stats.pearsonr(data1, tide_resample.timeshift(data2, delayval / timestep, 30)[0])
+    return pearsonr(data1, tide_resample.timeshift(data2, delayval / timestep, 30)[0])
 
 
 def cepstraldelay(data1, data2, timestep, displayplots=True):
@@ -368,7 +321,8 @@ def cepstraldelay(data1, data2, timestep, displayplots=True):
 
 class aliasedcorrelator:
 
-    def __init__(self, hiressignal, hires_Fs, lores_Fs, timerange, hiresstarttime=0.0, loresstarttime=0.0, padvalue=30.0):
+    def __init__(self, hiressignal, hires_Fs, lores_Fs, timerange, hiresstarttime=0.0, loresstarttime=0.0, padvalue=30.0,
+                 upsampleratio=100, interpolation='nearest', maxaliasedmatrices=64):
         """
 
         Parameters
@@ -381,6 +335,13 @@ class aliasedcorrelator:
             The sample rate of the aliased waveform
         timerange: 1D array
             The delays for which to calculate the correlation function
+        upsampleratio: int, optional
+            Oversampling factor of the resampler lookup table.  Default is 100.
+        interpolation: {'nearest', 'linear', 'hermite', 'sinc'}, optional
+            Interpolation between resampler lookup table points (see fastresampler).  Default is 'nearest'.
+        maxaliasedmatrices: int, optional
+            The number of aliased reference matrices (see getaliasedmatrix) to keep - the most recently used ones
+            are kept.  Default is 64.
 
         """
         self.hiressignal = hiressignal
@@ -391,8 +352,11 @@ class aliasedcorrelator:
         self.loresstarttime = loresstarttime
         self.highresaxis = np.arange(0.0, len(self.hiressignal)) * (1.0 / self.hires_Fs) - self.hiresstarttime
         self.padvalue = padvalue
-        self.tcgenerator = tide_resample.fastresampler(self.highresaxis, self.hiressignal, padvalue=self.padvalue)
+        self.tcgenerator = tide_resample.fastresampler(self.highresaxis, self.hiressignal, padvalue=self.padvalue,
+                                                       upsampleratio=upsampleratio, interpolation=interpolation)
         self.aliasedsignals = {}
+        self.aliasedmatrices = OrderedDict()
+        self.maxaliasedmatrices = maxaliasedmatrices
 
     def apply(self, loressignal, extraoffset):
         """
@@ -425,6 +389,60 @@ class aliasedcorrelator:
             corrfunc[i] = np.dot(aliasedhiressignal, targetsignal)
         return corrfunc
 
+    def getaliasedmatrix(self, numpoints, extraoffset):
+        """
+
+        Parameters
+        ----------
+        numpoints: int
+            The length of the aliased waveforms
+        extraoffset: float
+            Additional offset to apply to hiressignal (e.g. for slice offset)
+
+        Returns
+        -------
+        aliasedmatrix: 2D array
+            The normalized aliased reference signals, one row for each delay in timerange
+        """
+        matrixkey = "{:d}_{:.3f}".format(numpoints, extraoffset)
+        try:
+            self.aliasedmatrices.move_to_end(matrixkey)
+            return self.aliasedmatrices[matrixkey]
+        except KeyError:
+            pass
+        loresaxis = np.arange(0.0, numpoints) * (1.0 / self.lores_Fs) - self.loresstarttime
+        aliasedmatrix = np.zeros((len(self.timerange), numpoints), dtype=np.float64)
+        for i in range(len(self.timerange)):
+            theoffset = self.timerange[i] + extraoffset
+            try:
+                aliasedmatrix[i, :] = self.aliasedsignals["{:.3f}".format(theoffset)]
+            except KeyError:
+                aliasedmatrix[i, :] = tide_math.corrnormalize(self.tcgenerator.yfromx(loresaxis + theoffset))
+        self.aliasedmatrices[matrixkey] = aliasedmatrix
+        while len(self.aliasedmatrices) > self.maxaliasedmatrices:
+            self.aliasedmatrices.popitem(last=False)
+        return aliasedmatrix
+
+    def apply_batch(self, loressignals, extraoffset):
+        """
+
+        Parameters
+        ----------
+        loressignals: 2D array
+            The aliased waveforms to match, one per row (e.g. all the valid voxels in a slice)
+        extraoffset: float
+            Additional offset to apply to hiressignal (e.g. for slice offset)
+
+        Returns
+        -------
+        corrfuncs: 2D array
+            The correlation functions evaluated at timepoints of timerange, one row per input waveform
+        """
+        if loressignals.shape[0] == 0:
+            return np.zeros((0, len(self.timerange)), dtype=np.float64)
+        targetsignals = tide_math.corrnormalize(loressignals)
+        return np.dot(targetsignals, self.getaliasedmatrix(loressignals.shape[1], extraoffset).T)
+
 
 def aliasedcorrelate(hiressignal, hires_Fs, lowressignal, lowres_Fs, timerange, hiresstarttime=0.0, lowresstarttime=0.0, padvalue=30.0):
     """
@@ -460,27 +478,30 @@ def aliasedcorrelate(hiressignal, hires_Fs, lowressignal, lowres_Fs, timerange,
 
 # http://stackoverflow.com/questions/12323959/fast-cross-correlation-method-in-python
 def fastcorrelate(input1, input2, usefft=True, weighting='none', displayplots=False):
-    """
+    """Crosscorrelate two timecourses
 
     Parameters
     ----------
-    input1
-    input2
-    usefft
-    weighting
-    displayplots
+    input1 : array
+        The test timecourse.  If usefft is True, this can also be a 2D block of timecourses, one per row,
+        which are all correlated with input2 at once.
+    input2 : 1D array
+        The reference timecourse
+    usefft : bool, optional
+        Do the correlation in the frequency domain.  Default is True.
+    weighting : {'none', 'Liang', 'Eckart', 'PHAT'}, optional
+        Generalized crosscorrelation weighting (only used if usefft is True)
+    displayplots : bool, optional
 
     Returns
     -------
-
+    thexcorr : array
+        The full correlation function(s), len(input1) + len(input2) - 1 points long
     """
     if usefft:
         # Do an array flipped convolution, which is a correlation.
-        if weighting == 'none':
-            return signal.fftconvolve(input1, input2[::-1], mode='full')
-        else:
-            return weightedfftconvolve(input1, input2[::-1], mode='full', weighting=weighting,
-                                       displayplots=displayplots)
+        return weightedfftconvolve(input1, np.asarray(input2)[..., ::-1], mode='full', weighting=weighting,
+                                   displayplots=displayplots)
     else:
         return np.correlate(input1, input2, mode='full')
 
@@ -526,9 +547,10 @@ def _check_valid_mode_shapes(shape1, shape2):
 
 
 def weightedfftconvolve(in1, in2, mode="full", weighting='none', displayplots=False):
-    """Convolve two N-dimensional arrays using FFT.
-    Convolve `in1` and `in2` using the fast Fourier transform method, with
-    the output size determined by the `mode` argument.
+    """Convolve two arrays using FFT, optionally applying a generalized crosscorrelation weighting.
+    Convolve `in1` and `in2` along their last axis using the fast Fourier transform method, with
+    the output size determined by the `mode` argument.  Any leading axes are treated as a batch (for
+    example a block of voxel timecourses, one per row), and are broadcast against each other.
     This is generally much faster than `convolve` for large arrays (n > ~500),
     but can be slower when only a few output values are needed, and can only
     output float arrays (int or object array inputs will be cast to float).
@@ -537,8 +559,7 @@ def weightedfftconvolve(in1, in2, mode="full", weighting='none', displayplots=Fa
     in1 : array_like
         First input.
     in2 : array_like
-        Second input. Should have the same number of dimensions as `in1`;
-        if sizes of `in1` and `in2` are not equal then `in1` has to be the
+        Second input.  If sizes of `in1` and `in2` are not equal then `in1` has to be the
         larger array.
     mode : str {'full', 'valid', 'same'}, optional
         A string indicating the size of the output:
@@ -551,103 +572,180 @@ def weightedfftconvolve(in1, in2, mode="full", weighting='none', displayplots=Fa
         ``same``
            The output is the same size as `in1`, centered
            with respect to the 'full' output.
+    weighting : {'none', 'Liang', 'Eckart', 'PHAT'}, optional
+        The generalized crosscorrelation weighting.  The weighted result is scaled to have the same
+        maximum absolute value as the unweighted result.
     Returns
     -------
     out : array
-        An N-dimensional array containing a subset of the discrete linear
-        convolution of `in1` with `in2`.
+        An array containing a subset of the discrete linear convolution of `in1` with `in2`.
     """
     in1 = np.asarray(in1)
     in2 = np.asarray(in2)
 
     if np.isscalar(in1) and np.isscalar(in2):  # scalar inputs
         return in1 * in2
-    elif not in1.ndim == in2.ndim:
-        raise ValueError("in1 and in2 should have the same rank")
     elif in1.size == 0 or in2.size == 0:  # empty arrays
         return np.array([])
 
-    s1 = np.array(in1.shape)
-    s2 = np.array(in2.shape)
-    complex_result = (np.issubdtype(in1.dtype, np.complex) or
-                      np.issubdtype(in2.dtype, np.complex))
+    s1 = in1.shape[-1]
+    s2 = in2.shape[-1]
+    complex_result = (np.issubdtype(in1.dtype, np.complexfloating) or
+                      np.issubdtype(in2.dtype, np.complexfloating))
     size = s1 + s2 - 1
 
     if mode == "valid":
-        _check_valid_mode_shapes(s1, s2)
+        _check_valid_mode_shapes([s1], [s2])
 
-    # Always use 2**n-sized FFT
-    fsize = 2 ** np.ceil(np.log2(size)).astype(int)
-    fslice = tuple([slice(0, int(sz)) for sz in size])
+    fsize = tide_fft.nextfastlen(size, real=not complex_result)
     if not complex_result:
-        fft1 = rfftn(in1, fsize)
-        fft2 = rfftn(in2, fsize)
-        theorigmax = np.max(np.absolute(irfftn(gccproduct(fft1, fft2, 'none'), fsize)[fslice]))
-        ret = irfftn(gccproduct(fft1, fft2, weighting, displayplots=displayplots), fsize)[fslice].copy()
-        ret = irfftn(gccproduct(fft1, fft2, weighting, displayplots=displayplots), fsize)[fslice].copy()
-        ret = ret.real
-        ret *= theorigmax / np.max(np.absolute(ret))
+        ret = gcccorrelate(tide_fft.rfft(in1, fsize), tide_fft.rfft(in2, fsize), fsize, size,
+                           weighting=weighting, displayplots=displayplots)
     else:
-        fft1 = fftpack.fftn(in1, fsize)
-        fft2 = fftpack.fftn(in2, fsize)
-        theorigmax = np.max(np.absolute(fftpack.ifftn(gccproduct(fft1, fft2, 'none'))[fslice]))
-        ret = fftpack.ifftn(gccproduct(fft1, fft2, weighting, displayplots=displayplots))[fslice].copy()
-        ret *= theorigmax / np.max(np.absolute(ret))
-
-    # scale to preserve the maximum
+        fft1 = tide_fft.fft(in1, fsize)
+        fft2 = tide_fft.fft(in2, fsize)
+        ret = tide_fft.ifft(gccproduct(fft1, fft2, weighting, displayplots=displayplots))[..., :size]
+        if weighting != 'none':
+            theorigmax = np.max(np.absolute(tide_fft.ifft(fft1 * fft2)[..., :size]), axis=-1, keepdims=True)
+            ret *= _safescale(theorigmax, np.max(np.absolute(ret), axis=-1, keepdims=True))
 
     if mode == "full":
         return ret
     elif mode == "same":
-        return _centered(ret, s1)
+        return ret[..., (size - s1) // 2:(size - s1) // 2 + s1]
     elif mode == "valid":
-        return _centered(ret, s1 - s2 + 1)
+        return ret[..., s2 - 1:s1]
+
+
+def _safescale(targetmax, currentmax):
+    # the multiplier that rescales a function to the target maximum, leaving all zero functions alone
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(currentmax > 0.0, targetmax / np.where(currentmax > 0.0, currentmax, 1.0), 1.0)
 
 
-def gccproduct(fft1, fft2, weighting, threshfrac=0.1, displayplots=False):
+def gccproduct(fft1, fft2, weighting, threshfrac=0.1, displayplots=False, mag1=None, mag2=None):
     """Calculate product for generalized crosscorrelation
 
     Parameters
     ----------
-    fft1
-    fft2
-    weighting
-    threshfrac
-    displayplots
+    fft1, fft2 : complex arrays
+        The spectra to multiply.  Leading axes are treated as a batch, and the weighting threshold is found
+        separately for each spectrum along the last axis.
+    weighting : {'none', 'Liang', 'Eckart', 'PHAT'}
+        The weighting function (case insensitive).
+    threshfrac : float, optional
+        Frequencies where the weighting denominator is below threshfrac times its maximum are zeroed.
+    displayplots : bool, optional
+    mag1, mag2 : arrays, optional
+        The magnitude spectra of fft1 and fft2, if they have already been calculated.  Passing the magnitude of
+        a reference spectrum that is used many times saves recalculating it for every product.
 
     Returns
     -------
-
+    product : complex array
+        The weighted product of the spectra
     """
     product = fft1 * fft2
-    if weighting == 'none':
+    if weighting.lower() == 'none':
         return product
+    if mag1 is None:
+        mag1 = np.absolute(fft1)
+    if mag2 is None:
+        mag2 = np.absolute(fft2)
+    return product * gccweights(mag1, mag2, weighting, threshfrac=threshfrac, displayplots=displayplots)
+
 
-    # calculate the weighting function
-    if weighting == 'Liang':
-        denom = np.square(
-            np.sqrt(np.absolute(fft1 * np.conjugate(fft1))) + np.sqrt(np.absolute(fft2 * np.conjugate(fft2))))
-    elif weighting == 'Eckart':
-        denom = np.sqrt(np.absolute(fft1 * np.conjugate(fft1))) * np.sqrt(np.absolute(fft2 * np.conjugate(fft2)))
-    elif weighting == 'PHAT':
-        denom = np.absolute(product)
+def gccweights(mag1, mag2, weighting, threshfrac=0.1, displayplots=False):
+    """Calculate the (real) generalized crosscorrelation weighting spectrum from the magnitudes of the two spectra
+
+    Parameters
+    ----------
+    mag1, mag2 : arrays
+        The magnitude spectra.  Leading axes are broadcast.
+    weighting : {'Liang', 'Eckart', 'PHAT'}
+        The weighting function (case insensitive).
+    threshfrac : float, optional
+        Frequencies where the weighting denominator is below threshfrac times its maximum get zero weight.
+    displayplots : bool, optional
+
+    Returns
+    -------
+    weights : array
+        The reciprocal of the weighting denominator, to be multiplied by the crossspectrum
+    """
+    theweighting = weighting.lower()
+    if theweighting == 'liang':
+        denom = np.square(mag1 + mag2)
+    elif theweighting in ['eckart', 'phat']:
+        # for two spectra, |fft1 * fft2| and |fft1| * |fft2| are the same thing
+        denom = mag1 * mag2
     else:
         print('illegal weighting function specified in gccproduct')
         sys.exit()
 
     if displayplots:
-        xvec = range(0, len(denom))
+        xvec = range(0, denom.shape[-1])
         fig = pl.figure()
         ax = fig.add_subplot(111)
         ax.set_title('reciprocal weighting function')
-        pl.plot(xvec, abs(denom))
+        pl.plot(xvec, np.transpose(denom))
         pl.show()
 
-    # now apply it while preserving the max
-    theorigmax = np.max(np.absolute(denom))
-    thresh = theorigmax * threshfrac
-    if thresh > 0.0:
-        with np.errstate(invalid='ignore', divide='ignore'):
-            return np.nan_to_num(np.where(np.absolute(denom) > thresh, product / denom, np.float64(0.0)))
-    else:
-        return 0.0 * product
+    # ignore frequencies with very little power (an all zero spectrum gets all zero weights)
+    thresh = np.max(denom, axis=-1, keepdims=True) * threshfrac
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weights = 1.0 / denom
+    weights[~(denom > thresh)] = 0.0
+    return weights
+
+
+def gcccorrelate(spectrum1, spectrum2, fftlen, corrlen, weighting='none', threshfrac=0.1, mag1=None, mag2=None,
+                 displayplots=False):
+    """Calculate a (possibly weighted) correlation from the real FFTs of the two timecourses
+
+    Parameters
+    ----------
+    spectrum1, spectrum2 : complex arrays
+        rfft of the two (zero padded) inputs along the last axis, each fftlen long before transformation.
+        spectrum2 is the transform of the time reversed reference.  Leading axes are broadcast, so a block of
+        voxel spectra (one per row) can be correlated with a single reference in one call.
+    fftlen : int
+        The transform length
+    corrlen : int
+        The number of points of the correlation function to return
+    weighting : {'none', 'Liang', 'Eckart', 'PHAT'}, optional
+        Generalized crosscorrelation weighting.  The weighted correlation is scaled to have the same maximum
+        absolute value as the unweighted correlation.
+    threshfrac : float, optional
+        See gccproduct.
+    mag1, mag2 : arrays, optional
+        Precalculated magnitude spectra (see gccproduct).
+
+    Returns
+    -------
+    thexcorr : array
+        The correlation function(s)
+    """
+    product = spectrum1 * spectrum2
+    if weighting.lower() == 'none':
+        return tide_fft.irfft(product, fftlen, axis=-1)[..., :corrlen]
+    if mag1 is None:
+        mag1 = np.absolute(spectrum1)
+    if mag2 is None:
+        mag2 = np.absolute(spectrum2)
+    weights = gccweights(mag1, mag2, weighting, threshfrac=threshfrac, displayplots=displayplots)
+
+    # Both correlations are real, so put the unweighted one in the real part and the weighted one in the
+    # imaginary part of a single spectrum - one complex inverse transform then gives both of them, and the
+    # unweighted maximum that sets the scale comes for free.  The packed spectrum is product * (1 + i * weights)
+    # for the nonnegative frequencies, and the conjugate of the mirror image of that for the negative ones.
+    halflen = product.shape[-1]
+    packedfactor = 1.0 + 1j * weights
+    packed = np.empty(product.shape[:-1] + (fftlen,), dtype=np.complex128)
+    np.multiply(product, packedfactor, out=packed[..., :halflen])
+    np.conjugate(product[..., (fftlen + 1) // 2 - 1:0:-1], out=packed[..., halflen:])
+    packed[..., halflen:] *= packedfactor[..., (fftlen + 1) // 2 - 1:0:-1]
+    bothxcorrs = tide_fft.ifft(packed, axis=-1)[..., :corrlen]
+    theorigmax = np.max(np.absolute(bothxcorrs.real), axis=-1, keepdims=True)
+    thexcorr = bothxcorrs.imag
+    return thexcorr * _safescale(theorigmax, np.max(np.absolute(thexcorr), axis=-1, keepdims=True))
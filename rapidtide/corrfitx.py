@@ -39,6 +39,7 @@ def onecorrfitx(correlationfunc,
                 thefitter,
                 disablethresholds=False,
                 initiallag=None,
+                searchwidth=None,
                 despeckle_thresh=5.0,
                 lthreshval=0.0,
                 fixdelay=False,
@@ -47,7 +48,7 @@ def onecorrfitx(correlationfunc,
                 rt_floattype='float64'):
 
     if initiallag is not None:
-        thefitter.setguess(True, maxguess=initiallag)
+        thefitter.setguess(True, maxguess=initiallag, searchwidth=searchwidth)
         widthlimit = despeckle_thresh
     else:
         thefitter.setguess(False)
@@ -109,6 +110,7 @@ def _procOneVoxelFitcorrx(vox,
                           disablethresholds=False,
                           despeckle_thresh=5.0,
                           initiallag=None,
+                          searchwidth=None,
                           fixdelay=False,
                           fixeddelayvalue=0.0,
                           rt_floatset=np.float64,
@@ -120,6 +122,7 @@ def _procOneVoxelFitcorrx(vox,
                                                                                               fixdelay=fixdelay,
                                                                                               fixeddelayvalue=fixeddelayvalue,
                                                                                               initiallag=initiallag,
+                                                                                              searchwidth=searchwidth,
                                                                                               rt_floatset=rt_floatset,
                                                                                               rt_floattype=rt_floattype)
 
@@ -178,12 +181,19 @@ def fitcorrx(lagtcgenerator,
             chunksize=1000,
             despeckle_thresh=5.0,
             initiallags=None,
+            searchwidth=None,
+            fitmask=None,
             rt_floatset=np.float64,
             rt_floattype='float64'):
 
+    # initiallags, if given, holds a starting lag for each voxel to refit, and -1000000.0 for voxels to skip.
+    # searchwidth limits the peak search to within that many seconds of the starting lag.  fitmask, if given,
+    # selects the voxels to fit directly (with a full search, unless initiallags is also given).
     thefitter.setcorrtimeaxis(corrtimescale)
     inputshape = np.shape(corrout)
-    if initiallags is None:
+    if fitmask is not None:
+        themask = fitmask
+    elif initiallags is None:
         themask = None
     else:
         themask = np.where(initiallags > -1000000.0, 1, 0)
@@ -225,6 +235,7 @@ def fitcorrx(lagtcgenerator,
                                                    disablethresholds=False,
                                                    despeckle_thresh=despeckle_thresh,
                                                    initiallag=thislag,
+                                                   searchwidth=searchwidth,
                                                    fixdelay=fixdelay,
                                                    fixeddelayvalue=0.0,
                                                    rt_floatset=rt_floatset,
@@ -266,54 +277,54 @@ def fitcorrx(lagtcgenerator,
                 fitfails += 1
         del data_out
     else:
-        for vox in range(0, inputshape[0]):
-            if (vox % reportstep == 0 or vox == inputshape[0] - 1) and showprogressbar:
-                tide_util.progressbar(vox + 1, inputshape[0], label='Percent complete')
-            if themask is None:
-                dothisone = True
+        # only visit the voxels that need fitting (when despeckling, this is usually a small subset)
+        if themask is None:
+            voxellist = range(0, inputshape[0])
+        else:
+            voxellist = np.where(themask > 0)[0]
+        for idx, vox in enumerate(voxellist):
+            if (idx % reportstep == 0 or idx == len(voxellist) - 1) and showprogressbar:
+                tide_util.progressbar(idx + 1, len(voxellist), label='Percent complete')
+            if initiallags is None:
                 thislag = None
-            elif themask[vox] > 0:
-                dothisone = True
-                thislag = initiallags[vox]
             else:
-                dothisone = False
-                thislag = None
-            if dothisone:
-                dummy, \
-                volumetotalinc, \
-                lagtc[vox, :], \
-                lagtimes[vox], \
-                lagstrengths[vox], \
-                lagsigma[vox], \
-                gaussout[vox, :], \
-                windowout[vox, :], \
-                R2[vox], \
-                lagmask[vox], \
-                failreason = \
-                    _procOneVoxelFitcorrx(vox,
-                                          corrout[vox, :],
-                                          lagtcgenerator,
-                                          timeaxis,
-                                          thefitter,
-                                          disablethresholds=False,
-                                          despeckle_thresh=despeckle_thresh,
-                                          initiallag=thislag,
-                                          fixdelay=fixdelay,
-                                          rt_floatset=rt_floatset,
-                                          rt_floattype=rt_floattype)
-                volumetotal += volumetotalinc
-                if (FML_BADAMPLOW | FML_BADAMPHIGH) & failreason:
-                    ampfails += 1
-                if FML_BADSEARCHWINDOW & failreason:
-                    windowfails += 1
-                if FML_BADWIDTH & failreason:
-                    widthfails += 1
-                if FML_BADLAG & failreason:
-                    lagfails += 1
-                if FML_HITEDGE & failreason:
-                    edgefails += 1
-                if (FML_FITFAIL | FML_INITFAIL) & failreason:
-                    fitfails += 1
+                thislag = initiallags[vox]
+            dummy, \
+            volumetotalinc, \
+            lagtc[vox, :], \
+            lagtimes[vox], \
+            lagstrengths[vox], \
+            lagsigma[vox], \
+            gaussout[vox, :], \
+            windowout[vox, :], \
+            R2[vox], \
+            lagmask[vox], \
+            failreason = \
+                _procOneVoxelFitcorrx(vox,
+                                      corrout[vox, :],
+                                      lagtcgenerator,
+                                      timeaxis,
+                                      thefitter,
+                                      disablethresholds=False,
+                                      despeckle_thresh=despeckle_thresh,
+                                      initiallag=thislag,
+                                      searchwidth=searchwidth,
+                                      fixdelay=fixdelay,
+                                      rt_floatset=rt_floatset,
+                                      rt_floattype=rt_floattype)
+            volumetotal += volumetotalinc
+            if (FML_BADAMPLOW | FML_BADAMPHIGH) & failreason:
+                ampfails += 1
+            if FML_BADSEARCHWINDOW & failreason:
+                windowfails += 1
+            if FML_BADWIDTH & failreason:
+                widthfails += 1
+            if FML_BADLAG & failreason:
+                lagfails += 1
+            if FML_HITEDGE & failreason:
+                edgefails += 1
+            if (FML_FITFAIL | FML_INITFAIL) & failreason:
+                fitfails += 1
     print('\nCorrelation fitted in ' + str(volumetotal) + ' voxels')
     print('\tampfails=', ampfails,
           '\n\tlagfails=', lagfails,
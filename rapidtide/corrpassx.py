@@ -65,6 +65,127 @@ def _procOneVoxelCorrelation(vox,
     return vox, np.mean(thetc), thexcorr_y, thexcorr_x, theglobalmax
 
 
+def _procOneVoxelCoarseCorrelation(vox,
+                                   thecoarsecorrelator,
+                                   fmritc,
+                                   theinterpmatrix,
+                                   thexcorr_x,
+                                   oversampfactor=1,
+                                   globalmaxoffset=0,
+                                   rt_floatset=np.float64,
+                                   rt_floattype='float64'
+                                   ):
+    # correlate at the native sample rate, then band-limited interpolate onto the oversampled lag axis
+    thecoarsexcorr, dummy, thecoarseglobalmax = thecoarsecorrelator.run(fmritc, trim=False)
+    thexcorr_y = rt_floatset(theinterpmatrix.dot(thecoarsexcorr.T).T)
+
+    return vox, np.mean(fmritc), thexcorr_y, thexcorr_x, thecoarseglobalmax * oversampfactor + globalmaxoffset
+
+
+def makecoarsecorrelator(thecorrelator, referencetc, oversampfactor, sincwidth=8):
+    """
+    Set up the native rate half of a coarse to fine correlation pass.
+
+    Parameters
+    ----------
+    thecorrelator : correlator or multicorrelator
+        The oversampled correlator, with its reference timecourse and lag limits already set
+    referencetc : 1D or 2D array
+        The oversampled reference timecourse (or one per row for a multicorrelator).  Every oversampfactor'th
+        point must fall on a native sample.
+    oversampfactor : int
+        The oversampling factor
+    sincwidth : int, optional
+        Half width, in native samples, of the interpolation kernel.  Default is 8.
+
+    Returns
+    -------
+    thecoarsecorrelator : correlator or multicorrelator
+        A correlator of the same type, with the same settings as thecorrelator, running at the native sample rate
+    theinterpmatrix : sparse matrix
+        Maps the untrimmed native correlation onto the trimmed oversampled lag axis
+    thexcorr_x : 1D array
+        The trimmed oversampled lag axis
+    globalmaxoffset : int
+        Add this to oversampfactor times a native correlation index to get the matching oversampled index
+    """
+    thecoarsecorrelator = thecorrelator.__class__(Fs=thecorrelator.Fs / oversampfactor,
+                                                  ncprefilter=thecorrelator.ncprefilter,
+                                                  detrendorder=thecorrelator.detrendorder,
+                                                  windowfunc=thecorrelator.windowfunc,
+                                                  corrweighting=thecorrelator.corrweighting)
+    thecoarsecorrelator.setreftc(np.asarray(referencetc)[..., ::oversampfactor])
+    dummy, coarsecorrscale, dummy = thecoarsecorrelator.getcorrelation(trim=False)
+    dummy, thexcorr_x, dummy = thecorrelator.getcorrelation(trim=True)
+    theinterpmatrix = tide_resample.sincinterpmatrix(coarsecorrscale, thexcorr_x, sincwidth=sincwidth)
+    globalmaxoffset = (np.shape(referencetc)[-1] - 1) - (np.shape(thecoarsecorrelator.reftc)[-1] - 1) * oversampfactor
+    return thecoarsecorrelator, theinterpmatrix, thexcorr_x, globalmaxoffset
+
+
+def makelagwindows(initiallags, thexcorr_x, searchwidth):
+    """
+    Find the range of lags to search for the peak in for each voxel when the delay is already roughly known.
+
+    Parameters
+    ----------
+    initiallags : 1D array
+        The starting lag for each voxel, in seconds.  Voxels with a value of -1000000.0 or less get the full lag
+        range.
+    thexcorr_x : 1D array
+        The trimmed oversampled lag axis
+    searchwidth : float
+        The half width of the window, in seconds
+
+    Returns
+    -------
+    lagwindows : 2D int array
+        The first and one past the last lag index of the window for each voxel, shape (numvoxels, 2)
+    """
+    corrstep = thexcorr_x[1] - thexcorr_x[0]
+    halfwidth = int(np.ceil(searchwidth / corrstep))
+    centers = np.round((np.asarray(initiallags) - thexcorr_x[0]) / corrstep).astype(int)
+    lagwindows = np.zeros((len(centers), 2), dtype=int)
+    lagwindows[:, 0] = np.clip(centers - halfwidth, 0, len(thexcorr_x))
+    lagwindows[:, 1] = np.clip(centers + halfwidth + 1, 0, len(thexcorr_x))
+    fullrange = np.where(np.asarray(initiallags) <= -1000000.0)
+    lagwindows[fullrange, 0] = 0
+    lagwindows[fullrange, 1] = len(thexcorr_x)
+    return lagwindows
+
+
+def windowedgepeaks(corrout, lagwindows, bipolar=False):
+    """
+    Find the voxels where the largest correlation in the window is at one of its ends, so the real peak may be
+    outside of it.
+
+    Parameters
+    ----------
+    corrout : 2D array
+        The correlations, one row per voxel
+    lagwindows : 2D int array
+        The lag window of each voxel (see makelagwindows)
+    bipolar : bool, optional
+        Look for the largest absolute correlation.  Default is False.
+
+    Returns
+    -------
+    atedge : 1D bool array
+        True for the voxels whose peak is at the end of the window (windows that reach the end of the lag range do
+        not count)
+    """
+    numlags = np.shape(corrout)[-1]
+    windowstart = lagwindows[:, 0]
+    windowend = lagwindows[:, 1]
+    lagindex = np.arange(numlags)
+    inwindow = (lagindex[None, :] >= windowstart[:, None]) & (lagindex[None, :] < windowend[:, None])
+    if bipolar:
+        maxloc = np.argmax(np.where(inwindow, np.fabs(corrout), -np.inf), axis=1)
+    else:
+        maxloc = np.argmax(np.where(inwindow, corrout, -np.inf), axis=1)
+    atedge = ((maxloc == windowstart) & (windowstart > 0)) | ((maxloc == windowend - 1) & (windowend < numlags))
+    return atedge & (windowend > windowstart)
+
+
 def correlationpass(fmridata,
                     referencetc,
                     thecorrelator,
@@ -78,6 +199,9 @@ def correlationpass(fmridata,
                     nprocs=1,
                     oversampfactor=1,
                     interptype='univariate',
+                    coarsetofine=False,
+                    sincwidth=8,
+                    probecorrout=None,
                     showprogressbar=True,
                     chunksize=1000,
                     rt_floatset=np.float64,
@@ -88,7 +212,11 @@ def correlationpass(fmridata,
     ----------
     fmridata
     referencetc
+        The reference timecourse.  If thecorrelator is a multicorrelator, a 2D array with one reference per row.
     thecorrelator
+        A correlator, or a multicorrelator to correlate every voxel with several references at once.  With a
+        multicorrelator, corrout has shape (numvoxels, numreferences, numlags) (unless probecorrout is given), and
+        each entry of the returned global maximum list is an array with one value per reference.
     fmri_x
     os_fmri_x
     tr
@@ -100,6 +228,15 @@ def correlationpass(fmridata,
     nprocs
     oversampfactor
     interptype
+    coarsetofine : bool
+        If True (and oversampfactor > 1), correlate at the native sample rate and sinc interpolate the
+        correlation onto the oversampled lag axis, rather than resampling and correlating every voxel at the
+        oversampled rate.  The peak location matches the oversampled correlation for band limited data.
+    sincwidth : int
+        Half width, in native samples, of the coarse to fine interpolation kernel
+    probecorrout : 3D array, optional
+        With a multicorrelator, put the correlations with the first reference in corrout, with shape (numvoxels,
+        numlags), and the rest in probecorrout, with shape (numvoxels, numreferences - 1, numlags).
     showprogressbar
     chunksize
     rt_floatset
@@ -117,6 +254,41 @@ def correlationpass(fmridata,
     reportstep = 1000
     thetc = np.zeros(np.shape(os_fmri_x), dtype=rt_floattype)
     theglobalmaxlist = []
+    coarsetofine = coarsetofine and (oversampfactor > 1)
+    if coarsetofine:
+        thecoarsecorrelator, theinterpmatrix, thetrimmedcorrscale, globalmaxoffset = \
+            makecoarsecorrelator(thecorrelator, referencetc, oversampfactor, sincwidth=sincwidth)
+
+    def storecorrelation(vox, thexcorr):
+        if probecorrout is None:
+            corrout[vox, :] = thexcorr
+        else:
+            corrout[vox, :] = thexcorr[0, :]
+            probecorrout[vox, :, :] = thexcorr[1:, :]
+
+    def procvoxel(vox):
+        if coarsetofine:
+            return _procOneVoxelCoarseCorrelation(vox,
+                                                  thecoarsecorrelator,
+                                                  fmridata[vox, :],
+                                                  theinterpmatrix,
+                                                  thetrimmedcorrscale,
+                                                  oversampfactor=oversampfactor,
+                                                  globalmaxoffset=globalmaxoffset,
+                                                  rt_floatset=rt_floatset,
+                                                  rt_floattype=rt_floattype)
+        else:
+            return _procOneVoxelCorrelation(vox,
+                                             thetc,
+                                             thecorrelator,
+                                             fmri_x,
+                                             fmridata[vox, :],
+                                             os_fmri_x,
+                                             oversampfactor=oversampfactor,
+                                             interptype=interptype,
+                                             rt_floatset=rt_floatset,
+                                             rt_floattype=rt_floattype)
+
     if nprocs > 1:
         # define the consumer function here so it inherits most of the arguments
         def correlation_consumer(inQ, outQ):
@@ -130,16 +302,7 @@ def correlationpass(fmridata,
                         break
 
                     # process and send the data
-                    outQ.put(_procOneVoxelCorrelation(val,
-                                                      thetc,
-                                                      thecorrelator,
-                                                      fmri_x,
-                                                      fmridata[val, :],
-                                                      os_fmri_x,
-                                                      oversampfactor=oversampfactor,
-                                                      interptype=interptype,
-                                                      rt_floatset=rt_floatset,
-                                                      rt_floattype=rt_floattype))
+                    outQ.put(procvoxel(val))
 
                 except Exception as e:
                     print("error!", e)
@@ -156,7 +319,7 @@ def correlationpass(fmridata,
         for voxel in data_out:
             # corrmask[voxel[0]] = 1
             meanval[voxel[0]] = voxel[1]
-            corrout[voxel[0], :] = voxel[2]
+            storecorrelation(voxel[0], voxel[2])
             thecorrscale = voxel[3]
             theglobalmaxlist.append(voxel[4] + 0)
             volumetotal += 1
@@ -165,17 +328,8 @@ def correlationpass(fmridata,
         for vox in range(0, inputshape[0]):
             if (vox % reportstep == 0 or vox == inputshape[0] - 1) and showprogressbar:
                 tide_util.progressbar(vox + 1, inputshape[0], label='Percent complete')
-            dummy, meanval[vox], corrout[vox, :], thecorrscale, theglobalmax = _procOneVoxelCorrelation(vox,
-                                                                                          thetc,
-                                                                                          thecorrelator,
-                                                                                          fmri_x,
-                                                                                          fmridata[vox, :],
-                                                                                          os_fmri_x,
-                                                                                          oversampfactor=oversampfactor,
-                                                                                          interptype=interptype,
-                                                                                          rt_floatset=rt_floatset,
-                                                                                          rt_floattype=rt_floattype
-                                                                                          )
+            dummy, meanval[vox], thexcorr, thecorrscale, theglobalmax = procvoxel(vox)
+            storecorrelation(vox, thexcorr)
             theglobalmaxlist.append(theglobalmax + 0)
             volumetotal += 1
     print('\nCorrelation performed on ' + str(volumetotal) + ' voxels')
@@ -28,17 +28,8 @@ import os
 import sys
 from statsmodels.robust.scale import mad
 import glob
-from scipy import fftpack
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
 
+import rapidtide.fftbackend as tide_fft
 import rapidtide.io as tide_io
 
 try:
@@ -809,7 +800,7 @@ class hybrid(dlfilter):
 
 def filtscale(data, scalefac=1.0, reverse=False, hybrid=False, lognormalize=True, epsilon=1e-10, numorders=6):
     if not reverse:
-        specvals = fftpack.fft(data)
+        specvals = tide_fft.fft(data)
         if lognormalize:
             themag = np.log(np.absolute(specvals) + epsilon)
             scalefac = np.max(themag)
@@ -834,7 +825,7 @@ def filtscale(data, scalefac=1.0, reverse=False, hybrid=False, lognormalize=True
             else:
                 themag = data[:, 0] * scalefac
             specvals = themag * np.exp(1.0j * thephase)
-            return fftpack.ifft(specvals).real
+            return tide_fft.ifft(specvals).real
 
 
 def tobadpts(name):
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+The FFT routines used throughout rapidtide.  All transforms go through fft, ifft, rfft, and irfft in this module,
+which dispatch to pyfftw (with cached plans), scipy.fft (with worker threads), or numpy.fft, depending on what is
+installed and what has been selected with setfftbackend.  The number of threads used by a single transform is set
+with setfftthreads, and is independent of the number of worker processes (nprocs).
+"""
+
+from __future__ import print_function, division
+
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+# ----------------------------------------- Conditional imports ---------------------------------------
+try:
+    import pyfftw
+
+    pyfftwexists = True
+except ImportError:
+    pyfftwexists = False
+
+try:
+    import scipy.fft as scipyfft
+
+    scipyfftexists = True
+except ImportError:
+    scipyfftexists = False
+
+# ---------------------------------------- Global settings -------------------------------------------
+if pyfftwexists:
+    fftbackend = 'pyfftw'
+elif scipyfftexists:
+    fftbackend = 'scipy'
+else:
+    fftbackend = 'numpy'
+fftthreads = 1
+
+# the pyfftw plans, most recently used last.  Each plan holds aligned input and output buffers, so only the
+# maxfftplans most recently used are kept.
+fftplans = OrderedDict()
+maxfftplans = 32
+fastlens = {}
+
+
+def setfftbackend(thebackend):
+    r"""Select the FFT implementation.
+
+    Parameters
+    ----------
+    thebackend : {'pyfftw', 'scipy', 'numpy'}
+        The library to use for transforms.  The library must be installed.
+    """
+    global fftbackend
+    if (thebackend == 'pyfftw' and pyfftwexists) or (thebackend == 'scipy' and scipyfftexists) or \
+            (thebackend == 'numpy'):
+        fftbackend = thebackend
+        fftplans.clear()
+    else:
+        print('FFT backend', thebackend, 'is not available')
+        sys.exit()
+
+
+def getfftbackend():
+    return fftbackend
+
+
+def setfftthreads(numthreads):
+    r"""Set the number of threads used by each transform.  This is separate from the number of processes used
+    by the multiprocessing routines, so the total number of threads in use is nprocs * numthreads.
+
+    Parameters
+    ----------
+    numthreads : int
+        The number of threads.  Values less than 1 use all of the cpus.
+    """
+    global fftthreads
+    if numthreads < 1:
+        import multiprocessing as mp
+        numthreads = mp.cpu_count()
+    fftthreads = int(numthreads)
+    fftplans.clear()
+
+
+def getfftthreads():
+    return fftthreads
+
+
+def nextfastlen(thelen, real=True):
+    r"""Return the smallest length >= thelen that transforms efficiently (a product of small primes).  This
+    is often much shorter than the next power of 2.
+
+    Parameters
+    ----------
+    thelen : int
+        The minimum transform length
+    real : bool, optional
+        If True (default), the length is for a real input transform.
+
+    Returns
+    -------
+    fastlen : int
+    """
+    thekey = (int(thelen), real)
+    try:
+        return fastlens[thekey]
+    except KeyError:
+        pass
+    if scipyfftexists:
+        fastlen = scipyfft.next_fast_len(int(thelen), real=real)
+    else:
+        # 5-smooth numbers are fast for every FFT library
+        fastlen = int(thelen)
+        while True:
+            remainder = fastlen
+            for thefactor in [2, 3, 5]:
+                while remainder % thefactor == 0:
+                    remainder //= thefactor
+            if remainder == 1:
+                break
+            fastlen += 1
+    fastlens[thekey] = fastlen
+    return fastlen
+
+
+def _getplan(thetype, inputarray, n, axis):
+    # pyfftw plans depend on the shape and type of the input (calling the plan copies misaligned input)
+    thekey = (thetype, inputarray.shape, inputarray.dtype.str, n, axis, fftthreads)
+    try:
+        fftplans.move_to_end(thekey)
+        return fftplans[thekey]
+    except KeyError:
+        pass
+    thebuilder = getattr(pyfftw.builders, thetype)
+    fftplans[thekey] = thebuilder(pyfftw.empty_aligned(inputarray.shape, dtype=inputarray.dtype),
+                                  n=n, axis=axis, threads=fftthreads, planner_effort='FFTW_ESTIMATE',
+                                  avoid_copy=False)
+    while len(fftplans) > maxfftplans:
+        fftplans.popitem(last=False)
+    return fftplans[thekey]
+
+
+def _dotransform(thetype, inputarray, n, axis):
+    if fftbackend == 'pyfftw':
+        inputarray = np.asarray(inputarray)
+        if thetype in ['rfft']:
+            inputarray = inputarray.astype(np.float64, copy=False)
+        else:
+            inputarray = inputarray.astype(np.complex128, copy=False)
+        # the plan output buffer is reused, so hand back a copy
+        return _getplan(thetype, inputarray, n, axis)(inputarray).copy()
+    elif fftbackend == 'scipy':
+        return getattr(scipyfft, thetype)(inputarray, n=n, axis=axis, workers=fftthreads)
+    else:
+        return getattr(np.fft, thetype)(inputarray, n=n, axis=axis)
+
+
+def fft(inputarray, n=None, axis=-1):
+    r"""Complex forward transform along one axis (zero padded or truncated to n points if n is given)
+    """
+    return _dotransform('fft', inputarray, n, axis)
+
+
+def ifft(inputarray, n=None, axis=-1):
+    r"""Complex inverse transform along one axis
+    """
+    return _dotransform('ifft', inputarray, n, axis)
+
+
+def rfft(inputarray, n=None, axis=-1):
+    r"""Forward transform of real data along one axis, returning the n // 2 + 1 nonnegative frequency terms
+    """
+    return _dotransform('rfft', inputarray, n, axis)
+
+
+def irfft(inputarray, n=None, axis=-1):
+    r"""Inverse of rfft - returns n real points (2 * (m - 1) if n is not given)
+    """
+    return _dotransform('irfft', inputarray, n, axis)
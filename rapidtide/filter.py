@@ -27,69 +27,38 @@ package.
 from __future__ import print_function, division
 
 import numpy as np
-from scipy import fftpack, ndimage, signal
+from scipy import ndimage
 import sys
+from collections import OrderedDict
 
+import rapidtide.lazyimport as tide_lazy
+import rapidtide.fftbackend as tide_fft
+import rapidtide.multiproc as tide_multiproc
+import rapidtide.util as tide_util
 
-try:
-    from memory_profiler import profile
 
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
+memprofilerexists = tide_lazy.moduleexists('memory_profiler')
+profile = tide_lazy.lazyname('memory_profiler', 'profile')
 
-try:
-    from numba import jit
+nibabelexists = tide_lazy.moduleexists('nibabel')
+nib = tide_lazy.lazymodule('nibabel')
 
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-numbaexists = False
+# scipy.signal imports scipy.stats, which is slow to load
+signal = tide_lazy.lazymodule('scipy.signal')
 
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
-
-
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f, nopython=False)
-
-    return resdec
-
-
-def disablenumba():
-    global donotusenumba
-    donotusenumba = True
 
 
 # --------------------------- Filtering functions -------------------------------------------------
 # NB: No automatic padding for precalculated filters
 
-def padvec(inputdata, padlen=20, cyclic=False):
+def padvec(inputdata, padlen=20, cyclic=False, axis=-1):
     r"""Returns a padded copy of the input data; padlen points of
     reflected data are prepended and appended to the input data to reduce
     end effects when the data is then filtered.
 
     Parameters
     ----------
-    inputdata : 1D array
+    inputdata : array
         An array of any numerical type.
         :param inputdata:
 
@@ -101,43 +70,53 @@ def padvec(inputdata, padlen=20, cyclic=False):
         If True, pad by wrapping the data in a cyclic manner rather than reflecting at the ends
         :param cyclic:
 
+    axis : int, optional
+        The axis to pad along.  Default is -1 (the last axis).
+        :param axis:
+
     Returns
     -------
-    paddeddata : 1D array
+    paddeddata : array
         The input data, with padlen reflected points added to each end
 
     """
     if padlen > 0:
+        thedata = np.moveaxis(inputdata, axis, -1)
         if cyclic:
-            return np.concatenate((inputdata[-padlen:], inputdata, inputdata[0:padlen]))
+            paddeddata = np.concatenate((thedata[..., -padlen:], thedata, thedata[..., 0:padlen]), axis=-1)
         else:
-            return np.concatenate((inputdata[::-1][-padlen:], inputdata, inputdata[::-1][0:padlen]))
+            paddeddata = np.concatenate((thedata[..., ::-1][..., -padlen:], thedata, thedata[..., ::-1][..., 0:padlen]),
+                                        axis=-1)
+        return np.moveaxis(paddeddata, -1, axis)
     else:
         return inputdata
 
 
-def unpadvec(inputdata, padlen=20):
+def unpadvec(inputdata, padlen=20, axis=-1):
     r"""Returns a input data with the end pads removed (see padvec);
     padlen points of reflected data are removed from each end of the array.
 
     Parameters
     ----------
-    inputdata : 1D array
+    inputdata : array
         An array of any numerical type.
         :param inputdata:
     padlen : int, optional
         The number of points to remove from each end.  Default is 20.
         :param padlen:
+    axis : int, optional
+        The axis to unpad along.  Default is -1 (the last axis).
+        :param axis:
 
     Returns
     -------
-    unpaddeddata : 1D array
+    unpaddeddata : array
         The input data, with the padding data removed
 
 
     """
     if padlen > 0:
-        return inputdata[padlen:-padlen]
+        return np.moveaxis(np.moveaxis(inputdata, axis, -1)[..., padlen:-padlen], -1, axis)
     else:
         return inputdata
 
@@ -176,8 +155,100 @@ def ssmooth(xsize, ysize, zsize, sigma, inputdata):
     return ndimage.gaussian_filter(inputdata, [sigma / xsize, sigma / ysize, sigma / zsize])
 
 
+def ssmooth4d(xsize, ysize, zsize, sigma, inputdata, startpoint=0, endpoint=None, nprocs=1, showprogressbar=True):
+    r"""Applies an isotropic gaussian spatial filter, in place, to each volume of a 4D array
+
+    Parameters
+    ----------
+    xsize : float
+        The array x step size in spatial units
+        :param xsize:
+
+    ysize : float
+        The array y step size in spatial units
+        :param ysize:
+
+    zsize : float
+        The array z step size in spatial units
+        :param zsize:
+
+    sigma : float
+        The width of the gaussian filter kernel in spatial units
+        :param sigma:
+
+    inputdata : 4D numeric array
+        The spatial data to filter.  The last index is time.
+        :param inputdata:
+
+    startpoint : int, optional
+        The first volume to filter.  Default is 0.
+        :param startpoint:
+
+    endpoint : int, optional
+        The last volume to filter.  Default is the last volume in inputdata.
+        :param endpoint:
+
+    nprocs : int, optional
+        Number of threads to use.  The ndimage filters release the GIL, so volumes are filtered concurrently.
+        :param nprocs:
+
+    showprogressbar : bool, optional
+        Show a progress bar.  Default is True.
+        :param showprogressbar:
+
+    Returns
+    -------
+    filtereddata : 4D array
+        inputdata, with volumes startpoint through endpoint filtered
+
+    """
+    thesigmas = [sigma / xsize, sigma / ysize, sigma / zsize]
+    numvolumes = inputdata.shape[3]
+    if endpoint is None:
+        endpoint = numvolumes - 1
+
+    def _smoothvolume(thevolume):
+        # the gaussian filter is separable and works line by line, so it can write over its input
+        thedata = inputdata[:, :, :, thevolume]
+        ndimage.gaussian_filter(thedata, thesigmas, output=thedata)
+        return thevolume
+
+    if nprocs > 1:
+        def ssmooth_consumer(inQ, outQ):
+            while True:
+                try:
+                    # get a new message
+                    val = inQ.get()
+
+                    # this is the 'TERM' signal
+                    if val is None:
+                        break
+
+                    # process and send the data
+                    outQ.put(_smoothvolume(val))
+                except Exception as e:
+                    print("error!", e)
+                    break
+
+        volumemask = np.zeros(numvolumes, dtype=int)
+        volumemask[startpoint:endpoint + 1] = 1
+        tide_multiproc.run_multithread(ssmooth_consumer,
+                                       (numvolumes,),
+                                       volumemask,
+                                       nprocs=nprocs,
+                                       showprogressbar=showprogressbar)
+    else:
+        reportstep = 10
+        for i in range(startpoint, endpoint + 1):
+            if (i % reportstep == 0 or i == endpoint) and showprogressbar:
+                tide_util.progressbar(i - startpoint + 1, endpoint - startpoint + 1, label='Percent complete')
+            _smoothvolume(i)
+        if showprogressbar:
+            print()
+    return inputdata
+
+
 # - butterworth filters
-@conditionaljit()
 def dolpfiltfilt(Fs, upperpass, inputdata, order, padlen=20, cyclic=False, debug=False):
     r"""Performs a bidirectional (zero phase) Butterworth lowpass filter on an input vector
     and returns the result.  Ends are padded to reduce transients.
@@ -226,7 +297,6 @@ def dolpfiltfilt(Fs, upperpass, inputdata, order, padlen=20, cyclic=False, debug
     return unpadvec(signal.filtfilt(b, a, padvec(inputdata, padlen=padlen, cyclic=cyclic)).real, padlen=padlen).astype(np.float64)
 
 
-@conditionaljit()
 def dohpfiltfilt(Fs, lowerpass, inputdata, order, padlen=20, cyclic=False, debug=False):
     r"""Performs a bidirectional (zero phase) Butterworth highpass filter on an input vector
     and returns the result.  Ends are padded to reduce transients.
@@ -274,7 +344,6 @@ def dohpfiltfilt(Fs, lowerpass, inputdata, order, padlen=20, cyclic=False, debug
     return unpadvec(signal.filtfilt(b, a, padvec(inputdata, padlen=padlen, cyclic=cyclic)).real, padlen=padlen)
 
 
-@conditionaljit()
 def dobpfiltfilt(Fs, lowerpass, upperpass, inputdata, order, padlen=20, cyclic=False, debug=False):
     r"""Performs a bidirectional (zero phase) Butterworth bandpass filter on an input vector
     and returns the result.  Ends are padded to reduce transients.
@@ -349,8 +418,8 @@ def transferfuncfilt(inputdata, transferfunc):
     filtereddata : 1D float array
         Filtered input data
     """
-    inputdata_trans = transferfunc * fftpack.fft(inputdata)
-    return fftpack.ifft(inputdata_trans).real
+    inputdata_trans = transferfunc * tide_fft.fft(inputdata)
+    return tide_fft.ifft(inputdata_trans).real
 
 
 # - fft brickwall filters
@@ -388,7 +457,6 @@ def getlpfftfunc(Fs, upperpass, inputdata, debug=False):
     return transferfunc
 
 
-@conditionaljit()
 def dolpfftfilt(Fs, upperpass, inputdata, padlen=20, cyclic=False, debug=False):
     r"""Performs an FFT brickwall lowpass filter on an input vector
     and returns the result.  Ends are padded to reduce transients.
@@ -425,13 +493,12 @@ def dolpfftfilt(Fs, upperpass, inputdata, padlen=20, cyclic=False, debug=False):
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = getlpfftfunc(Fs, upperpass, padinputdata, debug=debug)
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
-@conditionaljit()
 def dohpfftfilt(Fs, lowerpass, inputdata, padlen=20, cyclic=False, debug=False):
     r"""Performs an FFT brickwall highpass filter on an input vector
     and returns the result.  Ends are padded to reduce transients.
@@ -468,13 +535,12 @@ def dohpfftfilt(Fs, lowerpass, inputdata, padlen=20, cyclic=False, debug=False):
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = 1.0 - getlpfftfunc(Fs, lowerpass, padinputdata, debug=debug)
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
-@conditionaljit()
 def dobpfftfilt(Fs, lowerpass, upperpass, inputdata, padlen=20, cyclic=False, debug=False):
     r"""Performs an FFT brickwall bandpass filter on an input vector
     and returns the result.  Ends are padded to reduce transients.
@@ -515,15 +581,14 @@ def dobpfftfilt(Fs, lowerpass, upperpass, inputdata, padlen=20, cyclic=False, de
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = getlpfftfunc(Fs, upperpass, padinputdata, debug=debug) * (
             1.0 - getlpfftfunc(Fs, lowerpass, padinputdata, debug=debug))
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 # - fft trapezoidal filters
-@conditionaljit()
 def getlptrapfftfunc(Fs, upperpass, upperstop, inputdata, debug=False):
     r"""Generates a trapezoidal lowpass transfer function.
 
@@ -571,7 +636,6 @@ def getlptrapfftfunc(Fs, upperpass, upperstop, inputdata, debug=False):
     return transferfunc
 
 
-@conditionaljit()
 def dolptrapfftfilt(Fs, upperpass, upperstop, inputdata, padlen=20, cyclic=False, debug=False):
     r"""Performs an FFT filter with a trapezoidal lowpass transfer
     function on an input vector and returns the result.  Ends are padded to reduce transients.
@@ -612,13 +676,12 @@ def dolptrapfftfilt(Fs, upperpass, upperstop, inputdata, padlen=20, cyclic=False
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = getlptrapfftfunc(Fs, upperpass, upperstop, padinputdata, debug=debug)
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
-@conditionaljit()
 def dohptrapfftfilt(Fs, lowerstop, lowerpass, inputdata, padlen=20, cyclic=False, debug=False):
     r"""Performs an FFT filter with a trapezoidal highpass transfer
     function on an input vector and returns the result.  Ends are padded to reduce transients.
@@ -659,13 +722,12 @@ def dohptrapfftfilt(Fs, lowerstop, lowerpass, inputdata, padlen=20, cyclic=False
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = 1.0 - getlptrapfftfunc(Fs, lowerstop, lowerpass, padinputdata, debug=debug)
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
-@conditionaljit()
 def dobptrapfftfilt(Fs, lowerstop, lowerpass, upperpass, upperstop, inputdata, padlen=20, cyclic=False, debug=False):
     r"""Performs an FFT filter with a trapezoidal bandpass transfer
     function on an input vector and returns the result.  Ends are padded to reduce transients.
@@ -714,14 +776,14 @@ def dobptrapfftfilt(Fs, lowerstop, lowerpass, upperpass, upperstop, inputdata, p
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     if debug:
         print("Fs=", Fs, " Fstopl=", lowerstop, " Fpassl=", lowerpass, " Fpassu=", upperpass,
               " Fstopu=", upperstop)
     transferfunc = getlptrapfftfunc(Fs, upperpass, upperstop, padinputdata, debug=debug) * (
             1.0 - getlptrapfftfunc(Fs, lowerstop, lowerpass, padinputdata, debug=debug))
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 # Simple example of Wiener deconvolution in Python.
@@ -731,8 +793,8 @@ def dobptrapfftfilt(Fs, lowerstop, lowerpass, upperpass, upperstop, inputdata, p
 def wiener_deconvolution(signal, kernel, lambd):
     "lambd is the SNR in the fourier domain"
     kernel = np.hstack((kernel, np.zeros(len(signal) - len(kernel))))  # zero pad the kernel to same length
-    H = fftpack.fft(kernel)
-    deconvolved = np.roll(np.real(fftpack.ifft(fftpack.fft(signal) * np.conj(H) / (H * np.conj(H) + lambd ** 2))),
+    H = tide_fft.fft(kernel)
+    deconvolved = np.roll(np.real(tide_fft.ifft(tide_fft.fft(signal) * np.conj(H) / (H * np.conj(H) + lambd ** 2))),
                           int(len(signal) // 2))
     return deconvolved
 
@@ -751,7 +813,7 @@ def pspec(inputdata):
         The power spectrum of the input signal.
 
     """
-    S = fftpack.fft(inputdata)
+    S = tide_fft.fft(inputdata)
     return np.sqrt(S * np.conj(S))
 
 
@@ -795,11 +857,11 @@ def spectrum(inputdata, Fs=1.0, mode='power', trim=True):
         :param mode:
     """
     if trim:
-        specvals = fftpack.fft(inputdata)[0:len(inputdata) // 2]
+        specvals = tide_fft.fft(inputdata)[0:len(inputdata) // 2]
         maxfreq = Fs / 2.0
         specaxis = np.linspace(0.0, maxfreq, len(specvals), endpoint=False)
     else:
-        specvals = fftpack.fft(inputdata)
+        specvals = tide_fft.fft(inputdata)
         maxfreq = Fs
         specaxis = np.linspace(0.0, maxfreq, len(specvals), endpoint=False)
     if mode == 'real':
@@ -921,16 +983,123 @@ def csdfilter(obsdata, commondata, padlen=20, cyclic=False, debug=False):
     """
     padobsdata = padvec(obsdata, padlen=padlen, cyclic=cyclic)
     padcommondata = padvec(commondata, padlen=padlen, cyclic=cyclic)
-    obsdata_trans = fftpack.fft(padobsdata)
-    transferfunc = np.sqrt(np.abs(fftpack.fft(padobsdata) * np.conj(fftpack.fft(padcommondata))))
+    obsdata_trans = tide_fft.fft(padobsdata)
+    transferfunc = np.sqrt(np.abs(tide_fft.fft(padobsdata) * np.conj(tide_fft.fft(padcommondata))))
     obsdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(obsdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(obsdata_trans).real, padlen=padlen)
+
+
+# the arb_pass filters, most recently used last.  Only the maxarbpassfilters most recently used are kept.
+arbpassfilters = OrderedDict()
+maxarbpassfilters = 64
+
+
+def getarbpassfilter(Fs, paddedlen, lowerstop, lowerpass, upperpass, upperstop,
+                     usebutterworth=False, butterorder=6,
+                     usetrapfftfilt=True, debug=False):
+    r"""Returns the filter used by arb_pass for a given sample rate, padded data length, and set of filter limits.
+    Once calculated, filters are cached for speed (the maxarbpassfilters most recently used ones are kept).
+
+    Parameters
+    ----------
+    Fs : float
+        Sample rate in Hz
+        :param Fs:
+
+    paddedlen : int
+        Length of the end padded data that will be filtered.  Not used for Butterworth filters.
+        :param paddedlen:
+
+    lowerstop : float
+        Upper end of lower stopband in Hz
+        :param lowerstop:
+
+    lowerpass : float
+        Lower end of passband in Hz
+        :param lowerpass:
+
+    upperpass : float
+        Upper end of passband in Hz
+        :param upperpass:
+
+    upperstop : float
+        Lower end of upper stopband in Hz
+        :param upperstop:
+
+    usebutterworth : boolean, optional
+        Whether to use a Butterworth filter characteristic.  Default is False.
+        :param usebutterworth:
+
+    butterorder : int, optional
+        Order of Butterworth filter.  Default is 6.
+        :param butterorder:
+
+    usetrapfftfilt : boolean, optional
+        Whether to use trapezoidal transition band for FFT filter.  Default is True.
+        :param usetrapfftfilt:
+
+    debug : boolean, optional
+        When True, internal states of the function will be printed to help debugging.
+        :param debug:
+
+    Returns
+    -------
+    filterstages : list
+        For Butterworth filters, a list of [b, a] coefficient pairs to be applied (with padding) in succession.
+        For FFT filters, a single element list containing the transfer function for the nonnegative
+        frequencies of a real FFT of length paddedlen.
+    """
+    if usebutterworth:
+        thekey = (Fs, None, lowerstop, lowerpass, upperpass, upperstop, True, butterorder, None)
+    else:
+        thekey = (Fs, paddedlen, lowerstop, lowerpass, upperpass, upperstop, False, None, usetrapfftfilt)
+    try:
+        arbpassfilters.move_to_end(thekey)
+        return arbpassfilters[thekey]
+    except KeyError:
+        pass
+
+    # check filter limits to see if we should do a lowpass, bandpass, or highpass
+    dolowpass = dohighpass = True
+    if lowerpass <= 0.0:
+        dohighpass = False
+    elif (upperpass >= Fs / 2.0) or (upperpass <= 0.0):
+        dolowpass = False
+    if usebutterworth:
+        filterstages = []
+        if dolowpass:
+            filterstages.append(signal.butter(butterorder, 2.0 * np.min([upperpass, Fs / 2.0]) / Fs))
+        if dohighpass:
+            filterstages.append(signal.butter(butterorder, 2.0 * np.max([lowerpass, 0.0]) / Fs, 'highpass'))
+    else:
+        scratch = np.zeros(paddedlen, dtype=np.float64)
+        transferfunc = np.ones(paddedlen, dtype=np.float64)
+        if usetrapfftfilt:
+            if dolowpass:
+                transferfunc *= getlptrapfftfunc(Fs, upperpass, upperstop, scratch, debug=debug)
+            if dohighpass:
+                transferfunc *= 1.0 - getlptrapfftfunc(Fs, lowerstop, lowerpass, scratch, debug=debug)
+        else:
+            if dolowpass:
+                transferfunc *= getlpfftfunc(Fs, upperpass, scratch, debug=debug)
+            if dohighpass:
+                transferfunc *= 1.0 - getlpfftfunc(Fs, lowerpass, scratch, debug=debug)
+
+        # only the real part of the inverse transform is kept, which is equivalent to applying the
+        # hermitian symmetric part of the transfer function, so the filter can be applied with a real FFT
+        transferfunc = 0.5 * (transferfunc + np.roll(transferfunc[::-1], 1))
+        filterstages = [transferfunc[:paddedlen // 2 + 1]]
+    if debug:
+        print('initialized arb_pass filter for', thekey)
+    arbpassfilters[thekey] = filterstages
+    while len(arbpassfilters) > maxarbpassfilters:
+        arbpassfilters.popitem(last=False)
+    return filterstages
 
 
-@conditionaljit()
 def arb_pass(Fs, inputdata, lowerstop, lowerpass, upperpass, upperstop,
              usebutterworth=False, butterorder=6,
-             usetrapfftfilt=True, padlen=20, cyclic=False, debug=False):
+             usetrapfftfilt=True, padlen=20, cyclic=False, axis=-1, debug=False):
     r"""Filters an input waveform over a specified range.  By default it is a trapezoidal
     FFT filter, but brickwall and butterworth filters are also available.  Ends are padded to reduce
     transients.
@@ -941,8 +1110,8 @@ def arb_pass(Fs, inputdata, lowerstop, lowerpass, upperpass, upperstop,
         Sample rate in Hz
         :param Fs:
 
-    inputdata : 1D numpy array
-        Input data to be filtered
+    inputdata : numpy array
+        Input data to be filtered.  If multidimensional, each timecourse along axis is filtered.
         :param inputdata:
 
     lowerstop : float
@@ -981,52 +1150,40 @@ def arb_pass(Fs, inputdata, lowerstop, lowerpass, upperpass, upperstop,
         If True, pad by wrapping the data in a cyclic manner rather than reflecting at the ends
         :param cyclic:
 
+    axis : int, optional
+        The time axis of inputdata.  Default is -1 (the last axis).
+        :param axis:
+
     debug : boolean, optional
         When True, internal states of the function will be printed to help debugging.
         :param debug:
 
     Returns
     -------
-    filtereddata : 1D float array
+    filtereddata : float array
         The filtered data
     """
-    # check filter limits to see if we should do a lowpass, bandpass, or highpass
-    if lowerpass <= 0.0:
-        # set up for lowpass
-        if usebutterworth:
-            retvec = dolpfiltfilt(Fs, upperpass, inputdata, butterorder, padlen=padlen, cyclic=False, debug=debug)
-            return retvec
-        else:
-            if usetrapfftfilt:
-                return dolptrapfftfilt(Fs, upperpass, upperstop, inputdata, padlen=padlen, cyclic=False, debug=debug)
-            else:
-                return dolpfftfilt(Fs, upperpass, inputdata, padlen=padlen, cyclic=False, debug=debug).astype(np.float64)
-    elif (upperpass >= Fs / 2.0) or (upperpass <= 0.0):
-        # set up for highpass
-        if usebutterworth:
-            return dohpfiltfilt(Fs, lowerpass, inputdata, butterorder, padlen=padlen, cyclic=False, debug=debug)
-        else:
-            if usetrapfftfilt:
-                return dohptrapfftfilt(Fs, lowerstop, lowerpass, inputdata, padlen=padlen, cyclic=False, debug=debug)
-            else:
-                return dohpfftfilt(Fs, lowerpass, inputdata, padlen=padlen, cyclic=False, debug=debug)
+    if usebutterworth:
+        filterstages = getarbpassfilter(Fs, None, lowerstop, lowerpass, upperpass, upperstop,
+                                        usebutterworth=True, butterorder=butterorder, debug=debug)
+        filtereddata = inputdata
+        for b, a in filterstages:
+            filtereddata = unpadvec(signal.filtfilt(b, a, padvec(filtereddata, padlen=padlen, cyclic=False, axis=axis),
+                                                    axis=axis).real,
+                                    padlen=padlen, axis=axis)
+        return filtereddata.astype(np.float64)
     else:
-        # set up for bandpass
-        if usebutterworth:
-            return (dohpfiltfilt(Fs, lowerpass,
-                                 dolpfiltfilt(Fs, upperpass, inputdata, butterorder, padlen=padlen, cyclic=False,
-                                              debug=debug),
-                                 butterorder, padlen=padlen, debug=debug))
-        else:
-            if usetrapfftfilt:
-                return (
-                    dobptrapfftfilt(Fs, lowerstop, lowerpass, upperpass, upperstop, inputdata,
-                                    padlen=padlen, cyclic=False, debug=debug).astype(np.float64))
-            else:
-                return dobpfftfilt(Fs, lowerpass, upperpass, inputdata, padlen=padlen, cyclic=False, debug=debug)
+        padinputdata = padvec(inputdata, padlen=padlen, cyclic=False, axis=axis)
+        paddedlen = np.shape(padinputdata)[axis]
+        transferfunc = getarbpassfilter(Fs, paddedlen, lowerstop, lowerpass, upperpass, upperstop,
+                                        usebutterworth=False, usetrapfftfilt=usetrapfftfilt, debug=debug)[0]
+        theshape = [1] * np.ndim(padinputdata)
+        theshape[axis] = -1
+        return unpadvec(tide_fft.irfft(tide_fft.rfft(padinputdata, axis=axis) * transferfunc.reshape(theshape),
+                                       n=paddedlen, axis=axis),
+                        padlen=padlen, axis=axis)
 
 
-@conditionaljit()
 def getarbpassfunc(Fs, inputdata, lowerstop, lowerpass, upperpass, upperstop,
                    usebutterworth=False, butterorder=6,
                    usetrapfftfilt=True, padlen=20, cyclic=False, debug=False):
@@ -1304,24 +1461,26 @@ class noncausalfilter:
     def getfreqs(self):
         return self.lowerstop, self.lowerpass, self.upperpass, self.upperstop
 
-    def apply(self, Fs, data):
+    def apply(self, Fs, data, axis=-1):
         r"""Apply the filter to a dataset.
 
         Parameters
         ----------
         Fs : float
             Sample frequency
-        data : 1D float array
-            The data to filter
+        data : float array
+            The data to filter.  If multidimensional, every timecourse along axis is filtered at once.
+        axis : int, optional
+            The time axis of data.  Default is -1 (the last axis).
 
         Returns
         -------
-        filtereddata : 1D float array
+        filtereddata : float array
             The filtered data
         """
         # do some bounds checking
         nyquistlimit = 0.5 * Fs
-        lowestfreq = 2.0 * Fs / np.shape(data)[0]
+        lowestfreq = 2.0 * Fs / np.shape(data)[axis]
 
         # first see if entire range is out of bounds
         if self.lowerpass >= nyquistlimit:
@@ -1372,7 +1531,7 @@ class noncausalfilter:
                 sys.exit()
 
         if self.padtime < 0.0:
-            padlen = int(len(data) // 2)
+            padlen = int(np.shape(data)[axis] // 2)
         else:
             padlen = int(self.padtime * Fs)
         if self.debug:
@@ -1395,29 +1554,34 @@ class noncausalfilter:
             return (arb_pass(Fs, data,
                              0.0, 0.0, Fs / 4.0, 1.1 * Fs / 4.0,
                              usebutterworth=self.usebutterworth, butterorder=self.butterworthorder,
-                             usetrapfftfilt=self.usetrapfftfilt, padlen=padlen, cyclic=self.cyclic, debug=self.debug))
+                             usetrapfftfilt=self.usetrapfftfilt, padlen=padlen, cyclic=self.cyclic, axis=axis,
+                             debug=self.debug))
         elif self.filtertype == 'vlf' or self.filtertype == 'lfo' \
                 or self.filtertype == 'resp' or self.filtertype == 'cardiac':
             return (arb_pass(Fs, data,
                              self.lowerstop, self.lowerpass, self.upperpass, self.upperstop,
                              usebutterworth=self.usebutterworth, butterorder=self.butterworthorder,
-                             usetrapfftfilt=self.usetrapfftfilt, padlen=padlen, cyclic=self.cyclic, debug=self.debug))
+                             usetrapfftfilt=self.usetrapfftfilt, padlen=padlen, cyclic=self.cyclic, axis=axis,
+                             debug=self.debug))
         elif self.filtertype == 'vlf_stop' or self.filtertype == 'lfo_stop' \
                 or self.filtertype == 'resp_stop' or self.filtertype == 'cardiac_stop':
             return (data - arb_pass(Fs, data,
                                     self.lowerstop, self.lowerpass, self.upperpass, self.upperstop,
                                     usebutterworth=self.usebutterworth, butterorder=self.butterworthorder,
-                                    usetrapfftfilt=self.usetrapfftfilt, padlen=padlen, cyclic=self.cyclic, debug=self.debug))
+                                    usetrapfftfilt=self.usetrapfftfilt, padlen=padlen, cyclic=self.cyclic, axis=axis,
+                                    debug=self.debug))
         elif self.filtertype == 'arb':
             return (arb_pass(Fs, data,
                              self.arb_lowerstop, self.arb_lowerpass, self.arb_upperpass, self.arb_upperstop,
                              usebutterworth=self.usebutterworth, butterorder=self.butterworthorder,
-                             usetrapfftfilt=self.usetrapfftfilt, padlen=padlen, cyclic=self.cyclic, debug=self.debug))
+                             usetrapfftfilt=self.usetrapfftfilt, padlen=padlen, cyclic=self.cyclic, axis=axis,
+                             debug=self.debug))
         elif self.filtertype == 'arb_stop':
             return (data - arb_pass(Fs, data,
                                     self.arb_lowerstop, self.arb_lowerpass, self.arb_upperpass, self.arb_upperstop,
                                     usebutterworth=self.usebutterworth, butterorder=self.butterworthorder,
-                                    usetrapfftfilt=self.usetrapfftfilt, padlen=padlen, cyclic=self.cyclic, debug=self.debug))
+                                    usetrapfftfilt=self.usetrapfftfilt, padlen=padlen, cyclic=self.cyclic, axis=axis,
+                                    debug=self.debug))
         else:
             print("bad filter type")
             sys.exit()
@@ -1425,13 +1589,13 @@ class noncausalfilter:
 
 # --------------------------- FFT helper functions ---------------------------------------------
 def polarfft(inputdata):
-    complexxform = fftpack.fft(inputdata)
+    complexxform = tide_fft.fft(inputdata)
     return np.abs(complexxform), np.angle(complexxform)
 
 
 def ifftfrompolar(r, theta):
     complexxform = r * np.exp( 1j * theta)
-    return fftpack.ifft(complexxform).real
+    return tide_fft.ifft(complexxform).real
 
 # --------------------------- Window functions -------------------------------------------------
 BHwindows = {}
@@ -21,78 +21,32 @@
 #
 from __future__ import print_function, division
 
-import matplotlib.pyplot as pl
-
 import numpy as np
 import scipy as sp
 import scipy.special as sps
 import warnings
+from collections import OrderedDict
 
-from scipy.signal import hilbert
-
+import rapidtide.lazyimport as tide_lazy
+import rapidtide.accel as tide_accel
 import rapidtide.util as tide_util
 
+pl = tide_lazy.lazymodule('matplotlib.pyplot')
+spstats = tide_lazy.lazymodule('scipy.stats')
+hilbert = tide_lazy.lazyname('scipy.signal', 'hilbert')
+
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder = 6
 MAXLINES = 10000000
 donotbeaggressive = True
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    from memory_profiler import profile
-
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
-
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-numbaexists = False
-
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
-
+memprofilerexists = tide_lazy.moduleexists('memory_profiler')
+profile = tide_lazy.lazyname('memory_profiler', 'profile')
 
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f, nopython=False)
+nibabelexists = tide_lazy.moduleexists('nibabel')
+nib = tide_lazy.lazymodule('nibabel')
 
-    return resdec
-
-
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f, nopython=False)
-
-    return resdec
-
-
-def disablenumba():
-    global donotusenumba
-    donotusenumba = True
 
 
 # --------------------------- Fitting functions -------------------------------------------------
@@ -129,7 +83,6 @@ def gaussskresiduals(p, y, x):
     return y - gausssk_eval(x, p)
 
 
-@conditionaljit()
 def gaussresiduals(p, y, x):
     """
 
@@ -192,10 +145,9 @@ def gausssk_eval(x, p):
 
     """
     t = (x - p[1]) / p[2]
-    return p[0] * sp.stats.norm.pdf(t) * sp.stats.norm.cdf(p[3] * t)
+    return p[0] * spstats.norm.pdf(t) * spstats.norm.cdf(p[3] * t)
 
 
-@conditionaljit()
 def kaiserbessel_eval(x, p):
     """
 
@@ -216,7 +168,6 @@ def kaiserbessel_eval(x, p):
     return np.where(np.fabs(x) <= p[1], sps.i0(p[0] * np.sqrt(1.0 - np.square((x / p[1])))) / p[1] / normfac, 0.0)
 
 
-@conditionaljit()
 def gauss_eval(x, p):
     """
 
@@ -232,44 +183,74 @@ def gauss_eval(x, p):
     return p[0] * np.exp(-(x - p[1]) ** 2 / (2.0 * p[2] * p[2]))
 
 
+def _trapezoid_eval_vec(x, toplength, p):
+    # vectorized version of trapezoid_eval_loop, used when numba is not available
+    corrx = np.asarray(x, dtype=np.float64) - p[0]
+    with np.errstate(over='ignore', invalid='ignore'):
+        return np.where(corrx < 0.0, 0.0,
+                        np.where(corrx < toplength,
+                                 p[1] * (1.0 - np.exp(-corrx / p[2])),
+                                 p[1] * (np.exp(-(corrx - toplength) / p[3]))))
+
+
+def _risetime_eval_vec(x, p):
+    # vectorized version of risetime_eval_loop, used when numba is not available
+    corrx = np.asarray(x, dtype=np.float64) - p[0]
+    with np.errstate(over='ignore', invalid='ignore'):
+        return np.where(corrx < 0.0, 0.0, p[1] * (1.0 - np.exp(-corrx / p[2])))
+
+
+@tide_accel.jitkernel(signatures=['({t}[::1], float64, float64[::1])'], fallback=_trapezoid_eval_vec)
 def trapezoid_eval_loop(x, toplength, p):
-    """
+    """Evaluate trapezoid_eval at every point of x
 
     Parameters
     ----------
-    x
-    toplength
-    p
+    x : 1D array
+    toplength : float
+    p : 1D float64 array
+        [start, amplitude, risetime, falltime]
 
     Returns
     -------
-
+    r : 1D float64 array
     """
-    r = np.zeros(len(x), dtype='float64')
+    r = np.zeros(len(x), dtype=np.float64)
     for i in range(0, len(x)):
-        r[i] = trapezoid_eval(x[i], toplength, p)
+        corrx = x[i] - p[0]
+        if corrx < 0.0:
+            r[i] = 0.0
+        elif corrx < toplength:
+            r[i] = p[1] * (1.0 - np.exp(-corrx / p[2]))
+        else:
+            r[i] = p[1] * (np.exp(-(corrx - toplength) / p[3]))
     return r
 
 
+@tide_accel.jitkernel(signatures=['({t}[::1], float64[::1])'], fallback=_risetime_eval_vec)
 def risetime_eval_loop(x, p):
-    """
+    """Evaluate risetime_eval at every point of x
 
     Parameters
     ----------
-    x
-    p
+    x : 1D array
+    p : 1D float64 array
+        [start, amplitude, risetime]
 
     Returns
     -------
-
+    r : 1D float64 array
     """
-    r = np.zeros(len(x), dtype='float64')
+    r = np.zeros(len(x), dtype=np.float64)
     for i in range(0, len(x)):
-        r[i] = risetime_eval(x[i], p)
+        corrx = x[i] - p[0]
+        if corrx < 0.0:
+            r[i] = 0.0
+        else:
+            r[i] = p[1] * (1.0 - np.exp(-corrx / p[2]))
     return r
 
 
-@conditionaljit()
 def trapezoid_eval(x, toplength, p):
     """
 
@@ -292,7 +273,6 @@ def trapezoid_eval(x, toplength, p):
         return p[1] * (np.exp(-(corrx - toplength) / p[3]))
 
 
-@conditionaljit()
 def risetime_eval(x, p):
     """
 
@@ -369,7 +349,6 @@ def locpeak(data, samplerate, lastpeaktime, winsizeinsecs=5.0, thresh=0.75, hyst
 
 
 # generate the polynomial fit timecourse from the coefficients
-@conditionaljit()
 def trendgen(thexvals, thefitcoffs, demean):
     """
 
@@ -396,26 +375,72 @@ def trendgen(thexvals, thefitcoffs, demean):
     return thefit
 
 
-def detrend(inputdata, order=1, demean=False):
+# the detrending bases, most recently used last.  Only the maxdetrendprojectors most recently used are kept.
+detrendprojectors = OrderedDict()
+maxdetrendprojectors = 32
+
+
+def getdetrendprojector(length, order):
+    """Returns an orthonormal polynomial basis for detrending timecourses of a given length.  The basis is
+    built from Legendre polynomials over the time axis used by detrend, and is cached for speed (the
+    maxdetrendprojectors most recently used bases are kept).
+
+    Parameters
+    ----------
+    length : int
+        The number of timepoints
+    order : int
+        The polynomial order of the trend
+
+    Returns
+    -------
+    thebasis : 2D float array
+        Orthonormal basis, shape (length, order + 1).  The fitted trend of x is (x @ thebasis) @ thebasis.T
+    theconstant : 1D float array
+        The basis evaluated at the center of the time axis, used to restore the constant term of the fit
     """
+    thekey = (length, order)
+    try:
+        detrendprojectors.move_to_end(thekey)
+        return detrendprojectors[thekey]
+    except KeyError:
+        pass
+    halflength = length / 2.0
+    thetimepoints = (np.arange(0.0, length, 1.0) - halflength) / halflength
+    thebasis, thetransform = np.linalg.qr(np.polynomial.legendre.legvander(thetimepoints, order))
+    theconstant = np.linalg.solve(thetransform.T, np.polynomial.legendre.legvander(np.array([0.0]), order)[0])
+    detrendprojectors[thekey] = (thebasis, theconstant)
+    while len(detrendprojectors) > maxdetrendprojectors:
+        detrendprojectors.popitem(last=False)
+    return detrendprojectors[thekey]
+
+
+def detrend(inputdata, order=1, demean=False):
+    """Removes a polynomial trend from one timecourse, or from every row of a block of timecourses
 
     Parameters
     ----------
-    inputdata
-    order
-    demean
+    inputdata : float array
+        The data to detrend.  Time is the last axis.
+    order : int
+        The polynomial order of the trend
+    demean : bool
+        If True, remove the constant term of the fit as well
 
     Returns
     -------
+    detrendeddata : float array
+        The detrended data
 
     """
-    thetimepoints = np.arange(0.0, len(inputdata), 1.0) - len(inputdata) / 2.0
-    thecoffs = np.polyfit(thetimepoints, inputdata, order)
-    thefittc = trendgen(thetimepoints, thecoffs, demean)
-    return inputdata - thefittc
+    thebasis, theconstant = getdetrendprojector(np.shape(inputdata)[-1], order)
+    thecoffs = np.dot(inputdata, thebasis)
+    detrendeddata = inputdata - np.dot(thecoffs, thebasis.T)
+    if not demean:
+        detrendeddata += np.dot(thecoffs, theconstant)[..., None]
+    return detrendeddata
 
 
-@conditionaljit()
 def findfirstabove(theyvals, thevalue):
     """
 
@@ -568,7 +593,6 @@ def territorydecomp(inputmap, template, atlas, inputmask=None, intercept=True, f
     return fitmap, thecoffs, theRs
 
 
-@conditionaljit2()
 def findmaxlag_gauss(thexcorr_x, thexcorr_y, lagmin, lagmax, widthlimit,
                      edgebufferfrac=0.0,
                      threshval=0.0,
@@ -785,34 +809,72 @@ def findmaxlag_gauss(thexcorr_x, thexcorr_y, lagmin, lagmax, widthlimit,
     return maxindex, maxlag, maxval, maxsigma, maskval, failreason, fitstart, fitend
 
 
-@conditionaljit2()
-def maxindex_noedge(thexcorr_x, thexcorr_y, bipolar=False):
-    """
+def _findmaxindex_noedge_np(thexcorr_y, lowerlim, upperlim, bipolar):
+    # numpy version of findmaxindex_noedge, used when numba is not available
+    done = False
+    while not done:
+        flipfac = 1.0
+        done = True
+        maxindex = int(np.argmax(thexcorr_y[lowerlim:upperlim])) + lowerlim
+        if bipolar:
+            minindex = int(np.argmax(np.fabs(thexcorr_y[lowerlim:upperlim]))) + lowerlim
+            if np.fabs(thexcorr_y[minindex]) > np.fabs(thexcorr_y[maxindex]):
+                maxindex = minindex
+                flipfac = -1.0
+        if upperlim == lowerlim:
+            done = True
+        if maxindex == 0:
+            lowerlim += 1
+            done = False
+        if maxindex == upperlim:
+            upperlim -= 1
+            done = False
+    return maxindex, flipfac
+
+
+@tide_accel.jitkernel(signatures=['({t}[::1], int64, int64, boolean)'], fallback=_findmaxindex_noedge_np)
+def findmaxindex_noedge(thexcorr_y, lowerlim, upperlim, bipolar):
+    """Find the location of the peak of a correlation function in the range [lowerlim, upperlim), excluding a peak
+    at the first point.  Ties and NaNs are handled the same way as np.argmax.
 
     Parameters
     ----------
-    thexcorr_x
-    thexcorr_y
-    bipolar
+    thexcorr_y : 1D array
+        The correlation function
+    lowerlim, upperlim : int
+        The search range
+    bipolar : bool
+        If True, find the maximum absolute value, and return a flipfac of -1.0 if it is negative
 
     Returns
     -------
-
+    maxindex : int
+    flipfac : float
     """
-    lowerlim = 0
-    upperlim = len(thexcorr_x) - 1
+    maxindex = lowerlim
+    flipfac = 1.0
     done = False
     while not done:
         flipfac = 1.0
         done = True
-        maxindex = (np.argmax(thexcorr_y[lowerlim:upperlim]) + lowerlim).astype('int32')
+        maxindex = lowerlim
+        for i in range(lowerlim, upperlim):
+            if np.isnan(thexcorr_y[i]):
+                maxindex = i
+                break
+            if thexcorr_y[i] > thexcorr_y[maxindex]:
+                maxindex = i
         if bipolar:
-            minindex = (np.argmax(np.fabs(thexcorr_y[lowerlim:upperlim])) + lowerlim).astype('int32')
+            minindex = lowerlim
+            for i in range(lowerlim, upperlim):
+                if np.isnan(thexcorr_y[i]):
+                    minindex = i
+                    break
+                if np.fabs(thexcorr_y[i]) > np.fabs(thexcorr_y[minindex]):
+                    minindex = i
             if np.fabs(thexcorr_y[minindex]) > np.fabs(thexcorr_y[maxindex]):
                 maxindex = minindex
                 flipfac = -1.0
-        else:
-            maxindex = (np.argmax(thexcorr_y[lowerlim:upperlim]) + lowerlim).astype('int32')
         if upperlim == lowerlim:
             done = True
         if maxindex == 0:
@@ -824,8 +886,22 @@ def maxindex_noedge(thexcorr_x, thexcorr_y, bipolar=False):
     return maxindex, flipfac
 
 
-# disabled conditionaljit on 11/8/16.  This causes crashes on some machines (but not mine, strangely enough)
-@conditionaljit2()
+def maxindex_noedge(thexcorr_x, thexcorr_y, bipolar=False):
+    """
+
+    Parameters
+    ----------
+    thexcorr_x
+    thexcorr_y
+    bipolar
+
+    Returns
+    -------
+
+    """
+    return findmaxindex_noedge(thexcorr_y, 0, len(thexcorr_x) - 1, bipolar)
+
+
 def findmaxlag_gauss_rev(thexcorr_x, thexcorr_y, lagmin, lagmax, widthlimit,
                          absmaxsigma=1000.0,
                          hardlimit=True,
@@ -1076,7 +1152,6 @@ def findmaxlag_gauss_rev(thexcorr_x, thexcorr_y, lagmin, lagmax, widthlimit,
     return maxindex, maxlag, flipfac * maxval, maxsigma, maskval, failreason, peakstart, peakend
 
 
-@conditionaljit2()
 def findmaxlag_quad(thexcorr_x, thexcorr_y, lagmin, lagmax, widthlimit,
                     edgebufferfrac=0.0, threshval=0.0, uthreshval=30.0,
                     debug=False, tweaklims=True, zerooutbadfit=True, refine=False, maxguess=0.0, useguess=False,
@@ -46,6 +46,37 @@ def _procOneItemGLM(vox,
            rt_floatset(thefit[0, 1] / thefit[0, 0]), datatoremove, rt_floatset(thedata - datatoremove)
 
 
+def makeglmmask(fmri_data, threshval, slabsize=None):
+    r"""Find the voxels that glmpass should fit - those with a mean (or, if the data has been demeaned, a standard
+    deviation) over threshval
+
+    Parameters
+    ----------
+    fmri_data : 2d numpy array
+        The data.  First index is the spatial dimension, second is time.
+    threshval : float
+        The threshold
+    slabsize : int, optional
+        If set, calculate the statistics this many voxels at a time, so that the data can be memory mapped.
+
+    Returns
+    -------
+    themask : 1d int array
+    """
+    numvoxels = fmri_data.shape[0]
+    if slabsize is None:
+        slabsize = numvoxels
+    meanim = np.zeros(numvoxels, dtype=np.float64)
+    stdim = np.zeros(numvoxels, dtype=np.float64)
+    for slabstart in range(0, numvoxels, slabsize):
+        meanim[slabstart:slabstart + slabsize] = np.mean(fmri_data[slabstart:slabstart + slabsize, :], axis=1)
+        stdim[slabstart:slabstart + slabsize] = np.std(fmri_data[slabstart:slabstart + slabsize, :], axis=1)
+    if np.mean(stdim) < np.mean(meanim):
+        return np.where(meanim > threshval, 1, 0)
+    else:
+        return np.where(stdim > threshval, 1, 0)
+
+
 def glmpass(numprocitems,
             fmri_data,
             threshval,
@@ -63,22 +94,22 @@ def glmpass(numprocitems,
             showprogressbar=True,
             addedskip=0,
             mp_chunksize=1000,
+            themask=None,
             rt_floatset=np.float64,
             rt_floattype='float64'):
     inputshape = np.shape(fmri_data)
-    if threshval is None:
-        themask = None
-    else:
+    # when the data is passed in slabs, the mask comes from makeglmmask on all of the data, so that every slab
+    # uses the same criterion
+    if (themask is None) and (threshval is not None):
         if procbyvoxel:
-            meanim = np.mean(fmri_data, axis=1)
-            stdim = np.std(fmri_data, axis=1)
+            themask = makeglmmask(fmri_data, threshval)
         else:
             meanim = np.mean(fmri_data, axis=0)
             stdim = np.std(fmri_data, axis=0)
-        if np.mean(stdim) < np.mean(meanim):
-            themask = np.where(meanim > threshval, 1, 0)
-        else:
-            themask = np.where(stdim > threshval, 1, 0)
+            if np.mean(stdim) < np.mean(meanim):
+                themask = np.where(meanim > threshval, 1, 0)
+            else:
+                themask = np.where(stdim > threshval, 1, 0)
     if False:  # temporary workaround until I figure out why nprocs > 1 is failing
         # define the consumer function here so it inherits most of the arguments
         def GLM_consumer(inQ, outQ):
@@ -188,6 +219,61 @@ def glmpass(numprocitems,
     return itemstotal
 
 
+def linfitmoments(thedata, theevs, procbyvoxel=True):
+    r"""Calculates the sums needed to fit a single regressor (plus intercept) to a block of data
+
+    Parameters
+    ----------
+    thedata : 2d numpy array
+        The data to fit.  First index is the spatial dimension, second is time.
+    theevs : 2d numpy array
+        The regressor for each item, same shape as thedata.
+    procbyvoxel : boolean
+        If True, sum over time (one fit per voxel).  If False, sum over voxels (one fit per timepoint).
+
+    Returns
+    -------
+    moments : list of arrays
+        [n, sum(x), sum(y), sum(x * x), sum(x * y), sum(y * y)].  Moments from different blocks of voxels can
+        be added together before calling linfitfrommoments.
+    """
+    if procbyvoxel:
+        theaxis = 1
+    else:
+        theaxis = 0
+    return [np.float64(thedata.shape[theaxis]),
+            np.sum(theevs, axis=theaxis, dtype=np.float64),
+            np.sum(thedata, axis=theaxis, dtype=np.float64),
+            np.sum(theevs * theevs, axis=theaxis, dtype=np.float64),
+            np.sum(theevs * thedata, axis=theaxis, dtype=np.float64),
+            np.sum(thedata * thedata, axis=theaxis, dtype=np.float64)]
+
+
+def linfitfrommoments(moments):
+    r"""Closed form least squares fit of y = b0 + b1 * x from the sums calculated by linfitmoments
+
+    Parameters
+    ----------
+    moments : list of arrays
+        [n, sum(x), sum(y), sum(x * x), sum(x * y), sum(y * y)]
+
+    Returns
+    -------
+    meanvalue, rvalue, r2value, fitcoff, fitNorm : arrays
+        The intercept, correlation coefficient magnitude, R squared, slope, and slope / intercept for each item,
+        matching the values returned by _procOneItemGLM.  Items with a constant regressor get a slope of zero.
+    """
+    n, sx, sy, sxx, sxy, syy = moments
+    cxx = sxx - sx * sx / n
+    cxy = sxy - sx * sy / n
+    cyy = syy - sy * sy / n
+    fitcoff = np.where(cxx > 0.0, cxy / np.where(cxx > 0.0, cxx, 1.0), 0.0)
+    meanvalue = (sy - fitcoff * sx) / n
+    r2value = np.where(cxx * cyy > 0.0, cxy * cxy / np.where(cxx * cyy > 0.0, cxx * cyy, 1.0), 0.0)
+    fitNorm = np.nan_to_num(fitcoff / meanvalue)
+    return meanvalue, np.sqrt(r2value), r2value, fitcoff, fitNorm
+
+
 def motionregress(themotionfilename,
                   thedataarray,
                   tr,
@@ -224,8 +310,7 @@ def motionregress(themotionfilename,
         if motionhp is None:
             motionhp = 0.0
         mothpfilt.setfreqs(0.9 * motionhp, motionhp, motionlp, np.min([0.5 / tr, motionlp * 1.1]))
-        for i in range(motionregressors.shape[0]):
-            motionregressors[i, :] = mothpfilt.apply(1.0 / tr, motionregressors[i, :])
+        motionregressors = mothpfilt.apply(1.0 / tr, motionregressors)
     if orthogonalize:
         motionregressors = tide_fit.gram_schmidt(motionregressors)
 
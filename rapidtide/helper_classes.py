@@ -21,18 +21,21 @@
 #
 from __future__ import print_function, division
 
-import matplotlib.pyplot as pl
-
 import numpy as np
 import scipy as sp
+from scipy import sparse
 import warnings
 import sys
 
+import rapidtide.lazyimport as tide_lazy
 import rapidtide.util as tide_util
+import rapidtide.fftbackend as tide_fft
 import rapidtide.fit as tide_fit
 import rapidtide.miscmath as tide_math
 import rapidtide.correlate as tide_corr
 
+pl = tide_lazy.lazymodule('matplotlib.pyplot')
+
 
 class fmridata:
     thedata = None
@@ -152,6 +155,9 @@ class correlator:
     datavalid = False
     timeaxisvalid = False
     corrorigin = 0
+    fftlen = 0
+    refspectrum = None
+    refmag = None
 
     def __init__(self,
                  Fs=0.0,
@@ -194,6 +200,11 @@ class correlator:
         self.corrlen = len(self.reftc) * 2 - 1
         self.corrorigin = self.corrlen // 2 + 1
 
+        # the reference spectrum (and its magnitude, for weighted correlations) is reused for every voxel
+        self.fftlen = tide_fft.nextfastlen(self.corrlen)
+        self.refspectrum = tide_fft.rfft(self.prepreftc[::-1], self.fftlen)
+        self.refmag = np.absolute(self.refspectrum)
+
         # make the time axis
         self.timeaxis = np.arange(0.0, self.corrlen) * (1.0 / self.Fs) \
                         - ((self.corrlen - 1) * (1.0 / self.Fs)) / 2.0
@@ -207,7 +218,7 @@ class correlator:
 
 
     def trim(self, vector):
-        return vector[self.corrorigin - self.lagmininpts:self.corrorigin + self.lagmaxinpts]
+        return vector[..., self.corrorigin - self.lagmininpts:self.corrorigin + self.lagmaxinpts]
 
 
     def getcorrelation(self, trim=True):
@@ -236,7 +247,12 @@ class correlator:
         self.preptesttc = self.preptc(self.testtc)
 
         # now actually do the correlation
-        self.thexcorr = tide_corr.fastcorrelate(self.preptesttc, self.prepreftc, usefft=True, weighting=self.corrweighting)
+        self.thexcorr = tide_corr.gcccorrelate(tide_fft.rfft(self.preptesttc, self.fftlen),
+                                               self.refspectrum,
+                                               self.fftlen,
+                                               self.corrlen,
+                                               weighting=self.corrweighting,
+                                               mag2=self.refmag)
         self.corrlen = len(self.thexcorr)
         self.corrorigin = self.corrlen // 2 + 1
 
@@ -250,6 +266,57 @@ class correlator:
             return self.thexcorr, self.timeaxis, self.theglobalmax
 
 
+class multicorrelator(correlator):
+    r"""Correlates a timecourse with several reference timecourses at once.  The test timecourse is prepared and
+    Fourier transformed once, and multiplied by the stacked spectra of the prepared references.  run returns the
+    correlation functions as a (numreferences, corrlen) array and the location of the maximum for each reference.
+    """
+    refspectra = None
+    refmags = None
+
+    def setreftc(self, reftcs):
+        # reftcs is a 2D array (or list of equal length timecourses), one reference per row
+        self.reftc = np.atleast_2d(np.asarray(reftcs, dtype=np.float64))
+        self.prepreftc = np.stack([self.preptc(thereftc) for thereftc in self.reftc])
+        self.corrlen = self.reftc.shape[1] * 2 - 1
+        self.corrorigin = self.corrlen // 2 + 1
+        self.fftlen = tide_fft.nextfastlen(self.corrlen)
+        self.refspectra = tide_fft.rfft(self.prepreftc[:, ::-1], self.fftlen, axis=-1)
+        self.refmags = np.absolute(self.refspectra)
+
+        # make the time axis
+        self.timeaxis = np.arange(0.0, self.corrlen) * (1.0 / self.Fs) \
+                        - ((self.corrlen - 1) * (1.0 / self.Fs)) / 2.0
+        self.timeaxisvalid = True
+        self.datavalid = False
+
+
+    def run(self, thetc, trim=True):
+        if len(thetc) != self.reftc.shape[1]:
+            print('timecourses are of different sizes - exiting')
+            sys.exit()
+
+        self.testtc = thetc
+        self.preptesttc = self.preptc(self.testtc)
+
+        # now do all the correlations with one forward transform
+        self.thexcorr = tide_corr.gcccorrelate(tide_fft.rfft(self.preptesttc, self.fftlen)[None, :],
+                                               self.refspectra,
+                                               self.fftlen,
+                                               self.corrlen,
+                                               weighting=self.corrweighting,
+                                               mag2=self.refmags)
+
+        # find the global maximum value for each reference
+        self.theglobalmax = np.argmax(self.thexcorr, axis=1)
+        self.datavalid = True
+
+        if trim:
+            return self.trim(self.thexcorr), self.trim(self.timeaxis), self.theglobalmax
+        else:
+            return self.thexcorr, self.timeaxis, self.theglobalmax
+
+
 class correlation_fitter:
     corrtimeaxis = None
     FML_BADAMPLOW = np.uint16(0x01)
@@ -338,6 +405,7 @@ class correlation_fitter:
         self.refine = refine
         self.maxguess = maxguess
         self.useguess = useguess
+        self.searchwidth = None
         self.searchfrac = searchfrac
         self.fastgauss = fastgauss
         self.lagmod = lagmod
@@ -345,40 +413,24 @@ class correlation_fitter:
         self.displayplots = displayplots
 
 
-    def _maxindex_noedge(self, corrfunc):
+    def _maxindex_noedge(self, corrfunc, lowerlim=0, upperlim=None):
         """
 
         Parameters
         ----------
         corrfunc
+        lowerlim : int, optional
+            The first index to search.  Default is 0.
+        upperlim : int, optional
+            The end of the search range.  Default is the last point of the correlation time axis.
 
         Returns
         -------
 
         """
-        lowerlim = 0
-        upperlim = len(self.corrtimeaxis) - 1
-        done = False
-        while not done:
-            flipfac = 1.0
-            done = True
-            maxindex = (np.argmax(corrfunc[lowerlim:upperlim]) + lowerlim).astype('int32')
-            if self.bipolar:
-                minindex = (np.argmax(np.fabs(corrfunc[lowerlim:upperlim])) + lowerlim).astype('int32')
-                if np.fabs(corrfunc[minindex]) > np.fabs(corrfunc[maxindex]):
-                    maxindex = minindex
-                    flipfac = -1.0
-            else:
-                maxindex = (np.argmax(corrfunc[lowerlim:upperlim]) + lowerlim).astype('int32')
-            if upperlim == lowerlim:
-                done = True
-            if maxindex == 0:
-                lowerlim += 1
-                done = False
-            if maxindex == upperlim:
-                upperlim -= 1
-                done = False
-        return maxindex, flipfac
+        if upperlim is None:
+            upperlim = len(self.corrtimeaxis) - 1
+        return tide_fit.findmaxindex_noedge(corrfunc, int(lowerlim), int(upperlim), self.bipolar)
 
 
     def setrange(self, lagmin, lagmax):
@@ -393,9 +445,12 @@ class correlation_fitter:
             self.corrtimeaxis = corrtimeaxis
 
 
-    def setguess(self, useguess, maxguess=0.0):
+    def setguess(self, useguess, maxguess=0.0, searchwidth=None):
+        # if searchwidth is set, the peak is the maximum within searchwidth seconds of maxguess, rather than
+        # the peak that contains maxguess
         self.useguess = useguess
         self.maxguess = maxguess
+        self.searchwidth = searchwidth
 
 
     def setlthresh(self, lthreshval):
@@ -461,8 +516,15 @@ class correlation_fitter:
         # make an initial guess at the fit parameters for the gaussian
         # start with finding the maximum value and its location
         flipfac = 1.0
-        if self.useguess:
+        if self.useguess and (self.searchwidth is None):
             maxindex = tide_util.valtoindex(self.corrtimeaxis, self.maxguess)
+        elif self.useguess:
+            maxindex, flipfac = self._maxindex_noedge(corrfunc,
+                                                      lowerlim=tide_util.valtoindex(self.corrtimeaxis,
+                                                                                    self.maxguess - self.searchwidth),
+                                                      upperlim=tide_util.valtoindex(self.corrtimeaxis,
+                                                                                    self.maxguess + self.searchwidth) + 1)
+            corrfunc *= flipfac
         else:
             maxindex, flipfac = self._maxindex_noedge(corrfunc)
             corrfunc *= flipfac
@@ -649,6 +711,149 @@ class correlation_fitter:
         return maxindex, maxlag, flipfac * maxval, maxsigma, maskval, failreason, peakstart, peakend
 
 
+class despeckler:
+    outmaparray = None
+    medianlags = None
+    lastlags = None
+
+    def __init__(self,
+                 spaceshape,
+                 validvoxels,
+                 despeckle_thresh=5.0,
+                 rt_floattype='float64'):
+        r"""Finds voxels whose lag differs from the median lag of their 3x3x3 neighborhood.  Medians are only
+        recalculated around voxels whose lags changed since the previous call, so repeated despeckling passes
+        that only touch a few voxels are cheap.
+
+        Parameters
+        ----------
+        spaceshape : tuple or int
+            The native spatial shape of the data
+        validvoxels : 1D int array
+            The indices (into the flattened spatial array) of the voxels that are fit
+        despeckle_thresh : float, optional
+            Voxels whose lag differs from the neighborhood median by more than this are refit.  Default is 5.0.
+        rt_floattype : str, optional
+            The floating point type of the lag maps.
+        """
+        self.spaceshape = np.atleast_1d(spaceshape)
+        self.validvoxels = np.asarray(validvoxels)
+        self.despeckle_thresh = despeckle_thresh
+        numspatiallocs = int(np.prod(self.spaceshape))
+        self.outmaparray = np.zeros(numspatiallocs, dtype=rt_floattype)
+        self.medianlags = np.zeros(numspatiallocs, dtype=rt_floattype)
+        self.validindex = np.zeros(numspatiallocs, dtype=np.intp) - 1
+        self.validindex[self.validvoxels] = np.arange(len(self.validvoxels))
+
+        # precompute the neighbors of every valid voxel.  Indices off the edge are clipped, which matches the
+        # 'reflect' boundary of a size 3 ndimage.median_filter.  Singleton dimensions are dropped, since they
+        # only repeat every neighbor equally and do not change the median.
+        theaxes = np.where(self.spaceshape > 1)[0]
+        thecoords = np.unravel_index(self.validvoxels, tuple(self.spaceshape))
+        theoffsets = np.stack(np.meshgrid(*([[-1, 0, 1]] * len(theaxes)), indexing='ij'), axis=-1).reshape(
+            (-1, len(theaxes)))
+        neighborcoords = [np.repeat(thecoords[i][:, None], len(theoffsets), axis=1)
+                          for i in range(len(self.spaceshape))]
+        for j, theaxis in enumerate(theaxes):
+            neighborcoords[theaxis] = np.clip(neighborcoords[theaxis] + theoffsets[None, :, j],
+                                              0, self.spaceshape[theaxis] - 1)
+        self.neighbors = np.ravel_multi_index(tuple(neighborcoords), tuple(self.spaceshape))
+
+    def getinitlags(self, lagtimes):
+        r"""Find the voxels to refit.
+
+        Parameters
+        ----------
+        lagtimes : 1D float array
+            The current lag times of the valid voxels
+
+        Returns
+        -------
+        refitvoxels : 1D int array
+            Indices (into lagtimes) of the voxels to refit
+        initlags : 1D float array
+            The median lag of the neighborhood of each voxel in refitvoxels, to use as the starting point of the refit
+        """
+        if self.lastlags is None:
+            candidates = np.arange(len(self.validvoxels))
+        else:
+            # only voxels next to a changed lag can have a different median.  Voxels that were refit without
+            # changing will give the same result if refit from the same median, so they are skipped.
+            changed = np.where(lagtimes != self.lastlags)[0]
+            candidates = self.validindex[self.neighbors[changed, :].ravel()]
+            candidates = np.unique(candidates[np.where(candidates >= 0)])
+        self.outmaparray[self.validvoxels] = lagtimes[:]
+        self.lastlags = np.array(lagtimes, copy=True)
+        if len(candidates) == 0:
+            return candidates, np.zeros(0, dtype=self.medianlags.dtype)
+        candidatevoxels = self.validvoxels[candidates]
+        neighborvals = self.outmaparray[self.neighbors[candidates, :]]
+        self.medianlags[candidatevoxels] = np.partition(neighborvals, neighborvals.shape[1] // 2,
+                                                        axis=1)[:, neighborvals.shape[1] // 2]
+        refit = np.where(np.abs(self.outmaparray[candidatevoxels] - self.medianlags[candidatevoxels])
+                         > self.despeckle_thresh)[0]
+        return candidates[refit], self.medianlags[candidatevoxels[refit]]
+
+    def getmask(self):
+        r"""Returns the neighborhood median lag for voxels that were flagged for refitting on the last call,
+        and 0 elsewhere, as a flattened spatial map.
+        """
+        return np.where(np.abs(self.outmaparray - self.medianlags) > self.despeckle_thresh, self.medianlags, 0.0)
+
+
+class parcellator:
+    def __init__(self,
+                 spaceshape,
+                 validvoxels,
+                 factor=2):
+        r"""Groups valid voxels into factor x factor x factor blocks ("parcels"), so that a spatially downsampled
+        version of the data can be analyzed and the results expanded back out to the valid voxels.
+
+        Parameters
+        ----------
+        spaceshape : tuple or int
+            The native spatial shape of the data
+        validvoxels : 1D int array
+            The indices (into the flattened spatial array) of the voxels that are fit
+        factor : int, optional
+            The downsampling factor along each spatial dimension.  Default is 2.
+        """
+        self.spaceshape = np.atleast_1d(spaceshape)
+        self.validvoxels = np.asarray(validvoxels)
+        self.factor = int(factor)
+        coarseshape = tuple((self.spaceshape + self.factor - 1) // self.factor)
+        thecoords = np.unravel_index(self.validvoxels, tuple(self.spaceshape))
+        coarseindex = np.ravel_multi_index(tuple([thecoord // self.factor for thecoord in thecoords]), coarseshape)
+
+        # only keep the parcels that contain valid voxels
+        dummy, self.parcelindex = np.unique(coarseindex, return_inverse=True)
+        self.numparcels = int(np.max(self.parcelindex)) + 1 if len(self.parcelindex) > 0 else 0
+        self.parcelsizes = np.bincount(self.parcelindex, minlength=self.numparcels)
+        self.averager = sparse.csr_matrix((1.0 / self.parcelsizes[self.parcelindex],
+                                           (self.parcelindex, np.arange(len(self.parcelindex)))),
+                                          shape=(self.numparcels, len(self.parcelindex)))
+
+    def average(self, thedata):
+        r"""Average the rows of thedata (one per valid voxel) within each parcel.
+
+        Parameters
+        ----------
+        thedata : 2D float array
+            The valid voxel data.  First index is the valid voxel, second is time.
+
+        Returns
+        -------
+        parceldata : 2D float array
+            The parcel averages, shape (numparcels, thedata.shape[1])
+        """
+        return self.averager.dot(thedata)
+
+    def expand(self, parcelvals):
+        r"""Expand a vector of per parcel values to a vector of per valid voxel values.
+        """
+        return np.asarray(parcelvals)[self.parcelindex]
+
+
 class freqtrack:
     freqs = None
     times = None
@@ -24,38 +24,36 @@ from __future__ import print_function, division
 import numpy as np
 import sys
 import os
-import pandas as pd
 import json
 import copy
 
+import rapidtide.lazyimport as tide_lazy
+
+pd = tide_lazy.lazymodule('pandas')
+
 # ---------------------------------------- Global constants -------------------------------------------
 MAXLINES = 10000000
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
+nibabelexists = tide_lazy.moduleexists('nibabel')
+nib = tide_lazy.lazymodule('nibabel')
 
 # ---------------------------------------- NIFTI file manipulation ---------------------------
 if nibabelexists:
-    def readfromnifti(inputfile):
-        r"""Open a nifti file and read in the various important parts
+    def loadnifti(inputfile, keepopen=False):
+        r"""Open a nifti file without reading the data.  The data can then be read all at once with get_fdata, or
+        a piece at a time by slicing dataobj.
 
         Parameters
         ----------
         inputfile : str
-            The name of the nifti file.
+            The name of the nifti file, with or without the extension.
+        keepopen : bool, optional
+            Keep the file open between reads, which makes reading a compressed file a piece at a time much faster.
 
         Returns
         -------
         nim : nifti image structure
-        nim_data : array-like
-        nim_hdr : nifti header
-        thedims : int array
-        thesizes : float array
 
         """
         if os.path.isfile(inputfile):
@@ -67,7 +65,27 @@ if nibabelexists:
         else:
             print('nifti file', inputfile, 'does not exist')
             sys.exit()
-        nim = nib.load(inputfilename)
+        return nib.load(inputfilename, keep_file_open=keepopen)
+
+
+    def readfromnifti(inputfile):
+        r"""Open a nifti file and read in the various important parts
+
+        Parameters
+        ----------
+        inputfile : str
+            The name of the nifti file.
+
+        Returns
+        -------
+        nim : nifti image structure
+        nim_data : array-like
+        nim_hdr : nifti header
+        thedims : int array
+        thesizes : float array
+
+        """
+        nim = loadnifti(inputfile)
         nim_data = nim.get_fdata()
         nim_hdr = nim.header.copy()
         thedims = nim_hdr['dim'].copy()
@@ -75,6 +93,27 @@ if nibabelexists:
         return nim, nim_data, nim_hdr, thedims, thesizes
 
 
+    def readniftiheader(inputfile):
+        r"""Read the header of a nifti file without loading the data
+
+        Parameters
+        ----------
+        inputfile : str
+            The name of the nifti file.
+
+        Returns
+        -------
+        nim_hdr : nifti header
+        thedims : int array
+        thesizes : float array
+
+        """
+        nim_hdr = loadnifti(inputfile).header.copy()
+        thedims = nim_hdr['dim'].copy()
+        thesizes = nim_hdr['pixdim'].copy()
+        return nim_hdr, thedims, thesizes
+
+
     # dims are the array dimensions along each axis
     def parseniftidims(thedims):
         r"""Split the dims array into individual elements
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Deferred imports for the heavy optional dependencies (plotting, sklearn, statsmodels, scipy.stats, pandas,
+nibabel, keras, memory_profiler).  Most of rapidtide only needs these on a few code paths, so rather than paying
+for them every time a program (or a multiprocessing worker) starts, modules bind them at import time with
+
+    pl = tide_lazy.lazymodule('matplotlib.pyplot')
+    mad = tide_lazy.lazyname('statsmodels.robust', 'mad')
+
+and the real import happens the first time an attribute is used (or the name is called).  moduleexists checks
+whether an optional package is installed without importing it.
+"""
+
+from __future__ import print_function, division
+
+import importlib
+
+try:
+    from importlib.util import find_spec
+except ImportError:
+    find_spec = None
+
+moduleexistscache = {}
+
+
+def moduleexists(modulename):
+    r"""Check whether a module can be imported, without importing it (for top level packages).
+
+    Parameters
+    ----------
+    modulename : str
+        The name of the module, e.g. 'memory_profiler'
+
+    Returns
+    -------
+    exists : bool
+    """
+    try:
+        return moduleexistscache[modulename]
+    except KeyError:
+        pass
+    if find_spec is not None:
+        try:
+            exists = find_spec(modulename) is not None
+        except (ImportError, ValueError, AttributeError):
+            exists = False
+    else:
+        try:
+            importlib.import_module(modulename)
+            exists = True
+        except ImportError:
+            exists = False
+    moduleexistscache[modulename] = exists
+    return exists
+
+
+class lazymodule(object):
+    r"""Stands in for a module until one of its attributes is used, at which point the module is imported.
+
+    Parameters
+    ----------
+    modulename : str
+        The full dotted name of the module
+    setup : function, optional
+        Called with the module right after it is imported (for example, to select a matplotlib backend)
+    """
+    def __init__(self, modulename, setup=None):
+        self._modulename = modulename
+        self._setup = setup
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            themodule = importlib.import_module(self._modulename)
+            if self._setup is not None:
+                self._setup(themodule)
+            self._module = themodule
+        return self._module
+
+    def isloaded(self):
+        return self._module is not None
+
+    def __getattr__(self, name):
+        # only called for attributes that this object does not have itself
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        if self._module is None:
+            return '<lazy module ' + self._modulename + ' (not yet imported)>'
+        return repr(self._module)
+
+
+class lazyname(object):
+    r"""Stands in for a function, class, or object defined in a module (the equivalent of
+    "from modulename import thename").  The module is imported the first time the name is called or one of its
+    attributes is used.
+
+    Parameters
+    ----------
+    modulename : str
+        The full dotted name of the module
+    thename : str
+        The name to fetch from the module
+    """
+    def __init__(self, modulename, thename):
+        self._modulename = modulename
+        self._thename = thename
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            self._target = getattr(importlib.import_module(self._modulename), self._thename)
+        return self._target
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return '<lazy name ' + self._modulename + '.' + self._thename + '>'
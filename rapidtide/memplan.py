@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Upfront memory planning for rapidtide.  Once the size of the input data is known (from the file header), the
+memory needed by each stage of the analysis is estimated from the array shapes and the selected options, and
+compared to a budget (the --memlimit value, or most of the memory currently available).  If the estimate does not
+fit, the planner switches to cheaper settings one at a time - returning worker results one chunk at a time, not
+copying the data into shared memory, single precision storage, running out of core (with slabs small enough to fit),
+and finally dropping the optional 4D outputs - and reports whether the run can go ahead, so that it can stop before
+any work is done rather than being killed hours in.
+"""
+
+from __future__ import print_function, division
+
+import multiprocessing as mp
+import os
+
+# ---------------------------------------- Global settings -------------------------------------------
+memunits = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+# fraction of the available memory that is used as the budget when no limit is given
+autobudgetfrac = 0.9
+
+# approximate python object overhead (tuple, numpy array headers) for each item returned by a worker
+resultoverhead = 400
+
+# the planner won't shrink the slabs of an out of core run below this many voxels
+minslabsize = 500
+
+
+def parsememsize(thestring):
+    r"""Convert a memory size string like '16G', '512M', '1.5T', or '1000000' into a number of bytes.
+
+    Parameters
+    ----------
+    thestring : str
+        A number, optionally followed by a K, M, G, or T suffix (powers of 1024) and an optional B.
+
+    Returns
+    -------
+    numbytes : int
+    """
+    thevalue = str(thestring).strip().upper()
+    if thevalue.endswith('B') and len(thevalue) > 1 and thevalue[-2] in 'KMGT':
+        thevalue = thevalue[:-1]
+    if len(thevalue) > 0 and thevalue[-1] in memunits:
+        thesuffix = thevalue[-1]
+        thevalue = thevalue[:-1]
+    else:
+        thesuffix = ''
+    try:
+        numbytes = int(float(thevalue) * memunits[thesuffix])
+    except ValueError:
+        raise ValueError('cannot interpret ' + str(thestring) + ' as a memory size')
+    if numbytes <= 0:
+        raise ValueError('memory size must be positive')
+    return numbytes
+
+
+def formatmemsize(numbytes):
+    r"""Format a number of bytes for printing, e.g. '1.50 GB'
+    """
+    for thesuffix, thescale in [('TB', memunits['T']), ('GB', memunits['G']), ('MB', memunits['M']),
+                                ('KB', memunits['K'])]:
+        if numbytes >= thescale:
+            return '{:.2f} '.format(numbytes / thescale) + thesuffix
+    return str(int(numbytes)) + ' B'
+
+
+def availablememory():
+    r"""Return the amount of memory that can be allocated without swapping, in bytes, or None if it can't be
+    determined.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as thefile:
+            for theline in thefile:
+                if theline.startswith('MemAvailable:'):
+                    return int(theline.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def sharedmemspace():
+    r"""Return the free space in /dev/shm, where shared arrays are kept, in bytes, or None if there isn't one.
+    """
+    try:
+        thestats = os.statvfs('/dev/shm')
+    except (OSError, AttributeError):
+        return None
+    return thestats.f_bavail * thestats.f_frsize
+
+
+def _forkstart():
+    thestartmethod = mp.get_start_method(allow_none=True)
+    if thestartmethod is None:
+        thestartmethod = mp.get_all_start_methods()[0]
+    return thestartmethod == 'fork'
+
+
+def estimatememory(numspatiallocs, timepoints, validtimepoints, corroutlen, optiondict, numvalidspatiallocs=None):
+    r"""Estimate the memory used by each stage of a rapidtide run.
+
+    Parameters
+    ----------
+    numspatiallocs : int
+        The number of voxels in the input file
+    timepoints : int
+        The number of timepoints in the input file
+    validtimepoints : int
+        The number of timepoints that are analyzed
+    corroutlen : int
+        The number of lags in the saved correlation functions
+    optiondict : dict
+        The run options.  Uses internalprecision, outputprecision, sharedmem, nprocs, passes, doglmfilt,
+        saveglmfiltered, savelagregressors, gausssigma, glmsourcefile, extraprobefiles, streamresults, outofcore,
+        and slabsize.
+    numvalidspatiallocs : int, optional
+        The number of voxels that will be analyzed.  Before the masks are made this isn't known, so the default
+        is to assume that every voxel is.
+
+    Returns
+    -------
+    estimate : dict
+        'phases' is a list of (phasename, arraylist, resident, shared) tuples, where arraylist is a list of
+        (arrayname, numbytes, isshared) tuples.  'peak' is the largest total over the phases, 'peakphase' is the
+        name of that phase, and 'sharedpeak' is the largest amount of shared memory in use at one time.  For an
+        out of core run, the resident sizes are for one slab of each memory mapped array, and 'mappedpeak' is the
+        largest amount of scratch file space in use at one time.
+    """
+    if numvalidspatiallocs is None:
+        numvalidspatiallocs = numspatiallocs
+    if optiondict['internalprecision'] == 'double':
+        internalsize = 8
+    else:
+        internalsize = 4
+    if optiondict['outputprecision'] == 'double':
+        outputsize = 8
+    else:
+        outputsize = 4
+    # out of core runs never use shared memory - the workers see the memory mapped files
+    outofcore = optiondict['outofcore']
+    shared = optiondict['sharedmem'] and (optiondict['nprocs'] > 1) and not outofcore
+    validfmrirow = validtimepoints * internalsize
+    validcorrrow = corroutlen * internalsize
+
+    # each array is (name, number of voxel rows, bytes per row, isshared, ismapped).  Out of core, the large arrays
+    # are memory mapped and only the slab being worked on has to be resident.
+    def validarray(arrayname, rowbytes, isshared=False):
+        return (arrayname, numvalidspatiallocs, rowbytes, isshared, outofcore)
+
+    def fullarray(arrayname, rowbytes, isshared=False):
+        return (arrayname, numspatiallocs, rowbytes, isshared, outofcore)
+
+    # the input file is read as double precision (in the internal precision, out of core)
+    def inputarray(arrayname):
+        if outofcore:
+            return fullarray(arrayname, timepoints * internalsize)
+        else:
+            return fullarray(arrayname, timepoints * 8)
+
+    readarrays = [inputarray('input data'), validarray('fmri_data_valid', validfmrirow)]
+    if shared:
+        readarrays.append(validarray('fmri_data_valid (shared copy)', validfmrirow, isshared=True))
+
+    # the arrays that live from the start of the correlation until the maps are saved
+    corrarrays = [validarray('fmri_data_valid', validfmrirow, isshared=shared),
+                  validarray('corrout', validcorrrow, isshared=shared),
+                  validarray('gaussout', validcorrrow, isshared=shared),
+                  validarray('windowout', validcorrrow, isshared=shared),
+                  fullarray('outcorrarray', validcorrrow, isshared=shared),
+                  validarray('lagtc', validfmrirow)]
+    refinearrays = []
+    if optiondict['passes'] > 1:
+        refinearrays = [validarray('shiftedtcs', validfmrirow, isshared=shared),
+                        validarray('weights', validfmrirow, isshared=shared)]
+    probefitarrays = []
+    if optiondict.get('extraprobefiles') is not None:
+        # the correlations with the extra probes are kept from the last pass on, and their fits need their own
+        # lagtc, gaussout and windowout
+        numprobes = len(optiondict['extraprobefiles'])
+        corrarrays.append(validarray('probecorrout', numprobes * validcorrrow))
+        probefitarrays = [validarray('probelagtc', validfmrirow),
+                          validarray('probegaussout', validcorrrow),
+                          validarray('probewindowout', validcorrrow)]
+    else:
+        numprobes = 0
+    passarrays = corrarrays + refinearrays + probefitarrays
+    if (optiondict['nprocs'] > 1) and not optiondict['streamresults']:
+        # worker results are all held until the stage (or slab) finishes - the largest per voxel result is the
+        # fit (lagtc, gaussout, windowout), the refinement (shiftedtcs, weights), or the correlation with all of
+        # the probes
+        itemlen = max(validtimepoints + 2 * corroutlen, (numprobes + 1) * corroutlen)
+        if optiondict['passes'] > 1:
+            itemlen = max(itemlen, 2 * validtimepoints)
+        passarrays.append(('worker results', numvalidspatiallocs, itemlen * internalsize + resultoverhead,
+                           False, False))
+    phases = [('read', readarrays), ('correlation', passarrays)]
+
+    glmarrays = corrarrays + refinearrays
+    savearrays = [validarray('lagtc', validfmrirow)] + refinearrays
+    if optiondict['doglmfilt']:
+        glmoutputs = [validarray('datatoremove', validtimepoints * outputsize, isshared=shared),
+                      validarray('filtereddata', validtimepoints * outputsize, isshared=shared)]
+        glmarrays = glmarrays + glmoutputs
+        savearrays = savearrays + glmoutputs
+        if (optiondict['gausssigma'] > 0.0) or (optiondict['glmsourcefile'] is not None):
+            glmarrays.append(inputarray('input data (reread)'))
+            glmarrays.append(validarray('fmri_data_valid (reread)', validfmrirow))
+            if shared:
+                glmarrays.append(validarray('fmri_data_valid (reread, shared copy)', validfmrirow, isshared=True))
+        phases.append(('glm', glmarrays))
+    else:
+        # the input is reread to get the mean
+        glmarrays.append(inputarray('input data (reread)'))
+        phases.append(('mean', glmarrays))
+
+    # the 4D output array is allocated after the correlation arrays are freed
+    if optiondict['savelagregressors'] or (optiondict['doglmfilt'] and optiondict['saveglmfiltered']):
+        savearrays.append(fullarray('outfmriarray', validfmrirow))
+    phases.append(('save', savearrays))
+
+    estimate = {'phases': [], 'peak': 0, 'peakphase': None, 'sharedpeak': 0, 'mappedpeak': 0}
+    for phasename, rowarrays in phases:
+        arraylist = []
+        mappedbytes = 0
+        for arrayname, numrows, rowbytes, isshared, ismapped in rowarrays:
+            if outofcore:
+                arraylist.append((arrayname, min(numrows, optiondict['slabsize']) * rowbytes, isshared))
+            else:
+                arraylist.append((arrayname, numrows * rowbytes, isshared))
+            if ismapped:
+                mappedbytes += numrows * rowbytes
+        resident = sum([numbytes for arrayname, numbytes, isshared in arraylist if not isshared])
+        sharedbytes = sum([numbytes for arrayname, numbytes, isshared in arraylist if isshared])
+        estimate['phases'].append((phasename, arraylist, resident, sharedbytes))
+        if resident + sharedbytes > estimate['peak']:
+            estimate['peak'] = resident + sharedbytes
+            estimate['peakphase'] = phasename
+        estimate['sharedpeak'] = max(estimate['sharedpeak'], sharedbytes)
+        estimate['mappedpeak'] = max(estimate['mappedpeak'], mappedbytes)
+    return estimate
+
+
+def _reductions(optiondict):
+    # the cheaper settings, in the order they are tried: (description, option, new value, applies)
+    return [('return worker results one chunk at a time', 'streamresults', True,
+             (optiondict['nprocs'] > 1) and not optiondict['streamresults']),
+            ('do not copy the fmri data into shared memory (workers see it through fork)', 'sharedmem', False,
+             optiondict['sharedmem'] and (optiondict['nprocs'] > 1) and _forkstart()),
+            ('use single precision for internal calculations', 'internalprecision', 'single',
+             optiondict['internalprecision'] == 'double'),
+            ('use single precision for output files', 'outputprecision', 'single',
+             optiondict['outputprecision'] == 'double'),
+            ('keep the large arrays in memory mapped files and process the voxels in slabs (as with --outofcore)',
+             'outofcore', True, not optiondict['outofcore']),
+            ('do not save the optional 4D outputs (as with --limitoutput)', 'limitoutput', True,
+             optiondict['savelagregressors'] or optiondict['savedatatoremove'])]
+
+
+def planmemory(numspatiallocs, timepoints, validtimepoints, corroutlen, optiondict, memlimit=None, availmem=None,
+               verbose=True):
+    r"""Make sure the run fits in memory, changing the options in optiondict if necessary.
+
+    Parameters
+    ----------
+    numspatiallocs, timepoints, validtimepoints, corroutlen : int
+        The size of the problem - see estimatememory
+    optiondict : dict
+        The run options.  These are modified in place if the run does not fit with the original settings.
+    memlimit : int, optional
+        The memory budget in bytes.  If not given, a fraction (autobudgetfrac) of the available memory is used.
+    availmem : int, optional
+        The available memory in bytes.  If not given, it is read from the system.
+    verbose : bool, optional
+        Print the plan
+
+    Returns
+    -------
+    fits : bool
+        True if the estimated peak is within the budget (or if there is no way of telling)
+    estimate : dict
+        The estimate for the final settings (see estimatememory)
+    changes : list of str
+        Descriptions of the changes that were made to the options
+    """
+    if memlimit is None:
+        if availmem is None:
+            availmem = availablememory()
+        if availmem is None:
+            budget = None
+        else:
+            budget = int(autobudgetfrac * availmem)
+    else:
+        budget = int(memlimit)
+
+    estimate = estimatememory(numspatiallocs, timepoints, validtimepoints, corroutlen, optiondict)
+    requestedpeak = estimate['peak']
+    changes = []
+    if budget is not None:
+        for description, theoption, thevalue, applies in _reductions(optiondict):
+            if estimate['peak'] <= budget:
+                break
+            if applies:
+                optiondict[theoption] = thevalue
+                if theoption == 'limitoutput':
+                    optiondict['savelagregressors'] = False
+                    optiondict['savedatatoremove'] = False
+                changes.append(description)
+                estimate = estimatememory(numspatiallocs, timepoints, validtimepoints, corroutlen, optiondict)
+            if optiondict['outofcore'] and (estimate['peak'] > budget):
+                # make the slabs smaller until they fit
+                startslabsize = optiondict['slabsize']
+                while (estimate['peak'] > budget) and (optiondict['slabsize'] // 2 >= minslabsize):
+                    optiondict['slabsize'] //= 2
+                    estimate = estimatememory(numspatiallocs, timepoints, validtimepoints, corroutlen, optiondict)
+                if optiondict['slabsize'] != startslabsize:
+                    changes.append('process ' + str(optiondict['slabsize']) + ' voxels per slab')
+    fits = (budget is None) or (estimate['peak'] <= budget)
+
+    if verbose:
+        printplan(estimate, budget, changes, fits, memlimit=memlimit, sharedmem=optiondict['sharedmem'],
+                  requestedpeak=requestedpeak)
+    return fits, estimate, changes
+
+
+def printplan(estimate, budget, changes, fits, memlimit=None, sharedmem=False, requestedpeak=None):
+    r"""Print the memory plan produced by planmemory
+    """
+    print()
+    print('Memory plan:')
+    for phasename, arraylist, resident, sharedbytes in estimate['phases']:
+        print('    {:<12s} {:>12s} resident, {:>12s} shared'.format(phasename, formatmemsize(resident),
+                                                                      formatmemsize(sharedbytes)))
+    if (requestedpeak is not None) and (requestedpeak != estimate['peak']):
+        print('    estimated peak with the requested settings:', formatmemsize(requestedpeak))
+    print('    estimated peak:', formatmemsize(estimate['peak']), '(' + estimate['peakphase'] + ')')
+    if estimate['mappedpeak'] > 0:
+        print('    scratch space for memory mapped arrays:', formatmemsize(estimate['mappedpeak']))
+    if budget is None:
+        print('    could not determine the available memory - no budget applied')
+    elif memlimit is None:
+        print('    budget:', formatmemsize(budget), '(' + str(int(100 * autobudgetfrac)) + '% of available memory)')
+    else:
+        print('    budget:', formatmemsize(budget), '(memlimit)')
+    for thechange in changes:
+        print('    changed to fit:', thechange)
+    if sharedmem and (estimate['sharedpeak'] > 0):
+        thespace = sharedmemspace()
+        if (thespace is not None) and (estimate['sharedpeak'] > thespace):
+            print('    note: shared arrays (' + formatmemsize(estimate['sharedpeak']) +
+                  ') will not fit in /dev/shm (' + formatmemsize(thespace) + ') and will be backed by temporary files')
+    if not fits:
+        print('    the run will not fit in the budget, even with the reduced settings')
+    print()
@@ -22,12 +22,14 @@
 from __future__ import print_function, division
 
 import numpy as np
-from scipy import fftpack
-import matplotlib.pyplot as plt
 
+import rapidtide.lazyimport as tide_lazy
+import rapidtide.fftbackend as tide_fft
 import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
-from statsmodels.robust import mad
+
+plt = tide_lazy.lazymodule('matplotlib.pyplot')
+mad = tide_lazy.lazyname('statsmodels.robust', 'mad')
 
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder = 6
@@ -35,61 +37,12 @@ MAXLINES = 10000000
 donotbeaggressive = True
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    from memory_profiler import profile
-
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
-
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-numbaexists = False
-
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
-
+memprofilerexists = tide_lazy.moduleexists('memory_profiler')
+profile = tide_lazy.lazyname('memory_profiler', 'profile')
 
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f, nopython=True)
+nibabelexists = tide_lazy.moduleexists('nibabel')
+nib = tide_lazy.lazymodule('nibabel')
 
-    return resdec
-
-
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f, nopython=True)
-
-    return resdec
-
-
-def disablenumba():
-    global donotusenumba
-    donotusenumba = True
 
 
 # --------------------------- Spectral analysis functions ---------------------------------------
@@ -126,7 +79,7 @@ def polarfft(invec, samplerate):
         thevec = invec[:-1]
     else:
         thevec = invec
-    spec = fftpack.fft(tide_filt.hamming(np.shape(thevec)[0]) * thevec)[0:np.shape(thevec)[0] // 2]
+    spec = tide_fft.fft(tide_filt.hamming(np.shape(thevec)[0]) * thevec)[0:np.shape(thevec)[0] // 2]
     magspec = abs(spec)
     phspec = phase(spec)
     maxfreq = samplerate / 2.0
@@ -156,10 +109,10 @@ def complex_cepstrum(x):
         unwrapped -= np.pi * ndelay[..., None] * np.arange(samples) / center
         return unwrapped, ndelay
 
-    spectrum = fftpack.fft(x)
+    spectrum = tide_fft.fft(x)
     unwrapped_phase, ndelay = _unwrap(np.angle(spectrum))
     log_spectrum = np.log(np.abs(spectrum)) + 1j * unwrapped_phase
-    ceps = fftpack.ifft(log_spectrum).real
+    ceps = tide_fft.ifft(log_spectrum).real
 
     return ceps, ndelay
 
@@ -176,7 +129,7 @@ def real_cepstrum(x):
 
     """
     # adapted from https://github.com/python-acoustics/python-acoustics/blob/master/acoustics/cepstrum.py
-    return fftpack.ifft(np.log(np.abs(fftpack.fft(x)))).real
+    return tide_fft.ifft(np.log(np.abs(tide_fft.fft(x)))).real
 
 
 # --------------------------- miscellaneous math functions -------------------------------------------------
@@ -252,7 +205,6 @@ def znormalize(vector):
     return stdnormalize(vector)
 
 
-@conditionaljit()
 def madnormalize(vector, returnnormfac=False):
     """
 
@@ -278,24 +230,29 @@ def madnormalize(vector, returnnormfac=False):
             return demedianed
 
 
-@conditionaljit()
-def stdnormalize(vector):
+def stdnormalize(vector, axis=None):
     """
 
     Parameters
     ----------
     vector
+    axis : int, optional
+        If set, normalize each vector along this axis separately.  Default is to normalize the whole array.
 
     Returns
     -------
 
     """
-    demeaned = vector - np.mean(vector)
-    sigstd = np.std(demeaned)
-    if sigstd > 0.0:
-        return demeaned / sigstd
-    else:
-        return demeaned
+    if axis is None:
+        demeaned = vector - np.mean(vector)
+        sigstd = np.std(demeaned)
+        if sigstd > 0.0:
+            return demeaned / sigstd
+        else:
+            return demeaned
+    demeaned = vector - np.mean(vector, axis=axis, keepdims=True)
+    sigstd = np.std(demeaned, axis=axis, keepdims=True)
+    return demeaned / np.where(sigstd > 0.0, sigstd, 1.0)
 
 
 def varnormalize(vector):
@@ -354,13 +311,13 @@ def ppnormalize(vector):
         return demeaned
 
 
-@conditionaljit()
 def corrnormalize(thedata, prewindow=True, detrendorder=1, windowfunc='hamming'):
     """
 
     Parameters
     ----------
-    thedata
+    thedata : float array
+        A timecourse, or a block of timecourses with time along the last axis
     prewindow
     detrendorder
     windowfunc
@@ -371,16 +328,16 @@ def corrnormalize(thedata, prewindow=True, detrendorder=1, windowfunc='hamming')
     """
     # detrend first
     if detrendorder > 0:
-        intervec = stdnormalize(tide_fit.detrend(thedata, order=detrendorder, demean=True))
+        intervec = stdnormalize(tide_fit.detrend(thedata, order=detrendorder, demean=True), axis=-1)
     else:
-        intervec = stdnormalize(thedata)
+        intervec = stdnormalize(thedata, axis=-1)
 
     # then window
     if prewindow:
-        return stdnormalize(tide_filt.windowfunction(np.shape(thedata)[0],
-                                                     type=windowfunc) * intervec) / np.sqrt(np.shape(thedata)[0])
+        return stdnormalize(tide_filt.windowfunction(np.shape(thedata)[-1],
+                                                     type=windowfunc) * intervec, axis=-1) / np.sqrt(np.shape(thedata)[-1])
     else:
-        return stdnormalize(intervec) / np.sqrt(np.shape(thedata)[0])
+        return stdnormalize(intervec, axis=-1) / np.sqrt(np.shape(thedata)[-1])
 
 
 def rms(vector):
@@ -32,15 +32,41 @@ try:
 except ImportError:
     import Queue as thrQueue
 
+import rapidtide.telemetry as tide_telemetry
 import rapidtide.util as tide_util
 
+# ---------------------------------------- Global settings -------------------------------------------
+# if True, run_multiproc hands back worker results one chunk at a time instead of holding all of them
+streamresults = False
+
+
+def setstreamresults(flag):
+    r"""Select whether run_multiproc returns its results as a list (the default), or as an iterator that only
+    holds one chunk of results at a time.  Streaming is only for callers that go through the results once.
+
+    Parameters
+    ----------
+    flag : bool
+    """
+    global streamresults
+    streamresults = bool(flag)
+
+
+def getstreamresults():
+    return streamresults
+
+
 def maxcpus():
     return mp.cpu_count() - 1
 
 
 def _process_data(data_in, inQ, outQ, showprogressbar=True, reportstep=1000, chunksize=10000):
+    return list(_iterate_data(data_in, inQ, outQ, showprogressbar=showprogressbar, reportstep=reportstep,
+                              chunksize=chunksize))
+
+
+def _iterate_data(data_in, inQ, outQ, showprogressbar=True, reportstep=1000, chunksize=10000):
     # send pos/data to workers
-    data_out = []
     totalnum = len(data_in)
     numchunks = int(totalnum // chunksize)
     remainder = totalnum - numchunks * chunksize
@@ -49,6 +75,8 @@ def _process_data(data_in, inQ, outQ, showprogressbar=True, reportstep=1000, chu
 
     # process all of the complete chunks
     for thechunk in range(numchunks):
+        tide_telemetry.startspan('chunk ' + str(thechunk), category='chunk')
+
         # queue the chunk
         for i, dat in enumerate(data_in[thechunk * chunksize:(thechunk + 1) * chunksize]):
             inQ.put(dat)
@@ -59,42 +87,68 @@ def _process_data(data_in, inQ, outQ, showprogressbar=True, reportstep=1000, chu
         while True:
             ret = outQ.get()
             if ret is not None:
-                data_out.append(ret)
+                yield ret
             numreturned += 1
             if (((numreturned + offset + 1) % reportstep) == 0) and showprogressbar:
                 tide_util.progressbar(numreturned + offset + 1, totalnum, label="Percent complete")
             if numreturned > chunksize - 1:
                 break
+        tide_telemetry.endspan(numitems=numreturned, unit='items')
 
     # queue the remainder
+    tide_telemetry.startspan('chunk ' + str(numchunks), category='chunk')
     for i, dat in enumerate(data_in[numchunks * chunksize:numchunks * chunksize + remainder]):
         inQ.put(dat)
     numreturned = 0
     offset = numchunks * chunksize
 
     # retrieve the remainder
-    while True:
+    while remainder > 0:
         ret = outQ.get()
         if ret is not None:
-            data_out.append(ret)
+            yield ret
         numreturned += 1
         if (((numreturned + offset + 1) % reportstep) == 0) and showprogressbar:
             tide_util.progressbar(numreturned + offset + 1, totalnum, label="Percent complete")
         if numreturned > remainder - 1:
             break
+    tide_telemetry.endspan(numitems=numreturned, unit='items')
     if showprogressbar:
         tide_util.progressbar(totalnum, totalnum, label="Percent complete")
     print()
 
-    return data_out
 
+def _stopworkers(workers, inQ, statsQ):
+    for i in range(len(workers)):
+        inQ.put(None)
+    if statsQ is not None:
+        tide_telemetry.collectworkerstats(statsQ, len(workers))
+    for w in workers:
+        w.terminate()
+        w.join()
+
+
+def _streamdata(data_in, inQ, outQ, workers, statsQ, showprogressbar=True, chunksize=1000):
+    try:
+        for ret in _iterate_data(data_in, inQ, outQ, showprogressbar=showprogressbar, chunksize=chunksize):
+            yield ret
+    finally:
+        _stopworkers(workers, inQ, statsQ)
 
-def run_multiproc(consumerfunc, inputshape, maskarray, nprocs=1, procbyvoxel=True, showprogressbar=True, chunksize=1000):
+
+def run_multiproc(consumerfunc, inputshape, maskarray, nprocs=1, procbyvoxel=True, showprogressbar=True, chunksize=1000,
+                  stream=None):
     # initialize the workers and the queues
     n_workers = nprocs
     inQ = mp.Queue()
     outQ = mp.Queue()
-    workers = [mp.Process(target=consumerfunc, args=(inQ, outQ)) for i in range(n_workers)]
+    if tide_telemetry.isenabled():
+        statsQ = mp.Queue()
+        workers = [mp.Process(target=tide_telemetry.telemetryworker, args=(consumerfunc, inQ, outQ, statsQ, i))
+                   for i in range(n_workers)]
+    else:
+        statsQ = None
+        workers = [mp.Process(target=consumerfunc, args=(inQ, outQ)) for i in range(n_workers)]
     for i, w in enumerate(workers):
         w.start()
 
@@ -112,15 +166,18 @@ def run_multiproc(consumerfunc, inputshape, maskarray, nprocs=1, procbyvoxel=Tru
         elif maskarray[d] > 0:
             data_in.append(d)
     print('processing', len(data_in), procunit + ' with', n_workers, 'processes')
+
+    # when streaming, the workers are shut down once the caller has gone through all of the results
+    if stream is None:
+        stream = streamresults
+    if stream:
+        return _streamdata(data_in, inQ, outQ, workers, statsQ, showprogressbar=showprogressbar,
+                           chunksize=chunksize)
     data_out = _process_data(data_in, inQ, outQ, showprogressbar=showprogressbar,
                              chunksize=chunksize)
 
     # shut down workers
-    for i in range(n_workers):
-        inQ.put(None)
-    for w in workers:
-        w.terminate()
-        w.join()
+    _stopworkers(workers, inQ, statsQ)
 
     return data_out
 
@@ -129,7 +186,13 @@ def run_multithread(consumerfunc, inputshape, maskarray, nprocs=1, showprogressb
     n_workers = nprocs
     inQ = thrQueue.Queue()
     outQ = thrQueue.Queue()
-    workers = [thread.Thread(target=consumerfunc, args=(inQ, outQ)) for i in range(n_workers)]
+    if tide_telemetry.isenabled():
+        statsQ = thrQueue.Queue()
+        workers = [thread.Thread(target=tide_telemetry.telemetryworker, args=(consumerfunc, inQ, outQ, statsQ, i))
+                   for i in range(n_workers)]
+    else:
+        statsQ = None
+        workers = [thread.Thread(target=consumerfunc, args=(inQ, outQ)) for i in range(n_workers)]
     for i, w in enumerate(workers):
         w.start()
 
@@ -147,6 +210,8 @@ def run_multithread(consumerfunc, inputshape, maskarray, nprocs=1, showprogressb
     # shut down workers
     for i in range(n_workers):
         inQ.put(None)
+    if statsQ is not None:
+        tide_telemetry.collectworkerstats(statsQ, n_workers)
     #for w in workers:
     #   #.terminate()
     #   w.join()
@@ -111,7 +111,8 @@ def getNullDistributionData(sourcetimecourse,
                                                 inputshape, None,
                                                 nprocs=optiondict['nprocs'],
                                                 showprogressbar=True,
-                                                chunksize=optiondict['mp_chunksize'])
+                                                chunksize=optiondict['mp_chunksize'],
+                                                stream=False)
 
         # unpack the data
         volumetotal = 0
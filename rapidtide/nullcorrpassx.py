@@ -164,7 +164,8 @@ def getNullDistributionDatax(rawtimecourse,
                                                 inputshape, None,
                                                 nprocs=nprocs,
                                                 showprogressbar=showprogressbar,
-                                                chunksize=chunksize)
+                                                chunksize=chunksize,
+                                                stream=False)
 
         # unpack the data
         corrlist = np.asarray(data_out, dtype=rt_floattype)
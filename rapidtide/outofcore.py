@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Out of core storage for the large (voxels by time and voxels by lag) arrays.  Once a scratch directory has been set
+with setscratchdir, allocarray and toscratch make memory mapped arrays backed by files in that directory, rather
+than arrays in memory, so the operating system only keeps the parts that are in use resident.  The stages of the
+analysis then go through the voxels one slab at a time (see slabranges), so only a slab of each array is touched
+at once.  Memory mapped arrays are shared with forked worker processes automatically.
+
+Without a scratch directory, allocarray and toscratch return ordinary arrays, so the calling code is the same
+either way.  The scratch files are removed by cleanup(), which is also run at exit.
+"""
+
+from __future__ import print_function, division
+
+import atexit
+import os
+import shutil
+
+import numpy as np
+
+# ---------------------------------------- Global settings -------------------------------------------
+scratchdir = None
+scratchfiles = []
+madescratchdir = False
+
+# the number of bytes read from an input file at once
+readblockbytes = 2 ** 28
+
+
+def setscratchdir(thedir):
+    r"""Keep the large arrays in memory mapped files in thedir from now on.  The directory is made if it does not
+    exist (and then removed by cleanup).
+
+    Parameters
+    ----------
+    thedir : str
+        The scratch directory.  It should be on a fast local disk with room for a few copies of the input data.
+    """
+    global scratchdir, madescratchdir
+    if not os.path.isdir(thedir):
+        os.makedirs(thedir)
+        madescratchdir = True
+    scratchdir = thedir
+
+
+def getscratchdir():
+    return scratchdir
+
+
+def isenabled():
+    return scratchdir is not None
+
+
+def slabranges(numitems, slabsize):
+    r"""Split numitems items into consecutive slabs.
+
+    Parameters
+    ----------
+    numitems : int
+        The number of items (usually voxels)
+    slabsize : int
+        The maximum number of items in each slab
+
+    Returns
+    -------
+    slabs : list of (int, int)
+        The (start, end) index of each slab, to be used as thearray[start:end]
+    """
+    slabsize = max(1, int(slabsize))
+    return [(slabstart, min(slabstart + slabsize, numitems)) for slabstart in range(0, numitems, slabsize)]
+
+
+def allocarray(theshape, thetype, name):
+    r"""Allocate a zeroed array - memory mapped in the scratch directory if there is one, in memory otherwise.
+
+    Parameters
+    ----------
+    theshape : tuple of int
+    thetype : str or numpy dtype
+    name : str
+        Used to name the scratch file
+
+    Returns
+    -------
+    thearray : numpy array or numpy memmap
+    """
+    if scratchdir is None:
+        return np.zeros(theshape, dtype=thetype)
+    thefilename = os.path.join(scratchdir, name + '_' + str(len(scratchfiles)) + '.dat')
+    scratchfiles.append(thefilename)
+    return np.memmap(thefilename, dtype=thetype, mode='w+', shape=theshape)
+
+
+def toscratch(inarray, name, thetype=None, rows=None, slabsize=10000):
+    r"""Copy an array (or some of its rows) into a new scratch array, one slab at a time.  Without a scratch
+    directory this is an ordinary copy.
+
+    Parameters
+    ----------
+    inarray : array
+        The array to copy.  The first axis is the voxel axis.
+    name : str
+        Used to name the scratch file
+    thetype : str or numpy dtype, optional
+        The type of the copy.  Default is the type of inarray.
+    rows : int array, optional
+        The rows to copy (in order).  Default is all of them.
+    slabsize : int, optional
+        The number of rows copied at once
+
+    Returns
+    -------
+    outarray : numpy array or numpy memmap
+    """
+    if thetype is None:
+        thetype = inarray.dtype
+    if rows is None:
+        numrows = inarray.shape[0]
+    else:
+        numrows = len(rows)
+    outarray = allocarray((numrows,) + tuple(inarray.shape[1:]), thetype, name)
+    for slabstart, slabend in slabranges(numrows, slabsize):
+        if rows is None:
+            outarray[slabstart:slabend] = inarray[slabstart:slabend]
+        else:
+            outarray[slabstart:slabend] = inarray[rows[slabstart:slabend]]
+    return outarray
+
+
+def readniftitoarray(nim, outarray, blockbytes=None):
+    r"""Copy the data of a 4D nifti image into outarray (voxels by timepoints), a few timepoints at a time, so
+    that the whole file is never in memory at once.
+
+    Parameters
+    ----------
+    nim : nifti image
+        An image from nibabel.load (the data is not read yet)
+    outarray : 2D array
+        The destination, with shape (xsize * ysize * numslices, timepoints)
+    blockbytes : int, optional
+        The approximate number of bytes read at once.  Default is readblockbytes.
+    """
+    if blockbytes is None:
+        blockbytes = readblockbytes
+    numspatiallocs, timepoints = outarray.shape
+    blocklen = max(1, int(blockbytes // (numspatiallocs * 8)))
+    for blockstart, blockend in slabranges(timepoints, blocklen):
+        theblock = np.asarray(nim.dataobj[..., blockstart:blockend])
+        outarray[:, blockstart:blockend] = theblock.reshape((numspatiallocs, blockend - blockstart))
+
+
+def cleanup():
+    r"""Remove the scratch files (and the scratch directory, if it was made by setscratchdir), and go back to
+    allocating arrays in memory.
+    """
+    global scratchdir, scratchfiles, madescratchdir
+    for thefilename in scratchfiles:
+        try:
+            os.remove(thefilename)
+        except OSError:
+            pass
+    if madescratchdir and (scratchdir is not None):
+        shutil.rmtree(scratchdir, ignore_errors=True)
+    scratchdir = None
+    scratchfiles = []
+    madescratchdir = False
+
+
+atexit.register(cleanup)
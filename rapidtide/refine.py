@@ -28,6 +28,7 @@ from __future__ import print_function, division
 import gc
 import sys
 
+import rapidtide.lazyimport as tide_lazy
 import rapidtide.miscmath as tide_math
 import rapidtide.util as tide_util
 import rapidtide.io as tide_io
@@ -37,10 +38,12 @@ import rapidtide.multiproc as tide_multiproc
 import rapidtide.resample as tide_resample
 import rapidtide.stats as tide_stats
 
-from sklearn.decomposition import FastICA, PCA
 import numpy as np
-from scipy.stats.stats import pearsonr
-from scipy.signal import welch
+
+FastICA = tide_lazy.lazyname('sklearn.decomposition', 'FastICA')
+PCA = tide_lazy.lazyname('sklearn.decomposition', 'PCA')
+pearsonr = tide_lazy.lazyname('scipy.stats', 'pearsonr')
+welch = tide_lazy.lazyname('scipy.signal', 'welch')
 
 
 def _procOneVoxelTimeShift(vox,
@@ -93,8 +96,7 @@ def _procOneVoxelTimeShift(vox,
     shifttr = -(-offsettime + lagtime) / fmritr  # lagtime is in seconds
     [shiftedtc, weights, paddedshiftedtc, paddedweights] = tide_resample.timeshift(normtc, shifttr, padtrs)
     if filterbeforePCA:
-        outtc = theprefilter.apply(fmrifreq, shiftedtc)
-        outweights = theprefilter.apply(fmrifreq, weights)
+        outtc, outweights = theprefilter.apply(fmrifreq, np.vstack((shiftedtc, weights)))
     else:
         outtc = 1.0 * shiftedtc
         outweights = 1.0 * weights
@@ -106,6 +108,17 @@ def _procOneVoxelTimeShift(vox,
         return vox, outtc, outweights, None
 
 
+def _sumrows(thearray, therows, slabsize=None):
+    # sum the selected rows, a slab of rows at a time if slabsize is set, so a memory mapped array is never read
+    # into memory all at once
+    if slabsize is None:
+        return np.sum(thearray[therows], axis=0)
+    thesum = np.zeros(thearray.shape[1:], dtype=np.float64)
+    for slabstart in range(0, len(therows), slabsize):
+        thesum += np.sum(thearray[therows[slabstart:slabstart + slabsize]], axis=0)
+    return thesum
+
+
 def refineregressor(fmridata,
                     fmritr,
                     shiftedtcs,
@@ -120,6 +133,7 @@ def refineregressor(fmridata,
                     padtrs=60,
                     includemask=None,
                     excludemask=None,
+                    slabsize=None,
                     rt_floatset=np.float64,
                     rt_floattype='float64'):
     """
@@ -154,6 +168,9 @@ def refineregressor(fmridata,
         Mask of voxels to include in refinement.  Default is None (all voxels).
     excludemask : 3D array
         Mask of voxels to exclude from refinement.  Default is None (no voxels).
+    slabsize : int, optional
+        If set, the averages are accumulated this many voxels at a time, so that the shifted timecourses are never
+        copied all at once (for memory mapped arrays).  PCA and ICA refinement still need all of them in memory.
     rt_floatset : function
         Function to coerce variable types
     rt_floattype : {'float32', 'float64'}
@@ -310,16 +327,12 @@ def refineregressor(fmridata,
 
     # now generate the refined timecourse(s)
     validlist = np.where(refinemask > 0)[0]
-    refinevoxels = shiftedtcs[validlist]
-    refineweights = weights[validlist]
-    weightsum = np.sum(refineweights, axis=0) / volumetotal
-    averagedata = np.sum(refinevoxels, axis=0) / volumetotal
+    weightsum = _sumrows(weights, validlist, slabsize=slabsize) / volumetotal
+    averagedata = _sumrows(shiftedtcs, validlist, slabsize=slabsize) / volumetotal
     if optiondict['cleanrefined']:
         invalidlist = np.where((1 - ampmask) > 0)[0]
-        discardvoxels = shiftedtcs[invalidlist]
-        discardweights = weights[invalidlist]
-        discardweightsum = np.sum(discardweights, axis=0) / volumetotal
-        averagediscard = np.sum(discardvoxels, axis=0) / volumetotal
+        discardweightsum = _sumrows(weights, invalidlist, slabsize=slabsize) / volumetotal
+        averagediscard = _sumrows(shiftedtcs, invalidlist, slabsize=slabsize) / volumetotal
     if optiondict['dodispersioncalc']:
         print('splitting regressors by time lag for phase delay estimation')
         laglist = np.arange(optiondict['dispersioncalc_lower'], optiondict['dispersioncalc_upper'],
@@ -359,6 +372,8 @@ def refineregressor(fmridata,
         pcacomponents = 1
     icacomponents = 1
 
+    if optiondict['refinetype'] in ['ica', 'pca']:
+        refinevoxels = shiftedtcs[validlist]
     if optiondict['refinetype'] == 'ica':
         print('performing ica refinement')
         thefit = FastICA(n_components=icacomponents).fit(refinevoxels)  # Reconstruct signals
@@ -25,15 +25,20 @@ import time
 
 import numpy as np
 import scipy as sp
-from scipy import fftpack, signal
-import pylab as pl
+from scipy import sparse
 import sys
 import bisect
+from collections import OrderedDict
 
+import rapidtide.lazyimport as tide_lazy
 import rapidtide.util as tide_util
+import rapidtide.fftbackend as tide_fft
 import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
 
+pl = tide_lazy.lazymodule('matplotlib.pyplot')
+signal = tide_lazy.lazymodule('scipy.signal')
+
 # this is here until numpy deals with their fft issue
 import warnings
 warnings.simplefilter(action='ignore', category=RuntimeWarning)
@@ -44,48 +49,6 @@ donotbeaggressive = True
 # ----------------------------------------- Conditional imports ---------------------------------------
 
 
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-numbaexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
-
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
-
-
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f, nopython=False)
-
-    return resdec
-
-
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f, nopython=False)
-
-    return resdec
-
-
-def disablenumba():
-    global donotusenumba
-    donotusenumba = True
-
 
 # --------------------------- Resampling and time shifting functions -------------------------------------------
 '''
@@ -237,7 +200,7 @@ def congrid(xaxis, loc, val, width, kernel='kaiser', cyclic=True, debug=False):
         except KeyError:
             if debug:
                 print('new key:', offsetkey)
-            xvals = indices - center + offset
+            xvals = np.arange(startpt, endpt + 1) - offsetinpts
             if kernel == 'gauss':
                 sigma = optsigma[kernelindex]
                 congridyvals[offsetkey] = tide_fit.gauss_eval(xvals, np.array([1.0, 0.0, sigma]))
@@ -255,14 +218,256 @@ def congrid(xaxis, loc, val, width, kernel='kaiser', cyclic=True, debug=False):
         return val * yvals, yvals, indices
 
 
+# the tabulated gridding kernels, most recently used last.  Only the maxcongridtables most recently used are kept.
+congridtables = OrderedDict()
+maxcongridtables = 16
+
+
+def getcongridtable(width, kernel='kaiser', quantization=1000):
+    """
+    Make (or fetch from the cache) the tabulated gridding kernel used by congrid_batch.
+
+    Parameters
+    ----------
+    width: float
+        The width of the gridding kernel in target bins
+    kernel: {'gauss', 'kaiser'}, optional
+        The type of convolution gridding kernel.  Default is 'kaiser'.
+    quantization: int, optional
+        The number of table entries per bin of offset.  The default, 1000, matches the offset rounding in congrid.
+
+    Returns
+    -------
+    relstarts: 1D int array
+        For each quantized offset, the position of the first kernel tap relative to the center bin
+    kerneltable: 2D array
+        The kernel weights, indexed by (quantized offset, tap).  Taps beyond the kernel support are zero.
+    """
+    tablekey = (kernel, width * 1.0, quantization)
+    try:
+        congridtables.move_to_end(tablekey)
+        return congridtables[tablekey]
+    except KeyError:
+        pass
+
+    optsigma = np.array([0.4241, 0.4927, 0.4839, 0.5063, 0.5516, 0.5695, 0.5682, 0.5974])
+    optbeta = np.array([1.9980, 2.3934, 3.3800, 4.2054, 4.9107, 5.7567, 6.6291, 7.4302])
+    if not (1.5 <= width <= 5.0) or (np.fmod(width, 0.5) > 0.0):
+        print('congrid_batch: width is', width)
+        print('congrid_batch: width must be a half-integral value between 1.5 and 5.0 inclusive')
+        sys.exit()
+    kernelindex = int((width - 1.5) // 0.5)
+
+    offsets = np.linspace(-0.5, 0.5, quantization + 1, endpoint=True)
+    numtaps = int(np.floor(width)) + 1
+    relstarts = np.ceil(np.round(offsets - width / 2.0, 6)).astype(int)
+    xvals = relstarts[:, None] + np.arange(numtaps)[None, :] - offsets[:, None]
+    if kernel == 'gauss':
+        kerneltable = tide_fit.gauss_eval(xvals, np.array([1.0, 0.0, optsigma[kernelindex]]))
+    elif kernel == 'kaiser':
+        kerneltable = tide_fit.kaiserbessel_eval(xvals, np.array([optbeta[kernelindex], width / 2.0]))
+    else:
+        print('illegal kernel value in congrid_batch - exiting')
+        sys.exit()
+    kerneltable = np.where(np.fabs(xvals) <= width / 2.0 + 1e-6, kerneltable, 0.0)
+    congridtables[tablekey] = (relstarts, kerneltable)
+    while len(congridtables) > maxcongridtables:
+        congridtables.popitem(last=False)
+    return congridtables[tablekey]
+
+
+def congrid_batch(xaxis, locs, vals, width, kernel='kaiser', cyclic=True, debug=False):
+    """
+    Vectorized version of congrid - calculate the gridding weights and target indices for an array of sample
+    locations at once.  Kernel values come from a table indexed by the quantized offset of each location from its
+    nearest grid point.
+
+    Parameters
+    ----------
+    xaxis: array-like
+        The target axis for resampling
+    locs: array-like
+        The locations, in x-axis units, of the samples to be gridded
+    vals: float or array-like
+        The values to be gridded (either a scalar, or one per location)
+    width: float
+        The width of the gridding kernel in target bins
+    kernel: {'gauss', 'kaiser'}, optional
+        The type of convolution gridding kernel.  Default is 'kaiser'.
+    cyclic: bool, optional
+        When True, gridding wraps around the endpoints of xaxis.  Default is True.
+    debug: bool, optional
+        When True, output additional information about the gridding process
+
+    Returns
+    -------
+    vals: 2D array
+        The input values, convolved with the gridding kernel, shape (len(locs), numtaps)
+    weights: 2D array
+        The values of convolution kernel for each location and tap (used for normalization)
+    indices: 2D int array
+        The indices along the x axis where the vals and weights fall.  Taps that fall outside the kernel
+        have zero weight, so the whole array can be scattered with np.add.at or np.bincount, e.g.
+        np.bincount(indices.ravel(), weights=weights.ravel(), minlength=len(xaxis))
+    """
+    locs = np.atleast_1d(np.asarray(locs, dtype=np.float64))
+    xstep = xaxis[1] - xaxis[0]
+    numpoints = len(xaxis)
+    relstarts, kerneltable = getcongridtable(width, kernel=kernel)
+    quantization = kerneltable.shape[0] - 1
+
+    if not cyclic:
+        outofrange = np.where((locs < xaxis[0] - xstep / 2.0) | (locs > xaxis[-1] + xstep / 2.0))[0]
+        if len(outofrange) > 0:
+            print(len(outofrange), 'locs not in range', xaxis[0], xaxis[-1])
+
+    # find the closest grid point to each target location, calculate relative offsets from this point
+    centers = np.round((np.clip(locs, xaxis[0], xaxis[-1]) - xaxis[0]) / xstep, 0).astype(int)
+    offsets = np.fmod(np.round((locs - xaxis[centers]) / xstep, 3), 1.0)
+    if cyclic:
+        wrapup = np.where((centers == numpoints - 1) & (offsets > 0.5))
+        centers[wrapup] = 0
+        offsets[wrapup] -= 1.0
+        wrapdown = np.where((centers == 0) & (offsets < -0.5))
+        centers[wrapdown] = numpoints - 1
+        offsets[wrapdown] += 1.0
+    if np.any(np.fabs(offsets) > 0.5):
+        badloc = np.where(np.fabs(offsets) > 0.5)[0][0]
+        print('(loc, xstep, center, offset):', locs[badloc], xstep, centers[badloc], offsets[badloc])
+        print('xaxis:', xaxis)
+        sys.exit()
+
+    offsetindices = np.round((offsets + 0.5) * quantization, 0).astype(int)
+    theweights = kerneltable[offsetindices, :]
+    theindices = np.remainder(centers[:, None] + relstarts[offsetindices, None]
+                              + np.arange(kerneltable.shape[1])[None, :], numpoints)
+    if debug:
+        print('centers, offsets, indices, weights', centers, offsets, theindices, theweights)
+    return np.asarray(vals, dtype=np.float64).reshape((-1, 1)) * theweights, theweights, theindices
+
+
+def kaisersinc(x, sincwidth, sincbeta=None):
+    """
+    Evaluate a Kaiser windowed sinc interpolation kernel.
+
+    Parameters
+    ----------
+    x: array-like
+        The offsets, in samples, at which to evaluate the kernel
+    sincwidth: int
+        The half width of the kernel in samples.  The kernel is zero for abs(x) >= sincwidth.
+    sincbeta: float, optional
+        The Kaiser window shape parameter.  If None, use 2 * sincwidth / 3 + 2 (the fastresampler default).
+
+    Returns
+    -------
+    kernel: array
+        The kernel values, same shape as x
+    """
+    if sincbeta is None:
+        sincbeta = 2.0 * sincwidth / 3.0 + 2.0
+    window = np.i0(sincbeta * np.sqrt(np.clip(1.0 - np.square(x / sincwidth), 0.0, 1.0))) / np.i0(sincbeta)
+    return np.sinc(x) * window
+
+
+def sincinterpmatrix(sourcex, destx, sincwidth=8):
+    """
+    Make the sparse matrix that band-limited (Kaiser windowed sinc) interpolates a uniformly sampled vector
+    onto an arbitrary set of points, so that the same interpolation can be applied cheaply to many vectors.
+
+    Parameters
+    ----------
+    sourcex: array-like
+        The uniformly spaced sample locations of the input vectors
+    destx: array-like
+        The locations to interpolate to
+    sincwidth: int, optional
+        The half width of the interpolation kernel in source samples.  Default is 8.
+
+    Returns
+    -------
+    interpmatrix: scipy.sparse.csr_matrix
+        Matrix of shape (len(destx), len(sourcex)).  interpmatrix.dot(y) gives the interpolated values of y.  Taps
+        that fall outside of the source vector are dropped, so accuracy falls off within sincwidth samples of
+        either end.
+    """
+    sincwidth = int(sincwidth)
+    numsource = len(sourcex)
+    fracindices = (np.asarray(destx, dtype=np.float64) - sourcex[0]) / (sourcex[1] - sourcex[0])
+    taps = np.floor(fracindices).astype(int)[:, None] + np.arange(-sincwidth + 1, sincwidth + 1)[None, :]
+    weights = kaisersinc(fracindices[:, None] - taps, sincwidth)
+    rows = np.repeat(np.arange(len(fracindices)), taps.shape[1]).reshape(taps.shape)
+    valid = np.where((taps >= 0) & (taps < numsource))
+    return sparse.csr_matrix((weights[valid], (rows[valid], taps[valid])),
+                             shape=(len(fracindices), numsource))
+
+
 class fastresampler:
     def __init__(self, timeaxis, timecourse, padvalue=30.0, upsampleratio=100, doplot=False, debug=False,
-                 method='univariate'):
+                 method='univariate', interpolation='nearest', sincwidth=8):
+        """
+        Set up a fast resampler for repeatedly evaluating a timecourse at arbitrary (shifted) time points.
+
+        Parameters
+        ----------
+        timeaxis: 1D array
+            The (evenly spaced) time axis of the input timecourse
+        timecourse: 1D array
+            The timecourse to resample
+        padvalue: float, optional
+            Time, in seconds, to pad each end of the timecourse with its end values.  Default is 30.0
+        upsampleratio: int, optional
+            The oversampling factor of the lookup table.  Default is 100.  Not used when interpolation is 'sinc'.
+        method: {'univariate', 'cubic', 'quadratic', 'poly', 'fourier'}, optional
+            The method used to build the lookup table.  Default is 'univariate'.
+        interpolation: {'nearest', 'linear', 'hermite', 'sinc'}, optional
+            How to evaluate the timecourse between lookup table points.  'nearest' (the default) returns the
+            table value at or below the requested time, 'linear' and 'hermite' (cubic Hermite) interpolate
+            between table points, so a much lower upsampleratio gives the same accuracy.  'sinc' does not build
+            a table at all, and evaluates a Kaiser windowed sinc kernel directly on the input samples.
+        sincwidth: int, optional
+            The half width, in input samples, of the windowed sinc kernel.  Default is 8.
+
+        Notes
+        -----
+        The worst case interpolation error (in units of the timecourse) is estimated on construction and is
+        available as the errorbound attribute.  For the table methods, this is computed from the finite
+        differences of the lookup table; for 'sinc' it is the ripple of the truncated kernel.
+        """
+        if interpolation not in ['nearest', 'linear', 'hermite', 'sinc']:
+            print('fastresampler: illegal interpolation method', interpolation)
+            sys.exit()
+        self.interpolation = interpolation
         self.upsampleratio = upsampleratio
         self.padvalue = padvalue
         self.initstep = timeaxis[1] - timeaxis[0]
         self.initstart = timeaxis[0]
         self.initend = timeaxis[-1]
+        if self.interpolation == 'sinc':
+            self._initsinc(timecourse, sincwidth)
+        else:
+            self._inittable(timeaxis, timecourse, method)
+        if debug:
+            print('fastresampler __init__:')
+            print('    padvalue:, ', self.padvalue)
+            print('    interpolation:', self.interpolation)
+            print('    initstep, hiresstep:', self.initstep, self.hiresstep)
+            print('    initial axis limits:', self.initstart, self.initend)
+            print('    hires axis limits:', self.hiresstart, self.hiresend)
+            print('    table size:', len(self.hires_y))
+            print('    estimated error bound:', self.errorbound)
+
+        # self.hires_y[:int(self.padvalue // self.hiresstep)] = 0.0
+        # self.hires_y[-int(self.padvalue // self.hiresstep):] = 0.0
+        if doplot:
+            fig = pl.figure()
+            ax = fig.add_subplot(111)
+            ax.set_title('fastresampler initial timecourses')
+            pl.plot(timeaxis, timecourse, self.hires_x, self.hires_y)
+            pl.legend(('input', 'hires'))
+            pl.show()
+
+    def _inittable(self, timeaxis, timecourse, method):
         self.hiresstep = self.initstep / np.float64(self.upsampleratio)
         self.hires_x = np.arange(timeaxis[0] - self.padvalue, self.initstep * len(timeaxis) + self.padvalue,
                                  self.hiresstep)
@@ -280,22 +485,47 @@ class fastresampler:
             self.hires_y = doresample(timeaxis, timecourse, self.hires_x, method=method)
         self.hires_y[:int(self.padvalue // self.hiresstep)] = self.hires_y[int(self.padvalue // self.hiresstep)]
         self.hires_y[-int(self.padvalue // self.hiresstep):] = self.hires_y[-int(self.padvalue // self.hiresstep)]
-        if debug:
-            print('fastresampler __init__:')
-            print('    padvalue:, ', self.padvalue)
-            print('    initstep, hiresstep:', self.initstep, self.hiresstep)
-            print('    initial axis limits:', self.initstart, self.initend)
-            print('    hires axis limits:', self.hiresstart, self.hiresend)
 
-        # self.hires_y[:int(self.padvalue // self.hiresstep)] = 0.0
-        # self.hires_y[-int(self.padvalue // self.hiresstep):] = 0.0
-        if doplot:
-            fig = pl.figure()
-            ax = fig.add_subplot(111)
-            ax.set_title('fastresampler initial timecourses')
-            pl.plot(timeaxis, timecourse, self.hires_x, self.hires_y)
-            pl.legend(('input', 'hires'))
-            pl.show()
+        # estimate the worst case error of evaluating between table points
+        if self.interpolation == 'nearest':
+            self.errorbound = np.max(np.fabs(np.diff(self.hires_y, n=1)))
+        elif self.interpolation == 'linear':
+            self.errorbound = np.max(np.fabs(np.diff(self.hires_y, n=2))) / 8.0
+        else:
+            # Catmull-Rom splines reproduce quadratics exactly - the maximum error on a cubic is sqrt(3)/108
+            # times its third difference
+            self.errorbound = np.max(np.fabs(np.diff(self.hires_y, n=3))) * np.sqrt(3.0) / 108.0
+
+    def _initsinc(self, timecourse, sincwidth):
+        self.sincwidth = int(sincwidth)
+        self.sincbeta = 2.0 * self.sincwidth / 3.0 + 2.0
+        self.hiresstep = self.initstep
+        self.padpts = int(np.ceil(self.padvalue / self.initstep)) + self.sincwidth + 1
+        self.hires_y = np.concatenate((np.full(self.padpts, timecourse[0], dtype=np.float64),
+                                       np.float64(timecourse),
+                                       np.full(self.padpts, timecourse[-1], dtype=np.float64)))
+        self.hiresstart = self.initstart - self.padpts * self.initstep
+        self.hires_x = self.hiresstart + np.arange(0.0, len(self.hires_y)) * self.initstep
+        self.hiresend = self.hires_x[-1]
+        self.taps = np.arange(-self.sincwidth + 1, self.sincwidth + 1)
+
+        # the kernel is exact at the sample points - the error comes from the truncated kernel not summing to one
+        fracs = np.linspace(0.0, 1.0, 101)
+        ripple = np.max(np.fabs(np.sum(self._sinckernel(fracs), axis=1) - 1.0))
+        self.errorbound = ripple * np.max(np.fabs(timecourse))
+
+    def _sinckernel(self, fracs):
+        return kaisersinc(fracs[:, None] - self.taps[None, :], self.sincwidth, sincbeta=self.sincbeta)
+
+    def _outofbounds(self, newtimeaxis):
+        print('')
+        print('indexing out of bounds in fastresampler')
+        print('    padvalue:, ', self.padvalue)
+        print('    initstep, hiresstep:', self.initstep, self.hiresstep)
+        print('    initial axis limits:', self.initstart, self.initend)
+        print('    hires axis limits:', self.hiresstart, self.hiresend)
+        print('    requested axis limits:', newtimeaxis[0], newtimeaxis[-1])
+        sys.exit()
 
     def yfromx(self, newtimeaxis, doplot=False, debug=False):
         if debug:
@@ -305,20 +535,38 @@ class fastresampler:
             print('    initial axis limits:', self.initstart, self.initend)
             print('    hires axis limits:', self.hiresstart, self.hiresend)
             print('    requested axis limits:', newtimeaxis[0], newtimeaxis[-1])
-        outindices = ((newtimeaxis - self.hiresstart) // self.hiresstep).astype(int)
-        if debug:
-            print('len(self.hires_y):', len(self.hires_y))
-        try:
-            out_y = self.hires_y[outindices]
-        except IndexError:
-            print('')
-            print('indexing out of bounds in fastresampler')
-            print('    padvalue:, ', self.padvalue)
-            print('    initstep, hiresstep:', self.initstep, self.hiresstep)
-            print('    initial axis limits:', self.initstart, self.initend)
-            print('    hires axis limits:', self.hiresstart, self.hiresend)
-            print('    requested axis limits:', newtimeaxis[0], newtimeaxis[-1])
-            sys.exit()
+        if self.interpolation == 'nearest':
+            outindices = ((newtimeaxis - self.hiresstart) // self.hiresstep).astype(int)
+            if debug:
+                print('len(self.hires_y):', len(self.hires_y))
+            try:
+                out_y = self.hires_y[outindices]
+            except IndexError:
+                self._outofbounds(newtimeaxis)
+        else:
+            fracindices = (newtimeaxis - self.hiresstart) / self.hiresstep
+            outindices = np.floor(fracindices).astype(int)
+            fracs = fracindices - outindices
+            if self.interpolation == 'linear':
+                lowtap, hightap = 0, 1
+            elif self.interpolation == 'hermite':
+                lowtap, hightap = -1, 2
+            else:
+                lowtap, hightap = self.taps[0], self.taps[-1]
+            if (np.min(outindices) + lowtap < 0) or (np.max(outindices) + hightap > len(self.hires_y) - 1):
+                self._outofbounds(newtimeaxis)
+            if self.interpolation == 'linear':
+                out_y = (1.0 - fracs) * self.hires_y[outindices] + fracs * self.hires_y[outindices + 1]
+            elif self.interpolation == 'hermite':
+                p0 = self.hires_y[outindices - 1]
+                p1 = self.hires_y[outindices]
+                p2 = self.hires_y[outindices + 1]
+                p3 = self.hires_y[outindices + 2]
+                out_y = p1 + 0.5 * fracs * (p2 - p0 + fracs * (2.0 * p0 - 5.0 * p1 + 4.0 * p2 - p3
+                                                               + fracs * (3.0 * (p1 - p2) + p3 - p0)))
+            else:
+                out_y = np.sum(self._sinckernel(fracs) * self.hires_y[outindices[:, None] + self.taps[None, :]],
+                               axis=1)
         if doplot:
             fig = pl.figure()
             ax = fig.add_subplot(111)
@@ -679,12 +927,12 @@ def timeshift(inputtc, shifttrs, padtrs, doplot=False, debug=False):
     modvec = np.cos(argvec) - imag * np.sin(argvec)
 
     # process the data (fft->modulate->ifft->filter)
-    fftdata = fftpack.fft(preshifted_y)  # do the actual shifting
-    shifted_y = fftpack.ifft(modvec * fftdata).real
+    fftdata = tide_fft.fft(preshifted_y)  # do the actual shifting
+    shifted_y = tide_fft.ifft(modvec * fftdata).real
 
     # process the weights
-    w_fftdata = fftpack.fft(weights)  # do the actual shifting
-    shifted_weights = fftpack.ifft(modvec * w_fftdata).real
+    w_fftdata = tide_fft.fft(weights)  # do the actual shifting
+    shifted_weights = tide_fft.ifft(modvec * w_fftdata).real
 
     if doplot:
         xvec = range(0, thepaddedlen)  # make a ramp vector (with pad)
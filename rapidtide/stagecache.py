@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+A cache of the results of the expensive early stages of a run (the prepared voxel data, the null correlation
+distributions, and the correlation arrays), so that a rerun that only changes later options (despeckling, GLM
+filtering, output options...) can skip them.  Each stage result is stored under a key that is a hash of everything
+the stage depends on - the contents of the input files, the arrays it is given, and the options it uses.  The cache
+directory is kept under a size limit by removing the least recently used results.
+"""
+
+from __future__ import print_function, division
+
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+import rapidtide.checkpoint as tide_checkpoint
+
+# ---------------------------------------- Global settings -------------------------------------------
+cachedir = None
+maxcachesize = 10 * 1024 ** 3
+
+# change this when the contents of a cached stage result change, so old results are not used
+cacheversion = 2
+
+# options that are never part of a key, because they only change the output files
+outputoptions = ['outputname', 'debug', 'verbose', 'displayplots', 'saveoptionsasjson', 'savecorrmask',
+                 'savecorrtimes', 'savedatatoremove', 'savedespecklemasks', 'saveglmfiltered', 'savelagregressors',
+                 'savemotionfiltered', 'limitoutput']
+
+# the options used to prepare the voxel data (file reading, smoothing, masking and motion regression)
+voxelsoptions = ['gausssigma', 'addedskip', 'corrmaskthreshpct', 'corrmaskvals', 'nothresh', 'internalprecision',
+                 'mot_pos', 'mot_deriv', 'mot_delayderiv', 'textio', 'release_version', 'git_tag']
+
+# options that are only used once the correlations have been fit (the later passes depend on them only through
+# the refined regressor, which is part of their keys)
+postfitoptions = ['passes', 'despeckle_passes', 'despeckle_thresh', 'doglmfilt', 'glmsourcefile', 'preservefiltering',
+                  'dodeconv', 'refinetype', 'refineweighting', 'refineprenorm', 'refineoffset', 'cleanrefined',
+                  'refineincludename', 'refineincludespec', 'refineexcludename', 'refineexcludespec', 'lagminthresh',
+                  'lagmaxthresh', 'ampthresh', 'sigmathresh', 'lagmaskside', 'pickleft', 'psdfilter', 'venousrefine',
+                  'estimatePCAdims', 'filterbeforePCA', 'dodispersioncalc', 'dispersioncalc_lower',
+                  'dispersioncalc_upper', 'dispersioncalc_step', 'multiresfactor', 'multireswidth', 'histlen']
+
+# options that the null distribution does not depend on (the significance thresholds are recalculated from it)
+significanceignore = postfitoptions + ['sighistlen', 'dosighistfit', 'nohistzero', 'ampthreshfromsig']
+
+# options that the correlations do not depend on
+correlationignore = significanceignore + ['lagmod', 'lthreshval', 'uthreshval', 'bipolar', 'absmaxsigma',
+                                          'absminsigma', 'findmaxtype', 'gaussrefine', 'searchfrac', 'fastgauss',
+                                          'enforcethresh', 'hardlimit', 'zerooutbadfit', 'widthlimit',
+                                          'edgebufferfrac', 'fixdelay', 'fixeddelayvalue', 'numestreps',
+                                          'permutationmethod']
+
+
+def setcachedir(thedir, maxsize=None):
+    r"""Cache stage results in thedir from now on.  The directory is made if it does not exist.
+
+    Parameters
+    ----------
+    thedir : str or None
+        The cache directory.  It is kept between runs.  None turns caching off.
+    maxsize : int, optional
+        The size limit of the cache directory, in bytes.  Default is to keep the current limit (10G to start).
+    """
+    global cachedir, maxcachesize
+    if (thedir is not None) and (not os.path.isdir(thedir)):
+        os.makedirs(thedir)
+    cachedir = thedir
+    if maxsize is not None:
+        maxcachesize = int(maxsize)
+
+
+def getcachedir():
+    return cachedir
+
+
+def isenabled():
+    return cachedir is not None
+
+
+def hasharray(thearray, thehasher, slabsize=10000):
+    r"""Add the shape, type and contents of an array to a hash, a slab at a time (so thearray can be memory mapped).
+
+    Parameters
+    ----------
+    thearray : array
+    thehasher : hashlib hash object
+        The hash to update
+    slabsize : int, optional
+        The number of rows hashed at once
+    """
+    thearray = np.asarray(thearray)
+    thehasher.update((str(thearray.shape) + str(thearray.dtype)).encode('utf-8'))
+    if thearray.ndim == 0:
+        thehasher.update(thearray.tobytes())
+        return
+    for slabstart in range(0, thearray.shape[0], slabsize):
+        thehasher.update(np.ascontiguousarray(thearray[slabstart:slabstart + slabsize]).tobytes())
+
+
+def stagekey(stagename, optiondict, options=None, ignore=None, parents=None, arrays=None, filenames=None,
+             values=None):
+    r"""Make the cache key for a stage.
+
+    Parameters
+    ----------
+    stagename : str
+    optiondict : dict
+        The run options
+    options : list of str, optional
+        The options the stage uses.  Default is all of them, other than those in ignore, the runtime options, the
+        output options, and the input file names (give the files the stage reads as filenames instead).
+    ignore : list of str, optional
+        Options that the stage does not use (when options is None)
+    parents : list of str, optional
+        The keys of the stages whose results this stage uses
+    arrays : list of arrays, optional
+        Arrays the stage is given (regressors, for example)
+    filenames : list of str, optional
+        Files the stage reads.  Their contents (but not their names) are part of the key.  None entries are
+        skipped.
+    values : list, optional
+        Any other values the stage depends on
+
+    Returns
+    -------
+    thekey : str
+    """
+    thehasher = hashlib.sha1()
+    thehasher.update((stagename + ':' + str(cacheversion)).encode('utf-8'))
+    if options is None:
+        if ignore is None:
+            ignore = []
+        options = [thekey for thekey in sorted(optiondict.keys())
+                   if thekey not in ignore and thekey not in tide_checkpoint.runtimeoptions
+                   and thekey not in outputoptions and thekey not in tide_checkpoint.inputfileoptions]
+    for theoption in options:
+        thehasher.update((theoption + '=' + repr(optiondict.get(theoption, None))).encode('utf-8'))
+    for theparent in (parents or []):
+        thehasher.update(str(theparent).encode('utf-8'))
+    for thearray in (arrays or []):
+        hasharray(thearray, thehasher)
+    for thefilename in (filenames or []):
+        if thefilename is not None:
+            tide_checkpoint.hashfile(thefilename, thehasher, hashname=False)
+    for thevalue in (values or []):
+        thehasher.update(repr(thevalue).encode('utf-8'))
+    return thehasher.hexdigest()
+
+
+def _entrydir(thekey):
+    return os.path.join(cachedir, thekey)
+
+
+def _entrysize(thedir):
+    return sum([os.path.getsize(os.path.join(thedir, thefile)) for thefile in os.listdir(thedir)])
+
+
+def load(thekey):
+    r"""Get a stage result from the cache.
+
+    Parameters
+    ----------
+    thekey : str
+        The stage key (see stagekey)
+
+    Returns
+    -------
+    thearrays : dict of arrays, or None
+        The arrays of the stage result, memory mapped from the cache files, or None if the result is not in the
+        cache.  Copy them before the next call to save, which may evict them.
+    """
+    if cachedir is None:
+        return None
+    thedir = _entrydir(thekey)
+    if not os.path.isdir(thedir):
+        return None
+    thearrays = {}
+    try:
+        for thefile in os.listdir(thedir):
+            if thefile.endswith('.npy'):
+                thearrays[thefile[:-4]] = np.load(os.path.join(thedir, thefile), mmap_mode='r')
+        # this result is now the most recently used
+        os.utime(thedir, None)
+    except (OSError, ValueError):
+        return None
+    return thearrays
+
+
+def save(thekey, thearrays):
+    r"""Put a stage result in the cache, then remove the least recently used results if the cache is over its size
+    limit.
+
+    Parameters
+    ----------
+    thekey : str
+        The stage key (see stagekey)
+    thearrays : dict of arrays
+        The arrays of the stage result.  Scalars are saved as 0 dimensional arrays.
+    """
+    if cachedir is None:
+        return
+    thesize = sum([np.asarray(thearray).nbytes for thearray in thearrays.values()])
+    if thesize > maxcachesize:
+        print('stage result is larger than the cache size limit - not cached')
+        return
+    thedir = _entrydir(thekey)
+    if os.path.isdir(thedir):
+        os.utime(thedir, None)
+        return
+
+    # write to a temporary directory and rename it, so that an interrupted run never leaves a partial result
+    tempdir = thedir + '.' + str(os.getpid()) + '.tmp'
+    os.makedirs(tempdir)
+    try:
+        for thename, thearray in thearrays.items():
+            with open(os.path.join(tempdir, thename + '.npy'), 'wb') as thefile:
+                np.save(thefile, thearray)
+        os.rename(tempdir, thedir)
+    except OSError:
+        # most likely another run has just saved the same result
+        shutil.rmtree(tempdir, ignore_errors=True)
+    evict(keep=thekey)
+
+
+def evict(maxsize=None, keep=None):
+    r"""Remove the least recently used stage results until the cache is no larger than maxsize.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The size limit, in bytes.  Default is the current cache size limit.
+    keep : str, optional
+        The key of a result that should not be removed
+
+    Returns
+    -------
+    numremoved : int
+        The number of results removed
+    """
+    if cachedir is None:
+        return 0
+    if maxsize is None:
+        maxsize = maxcachesize
+    theentries = []
+    totalsize = 0
+    for thekey in os.listdir(cachedir):
+        thedir = _entrydir(thekey)
+        if thekey.endswith('.tmp') or not os.path.isdir(thedir):
+            continue
+        thesize = _entrysize(thedir)
+        totalsize += thesize
+        if thekey != keep:
+            theentries.append((os.path.getmtime(thedir), thesize, thedir))
+    numremoved = 0
+    for themtime, thesize, thedir in sorted(theentries):
+        if totalsize <= maxsize:
+            break
+        shutil.rmtree(thedir, ignore_errors=True)
+        totalsize -= thesize
+        numremoved += 1
+    return numremoved
+
+
+def cachesize():
+    r"""Return the total size of the stage results in the cache, in bytes.
+    """
+    if cachedir is None:
+        return 0
+    return sum([_entrysize(_entrydir(thekey)) for thekey in os.listdir(cachedir)
+                if os.path.isdir(_entrydir(thekey)) and not thekey.endswith('.tmp')])
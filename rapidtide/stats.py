@@ -23,77 +23,30 @@ from __future__ import print_function, division
 
 import numpy as np
 import scipy as sp
-import pylab as pl
-
-from scipy.stats import johnsonsb
 
+import rapidtide.lazyimport as tide_lazy
 import rapidtide.io as tide_io
 import rapidtide.fit as tide_fit
 
+pl = tide_lazy.lazymodule('matplotlib.pyplot')
+spstats = tide_lazy.lazymodule('scipy.stats')
+johnsonsb = tide_lazy.lazyname('scipy.stats', 'johnsonsb')
+cKDTree = tide_lazy.lazyname('scipy.spatial', 'cKDTree')
+
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder = 6
 MAXLINES = 10000000
 donotbeaggressive = True
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    from memory_profiler import profile
-
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
-
-
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-numbaexists = False
-
-
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-
-donotusenumba = False
+memprofilerexists = tide_lazy.moduleexists('memory_profiler')
+profile = tide_lazy.lazyname('memory_profiler', 'profile')
 
 
-try:
-    import pyfftw
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
+nibabelexists = tide_lazy.moduleexists('nibabel')
+nib = tide_lazy.lazymodule('nibabel')
 
 
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f, nopython=False)
-
-    return resdec
-
-
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f, nopython=False)
-
-    return resdec
-
-
-def disablenumba():
-    global donotusenumba
-    donotusenumba = True
 
 
 # --------------------------- probability functions -------------------------------------------------
@@ -259,7 +212,7 @@ def tfromr(r, nsamps, dfcorrfac=1.0, oversampfactor=1.0, returnp=False):
     else:
         dof = int((dfcorrfac * nsamps) // oversampfactor)
         tval = r * np.sqrt(dof / (1 - r * r))
-        pval = sp.stats.t.sf(abs(tval), dof) * 2.0
+        pval = spstats.t.sf(abs(tval), dof) * 2.0
     if returnp:
         return tval, pval
     else:
@@ -287,7 +240,7 @@ def zfromr(r, nsamps, dfcorrfac=1.0, oversampfactor=1.0, returnp=False):
     else:
         dof = int((dfcorrfac * nsamps) // oversampfactor)
         zval = r / np.sqrt(1.0 / (dof - 3))
-        pval = 1.0 - sp.stats.norm.cdf(abs(zval))
+        pval = 1.0 - spstats.norm.cdf(abs(zval))
     if returnp:
         return zval, pval
     else:
@@ -493,7 +446,7 @@ def getfracval(datamat, thefrac, numbins=200, nozero=False):
     return getfracvals(datamat, [thefrac], numbins=numbins, nozero=nozero)[0]
 
 
-def getfracvals(datamat, thefracs, numbins=200, displayplots=False, nozero=False):
+def getfracvals(datamat, thefracs, numbins=200, displayplots=False, nozero=False, slabsize=None):
     """
 
     Parameters
@@ -503,14 +456,26 @@ def getfracvals(datamat, thefracs, numbins=200, displayplots=False, nozero=False
     numbins
     displayplots
     nozero
+    slabsize : int, optional
+        If set, go through the rows of datamat this many at a time, accumulating the histogram, rather than
+        histogramming the whole array at once.  The result is the same.
 
     Returns
     -------
 
     """
-    themax = datamat.max()
-    themin = datamat.min()
-    (meanhist, bins) = np.histogram(datamat, bins=numbins, range=(themin, themax))
+    if slabsize is None:
+        themax = datamat.max()
+        themin = datamat.min()
+        (meanhist, bins) = np.histogram(datamat, bins=numbins, range=(themin, themax))
+    else:
+        slabs = [(slabstart, slabstart + slabsize) for slabstart in range(0, datamat.shape[0], slabsize)]
+        themax = np.max([datamat[slabstart:slabend].max() for slabstart, slabend in slabs])
+        themin = np.min([datamat[slabstart:slabend].min() for slabstart, slabend in slabs])
+        meanhist = np.zeros(numbins, dtype=np.int64)
+        for slabstart, slabend in slabs:
+            slabhist, bins = np.histogram(datamat[slabstart:slabend], bins=numbins, range=(themin, themax))
+            meanhist += slabhist
     cummeanhist = np.cumsum(meanhist)
     if nozero:
         cummeanhist = cummeanhist - cummeanhist[0]
@@ -649,3 +614,192 @@ def getmasksize(themask):
     return len(np.where(themask > 0)[0])
 
 
+
+
+# --------------------------- Signal quality metrics -------------------------------------------------
+def _embed(waveform, m):
+    # make a (N - m + 1, m) array of the length m templates of waveform, without copying
+    waveform = np.ascontiguousarray(waveform, dtype=np.float64)
+    return np.lib.stride_tricks.as_strided(waveform,
+                                           shape=(len(waveform) - m + 1, m),
+                                           strides=(waveform.strides[0], waveform.strides[0]),
+                                           writeable=False)
+
+
+def _templatematchcounts(waveform, m, r, numtemplates=None):
+    # count, for each length m template, the number of templates (including itself) within Chebyshev distance r
+    templates = _embed(waveform, m)
+    if numtemplates is not None:
+        templates = templates[:numtemplates, :]
+    thetree = cKDTree(templates)
+    return np.asarray(thetree.query_ball_point(templates, r, p=np.inf, return_length=True), dtype=np.float64)
+
+
+def approximateentropy(waveform, m, r):
+    """
+    Calculate the approximate entropy of a waveform, using a k-d tree to count template matches
+
+    Parameters
+    ----------
+    waveform: array-like
+        The waveform
+    m: int
+        The template length
+    r: float
+        The tolerance for two templates to match (Chebyshev distance)
+
+    Returns
+    -------
+    apen: float
+        The approximate entropy
+    """
+    N = len(waveform)
+
+    def _phi(m):
+        C = _templatematchcounts(waveform, m, r) / (N - m + 1.0)
+        return np.mean(np.log(C))
+
+    return abs(_phi(m + 1) - _phi(m))
+
+
+def sampleentropy(waveform, m, r):
+    """
+    Calculate the sample entropy of a waveform, using a k-d tree to count template matches
+
+    Parameters
+    ----------
+    waveform: array-like
+        The waveform
+    m: int
+        The template length
+    r: float
+        The tolerance for two templates to match (Chebyshev distance)
+
+    Returns
+    -------
+    sampen: float
+        The sample entropy.  Returns np.inf if no templates of length m + 1 match.
+    """
+    N = len(waveform)
+    B = np.sum(_templatematchcounts(waveform, m, r, numtemplates=N - m) - 1.0)
+    A = np.sum(_templatematchcounts(waveform, m + 1, r, numtemplates=N - m) - 1.0)
+    if A == 0.0 or B == 0.0:
+        return np.inf
+    return -np.log(A / B)
+
+
+def _windowlimits(numpoints, windowpts):
+    # start and end (exclusive) of a centered window at each point, truncated at the ends of the data
+    halfwidth = windowpts // 2
+    centers = np.arange(numpoints)
+    return np.maximum(0, centers - halfwidth), np.minimum(centers + halfwidth + 1, numpoints)
+
+
+def windowedmoments(waveform, windowpts):
+    """
+    Calculate the mean and second, third, and fourth central moments of a waveform over a sliding window,
+    using cumulative sums so the cost does not depend on the window size.
+
+    Parameters
+    ----------
+    waveform: array-like
+        The waveform
+    windowpts: int
+        The window length in points (should be odd).  The window is truncated at the ends of the data.
+
+    Returns
+    -------
+    mean, m2, m3, m4: arrays
+        The windowed mean and (biased) central moments at every point
+    """
+    # remove the overall mean first to limit cancellation errors
+    centered = np.asarray(waveform, dtype=np.float64) - np.mean(waveform)
+    startpts, endpts = _windowlimits(len(centered), windowpts)
+    n = (endpts - startpts).astype(np.float64)
+    sums = []
+    for power in range(1, 5):
+        cumsum = np.concatenate(([0.0], np.cumsum(centered ** power)))
+        sums.append((cumsum[endpts] - cumsum[startpts]) / n)
+    mu, s2, s3, s4 = sums
+    m2 = np.maximum(s2 - mu * mu, 0.0)
+    m3 = s3 - 3.0 * mu * s2 + 2.0 * mu ** 3
+    m4 = s4 - 4.0 * mu * s3 + 6.0 * mu * mu * s2 - 3.0 * mu ** 4
+    return mu + np.mean(waveform), m2, m3, m4
+
+
+def windowedskewness(waveform, windowpts):
+    """
+    Sliding window skewness, equivalent to scipy.stats.skew on each window
+
+    Parameters
+    ----------
+    waveform: array-like
+        The waveform
+    windowpts: int
+        The window length in points (should be odd).  The window is truncated at the ends of the data.
+
+    Returns
+    -------
+    skewness: array
+        The skewness of the window centered on every point
+    """
+    mean, m2, m3, m4 = windowedmoments(waveform, windowpts)
+    return np.where(m2 > 0.0, m3 / np.power(np.where(m2 > 0.0, m2, 1.0), 1.5), 0.0)
+
+
+def windowedkurtosis(waveform, windowpts, fisher=True):
+    """
+    Sliding window kurtosis, equivalent to scipy.stats.kurtosis on each window
+
+    Parameters
+    ----------
+    waveform: array-like
+        The waveform
+    windowpts: int
+        The window length in points (should be odd).  The window is truncated at the ends of the data.
+    fisher: bool, optional
+        If True (default), subtract 3 so a normal distribution gives 0.0 (Fisher's definition).
+
+    Returns
+    -------
+    kurtosis: array
+        The kurtosis of the window centered on every point
+    """
+    mean, m2, m3, m4 = windowedmoments(waveform, windowpts)
+    thekurtosis = np.where(m2 > 0.0, m4 / np.square(np.where(m2 > 0.0, m2, 1.0)), 0.0)
+    if fisher:
+        return thekurtosis - 3.0
+    else:
+        return thekurtosis
+
+
+def windowedapproximateentropy(waveform, windowpts, m=2, rfac=0.2):
+    """
+    Sliding window approximate entropy, with the match tolerance set to rfac times the standard deviation of each
+    window.  The template matches in each window are counted with a Chebyshev k-d tree (see approximateentropy), so
+    the cost per window grows as N log N in the window length rather than as N**2.
+
+    Parameters
+    ----------
+    waveform: array-like
+        The waveform
+    windowpts: int
+        The window length in points (should be odd).  The window is truncated at the ends of the data.
+    m: int, optional
+        The template length.  Default is 2.
+    rfac: float, optional
+        The match tolerance as a fraction of the window standard deviation.  Default is 0.2.
+
+    Returns
+    -------
+    apen: array
+        The approximate entropy of the window centered on every point
+    """
+    waveform = np.ascontiguousarray(waveform, dtype=np.float64)
+    numpoints = len(waveform)
+    startpts, endpts = _windowlimits(numpoints, windowpts)
+    apen = np.zeros(numpoints, dtype=np.float64)
+    for i in range(numpoints):
+        thewindow = waveform[startpts[i]:endpts[i]]
+        apen[i] = approximateentropy(thewindow, m, rfac * np.std(thewindow))
+    return apen
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Run telemetry for rapidtide.  Work is recorded as nested spans (run -> pass -> stage -> worker chunk), each with
+its wall time, item throughput, the peak resident memory of the process (and its children), and the amount of
+shared memory in use.  When run_multiproc or run_multithread is called while telemetry is on, every worker also
+reports how long it was busy and how long it sat waiting for work.
+
+Telemetry is off by default, and startspan/endspan do nothing until enable() is called.  The results can be
+written as JSON (writejson) for comparing runs, or in the Chrome trace-event format (writechrometrace) for viewing
+in chrome://tracing or Perfetto.
+"""
+
+from __future__ import print_function, division
+
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import weakref
+
+# ---------------------------------------- Global settings -------------------------------------------
+enabled = False
+spans = []
+spanstack = []
+workerstats = []
+sharedmem = {'current': 0, 'peak': 0}
+sharedrefs = {}
+nextspanid = [0]
+
+# ru_maxrss is in kilobytes on linux, bytes on macOS
+if sys.platform == 'darwin':
+    rssscale = 1
+else:
+    rssscale = 1024
+
+
+def enable():
+    r"""Start recording telemetry (clearing anything recorded so far).
+    """
+    global enabled
+    reset()
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def isenabled():
+    return enabled
+
+
+def reset():
+    del spans[:]
+    del spanstack[:]
+    del workerstats[:]
+    sharedmem['current'] = 0
+    sharedmem['peak'] = 0
+    sharedrefs.clear()
+    nextspanid[0] = 0
+
+
+def memusage():
+    r"""Peak resident set size (in bytes) of this process and of its finished children, and the shared memory
+    currently allocated through addsharedmem.
+
+    Returns
+    -------
+    usage : dict
+    """
+    selfusage = resource.getrusage(resource.RUSAGE_SELF)
+    childusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'maxrss': selfusage.ru_maxrss * rssscale,
+            'maxrss_children': childusage.ru_maxrss * rssscale,
+            'sharedmem': sharedmem['current'],
+            'sharedmem_peak': sharedmem['peak']}
+
+
+def _releaseshared(theref):
+    try:
+        dummy, thesize = sharedrefs.pop(id(theref))
+    except KeyError:
+        return
+    sharedmem['current'] -= thesize
+
+
+def addsharedmem(thesharedarray):
+    r"""Count a multiprocessing shared array in the shared memory total until it is garbage collected.
+
+    Parameters
+    ----------
+    thesharedarray : multiprocessing.RawArray
+    """
+    if not enabled:
+        return
+    import ctypes
+    thesize = ctypes.sizeof(thesharedarray)
+    # the weak reference has to be kept alive, or the callback will never fire
+    theref = weakref.ref(thesharedarray, _releaseshared)
+    sharedrefs[id(theref)] = (theref, thesize)
+    sharedmem['current'] += thesize
+    sharedmem['peak'] = max(sharedmem['peak'], sharedmem['current'])
+
+
+def currentspan():
+    if len(spanstack) > 0:
+        return spanstack[-1]
+    return None
+
+
+def startspan(name, category='stage', args=None):
+    r"""Open a span, nested inside the currently open span (if any).  Every startspan must be matched by an
+    endspan.
+
+    Parameters
+    ----------
+    name : str
+        The name of the span, e.g. 'Correlation calculation'
+    category : str, optional
+        The kind of span - 'run', 'pass', 'stage', or 'chunk'.  Default is 'stage'.
+    args : dict, optional
+        Extra information to store with the span
+
+    Returns
+    -------
+    thespan : dict or None
+        The span record, or None if telemetry is off
+    """
+    if not enabled:
+        return None
+    parent = currentspan()
+    thespan = {'id': nextspanid[0],
+               'parent': None if parent is None else parent['id'],
+               'name': name,
+               'category': category,
+               'path': name if parent is None else parent['path'] + '/' + name,
+               'depth': len(spanstack),
+               'pid': os.getpid(),
+               'tid': threading.current_thread().ident,
+               'start': time.time(),
+               'end': None,
+               'duration': None,
+               'numitems': None,
+               'unit': None,
+               'throughput': None,
+               'args': {} if args is None else dict(args)}
+    nextspanid[0] += 1
+    spanstack.append(thespan)
+    return thespan
+
+
+def endspan(numitems=None, unit=None):
+    r"""Close the most recently opened span.
+
+    Parameters
+    ----------
+    numitems : int, optional
+        The number of items processed in the span, used to calculate the throughput
+    unit : str, optional
+        What the items are, e.g. 'voxels'
+
+    Returns
+    -------
+    thespan : dict or None
+    """
+    if not enabled or len(spanstack) == 0:
+        return None
+    thespan = spanstack.pop()
+    thespan['end'] = time.time()
+    thespan['duration'] = thespan['end'] - thespan['start']
+    if numitems is not None:
+        thespan['numitems'] = int(numitems)
+        thespan['unit'] = unit
+        if thespan['duration'] > 0.0:
+            thespan['throughput'] = numitems / thespan['duration']
+    thespan.update(memusage())
+    spans.append(thespan)
+    return thespan
+
+
+class span(object):
+    r"""Context manager version of startspan/endspan.  Set numitems (and unit) on the object inside the block to
+    record the throughput.
+
+        with tide_telemetry.span('Time lag estimation') as thespan:
+            thespan.numitems = fitcorr(...)
+    """
+    def __init__(self, name, category='stage', args=None, unit='voxels'):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.unit = unit
+        self.numitems = None
+
+    def __enter__(self):
+        startspan(self.name, category=self.category, args=self.args)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        endspan(numitems=self.numitems, unit=self.unit)
+        return False
+
+
+# ---------------------------------------- Worker telemetry -------------------------------------------
+class timedqueue(object):
+    r"""Wraps a worker's input queue, recording how long the worker spends waiting for work.
+    """
+    def __init__(self, theq):
+        self.theq = theq
+        self.idletime = 0.0
+        self.numitems = 0
+
+    def get(self, *args, **kwargs):
+        starttime = time.time()
+        val = self.theq.get(*args, **kwargs)
+        self.idletime += time.time() - starttime
+        if val is not None:
+            self.numitems += 1
+        return val
+
+    def put(self, *args, **kwargs):
+        return self.theq.put(*args, **kwargs)
+
+
+def telemetryworker(consumerfunc, inQ, outQ, statsQ, workerid):
+    r"""Run a multiproc consumer function, then send its busy and idle times back on statsQ.
+    """
+    timedQ = timedqueue(inQ)
+    starttime = time.time()
+    try:
+        consumerfunc(timedQ, outQ)
+    finally:
+        endtime = time.time()
+        statsQ.put({'worker': workerid,
+                    'pid': os.getpid(),
+                    'tid': threading.current_thread().ident,
+                    'start': starttime,
+                    'end': endtime,
+                    'numitems': timedQ.numitems,
+                    'idletime': timedQ.idletime,
+                    'busytime': max(endtime - starttime - timedQ.idletime, 0.0),
+                    'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rssscale})
+
+
+def collectworkerstats(statsQ, numworkers, timeout=10.0):
+    r"""Gather the statistics sent by numworkers telemetryworkers, attaching them to the current span.
+    """
+    try:
+        import queue as thrQueue
+    except ImportError:
+        import Queue as thrQueue
+    parent = currentspan()
+    for i in range(numworkers):
+        try:
+            thestats = statsQ.get(timeout=timeout)
+        except thrQueue.Empty:
+            print('telemetry: timed out waiting for worker statistics')
+            break
+        thestats['parent'] = None if parent is None else parent['id']
+        thestats['path'] = 'worker ' + str(thestats['worker']) if parent is None else \
+            parent['path'] + '/worker ' + str(thestats['worker'])
+        thewall = thestats['end'] - thestats['start']
+        if thewall > 0.0:
+            thestats['utilization'] = thestats['busytime'] / thewall
+        else:
+            thestats['utilization'] = 0.0
+        workerstats.append(thestats)
+
+
+# ---------------------------------------- Output -------------------------------------------
+def summary():
+    r"""Per span and per worker results, in the order the spans were started.
+
+    Returns
+    -------
+    thesummary : dict
+    """
+    return {'version': 1,
+            'hostname': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'pid': os.getpid(),
+            'spans': sorted(spans, key=lambda x: x['id']),
+            'workers': list(workerstats)}
+
+
+def writejson(filename):
+    r"""Write the recorded spans and worker statistics as JSON.
+
+    Parameters
+    ----------
+    filename : str
+    """
+    with open(filename, 'w') as thefile:
+        json.dump(summary(), thefile, indent=4, sort_keys=True)
+
+
+def chrometrace():
+    r"""Convert the recorded spans and worker statistics to Chrome trace events.
+
+    Returns
+    -------
+    thetrace : dict
+    """
+    events = []
+    starttimes = [thespan['start'] for thespan in spans] + [theworker['start'] for theworker in workerstats]
+    if len(starttimes) == 0:
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    origin = min(starttimes)
+    mainpid = os.getpid()
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': mainpid, 'args': {'name': 'rapidtide'}})
+    for thespan in sorted(spans, key=lambda x: x['id']):
+        theargs = dict(thespan['args'])
+        for thekey in ['numitems', 'unit', 'throughput', 'maxrss', 'sharedmem']:
+            if thespan[thekey] is not None:
+                theargs[thekey] = thespan[thekey]
+        events.append({'name': thespan['name'],
+                       'cat': thespan['category'],
+                       'ph': 'X',
+                       'ts': (thespan['start'] - origin) * 1e6,
+                       'dur': thespan['duration'] * 1e6,
+                       'pid': thespan['pid'],
+                       'tid': thespan['tid'],
+                       'args': theargs})
+        events.append({'name': 'memory',
+                       'ph': 'C',
+                       'ts': (thespan['end'] - origin) * 1e6,
+                       'pid': thespan['pid'],
+                       'args': {'maxrss': thespan['maxrss'], 'sharedmem': thespan['sharedmem']}})
+    for theworker in workerstats:
+        if theworker['pid'] != mainpid:
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': theworker['pid'],
+                           'args': {'name': 'worker ' + str(theworker['worker'])}})
+        events.append({'name': theworker['path'],
+                       'cat': 'worker',
+                       'ph': 'X',
+                       'ts': (theworker['start'] - origin) * 1e6,
+                       'dur': (theworker['end'] - theworker['start']) * 1e6,
+                       'pid': theworker['pid'],
+                       'tid': theworker['tid'],
+                       'args': {'numitems': theworker['numitems'],
+                                'busytime': theworker['busytime'],
+                                'idletime': theworker['idletime'],
+                                'utilization': theworker['utilization'],
+                                'maxrss': theworker['maxrss']}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def writechrometrace(filename):
+    r"""Write the recorded spans and worker statistics as a Chrome trace-event file.
+
+    Parameters
+    ----------
+    filename : str
+    """
+    with open(filename, 'w') as thefile:
+        json.dump(chrometrace(), thefile)
+
+
+def proctelemetry(maxdepth=2):
+    r"""Print the duration, throughput, and peak memory of each span, and the utilization of the workers.
+
+    Parameters
+    ----------
+    maxdepth : int, optional
+        Spans nested deeper than this (e.g. worker chunks) are not printed.  Default is 2.
+    """
+    print('Duration\tThroughput\tPeak RSS (MB)\tShared (MB)\tSpan')
+    for thespan in sorted(spans, key=lambda x: x['id']):
+        if thespan['depth'] > maxdepth:
+            continue
+        if thespan['throughput'] is not None:
+            thethroughput = '{0:.1f} {1}/s'.format(thespan['throughput'], thespan['unit'])
+        else:
+            thethroughput = '-'
+        print('{0:.2f}\t{1}\t{2:.1f}\t{3:.1f}\t{4}'.format(thespan['duration'],
+                                                         thethroughput,
+                                                         thespan['maxrss'] / 1048576.0,
+                                                         thespan['sharedmem'] / 1048576.0,
+                                                         '  ' * thespan['depth'] + thespan['name']))
+    for theworker in workerstats:
+        print('{0}: {1} items, {2:.1f}% busy, {3:.2f}s idle'.format(theworker['path'],
+                                                                  theworker['numitems'],
+                                                                  100.0 * theworker['utilization'],
+                                                                  theworker['idletime']))
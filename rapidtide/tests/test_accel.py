@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.accel as tide_accel
+import rapidtide.fit as tide_fit
+
+
+def test_kernelparity(debug=False):
+    # the loop based kernels (what numba compiles) must match their numpy fallbacks
+    np.random.seed(12345)
+    x = np.linspace(-5.0, 25.0, 301)
+    for p in [np.array([1.0, 2.0, 3.0, 4.0]), np.array([-2.0, 0.5, 0.7, 10.0])]:
+        toplength = 8.0
+        loopvals = tide_fit.trapezoid_eval_loop.kernel.pyfunc(x, toplength, p)
+        vecvals = tide_fit.trapezoid_eval_loop(x, toplength, p)
+        if debug:
+            print('trapezoid max diff:', np.max(np.fabs(loopvals - vecvals)))
+        np.testing.assert_allclose(loopvals, vecvals, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(loopvals, [tide_fit.trapezoid_eval(thex, toplength, p) for thex in x])
+
+        loopvals = tide_fit.risetime_eval_loop.kernel.pyfunc(x, p[:3])
+        vecvals = tide_fit.risetime_eval_loop(x, p[:3])
+        np.testing.assert_allclose(loopvals, vecvals, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(loopvals, [tide_fit.risetime_eval(thex, p[:3]) for thex in x])
+
+    thekernel = tide_fit.findmaxindex_noedge.kernel.pyfunc
+    for i in range(50):
+        corrfunc = np.random.randn(101)
+        if i % 5 == 0:
+            # peak at the edge
+            corrfunc[0] = 10.0
+        if i % 7 == 0:
+            corrfunc[np.random.randint(101)] = np.nan
+        for bipolar in [False, True]:
+            kernelresult = thekernel(corrfunc, 0, 100, bipolar)
+            npresult = tide_fit.findmaxindex_noedge(corrfunc, 0, 100, bipolar)
+            if debug:
+                print(i, bipolar, kernelresult, npresult)
+            assert kernelresult == npresult
+            assert kernelresult[0] > 0
+
+
+def test_disableaccel(debug=False):
+    wasenabled = tide_accel.accelenabled()
+    tide_accel.disableaccel()
+    assert not tide_accel.accelenabled()
+    assert tide_accel.warmup(verbose=debug) == 0
+
+    # everything should still work (using the fallbacks) with acceleration off
+    corrfunc = np.zeros(51, dtype=np.float32)
+    corrfunc[20] = 1.0
+    assert tide_fit.maxindex_noedge(np.arange(51), corrfunc) == (20, 1.0)
+    corrfunc[30] = -2.0
+    assert tide_fit.maxindex_noedge(np.arange(51), corrfunc, bipolar=True) == (30, -1.0)
+
+    tide_accel.enableaccel()
+    assert tide_accel.accelenabled() == tide_accel.numbaexists
+    if not wasenabled:
+        tide_accel.disableaccel()
+
+    kernelnames = [thekernel.name() for thekernel in tide_accel.jitkernels]
+    if debug:
+        print(kernelnames)
+    assert 'rapidtide.fit.findmaxindex_noedge' in kernelnames
+
+
+def main():
+    test_kernelparity(debug=True)
+    test_disableaccel(debug=True)
+
+
+if __name__ == '__main__':
+    main()
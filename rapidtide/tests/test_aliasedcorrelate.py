@@ -64,8 +64,45 @@ def test_aliasedcorrelate(display=False):
     #np.testing.assert_almost_equal(fastcorrelate_result, stdcorrelate_result, aethresh)
 
 
+def test_aliasedcorrelator_batch():
+    Fs_hi = 10.0
+    Fs_lo = 1.0
+    inlenhi = 1000
+    inlenlo = 100
+    width = 2.5
+    timerange = np.linspace(0.0, width, num=101) - width / 2.0
+    hiaxis = np.linspace(0.0, 2.0 * np.pi * inlenhi / Fs_hi, num=inlenhi, endpoint=False)
+    loaxis = np.linspace(0.0, 2.0 * np.pi * inlenlo / Fs_lo, num=inlenlo, endpoint=False)
+    sighi = np.sin(1.36129345 * hiaxis) + 0.33 * np.sin(2.0 * hiaxis)
+    np.random.seed(1)
+    siglos = np.zeros((20, inlenlo), dtype=np.float64)
+    for i in range(siglos.shape[0]):
+        siglos[i, :] = np.sin(1.36129345 * (loaxis + 0.1 * i)) + 0.1 * np.random.randn(inlenlo)
+
+    thecorrelator = aliasedcorrelator(sighi, Fs_hi, Fs_lo, timerange, padvalue=width)
+    for extraoffset in [0.0, 0.35]:
+        batchresult = thecorrelator.apply_batch(siglos, extraoffset)
+        assert batchresult.shape == (siglos.shape[0], len(timerange))
+        for i in range(siglos.shape[0]):
+            np.testing.assert_allclose(batchresult[i, :], thecorrelator.apply(siglos[i, :], extraoffset),
+                                       rtol=1e-10, atol=1e-10)
+
+    # only the most recently used reference matrices are kept
+    thecorrelator = aliasedcorrelator(sighi, Fs_hi, Fs_lo, timerange, padvalue=width, maxaliasedmatrices=4)
+    for extraoffset in np.linspace(0.0, 0.9, 10):
+        thecorrelator.apply_batch(siglos, extraoffset)
+    assert len(thecorrelator.aliasedmatrices) == 4
+    lastkey = list(thecorrelator.aliasedmatrices.keys())[-1]
+    firstresult = thecorrelator.apply_batch(siglos, 0.6)
+    assert list(thecorrelator.aliasedmatrices.keys())[-2] == lastkey
+    thecorrelator.apply_batch(siglos, 0.0)
+    assert len(thecorrelator.aliasedmatrices) == 4
+    np.testing.assert_allclose(thecorrelator.apply_batch(siglos, 0.6), firstresult, rtol=1e-12, atol=1e-12)
+
+
 def main():
     test_aliasedcorrelate(display=True)
+    test_aliasedcorrelator_batch()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import print_function, division
+
+import os
+
+import numpy as np
+
+import rapidtide.checkpoint as tide_checkpoint
+from rapidtide.tests.utils import get_test_temp_path, create_dir
+
+
+def test_hashinputs(debug=False):
+    create_dir(get_test_temp_path())
+    thefilename = os.path.join(get_test_temp_path(), 'checkpointinput.txt')
+    with open(thefilename, 'w') as thefile:
+        thefile.write('1.0\n2.0\n')
+    optiondict = {'in_file': thefilename, 'passes': 3, 'nprocs': 1}
+    thehash = tide_checkpoint.hashinputs(optiondict)
+    if debug:
+        print(thehash)
+
+    # runtime options do not change the hash
+    optiondict['nprocs'] = 8
+    optiondict['fftthreads'] = 4
+    assert tide_checkpoint.hashinputs(optiondict) == thehash
+
+    # other options do
+    optiondict['passes'] = 2
+    assert tide_checkpoint.hashinputs(optiondict) != thehash
+    optiondict['passes'] = 3
+    assert tide_checkpoint.hashinputs(optiondict) == thehash
+
+    # and so do the contents of the input files
+    with open(thefilename, 'w') as thefile:
+        thefile.write('1.0\n2.5\n')
+    assert tide_checkpoint.hashinputs(optiondict) != thehash
+
+
+def test_saveandload(debug=False):
+    create_dir(get_test_temp_path())
+    outputname = os.path.join(get_test_temp_path(), 'checkpointtest')
+    optiondict = {'passes': 2, 'lagmin': -10.0}
+    maparray = np.random.normal(size=100)
+    bigarray = np.random.normal(size=(100, 20))
+
+    # a disabled checkpointer does nothing
+    thecheckpointer = tide_checkpoint.checkpointer(outputname, 'abc', 2, enabled=False)
+    thecheckpointer.save('refprep', 0, optiondict)
+    assert not os.path.exists(thecheckpointer.statefile)
+    assert not thecheckpointer.isdone('refprep', 0)
+
+    thecheckpointer = tide_checkpoint.checkpointer(outputname, 'abc', 2)
+    thecheckpointer.save('refprep', 0, optiondict, state={'theref': maparray[:10]})
+    np.random.seed(12345)
+    thecheckpointer.save('correlation', 1, optiondict, state={'lagtimes': maparray, 'nothing': None},
+                         arrays={'corrout': bigarray})
+    nextrandom = np.random.normal(size=5)
+    optiondict['lagmin'] = -5.0
+    optiondict['nprocs'] = 4
+
+    # reload and check what was saved
+    thereader = tide_checkpoint.checkpointer(outputname, 'abc', 2)
+    assert thereader.load() == 'ok'
+    assert thereader.resumed
+    if debug:
+        print(thereader.laststage, thereader.lastpass, thereader.arraynames)
+    assert thereader.isdone('refprep', 0)
+    assert thereader.isdone('significance', 1)
+    assert thereader.isdone('correlation', 1)
+    assert not thereader.isdone('fit', 1)
+    assert not thereader.isdone('significance', 2)
+    assert not thereader.isdone('glm', 1)
+    assert np.all(thereader.getstate('lagtimes') == maparray)
+    assert thereader.getstate('nothing') is None
+    thereader.restoreoptions(optiondict)
+    assert optiondict['lagmin'] == -10.0
+    assert optiondict['nprocs'] == 4
+    assert np.all(np.random.normal(size=5) == nextrandom)
+    restored = np.zeros((100, 20))
+    thereader.restorearray('corrout', restored, slabsize=7)
+    assert np.all(restored == bigarray)
+    try:
+        thereader.restorearray('corrout', np.zeros((100, 10)))
+        assert False
+    except ValueError:
+        pass
+
+    # saving an earlier stage than the checkpoint does nothing
+    thereader.save('significance', 1, optiondict)
+    assert thereader.laststage == 'correlation'
+
+    # arrays that are no longer needed are removed
+    thereader.save('fit', 1, optiondict, arrays={'lagtc': bigarray})
+    assert not os.path.exists(thereader._arrayfile('corrout'))
+    assert os.path.exists(thereader._arrayfile('lagtc'))
+
+    # a different hash does not match
+    assert tide_checkpoint.checkpointer(outputname, 'abd', 2).load() == 'mismatch'
+
+    thereader.remove()
+    assert not os.path.exists(thereader.statefile)
+    assert not os.path.exists(thereader._arrayfile('lagtc'))
+    assert tide_checkpoint.checkpointer(outputname, 'abc', 2).load() == 'missing'
+
+
+def test_plannedoptions(debug=False):
+    create_dir(get_test_temp_path())
+    outputname = os.path.join(get_test_temp_path(), 'checkpointplantest')
+    useroptions = {'passes': 2, 'internalprecision': 'double', 'limitoutput': False, 'savelagregressors': True,
+                   'streamresults': False}
+
+    # the memory planner switched to single precision and streamed results in the original run
+    optiondict = dict(useroptions, internalprecision='single', streamresults=True)
+    thecheckpointer = tide_checkpoint.checkpointer(outputname, 'abc', 2)
+    thecheckpointer.setplannedoptions(optiondict, useroptions)
+    if debug:
+        print(thecheckpointer.plannedoptions)
+    assert thecheckpointer.plannedoptions == {'internalprecision': 'single'}
+    thecheckpointer.save('refprep', 0, optiondict)
+
+    # with more memory free, the resumed run's planner changes nothing, but the original plan is put back.  With
+    # less, it makes other changes, which are undone.
+    for plannedchanges in [{}, {'limitoutput': True, 'savelagregressors': False}]:
+        optiondict = dict(useroptions, **plannedchanges)
+        thereader = tide_checkpoint.checkpointer(outputname, 'abc', 2)
+        assert thereader.load() == 'ok'
+        thereader.setplannedoptions(optiondict, useroptions)
+        assert optiondict == dict(useroptions, internalprecision='single')
+        assert thereader.plannedoptions == {'internalprecision': 'single'}
+    thereader.remove()
+
+
+def main():
+    test_hashinputs(debug=True)
+    test_saveandload(debug=True)
+    test_plannedoptions(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.corrpassx as tide_corrpass
+import rapidtide.filter as tide_filt
+import rapidtide.helper_classes as tide_classes
+import rapidtide.resample as tide_resample
+
+
+def peaklocs(corrout, corrscale):
+    # parabolic interpolation of the correlation peak
+    maxlocs = np.clip(np.argmax(corrout, axis=1), 1, corrout.shape[1] - 2)
+    rows = np.arange(corrout.shape[0])
+    y0, y1, y2 = corrout[rows, maxlocs - 1], corrout[rows, maxlocs], corrout[rows, maxlocs + 1]
+    return corrscale[maxlocs] + 0.5 * (y0 - y2) / (y0 - 2.0 * y1 + y2) * (corrscale[1] - corrscale[0])
+
+
+def test_sincinterpmatrix(debug=False):
+    # a band limited signal should be reproduced between the samples
+    sourcex = np.arange(0.0, 200.0)
+    destx = np.linspace(20.0, 180.0, 777)
+    freq = 0.11
+    interpmatrix = tide_resample.sincinterpmatrix(sourcex, destx, sincwidth=8)
+    interped = interpmatrix.dot(np.sin(2.0 * np.pi * freq * sourcex + 0.3))
+    if debug:
+        print('max interpolation error:', np.max(np.fabs(interped - np.sin(2.0 * np.pi * freq * destx + 0.3))))
+    np.testing.assert_allclose(interped, np.sin(2.0 * np.pi * freq * destx + 0.3), atol=1e-3)
+
+    # at the sample points it is exact
+    interpmatrix = tide_resample.sincinterpmatrix(sourcex, sourcex[10:20])
+    np.testing.assert_allclose(interpmatrix.dot(sourcex), sourcex[10:20], atol=1e-12)
+
+
+def test_coarsetofine(debug=False):
+    np.random.seed(12345)
+    tr = 2.0
+    oversampfactor = 4
+    numpoints = 300
+    numvoxels = 100
+    fmri_x = np.arange(0.0, numpoints) * tr
+    os_fmri_x = np.arange(0.0, numpoints * oversampfactor - (oversampfactor - 1)) * tr / oversampfactor
+
+    # make a band limited source signal on a fine grid, and sample delayed copies of it
+    theprefilter = tide_filt.noncausalfilter('lfo')
+    fine_x = np.arange(0.0, 4 * numpoints * tr, 0.05)
+    fine_y = tide_resample.doresample(np.arange(0.0, 4 * numpoints) * tr,
+                                      theprefilter.apply(1.0 / tr, np.random.normal(size=4 * numpoints)),
+                                      fine_x)
+    delays = np.random.uniform(-8.0, 8.0, size=numvoxels)
+    fmridata = np.zeros((numvoxels, numpoints), dtype=np.float64)
+    for vox in range(numvoxels):
+        fmridata[vox, :] = np.interp(fmri_x + 100.0 + delays[vox], fine_x, fine_y) + \
+            0.3 * np.random.normal(size=numpoints)
+    referencetc = np.interp(os_fmri_x + 100.0, fine_x, fine_y)
+
+    lagmininpts = lagmaxinpts = int(15.0 / (tr / oversampfactor))
+    results = {}
+    for coarsetofine in [False, True]:
+        thecorrelator = tide_classes.correlator(Fs=oversampfactor / tr,
+                                                ncprefilter=theprefilter,
+                                                detrendorder=1,
+                                                windowfunc='hamming')
+        corrout = np.zeros((numvoxels, lagmininpts + lagmaxinpts), dtype=np.float64)
+        meanval = np.zeros(numvoxels, dtype=np.float64)
+        volumetotal, theglobalmaxlist, thecorrscale = tide_corrpass.correlationpass(fmridata,
+                                                                                  referencetc,
+                                                                                  thecorrelator,
+                                                                                  fmri_x,
+                                                                                  os_fmri_x,
+                                                                                  0,
+                                                                                  lagmininpts,
+                                                                                  lagmaxinpts,
+                                                                                  corrout,
+                                                                                  meanval,
+                                                                                  oversampfactor=oversampfactor,
+                                                                                  coarsetofine=coarsetofine,
+                                                                                  showprogressbar=False)
+        assert volumetotal == numvoxels
+        results[coarsetofine] = (corrout, np.asarray(theglobalmaxlist), thecorrscale)
+
+    finecorr, finemaxes, finescale = results[False]
+    coarsecorr, coarsemaxes, coarsescale = results[True]
+    np.testing.assert_allclose(coarsescale, finescale)
+    finelags = peaklocs(finecorr, finescale)
+    coarselags = peaklocs(coarsecorr, coarsescale)
+    if debug:
+        print('max correlation difference:', np.max(np.fabs(finecorr - coarsecorr)))
+        print('max lag difference:', np.max(np.fabs(finelags - coarselags)))
+        print('lag errors:', np.std(finelags + delays), np.std(coarselags + delays))
+
+    # same correlation functions, same peak locations, and the global maxima land within a native TR
+    assert np.max(np.fabs(finecorr - coarsecorr)) < 0.05
+    assert np.max(np.fabs(finelags - coarselags)) < 0.02
+    assert np.max(np.fabs(finemaxes - coarsemaxes)) <= oversampfactor
+    assert np.std(coarselags + delays) < 0.1
+
+
+def main():
+    test_sincinterpmatrix(debug=True)
+    test_coarsetofine(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,8 @@ from __future__ import print_function, division
 import numpy as np
 import scipy as sp
 
-from rapidtide.resample import congrid
+import rapidtide.resample as tide_resample
+from rapidtide.resample import congrid, congrid_batch
 from rapidtide.tests.utils import mse
 
 import matplotlib.pyplot as plt
@@ -134,8 +135,49 @@ def test_congrid(debug=False, display=False):
         for theline in outputlines:
             print(theline)
 
+def test_congrid_batch(debug=False):
+    gridlen = 32
+    gridaxis = sp.linspace(-np.pi, np.pi, num=gridlen, endpoint=False)
+    numsamples = 500
+    np.random.seed(12345)
+    testlocs = np.random.uniform(-np.pi, np.pi, numsamples)
+    testvals = funcvalue2(testlocs, frequency=0.5)
+
+    for gridkernel in ['gauss', 'kaiser']:
+        for congridbins in [1.5, 2.0, 3.0, 4.5]:
+            # grid one sample at a time
+            weights = np.zeros((gridlen), dtype=float)
+            griddeddata = np.zeros((gridlen), dtype=float)
+            for i in range(numsamples):
+                thevals, theweights, theindices = congrid(gridaxis, testlocs[i], testvals[i], congridbins,
+                                                          kernel=gridkernel)
+                for j in range(len(theindices)):
+                    weights[theindices[j]] += theweights[j]
+                    griddeddata[theindices[j]] += thevals[j]
+
+            # now grid everything at once
+            thevals, theweights, theindices = congrid_batch(gridaxis, testlocs, testvals, congridbins,
+                                                            kernel=gridkernel)
+            batchweights = np.bincount(theindices.ravel(), weights=theweights.ravel(), minlength=gridlen)
+            batchdata = np.zeros((gridlen), dtype=float)
+            np.add.at(batchdata, theindices, thevals)
+            if debug:
+                print(gridkernel, congridbins, np.max(np.fabs(batchweights - weights)))
+            np.testing.assert_allclose(batchweights, weights, rtol=1e-6, atol=1e-6)
+            np.testing.assert_allclose(batchdata, griddeddata, rtol=1e-6, atol=1e-6)
+
+    # only the most recently used kernel tables are kept
+    for quantization in range(100, 100 + 2 * tide_resample.maxcongridtables):
+        tide_resample.getcongridtable(3.0, quantization=quantization)
+    assert len(tide_resample.congridtables) == tide_resample.maxcongridtables
+    lastkey = list(tide_resample.congridtables.keys())[-1]
+    tide_resample.getcongridtable(3.0, quantization=100 + tide_resample.maxcongridtables)
+    assert list(tide_resample.congridtables.keys())[-2] == lastkey
+
+
 def main():
     test_congrid(debug=True, display=True)
+    test_congrid_batch(debug=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+from scipy import ndimage
+
+from rapidtide.helper_classes import despeckler
+
+
+def despeckle_ref(spaceshape, validvoxels, lagtimes, despeckle_thresh):
+    # the original, full volume median filter
+    outmaparray = np.zeros(int(np.prod(spaceshape)), dtype=np.float64)
+    outmaparray[validvoxels] = lagtimes[:]
+    medianlags = ndimage.median_filter(outmaparray.reshape(spaceshape), 3).reshape(-1)
+    initlags = np.where(np.abs(outmaparray - medianlags) > despeckle_thresh, medianlags, -1000000.0)[validvoxels]
+    return np.where(initlags > -1000000.0)[0], medianlags
+
+
+def test_despeckler(debug=False):
+    np.random.seed(12345)
+    despeckle_thresh = 2.0
+    for spaceshape in [(9, 10, 7), (1, 1, 1, 1, 200), (11, 1, 8)]:
+        numspatiallocs = int(np.prod(spaceshape))
+        validvoxels = np.where(np.random.uniform(size=numspatiallocs) > 0.2)[0]
+        lagtimes = np.random.normal(size=len(validvoxels))
+        speckles = np.random.choice(len(validvoxels), size=len(validvoxels) // 10, replace=False)
+        lagtimes[speckles] += 10.0
+
+        thedespeckler = despeckler(spaceshape, validvoxels, despeckle_thresh=despeckle_thresh)
+        for thepass in range(3):
+            refitvoxels, initlags = thedespeckler.getinitlags(lagtimes)
+            refvoxels, refmedians = despeckle_ref(spaceshape, validvoxels, lagtimes, despeckle_thresh)
+            if debug:
+                print(spaceshape, thepass, len(refitvoxels), len(refvoxels))
+
+            # the medians must be right everywhere in the brain, even though only some are recalculated
+            np.testing.assert_allclose(thedespeckler.medianlags[validvoxels], refmedians[validvoxels])
+            np.testing.assert_allclose(initlags, refmedians[validvoxels[refitvoxels]])
+            if thepass == 0:
+                np.testing.assert_array_equal(refitvoxels, refvoxels)
+            else:
+                # voxels that did not change, and have no changed neighbors, are not refit again
+                assert set(refitvoxels).issubset(set(refvoxels))
+
+            # "refit" a few of the flagged voxels
+            lagtimes[refitvoxels[::2]] = initlags[::2]
+
+
+def main():
+    test_despeckler(debug=True)
+
+
+if __name__ == '__main__':
+    main()
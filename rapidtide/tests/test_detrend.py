@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.fit as tide_fit
+import rapidtide.miscmath as tide_math
+
+
+def detrend_ref(inputdata, order=1, demean=False):
+    # the original, polyfit based implementation
+    thetimepoints = np.arange(0.0, len(inputdata), 1.0) - len(inputdata) / 2.0
+    thecoffs = np.polyfit(thetimepoints, inputdata, order)
+    thefittc = tide_fit.trendgen(thetimepoints, thecoffs, demean)
+    return inputdata - thefittc
+
+
+def test_detrend(debug=False):
+    np.random.seed(12345)
+    for tclen in [50, 51, 300]:
+        thetrend = np.linspace(-3.0, 5.0, tclen) ** 2
+        thedata = np.random.normal(size=(6, tclen)) + thetrend[None, :] + 10.0
+        for order in [1, 2, 3]:
+            for demean in [True, False]:
+                blockresult = tide_fit.detrend(thedata, order=order, demean=demean)
+                for i in range(thedata.shape[0]):
+                    theref = detrend_ref(thedata[i, :], order=order, demean=demean)
+                    if debug:
+                        print(tclen, order, demean, np.max(np.fabs(tide_fit.detrend(thedata[i, :], order=order,
+                                                                                  demean=demean) - theref)))
+                    np.testing.assert_allclose(tide_fit.detrend(thedata[i, :], order=order, demean=demean), theref,
+                                               atol=1e-9)
+                    np.testing.assert_allclose(blockresult[i, :], theref, atol=1e-9)
+
+    # only the most recently used bases are kept
+    for tclen in range(100, 100 + 2 * tide_fit.maxdetrendprojectors):
+        tide_fit.getdetrendprojector(tclen, 2)
+    assert len(tide_fit.detrendprojectors) == tide_fit.maxdetrendprojectors
+    lastkey = list(tide_fit.detrendprojectors.keys())[-1]
+    tide_fit.getdetrendprojector(100 + tide_fit.maxdetrendprojectors, 2)
+    assert list(tide_fit.detrendprojectors.keys())[-2] == lastkey
+
+
+def test_corrnormalize_batch(debug=False):
+    np.random.seed(12345)
+    thedata = np.random.normal(size=(6, 200))
+    for prewindow in [True, False]:
+        for detrendorder in [0, 1, 3]:
+            blockresult = tide_math.corrnormalize(thedata, prewindow=prewindow, detrendorder=detrendorder)
+            for i in range(thedata.shape[0]):
+                theref = tide_math.corrnormalize(thedata[i, :], prewindow=prewindow, detrendorder=detrendorder)
+                if debug:
+                    print(prewindow, detrendorder, i, np.max(np.fabs(blockresult[i, :] - theref)))
+                np.testing.assert_allclose(blockresult[i, :], theref, atol=1e-12)
+
+
+def main():
+    test_detrend(debug=True)
+    test_corrnormalize_batch(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -78,8 +78,32 @@ def test_fastresampler(debug=False):
         plt.show()
 
 
+def test_fastresampler_interpolation(debug=False):
+    tr = 0.5
+    testlen = 400
+    timeaxis = np.arange(0.0, 1.0 * testlen) * tr
+    timecoursein = np.sin(2.0 * np.pi * 0.05 * timeaxis) + 0.5 * np.cos(2.0 * np.pi * 0.13 * timeaxis)
+
+    # the dense lookup table is the reference
+    reference = fastresampler(timeaxis, timecoursein, padvalue=30.0)
+    newtimeaxis = timeaxis[20:-20] + 0.123
+
+    for interpolation, upsampleratio in [('linear', 10), ('hermite', 4), ('sinc', 1)]:
+        genlaggedtc = fastresampler(timeaxis, timecoursein, padvalue=30.0, upsampleratio=upsampleratio,
+                                    interpolation=interpolation)
+        if interpolation != 'sinc':
+            assert len(genlaggedtc.hires_y) < len(reference.hires_y) // 5
+        tcshifted = genlaggedtc.yfromx(newtimeaxis)
+        maxerr = np.max(np.fabs(tcshifted - reference.yfromx(newtimeaxis)))
+        if debug:
+            print(interpolation, upsampleratio, 'error bound:', genlaggedtc.errorbound, 'max error:', maxerr)
+        assert maxerr < reference.errorbound + genlaggedtc.errorbound + 1e-3
+        assert genlaggedtc.errorbound < 1e-2
+
+
 def main():
     test_fastresampler(debug=True)
+    test_fastresampler_interpolation(debug=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.correlate as tide_corr
+import rapidtide.fftbackend as tide_fft
+
+
+def test_fftbackend(debug=False):
+    np.random.seed(12345)
+    realdata = np.random.normal(size=(4, 300))
+    complexdata = realdata + 1j * np.random.normal(size=(4, 300))
+
+    availablebackends = ['numpy']
+    if tide_fft.scipyfftexists:
+        availablebackends.append('scipy')
+    if tide_fft.pyfftwexists:
+        availablebackends.append('pyfftw')
+    originalbackend = tide_fft.getfftbackend()
+
+    for thebackend in availablebackends:
+        tide_fft.setfftbackend(thebackend)
+        for numthreads in [1, 2]:
+            tide_fft.setfftthreads(numthreads)
+            assert tide_fft.getfftthreads() == numthreads
+            if debug:
+                print('testing', tide_fft.getfftbackend(), 'with', tide_fft.getfftthreads(), 'threads')
+            for theaxis in [-1, 0]:
+                np.testing.assert_allclose(tide_fft.fft(complexdata, axis=theaxis),
+                                           np.fft.fft(complexdata, axis=theaxis), rtol=1e-10, atol=1e-10)
+                np.testing.assert_allclose(tide_fft.ifft(complexdata, axis=theaxis),
+                                           np.fft.ifft(complexdata, axis=theaxis), rtol=1e-10, atol=1e-10)
+                np.testing.assert_allclose(tide_fft.rfft(realdata, n=512, axis=theaxis),
+                                           np.fft.rfft(realdata, n=512, axis=theaxis), rtol=1e-10, atol=1e-10)
+
+            # round trip through the real transforms, twice to exercise any cached plans
+            for i in range(2):
+                thespectrum = tide_fft.rfft(realdata, n=360)
+                np.testing.assert_allclose(tide_fft.irfft(thespectrum, n=360)[:, :300], realdata, atol=1e-10)
+
+            # the correlation routines give the same answer with every backend
+            np.testing.assert_allclose(tide_corr.fastcorrelate(realdata[0, :], realdata[1, :]),
+                                       np.correlate(realdata[0, :], realdata[1, :], mode='full'), atol=1e-9)
+
+    # only the most recently used pyfftw plans are kept
+    if tide_fft.pyfftwexists:
+        tide_fft.setfftbackend('pyfftw')
+        for thelen in range(100, 100 + 2 * tide_fft.maxfftplans):
+            tide_fft.rfft(np.zeros(thelen))
+        assert len(tide_fft.fftplans) == tide_fft.maxfftplans
+        lastkey = list(tide_fft.fftplans.keys())[-1]
+        tide_fft.rfft(np.zeros(100 + tide_fft.maxfftplans))
+        assert list(tide_fft.fftplans.keys())[-2] == lastkey
+        np.testing.assert_allclose(tide_fft.rfft(realdata[0, :]), np.fft.rfft(realdata[0, :]), atol=1e-10)
+
+    tide_fft.setfftthreads(0)
+    assert tide_fft.getfftthreads() >= 1
+    tide_fft.setfftthreads(1)
+    tide_fft.setfftbackend(originalbackend)
+
+    # fast lengths are never shorter than requested, and only have small prime factors
+    for thelen in [1, 7, 97, 127, 257, 1000, 1025, 4097]:
+        fastlen = tide_fft.nextfastlen(thelen)
+        assert fastlen >= thelen
+        assert fastlen <= 2 * thelen
+        remainder = fastlen
+        for thefactor in [2, 3, 5, 7, 11]:
+            while remainder % thefactor == 0:
+                remainder //= thefactor
+        assert remainder == 1
+        if debug:
+            print(thelen, fastlen)
+
+
+def main():
+    test_fftbackend(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,8 +20,9 @@ import numpy as np
 import scipy as sp
 import matplotlib.pyplot as plt
 
+import rapidtide.filter as tide_filt
 from rapidtide.util import valtoindex
-from rapidtide.filter import noncausalfilter
+from rapidtide.filter import noncausalfilter, ssmooth, ssmooth4d, arb_pass, dobptrapfftfilt, dobpfftfilt, dolpfiltfilt, dohpfiltfilt
 
 
 def spectralfilterprops(thefilter, debug=False):
@@ -181,8 +182,74 @@ def test_filterprops(display=False):
                      display=display)
 
 
+def test_arb_pass_batch(debug=False):
+    Fs = 1.0 / 0.72
+    tclen = 417
+    padlen = 41
+    lowerstop, lowerpass, upperpass, upperstop = 0.009, 0.01, 0.15, 0.2
+    np.random.seed(12345)
+    thedata = np.random.normal(size=(5, tclen))
+
+    # the cached real FFT filter must match the original complex FFT implementations
+    for i in range(thedata.shape[0]):
+        trapfilt = arb_pass(Fs, thedata[i, :], lowerstop, lowerpass, upperpass, upperstop, padlen=padlen)
+        trapref = dobptrapfftfilt(Fs, lowerstop, lowerpass, upperpass, upperstop, thedata[i, :], padlen=padlen)
+        brickfilt = arb_pass(Fs, thedata[i, :], lowerstop, lowerpass, upperpass, upperstop,
+                             usetrapfftfilt=False, padlen=padlen)
+        brickref = dobpfftfilt(Fs, lowerpass, upperpass, thedata[i, :], padlen=padlen)
+        butterfilt = arb_pass(Fs, thedata[i, :], lowerstop, lowerpass, upperpass, upperstop,
+                              usebutterworth=True, butterorder=3, padlen=padlen)
+        butterref = dohpfiltfilt(Fs, lowerpass, dolpfiltfilt(Fs, upperpass, thedata[i, :], 3, padlen=padlen),
+                                 3, padlen=padlen)
+        if debug:
+            print(i, np.max(np.fabs(trapfilt - trapref)), np.max(np.fabs(brickfilt - brickref)),
+                  np.max(np.fabs(butterfilt - butterref)))
+        assert np.allclose(trapfilt, trapref, atol=1e-10)
+        assert np.allclose(brickfilt, brickref, atol=1e-10)
+        assert np.allclose(butterfilt, butterref, atol=1e-10)
+
+    # filtering a block of timecourses along either axis must match filtering them one at a time
+    for filtertype in ['lfo', 'lfo_stop', 'resp', 'cardiac']:
+        for usebutterworth in [False, True]:
+            thefilter = noncausalfilter(filtertype=filtertype, usebutterworth=usebutterworth)
+            byrow = np.zeros_like(thedata)
+            for i in range(thedata.shape[0]):
+                byrow[i, :] = thefilter.apply(Fs, thedata[i, :])
+            assert np.allclose(thefilter.apply(Fs, thedata), byrow, atol=1e-10)
+            assert np.allclose(thefilter.apply(Fs, thedata.T, axis=0), byrow.T, atol=1e-10)
+
+    # only the most recently used filters are kept
+    for paddedlen in range(200, 200 + 2 * tide_filt.maxarbpassfilters):
+        tide_filt.getarbpassfilter(Fs, paddedlen, lowerstop, lowerpass, upperpass, upperstop)
+    assert len(tide_filt.arbpassfilters) == tide_filt.maxarbpassfilters
+    lastkey = list(tide_filt.arbpassfilters.keys())[-1]
+    tide_filt.getarbpassfilter(Fs, 200 + tide_filt.maxarbpassfilters, lowerstop, lowerpass, upperpass, upperstop)
+    assert list(tide_filt.arbpassfilters.keys())[-2] == lastkey
+    trapfilt = arb_pass(Fs, thedata[0, :], lowerstop, lowerpass, upperpass, upperstop, padlen=padlen)
+    assert np.allclose(trapfilt, dobptrapfftfilt(Fs, lowerstop, lowerpass, upperpass, upperstop, thedata[0, :],
+                                                 padlen=padlen), atol=1e-10)
+
+
+def test_ssmooth4d(debug=False):
+    np.random.seed(12345)
+    thedata = np.random.normal(size=(12, 13, 7, 10))
+    xsize, ysize, zsize, sigma = 2.0, 2.0, 3.0, 2.5
+    theref = 1.0 * thedata
+    for i in range(2, 8):
+        theref[:, :, :, i] = ssmooth(xsize, ysize, zsize, sigma, thedata[:, :, :, i])
+    for nprocs in [1, 3]:
+        filtereddata = 1.0 * thedata
+        ssmooth4d(xsize, ysize, zsize, sigma, filtereddata, startpoint=2, endpoint=7, nprocs=nprocs,
+                  showprogressbar=debug)
+        if debug:
+            print(nprocs, np.max(np.fabs(filtereddata - theref)))
+        assert np.allclose(filtereddata, theref, atol=1e-12)
+
+
 def main():
     test_filterprops(display=True)
+    test_arb_pass_batch(debug=True)
+    test_ssmooth4d(debug=True)
 
 
 if __name__ == '__main__':
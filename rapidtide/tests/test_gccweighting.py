@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import time
+
+import numpy as np
+
+import rapidtide.correlate as tide_corr
+import rapidtide.fftbackend as tide_fft
+
+
+def _directgcc(sig1, sig2, fftlen, weighting, threshfrac=0.1):
+    # the weighted correlation calculated the long way - one inverse transform for the unweighted maximum, and
+    # another for the weighted correlation
+    corrlen = len(sig1) + len(sig2) - 1
+    fft1 = np.fft.rfft(sig1, fftlen)
+    fft2 = np.fft.rfft(sig2[::-1], fftlen)
+    product = fft1 * fft2
+    if weighting == 'Liang':
+        denom = np.square(np.absolute(fft1) + np.absolute(fft2))
+    else:
+        denom = np.absolute(fft1) * np.absolute(fft2)
+    thresh = np.max(denom) * threshfrac
+    weighted = np.where(denom > thresh, product / np.where(denom > thresh, denom, 1.0), 0.0)
+    theorigmax = np.max(np.absolute(np.fft.irfft(product, fftlen)[:corrlen]))
+    thexcorr = np.fft.irfft(weighted, fftlen)[:corrlen]
+    return thexcorr * theorigmax / np.max(np.absolute(thexcorr))
+
+
+def test_gccweighting(debug=False):
+    np.random.seed(12345)
+    numvoxels = 20
+    inlen = 300
+    reference = np.random.normal(size=inlen)
+    block = np.random.normal(size=(numvoxels, inlen))
+    for i in range(numvoxels):
+        block[i, :] += np.roll(reference, i - numvoxels // 2)
+    corrlen = 2 * inlen - 1
+    fftlen = tide_fft.nextfastlen(corrlen)
+
+    for weighting in ['none', 'Liang', 'Eckart', 'PHAT']:
+        # single timecourses match the direct calculation, and the weighting name is case insensitive
+        for i in range(numvoxels):
+            thexcorr = tide_corr.fastcorrelate(block[i, :], reference, weighting=weighting)
+            if weighting == 'none':
+                np.testing.assert_allclose(thexcorr, np.correlate(block[i, :], reference, mode='full'), atol=1e-9)
+            else:
+                np.testing.assert_allclose(thexcorr, _directgcc(block[i, :], reference, fftlen, weighting),
+                                           atol=1e-9)
+                np.testing.assert_allclose(tide_corr.fastcorrelate(block[i, :], reference,
+                                                                   weighting=weighting.lower()),
+                                           thexcorr, atol=1e-12)
+
+        # a block of voxels gives the same answer as correlating them one at a time
+        blockxcorr = tide_corr.fastcorrelate(block, reference, weighting=weighting)
+        assert blockxcorr.shape == (numvoxels, corrlen)
+        for i in range(numvoxels):
+            np.testing.assert_allclose(blockxcorr[i, :],
+                                       tide_corr.fastcorrelate(block[i, :], reference, weighting=weighting),
+                                       atol=1e-12)
+
+        # the peak is where the reference was shifted to
+        np.testing.assert_array_equal(np.argmax(blockxcorr, axis=1) - (inlen - 1),
+                                      np.arange(numvoxels) - numvoxels // 2)
+
+        # reusing the reference spectrum and magnitude gives the same answer
+        refspectrum = tide_fft.rfft(reference[::-1], fftlen)
+        reusedxcorr = tide_corr.gcccorrelate(tide_fft.rfft(block, fftlen, axis=-1), refspectrum, fftlen, corrlen,
+                                             weighting=weighting, mag2=np.absolute(refspectrum))
+        np.testing.assert_allclose(reusedxcorr, blockxcorr, atol=1e-12)
+
+        if debug:
+            starttime = time.time()
+            for i in range(100):
+                tide_corr.gcccorrelate(tide_fft.rfft(block, fftlen, axis=-1), refspectrum, fftlen, corrlen,
+                                       weighting=weighting, mag2=np.absolute(refspectrum))
+            print(weighting, (time.time() - starttime) / (100 * numvoxels) * 1e6, 'microseconds per voxel')
+
+    # an all zero input gives an all zero result rather than nans
+    for weighting in ['none', 'PHAT']:
+        thexcorr = tide_corr.fastcorrelate(np.zeros(inlen), reference, weighting=weighting)
+        assert np.all(thexcorr == 0.0)
+
+    # complex inputs still work
+    complexsig = block[0, :] + 1j * block[1, :]
+    np.testing.assert_allclose(tide_corr.weightedfftconvolve(complexsig, reference[::-1]),
+                               np.convolve(complexsig, reference[::-1]), atol=1e-9)
+
+
+def main():
+    test_gccweighting(debug=True)
+
+
+if __name__ == '__main__':
+    main()
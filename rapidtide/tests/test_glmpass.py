@@ -171,8 +171,45 @@ def test_glmpass(debug=True, display=False):
     assert mse(datatoremove, targetarray) < 1e-3
     
 
+def test_linfitfrommoments(debug=False):
+    xsize = 150
+    tsize = 200
+    mean = 100.0
+
+    targetarray, xwaveforms, twaveforms = gen2d(xsize=xsize, xcycles=7, tsize=tsize, tcycles=23)
+    testarray = targetarray + np.random.random((xsize, tsize)) + mean
+    for procbyvoxel, theevs, numitems in [(True, twaveforms, xsize), (False, xwaveforms, tsize)]:
+        meanvals = np.zeros(numitems, dtype=np.float64)
+        rvals = np.zeros(numitems, dtype=np.float64)
+        r2vals = np.zeros(numitems, dtype=np.float64)
+        fitcoffs = np.zeros(numitems, dtype=np.float64)
+        fitNorm = np.zeros(numitems, dtype=np.float64)
+        tide_glmpass.glmpass(numitems, testarray, None, theevs,
+                             meanvals, rvals, r2vals, fitcoffs, fitNorm,
+                             0.0 * testarray,
+                             0.0 * testarray,
+                             showprogressbar=False,
+                             procbyvoxel=procbyvoxel,
+                             nprocs=1
+                             )
+
+        # moments from separate blocks of voxels should add up to the moments of the whole array
+        if procbyvoxel:
+            moments = tide_glmpass.linfitmoments(testarray, theevs, procbyvoxel=procbyvoxel)
+        else:
+            moments = [a + b for a, b in zip(
+                tide_glmpass.linfitmoments(testarray[:50, :], theevs[:50, :], procbyvoxel=procbyvoxel),
+                tide_glmpass.linfitmoments(testarray[50:, :], theevs[50:, :], procbyvoxel=procbyvoxel))]
+        for thevals, thefitvals in zip([meanvals, rvals, r2vals, fitcoffs, fitNorm],
+                                       tide_glmpass.linfitfrommoments(moments)):
+            if debug:
+                print(procbyvoxel, np.max(np.fabs(thevals - thefitvals)))
+            np.testing.assert_allclose(thevals, thefitvals, rtol=1e-6, atol=1e-8)
+
+
 def main():
     test_glmpass(debug=True, display=True)
+    test_linfitfrommoments(debug=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.miscmath as tide_math
+import rapidtide.workflows.rapidtideX as rapidtideX
+
+
+def makedata(numvoxels=1037, numtimepoints=120):
+    # voxels with different baselines and amounts of two shared signals, plus a few dark ones that the mask drops
+    np.random.seed(12345)
+    thesignal = np.sin(np.linspace(0.0, 12.0, numtimepoints))
+    theothersignal = np.cos(np.linspace(0.0, 31.0, numtimepoints))
+    thedata = np.random.uniform(500.0, 1500.0, size=(numvoxels, 1)) \
+        + np.random.uniform(5.0, 20.0, size=(numvoxels, 1)) * thesignal[None, :] \
+        + np.random.uniform(-15.0, 15.0, size=(numvoxels, 1)) * theothersignal[None, :] \
+        + np.random.normal(size=(numvoxels, numtimepoints))
+    thedata[::50, :] = np.random.normal(size=(len(thedata[::50, :]), numtimepoints))
+    return thedata
+
+
+def makeoptions(meanscaleglobal=True, globalsignalmethod='sum'):
+    return {'globalmaskmethod': 'mean',
+            'corrmaskthreshpct': 25.0,
+            'nothresh': False,
+            'meanscaleglobal': meanscaleglobal,
+            'globalsignalmethod': globalsignalmethod}
+
+
+def test_globalmean(debug=False):
+    rapidtideX.rt_floatset = np.float64
+    thedata = makedata()
+    numvoxels = thedata.shape[0]
+    includemask = np.ones(numvoxels, dtype=np.int16)
+    includemask[300:400] = 0
+    excludemask = np.zeros(numvoxels, dtype=np.int16)
+    excludemask[700:710] = 1
+
+    for meanscaleglobal in [False, True]:
+        optiondict = makeoptions(meanscaleglobal=meanscaleglobal)
+        results = []
+        for slabsize in [numvoxels, 100, 256, 1]:
+            results.append(rapidtideX.getglobalsignal(thedata, optiondict, includemask=includemask,
+                                                      excludemask=excludemask, slabsize=slabsize))
+        globalmean, themask = results[0]
+
+        # the mask leaves out the dark voxels and the masked ones
+        assert np.all(themask[::50] == 0)
+        assert np.all(themask[300:400] == 0)
+        assert np.all(themask[700:710] == 0)
+        assert np.sum(themask) > 0.8 * numvoxels
+
+        # add up the masked voxels one at a time.  Subtracting 1.0 from each mean scaled voxel only shifts the sum,
+        # so it makes no difference once the sum is normalized.
+        for offset in [0.0, 1.0]:
+            thesum = np.zeros(thedata.shape[1], dtype=np.float64)
+            for vox in range(numvoxels):
+                if themask[vox] > 0:
+                    if meanscaleglobal:
+                        thesum += thedata[vox, :] / np.mean(thedata[vox, :]) - offset
+                    else:
+                        thesum += thedata[vox, :]
+            if debug:
+                print('meanscaleglobal:', meanscaleglobal, 'offset:', offset,
+                      np.max(np.fabs(globalmean - tide_math.stdnormalize(thesum))))
+            np.testing.assert_allclose(globalmean, tide_math.stdnormalize(thesum), atol=1e-10)
+
+        # the slab size makes no difference, even when it does not divide the number of voxels
+        for theslabsignal, theslabmask in results[1:]:
+            np.testing.assert_allclose(theslabsignal, globalmean, atol=1e-10)
+            assert np.all(theslabmask == themask)
+
+
+def test_firstcomponent(debug=False):
+    rapidtideX.rt_floatset = np.float64
+    thedata = makedata()
+    numvoxels = thedata.shape[0]
+    themask = np.ones(numvoxels, dtype=np.int16)
+    themask[::7] = 0
+
+    for meanscaleglobal in [False, True]:
+        optiondict = makeoptions(meanscaleglobal=meanscaleglobal, globalsignalmethod='pca')
+
+        # the first right singular vector of the masked, demeaned data
+        therows = thedata[np.where(themask > 0)[0], :]
+        if meanscaleglobal:
+            therows = therows / np.mean(therows, axis=1, keepdims=True)
+        therows = therows - np.mean(therows, axis=1, keepdims=True)
+        u, s, vh = np.linalg.svd(therows, full_matrices=False)
+        thecomponent = vh[0, :]
+
+        for slabsize in [numvoxels, 100, 256]:
+            thevector = rapidtideX._firstcomponent(thedata, themask, optiondict, slabsize=slabsize)
+            if debug:
+                print('meanscaleglobal:', meanscaleglobal, 'slabsize:', slabsize,
+                      np.fabs(np.dot(thevector, thecomponent)))
+            np.testing.assert_allclose(np.linalg.norm(thevector), 1.0, atol=1e-10)
+            np.testing.assert_allclose(np.fabs(np.dot(thevector, thecomponent)), 1.0, atol=1e-8)
+
+    # as the global signal, it is signed to agree with the global mean
+    optiondict = makeoptions(globalsignalmethod='pca')
+    thepcasignal, dummy = rapidtideX.getglobalsignal(thedata, optiondict, slabsize=300)
+    optiondict['globalsignalmethod'] = 'sum'
+    globalmean, dummy = rapidtideX.getglobalsignal(thedata, optiondict, slabsize=300)
+    if debug:
+        print('pca vs mean:', np.corrcoef(thepcasignal, globalmean)[0, 1])
+    assert np.corrcoef(thepcasignal, globalmean)[0, 1] > 0.9
+
+
+def main():
+    test_globalmean(debug=True)
+    test_firstcomponent(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import rapidtide.lazyimport as tide_lazy
+
+# packages that are slow to import, and should only be loaded by the code paths that use them
+DEFERREDMODULES = ['scipy.stats', 'scipy.signal', 'matplotlib', 'numba', 'sklearn', 'statsmodels', 'pandas', 'keras',
+                   'memory_profiler', 'nibabel', 'pyqtgraph']
+
+# the modules that should import without loading any of them
+LIGHTMODULES = ['rapidtide.workflows.rapidtideX', 'rapidtide.correlate', 'rapidtide.corrfitx', 'rapidtide.corrpassx',
+                'rapidtide.filter', 'rapidtide.fit', 'rapidtide.helper_classes', 'rapidtide.io', 'rapidtide.refine',
+                'rapidtide.resample', 'rapidtide.stats', 'rapidtide.util']
+
+
+def importmodule(modulename, debug=False):
+    # import the module in a fresh interpreter, and return the modules that were loaded.  The import time is only
+    # reported, since it depends on the machine.
+    theprogram = ('import sys, ' + modulename + '\n' +
+                  'print(\' \'.join(sorted(sys.modules.keys())))\n')
+    theprocess = subprocess.run([sys.executable, '-X', 'importtime', '-c', theprogram],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert theprocess.returncode == 0
+    if debug:
+        for theline in theprocess.stderr.splitlines():
+            if theline.startswith('import time:'):
+                fields = theline.split('|')
+                if fields[2].strip() == modulename:
+                    print(modulename, 'took', float(fields[1]) / 1.0e6, 'seconds to import')
+    return theprocess.stdout.split()
+
+
+def test_lazyimport(debug=False):
+    # modules are not imported until they are used
+    thelazymodule = tide_lazy.lazymodule('json')
+    assert not thelazymodule.isloaded()
+    assert thelazymodule.loads('[1, 2]') == [1, 2]
+    assert thelazymodule.isloaded()
+
+    # names can be called, and their attributes used, like the real thing
+    thelazyname = tide_lazy.lazyname('numpy', 'linspace')
+    np.testing.assert_array_equal(thelazyname(0.0, 1.0, 3), np.array([0.0, 0.5, 1.0]))
+    thelazyname = tide_lazy.lazyname('os', 'path')
+    assert thelazyname.join('a', 'b') == os.path.join('a', 'b')
+
+    assert tide_lazy.moduleexists('numpy')
+    assert not tide_lazy.moduleexists('rapidtide_nonexistent_module')
+
+
+def test_importtime(debug=False):
+    for modulename in LIGHTMODULES:
+        loadedmodules = importmodule(modulename, debug=debug)
+        for themodule in DEFERREDMODULES:
+            isloaded = [theloaded for theloaded in loadedmodules
+                        if (theloaded == themodule) or theloaded.startswith(themodule + '.')]
+            if debug and isloaded:
+                print(modulename, 'loaded', themodule)
+            assert not isloaded
+
+
+def main():
+    test_lazyimport(debug=True)
+    test_importtime(debug=True)
+
+
+if __name__ == '__main__':
+    main()
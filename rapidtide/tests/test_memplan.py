@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import types
+
+import rapidtide.memplan as tide_memplan
+import rapidtide.multiproc as tide_multiproc
+
+
+def makeoptions():
+    return {'internalprecision': 'double',
+            'outputprecision': 'single',
+            'sharedmem': True,
+            'nprocs': 4,
+            'passes': 3,
+            'doglmfilt': True,
+            'saveglmfiltered': True,
+            'savelagregressors': True,
+            'savedatatoremove': True,
+            'limitoutput': False,
+            'gausssigma': 0.0,
+            'glmsourcefile': None,
+            'streamresults': False,
+            'outofcore': False,
+            'slabsize': 10000}
+
+
+# a 1mm dataset: 200 x 200 x 150 voxels, 600 timepoints, 80 lags
+THESIZE = (200 * 200 * 150, 600, 600, 80)
+
+
+def planmemory(optiondict, **kwargs):
+    return tide_memplan.planmemory(*THESIZE, optiondict=optiondict, **kwargs)
+
+
+def squared_consumer(inQ, outQ):
+    while True:
+        val = inQ.get()
+        if val is None:
+            break
+        outQ.put((val, val * val))
+
+
+def test_parsememsize(debug=False):
+    assert tide_memplan.parsememsize('1000') == 1000
+    assert tide_memplan.parsememsize('16G') == 16 * 1024 ** 3
+    assert tide_memplan.parsememsize('512mb') == 512 * 1024 ** 2
+    assert tide_memplan.parsememsize('1.5T') == int(1.5 * 1024 ** 4)
+    for badvalue in ['lots', '', '-2G']:
+        try:
+            tide_memplan.parsememsize(badvalue)
+        except ValueError:
+            pass
+        else:
+            assert False, badvalue + ' should not parse'
+    if debug:
+        print(tide_memplan.formatmemsize(tide_memplan.parsememsize('1.5G')))
+
+
+def test_planmemory(debug=False):
+    optiondict = makeoptions()
+    estimate = tide_memplan.estimatememory(*THESIZE, optiondict=optiondict)
+    if debug:
+        tide_memplan.printplan(estimate, None, [], True)
+    phasenames = [thephase[0] for thephase in estimate['phases']]
+    assert phasenames == ['read', 'correlation', 'glm', 'save']
+    assert estimate['peak'] == max([thephase[2] + thephase[3] for thephase in estimate['phases']])
+    assert estimate['sharedpeak'] > 0
+
+    # plenty of memory - nothing changes
+    fits, estimate, changes = planmemory(optiondict, memlimit=estimate['peak'], verbose=debug)
+    assert fits
+    assert changes == []
+    assert optiondict == makeoptions()
+
+    # a bit short - the cheapest change is enough
+    fits, estimate, changes = planmemory(optiondict, memlimit=estimate['peak'] - 1, verbose=debug)
+    assert fits
+    assert len(changes) == 1
+    assert optiondict['streamresults']
+    assert optiondict['internalprecision'] == 'double'
+
+    # much too small - running out of core, with smaller slabs, is enough
+    optiondict = makeoptions()
+    fits, estimate, changes = planmemory(optiondict, memlimit=50 * 1024 ** 2, verbose=debug)
+    assert fits
+    assert optiondict['outofcore']
+    assert optiondict['slabsize'] < makeoptions()['slabsize']
+    assert optiondict['savelagregressors']
+    assert estimate['mappedpeak'] > estimate['peak']
+
+    # far too small - everything is tried, and it still doesn't fit
+    optiondict = makeoptions()
+    fits, estimate, changes = planmemory(optiondict, memlimit=1024 ** 2, verbose=debug)
+    assert not fits
+    assert optiondict['slabsize'] >= tide_memplan.minslabsize
+    assert optiondict['internalprecision'] == 'single'
+    assert not optiondict['savelagregressors']
+    assert not optiondict['savedatatoremove']
+    assert changes[-1].startswith('do not save the optional 4D outputs')
+
+    # single precision halves the correlation and timecourse arrays
+    optiondict = makeoptions()
+    doubleestimate = tide_memplan.estimatememory(*THESIZE, optiondict=optiondict)
+    optiondict['internalprecision'] = 'single'
+    singleestimate = tide_memplan.estimatememory(*THESIZE, optiondict=optiondict)
+    assert singleestimate['peak'] < doubleestimate['peak']
+
+    # each extra probe adds one correlation array, not one more than that
+    optiondict = makeoptions()
+    optiondict['extraprobefiles'] = ['probe1.txt', 'probe2.txt']
+    probeestimate = tide_memplan.estimatememory(*THESIZE, optiondict=optiondict)
+    corrbytes = dict([thearray[:2] for thearray in doubleestimate['phases'][1][1]])['corrout']
+    assert dict([thearray[:2] for thearray in probeestimate['phases'][1][1]])['probecorrout'] == 2 * corrbytes
+    assert probeestimate['peak'] > doubleestimate['peak']
+
+    # with no budget, the plan is only reported
+    optiondict = makeoptions()
+    savedfunc = tide_memplan.availablememory
+    tide_memplan.availablememory = lambda: None
+    try:
+        fits, estimate, changes = planmemory(optiondict, verbose=debug)
+    finally:
+        tide_memplan.availablememory = savedfunc
+    assert fits
+    assert changes == []
+
+
+def test_streamresults(debug=False):
+    listout = tide_multiproc.run_multiproc(squared_consumer, (25, 10), None, nprocs=2, showprogressbar=False,
+                                           chunksize=10, stream=False)
+    assert isinstance(listout, list)
+
+    tide_multiproc.setstreamresults(True)
+    streamout = tide_multiproc.run_multiproc(squared_consumer, (25, 10), None, nprocs=2, showprogressbar=False,
+                                             chunksize=10)
+    tide_multiproc.setstreamresults(False)
+    assert isinstance(streamout, types.GeneratorType)
+    streamout = list(streamout)
+    if debug:
+        print(streamout)
+    assert sorted(streamout) == sorted(listout)
+    assert sorted(streamout) == [(i, i * i) for i in range(25)]
+
+
+def main():
+    test_parsememsize(debug=True)
+    test_planmemory(debug=True)
+    test_streamresults(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.corrpassx as tide_corrpass
+import rapidtide.filter as tide_filt
+import rapidtide.helper_classes as tide_classes
+
+
+def test_multicorrelator(debug=False):
+    np.random.seed(12345)
+    tr = 2.0
+    oversampfactor = 2
+    numpoints = 200
+    numvoxels = 30
+    numprobes = 3
+    lagmininpts = lagmaxinpts = 40
+    fmri_x = np.arange(0.0, numpoints) * tr
+    os_fmri_x = np.arange(0.0, numpoints * oversampfactor - (oversampfactor - 1)) * tr / oversampfactor
+    theprefilter = tide_filt.noncausalfilter('lfo')
+    fmridata = np.random.normal(size=(numvoxels, numpoints))
+    referencetcs = np.stack([theprefilter.apply(oversampfactor / tr, np.random.normal(size=len(os_fmri_x)))
+                             for i in range(numprobes)])
+
+    for weighting in ['none', 'PHAT']:
+        for coarsetofine in [False, True]:
+            # one probe at a time
+            singlecorrouts = []
+            singlemaxes = []
+            for theprobe in range(numprobes):
+                thecorrelator = tide_classes.correlator(Fs=oversampfactor / tr,
+                                                        ncprefilter=theprefilter,
+                                                        detrendorder=1,
+                                                        windowfunc='hamming',
+                                                        corrweighting=weighting)
+                corrout = np.zeros((numvoxels, lagmininpts + lagmaxinpts), dtype=np.float64)
+                meanval = np.zeros(numvoxels, dtype=np.float64)
+                dummy, theglobalmaxlist, dummy = tide_corrpass.correlationpass(fmridata,
+                                                                               referencetcs[theprobe, :],
+                                                                               thecorrelator,
+                                                                               fmri_x,
+                                                                               os_fmri_x,
+                                                                               0,
+                                                                               lagmininpts,
+                                                                               lagmaxinpts,
+                                                                               corrout,
+                                                                               meanval,
+                                                                               oversampfactor=oversampfactor,
+                                                                               coarsetofine=coarsetofine,
+                                                                               showprogressbar=False)
+                singlecorrouts.append(corrout)
+                singlemaxes.append(np.asarray(theglobalmaxlist))
+
+            # all probes at once
+            themulticorrelator = tide_classes.multicorrelator(Fs=oversampfactor / tr,
+                                                              ncprefilter=theprefilter,
+                                                              detrendorder=1,
+                                                              windowfunc='hamming',
+                                                              corrweighting=weighting)
+            multicorrout = np.zeros((numvoxels, numprobes, lagmininpts + lagmaxinpts), dtype=np.float64)
+            meanval = np.zeros(numvoxels, dtype=np.float64)
+            dummy, theglobalmaxlist, dummy = tide_corrpass.correlationpass(fmridata,
+                                                                           referencetcs,
+                                                                           themulticorrelator,
+                                                                           fmri_x,
+                                                                           os_fmri_x,
+                                                                           0,
+                                                                           lagmininpts,
+                                                                           lagmaxinpts,
+                                                                           multicorrout,
+                                                                           meanval,
+                                                                           oversampfactor=oversampfactor,
+                                                                           coarsetofine=coarsetofine,
+                                                                           showprogressbar=False)
+            theglobalmaxlist = np.asarray(theglobalmaxlist)
+            for theprobe in range(numprobes):
+                if debug:
+                    print(weighting, coarsetofine, theprobe,
+                          np.max(np.fabs(multicorrout[:, theprobe, :] - singlecorrouts[theprobe])))
+                np.testing.assert_allclose(multicorrout[:, theprobe, :], singlecorrouts[theprobe], atol=1e-12)
+                np.testing.assert_array_equal(theglobalmaxlist[:, theprobe], singlemaxes[theprobe])
+
+            # the first reference can go in its own array
+            maincorrout = np.zeros((numvoxels, lagmininpts + lagmaxinpts), dtype=np.float64)
+            probecorrout = np.zeros((numvoxels, numprobes - 1, lagmininpts + lagmaxinpts), dtype=np.float64)
+            tide_corrpass.correlationpass(fmridata, referencetcs, themulticorrelator, fmri_x, os_fmri_x, 0,
+                                          lagmininpts, lagmaxinpts, maincorrout, meanval,
+                                          oversampfactor=oversampfactor, coarsetofine=coarsetofine,
+                                          probecorrout=probecorrout, showprogressbar=False)
+            np.testing.assert_array_equal(maincorrout, multicorrout[:, 0, :])
+            np.testing.assert_array_equal(probecorrout, multicorrout[:, 1:, :])
+
+
+def main():
+    test_multicorrelator(debug=True)
+
+
+if __name__ == '__main__':
+    main()
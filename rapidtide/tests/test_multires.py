@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.corrpassx as tide_corrpass
+import rapidtide.filter as tide_filt
+import rapidtide.fit as tide_fit
+import rapidtide.resample as tide_resample
+from rapidtide.helper_classes import parcellator, correlation_fitter, correlator
+
+
+def test_parcellator(debug=False):
+    np.random.seed(12345)
+    spaceshape = (9, 10, 7)
+    factor = 2
+    numspatiallocs = int(np.prod(spaceshape))
+    validvoxels = np.where(np.random.uniform(size=numspatiallocs) > 0.3)[0]
+    thedata = np.random.normal(size=(len(validvoxels), 20))
+
+    theparcellator = parcellator(spaceshape, validvoxels, factor=factor)
+    parceldata = theparcellator.average(thedata)
+    if debug:
+        print(len(validvoxels), 'valid voxels in', theparcellator.numparcels, 'parcels')
+    assert parceldata.shape == (theparcellator.numparcels, 20)
+    assert np.sum(theparcellator.parcelsizes) == len(validvoxels)
+
+    # every parcel is the mean of the valid voxels in its block
+    thecoords = np.unravel_index(validvoxels, spaceshape)
+    blockid = [tuple(thecoords[j][i] // factor for j in range(3)) for i in range(len(validvoxels))]
+    for i in range(len(validvoxels)):
+        members = [k for k in range(len(validvoxels)) if blockid[k] == blockid[i]]
+        np.testing.assert_allclose(parceldata[theparcellator.parcelindex[i], :],
+                                   np.mean(thedata[members, :], axis=0))
+
+    # expanding gives each voxel its parcel's value
+    np.testing.assert_allclose(theparcellator.expand(parceldata[:, 0]),
+                               parceldata[theparcellator.parcelindex, 0])
+
+
+def test_windowedsearch(debug=False):
+    corrtimeaxis = np.linspace(-20.0, 20.0, 401)
+    thefitter = correlation_fitter(corrtimeaxis=corrtimeaxis, lagmin=-20.0, lagmax=20.0)
+    thefitter.setcorrtimeaxis(corrtimeaxis)
+
+    # a correlation function with a big peak at -8s and a smaller one at 6s
+    corrfunc = tide_fit.gauss_eval(corrtimeaxis, [0.8, -8.0, 1.5]) + tide_fit.gauss_eval(corrtimeaxis, [0.5, 6.0, 1.5])
+
+    thefitter.setguess(False)
+    maxindex, maxlag, maxval, maxsigma, maskval, failreason, peakstart, peakend = thefitter.fit(corrfunc + 0.0)
+    if debug:
+        print('full search:', maxlag, maxval)
+    assert np.fabs(maxlag + 8.0) < 0.1
+
+    # a narrowed search around a starting lag finds the nearby peak, even if the starting lag is off a bit
+    thefitter.setguess(True, maxguess=4.0, searchwidth=5.0)
+    maxindex, maxlag, maxval, maxsigma, maskval, failreason, peakstart, peakend = thefitter.fit(corrfunc + 0.0)
+    if debug:
+        print('narrowed search:', maxlag, maxval)
+    assert np.fabs(maxlag - 6.0) < 0.1
+    assert np.fabs(maxval - 0.5) < 0.01
+
+
+def test_windowedgepeaks(debug=False):
+    np.random.seed(12345)
+    tr = 2.0
+    oversampfactor = 4
+    numpoints = 300
+    numvoxels = 50
+    fmri_x = np.arange(0.0, numpoints) * tr
+    os_fmri_x = np.arange(0.0, numpoints * oversampfactor - (oversampfactor - 1)) * tr / oversampfactor
+
+    # delayed copies of a band limited signal
+    theprefilter = tide_filt.noncausalfilter('lfo')
+    fine_x = np.arange(0.0, 4 * numpoints * tr, 0.05)
+    fine_y = tide_resample.doresample(np.arange(0.0, 4 * numpoints) * tr,
+                                      theprefilter.apply(1.0 / tr, np.random.normal(size=4 * numpoints)),
+                                      fine_x)
+    delays = np.random.uniform(-8.0, 8.0, size=numvoxels)
+    fmridata = np.zeros((numvoxels, numpoints), dtype=np.float64)
+    for vox in range(numvoxels):
+        fmridata[vox, :] = np.interp(fmri_x + 100.0 + delays[vox], fine_x, fine_y) + \
+            0.3 * np.random.normal(size=numpoints)
+    referencetc = np.interp(os_fmri_x + 100.0, fine_x, fine_y)
+    lagmininpts = lagmaxinpts = int(15.0 / (tr / oversampfactor))
+    thecorrelator = correlator(Fs=oversampfactor / tr, ncprefilter=theprefilter, detrendorder=1,
+                               windowfunc='hamming')
+    corrout = np.zeros((numvoxels, lagmininpts + lagmaxinpts), dtype=np.float64)
+    meanval = np.zeros(numvoxels, dtype=np.float64)
+    dummy, dummy, thecorrscale = tide_corrpass.correlationpass(fmridata, referencetc, thecorrelator, fmri_x,
+                                                               os_fmri_x, 0, lagmininpts, lagmaxinpts, corrout,
+                                                               meanval, oversampfactor=oversampfactor,
+                                                               coarsetofine=True, showprogressbar=False)
+
+    # the correlation peaks at minus the delay.  The starting lags are off by up to a second, one voxel has none,
+    # and one is too far off.
+    truelags = -delays
+    initiallags = truelags + np.random.uniform(-1.0, 1.0, size=numvoxels)
+    initiallags[7] = -1000000.0
+    initiallags[11] = truelags[11] + 5.0
+    searchwidth = 3.0
+
+    # the windows cover searchwidth on each side of the starting lag, or the full range if there is none
+    lagwindows = tide_corrpass.makelagwindows(initiallags, thecorrscale, searchwidth)
+    windowlens = lagwindows[:, 1] - lagwindows[:, 0]
+    if debug:
+        print('lag points per voxel:', corrout.shape[1], 'full,', np.mean(windowlens), 'windowed')
+    assert windowlens[7] == corrout.shape[1]
+    assert np.all(np.delete(windowlens, 7) <= 2 * int(np.ceil(searchwidth / (tr / oversampfactor))) + 1)
+    for vox in range(numvoxels):
+        if vox != 11:
+            assert lagwindows[vox, 0] <= np.argmin(np.fabs(thecorrscale - truelags[vox])) < lagwindows[vox, 1]
+
+    # only the voxel whose starting lag is too far off peaks at the end of its window
+    atedge = tide_corrpass.windowedgepeaks(corrout, lagwindows)
+    if debug:
+        print('peaks at the window edge:', np.where(atedge)[0])
+    assert atedge[11]
+    assert np.sum(atedge) == 1
+
+    # the same as looking at each voxel in turn, for random windows (some empty, some at the ends of the range)
+    numlags = corrout.shape[1]
+    lagwindows = np.sort(np.random.randint(0, numlags + 1, size=(numvoxels, 2)), axis=1)
+    lagwindows[:5, 0] = 0
+    lagwindows[5:10, 1] = numlags
+    for bipolar in [False, True]:
+        atedge = tide_corrpass.windowedgepeaks(corrout, lagwindows, bipolar=bipolar)
+        for vox in range(numvoxels):
+            windowstart, windowend = lagwindows[vox]
+            if windowend <= windowstart:
+                assert not atedge[vox]
+                continue
+            thewindow = corrout[vox, windowstart:windowend]
+            maxloc = windowstart + np.argmax(np.fabs(thewindow) if bipolar else thewindow)
+            assert atedge[vox] == (((maxloc == windowstart) and (windowstart > 0))
+                                   or ((maxloc == windowend - 1) and (windowend < numlags)))
+
+
+def main():
+    test_parcellator(debug=True)
+    test_windowedsearch(debug=True)
+    test_windowedgepeaks(debug=True)
+
+
+if __name__ == '__main__':
+    main()
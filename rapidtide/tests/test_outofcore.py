@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import print_function, division
+
+import os
+
+import nibabel as nib
+import numpy as np
+
+import rapidtide.glmpass as tide_glmpass
+import rapidtide.io as tide_io
+import rapidtide.outofcore as tide_ooc
+import rapidtide.refine as tide_refine
+import rapidtide.stats as tide_stats
+from rapidtide.tests.utils import get_test_temp_path, create_dir
+
+
+def test_slabranges(debug=False):
+    theslabs = tide_ooc.slabranges(25, 10)
+    if debug:
+        print(theslabs)
+    assert theslabs == [(0, 10), (10, 20), (20, 25)]
+    assert tide_ooc.slabranges(10, 10) == [(0, 10)]
+    assert tide_ooc.slabranges(0, 10) == []
+
+
+def test_scratcharrays(debug=False):
+    thedata = np.random.normal(size=(1000, 30))
+    therows = np.where(thedata[:, 0] > 0.0)[0]
+
+    # without a scratch directory, these are ordinary arrays
+    assert not tide_ooc.isenabled()
+    assert not isinstance(tide_ooc.allocarray((10, 10), 'float64', 'test'), np.memmap)
+
+    scratchdir = os.path.join(get_test_temp_path(), 'scratch')
+    create_dir(get_test_temp_path())
+    tide_ooc.setscratchdir(scratchdir)
+    try:
+        assert tide_ooc.isenabled()
+        thecopy = tide_ooc.toscratch(thedata, 'testdata', rows=therows, slabsize=64)
+        assert isinstance(thecopy, np.memmap)
+        assert np.all(thecopy == thedata[therows, :])
+        singlecopy = tide_ooc.toscratch(thedata, 'singledata', thetype='float32', slabsize=64)
+        assert singlecopy.dtype == np.float32
+        assert np.allclose(singlecopy, thedata, atol=1e-6)
+        if debug:
+            print(os.listdir(scratchdir))
+        assert len(os.listdir(scratchdir)) == 2
+    finally:
+        tide_ooc.cleanup()
+    assert not os.path.exists(scratchdir)
+    assert not tide_ooc.isenabled()
+
+
+def test_readniftitoarray(debug=False):
+    thedata = np.random.normal(size=(6, 5, 4, 20))
+    create_dir(get_test_temp_path())
+    thefilename = os.path.join(get_test_temp_path(), 'ooctest')
+    tide_io.savetonifti(thedata, nib.Nifti1Image(thedata, np.eye(4)).header, thefilename)
+    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(thefilename)
+
+    # read a few timepoints at a time
+    theimage = tide_io.loadnifti(thefilename, keepopen=True)
+    outarray = np.zeros((6 * 5 * 4, 20), dtype=np.float64)
+    tide_ooc.readniftitoarray(theimage, outarray, blockbytes=6 * 5 * 4 * 8 * 3)
+    if debug:
+        print(np.max(np.fabs(outarray - nim_data.reshape((6 * 5 * 4, 20)))))
+    assert np.all(outarray == nim_data.reshape((6 * 5 * 4, 20)))
+
+
+def test_slabreductions(debug=False):
+    # the global reductions must not depend on the slab size
+    thedata = np.random.normal(loc=10.0, size=(1000, 30))
+    thedata[:200, :] = 0.0
+    thefracs = tide_stats.getfracvals(thedata, [0.5, 0.98])
+    assert tide_stats.getfracvals(thedata, [0.5, 0.98], slabsize=128) == thefracs
+
+    themask = tide_glmpass.makeglmmask(thedata, 5.0)
+    assert np.all(tide_glmpass.makeglmmask(thedata, 5.0, slabsize=128) == themask)
+    assert np.sum(themask) == 800
+
+    therows = np.where(thedata[:, 0] != 0.0)[0]
+    thesum = tide_refine._sumrows(thedata, therows)
+    slabsum = tide_refine._sumrows(thedata, therows, slabsize=128)
+    if debug:
+        print(np.max(np.fabs(thesum - slabsum)))
+    assert np.allclose(thesum, slabsum, rtol=1e-12)
+
+
+def main():
+    test_slabranges(debug=True)
+    test_scratcharrays(debug=True)
+    test_readniftitoarray(debug=True)
+    test_slabreductions(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+from scipy.stats import kurtosis, skew
+
+import rapidtide.stats as tide_stats
+
+
+def approximateentropy_ref(waveform, m, r):
+    # the original, direct implementation
+    def _maxdist(x_i, x_j):
+        return max([abs(ua - va) for ua, va in zip(x_i, x_j)])
+
+    def _phi(m):
+        x = [[waveform[j] for j in range(i, i + m - 1 + 1)] for i in range(N - m + 1)]
+        C = [len([1 for x_j in x if _maxdist(x_i, x_j) <= r]) / (N - m + 1.0) for x_i in x]
+        return (N - m + 1.0) ** (-1) * sum(np.log(C))
+
+    N = len(waveform)
+
+    return abs(_phi(m + 1) - _phi(m))
+
+
+def sampleentropy_ref(waveform, m, r):
+    N = len(waveform)
+
+    def _count(thelen):
+        x = np.array([waveform[i:i + thelen] for i in range(N - m)])
+        count = 0
+        for i in range(len(x)):
+            for j in range(len(x)):
+                if i != j and np.max(np.fabs(x[i] - x[j])) <= r:
+                    count += 1
+        return count
+
+    return -np.log(_count(m + 1) / _count(m))
+
+
+def makewaveform(numpoints=400, Fs=25.0):
+    np.random.seed(42)
+    timeaxis = np.arange(0.0, numpoints) / Fs
+    return np.sin(2.0 * np.pi * 1.1 * timeaxis) + 0.4 * np.sin(2.0 * np.pi * 2.2 * timeaxis) \
+           + 0.3 * np.random.randn(numpoints)
+
+
+def test_entropy(debug=False):
+    waveform = makewaveform(numpoints=150)
+    for r in [0.1, 0.2, 0.5]:
+        if debug:
+            print(r, approximateentropy_ref(waveform, 2, r), tide_stats.approximateentropy(waveform, 2, r))
+        np.testing.assert_almost_equal(tide_stats.approximateentropy(waveform, 2, r),
+                                       approximateentropy_ref(waveform, 2, r), 10)
+        np.testing.assert_almost_equal(tide_stats.sampleentropy(waveform, 2, r),
+                                       sampleentropy_ref(waveform, 2, r), 10)
+
+
+def test_windowedmetrics(debug=False):
+    waveform = makewaveform()
+    numpoints = len(waveform)
+    for windowpts in [25, 125]:
+        halfwidth = windowpts // 2
+        S_ref = np.zeros(numpoints, dtype=np.float64)
+        K_ref = np.zeros(numpoints, dtype=np.float64)
+        E_ref = np.zeros(numpoints, dtype=np.float64)
+        for i in range(numpoints):
+            startpt = np.max([0, i - halfwidth])
+            endpt = np.min([i + halfwidth, numpoints])
+            S_ref[i] = skew(waveform[startpt:endpt + 1], nan_policy='omit')
+            K_ref[i] = kurtosis(waveform[startpt:endpt + 1], fisher=False)
+            if windowpts < 50:
+                E_ref[i] = approximateentropy_ref(waveform[startpt:endpt + 1], 2,
+                                                  0.2 * np.std(waveform[startpt:endpt + 1]))
+        if debug:
+            print(windowpts, np.max(np.fabs(tide_stats.windowedskewness(waveform, windowpts) - S_ref)),
+                  np.max(np.fabs(tide_stats.windowedkurtosis(waveform, windowpts, fisher=False) - K_ref)))
+        np.testing.assert_allclose(tide_stats.windowedskewness(waveform, windowpts), S_ref, atol=1e-8)
+        np.testing.assert_allclose(tide_stats.windowedkurtosis(waveform, windowpts, fisher=False), K_ref, atol=1e-8)
+        if windowpts < 50:
+            np.testing.assert_allclose(tide_stats.windowedapproximateentropy(waveform, windowpts), E_ref, atol=1e-8)
+
+
+def main():
+    test_entropy(debug=True)
+    test_windowedmetrics(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import print_function, division
+
+import os
+import shutil
+
+import numpy as np
+
+import rapidtide.stagecache as tide_stagecache
+from rapidtide.tests.utils import get_test_temp_path, create_dir
+
+
+def test_stagekey(debug=False):
+    create_dir(get_test_temp_path())
+    thefilename = os.path.join(get_test_temp_path(), 'stagecacheinput.txt')
+    with open(thefilename, 'w') as thefile:
+        thefile.write('1.0\n2.0\n')
+    optiondict = {'lagmin': -10.0, 'despeckle_thresh': 5.0, 'nprocs': 1, 'outputname': 'a', 'in_file': thefilename}
+    theregressor = np.sin(np.linspace(0.0, 10.0, 100))
+
+    def thekey():
+        return tide_stagecache.stagekey('correlation', optiondict, ignore=tide_stagecache.correlationignore,
+                                        parents=['abc'], arrays=[theregressor],
+                                        filenames=[optiondict['in_file'], None])
+
+    basekey = thekey()
+    if debug:
+        print(basekey)
+
+    # ignored, runtime, and output options do not change the key
+    optiondict['despeckle_thresh'] = 3.0
+    optiondict['nprocs'] = 8
+    optiondict['outputname'] = 'b'
+    assert thekey() == basekey
+
+    # nor does the name of an input file, if the contents are the same
+    thecopyname = os.path.join(get_test_temp_path(), 'stagecacheinput_copy.txt')
+    shutil.copyfile(thefilename, thecopyname)
+    optiondict['in_file'] = thecopyname
+    assert thekey() == basekey
+    optiondict['in_file'] = thefilename
+
+    # the options the stage uses do
+    optiondict['lagmin'] = -5.0
+    assert thekey() != basekey
+    optiondict['lagmin'] = -10.0
+    assert thekey() == basekey
+
+    # and so do the input arrays and files
+    savedvalue = theregressor[10]
+    theregressor[10] = 2.0
+    assert thekey() != basekey
+    theregressor[10] = savedvalue
+    assert thekey() == basekey
+    with open(thefilename, 'w') as thefile:
+        thefile.write('1.0\n2.5\n')
+    assert thekey() != basekey
+
+    # a stage with a list of options only depends on those
+    optiondict['lagmin'] = -5.0
+    assert tide_stagecache.stagekey('voxels', optiondict, options=['despeckle_thresh']) == \
+        tide_stagecache.stagekey('voxels', dict(optiondict, lagmin=-1.0), options=['despeckle_thresh'])
+
+
+def test_saveandload(debug=False):
+    thecachedir = os.path.join(get_test_temp_path(), 'stagecache')
+    shutil.rmtree(thecachedir, ignore_errors=True)
+
+    # without a cache directory, nothing is saved
+    assert not tide_stagecache.isenabled()
+    tide_stagecache.save('abc', {'thearray': np.zeros(10)})
+    assert tide_stagecache.load('abc') is None
+
+    tide_stagecache.setcachedir(thecachedir, maxsize=2 ** 20)
+    try:
+        assert tide_stagecache.isenabled()
+        thedata = np.random.normal(size=(100, 50))
+        tide_stagecache.save('abc', {'thedata': thedata, 'thevalue': 3.5})
+        assert tide_stagecache.load('abd') is None
+        theresult = tide_stagecache.load('abc')
+        if debug:
+            print(sorted(theresult.keys()), tide_stagecache.cachesize())
+        assert np.all(theresult['thedata'] == thedata)
+        assert float(theresult['thevalue']) == 3.5
+        del theresult
+
+        # results larger than the size limit are not saved
+        tide_stagecache.save('toobig', {'thedata': np.zeros(2 ** 18)})
+        assert tide_stagecache.load('toobig') is None
+
+        # the least recently used results are removed first
+        for thekey in ['def', 'ghi']:
+            tide_stagecache.save(thekey, {'thedata': thedata})
+        for theage, thekey in enumerate(['ghi', 'abc', 'def']):
+            thetime = 1000000.0 + 1000.0 * theage
+            os.utime(os.path.join(thecachedir, thekey), (thetime, thetime))
+        assert tide_stagecache.evict(maxsize=2 * 40000 + 1000) == 1
+        assert tide_stagecache.load('ghi') is None
+        assert tide_stagecache.load('abc') is not None
+        assert tide_stagecache.load('def') is not None
+
+        # loading a result makes it the most recently used
+        os.utime(os.path.join(thecachedir, 'def'), (1000000.0, 1000000.0))
+        assert tide_stagecache.load('abc') is not None
+        assert tide_stagecache.evict(maxsize=40000 + 1000) == 1
+        assert tide_stagecache.load('def') is None
+        assert tide_stagecache.load('abc') is not None
+        assert tide_stagecache.cachesize() < 40000 + 1000
+    finally:
+        tide_stagecache.setcachedir(None)
+        shutil.rmtree(thecachedir, ignore_errors=True)
+
+
+def main():
+    test_stagekey(debug=True)
+    test_saveandload(debug=True)
+
+
+if __name__ == '__main__':
+    main()
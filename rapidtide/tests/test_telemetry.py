@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import json
+import os.path as op
+import time
+
+import numpy as np
+
+import rapidtide.multiproc as tide_multiproc
+import rapidtide.telemetry as tide_telemetry
+from rapidtide.tests.utils import get_test_temp_path, create_dir
+
+
+def test_spans(debug=False):
+    # nothing is recorded until telemetry is turned on
+    tide_telemetry.disable()
+    assert tide_telemetry.startspan('ignored') is None
+    tide_telemetry.endspan()
+
+    tide_telemetry.enable()
+    tide_telemetry.startspan('run', category='run')
+    for thepass in range(1, 3):
+        tide_telemetry.startspan('pass ' + str(thepass), category='pass')
+        with tide_telemetry.span('stage') as thestage:
+            time.sleep(0.01)
+            thestage.numitems = 100
+        tide_telemetry.endspan()
+    tide_telemetry.endspan()
+    tide_telemetry.disable()
+
+    thesummary = tide_telemetry.summary()
+    if debug:
+        tide_telemetry.proctelemetry()
+    thepaths = [thespan['path'] for thespan in thesummary['spans']]
+    assert thepaths == ['run', 'run/pass 1', 'run/pass 1/stage', 'run/pass 2', 'run/pass 2/stage']
+    for thespan in thesummary['spans']:
+        assert thespan['duration'] >= 0.0
+        assert thespan['maxrss'] > 0
+        if thespan['name'] == 'stage':
+            assert thespan['depth'] == 2
+            assert thespan['unit'] == 'voxels'
+            assert 0.0 < thespan['throughput'] <= 100 / 0.01
+
+
+def test_workers(debug=False):
+    def dummy_consumer(inQ, outQ):
+        while True:
+            val = inQ.get()
+            if val is None:
+                break
+            time.sleep(0.001)
+            outQ.put(val)
+
+    tide_telemetry.enable()
+    tide_telemetry.startspan('multithread stage')
+    data_out = tide_multiproc.run_multithread(dummy_consumer, (40, 10), None, nprocs=2, showprogressbar=False,
+                                              chunksize=15)
+    tide_telemetry.endspan(numitems=len(data_out), unit='voxels')
+    tide_telemetry.disable()
+    assert sorted(data_out) == list(range(40))
+
+    thesummary = tide_telemetry.summary()
+    thechunks = [thespan for thespan in thesummary['spans'] if thespan['category'] == 'chunk']
+    assert len(thechunks) == 3
+    assert np.sum([thechunk['numitems'] for thechunk in thechunks]) == 40
+    assert len(thesummary['workers']) == 2
+    assert np.sum([theworker['numitems'] for theworker in thesummary['workers']]) == 40
+    for theworker in thesummary['workers']:
+        if debug:
+            print(theworker)
+        assert theworker['path'].startswith('multithread stage/worker ')
+        assert 0.0 <= theworker['utilization'] <= 1.0
+
+    # check the output files
+    create_dir(get_test_temp_path())
+    jsonname = op.join(get_test_temp_path(), 'telemetrytest.json')
+    tracename = op.join(get_test_temp_path(), 'telemetrytest_trace.json')
+    tide_telemetry.writejson(jsonname)
+    tide_telemetry.writechrometrace(tracename)
+    with open(jsonname, 'r') as thefile:
+        thejson = json.load(thefile)
+    assert len(thejson['spans']) == len(thesummary['spans'])
+    with open(tracename, 'r') as thefile:
+        thetrace = json.load(thefile)
+    completeevents = [theevent for theevent in thetrace['traceEvents'] if theevent['ph'] == 'X']
+    assert len(completeevents) == len(thesummary['spans']) + len(thesummary['workers'])
+    for theevent in completeevents:
+        assert theevent['ts'] >= 0.0
+        assert theevent['dur'] >= 0.0
+
+
+def main():
+    test_spans(debug=True)
+    test_workers(debug=True)
+
+
+if __name__ == '__main__':
+    main()
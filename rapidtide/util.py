@@ -27,48 +27,25 @@ import sys
 import bisect
 import os
 import resource
-import matplotlib.pyplot as plt
 
+import rapidtide.lazyimport as tide_lazy
+import rapidtide.accel as tide_accel
+import rapidtide.fftbackend as tide_fft
 import rapidtide.io as tide_io
 
+plt = tide_lazy.lazymodule('matplotlib.pyplot')
+
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder = 6
 MAXLINES = 10000000
 donotbeaggressive = True
 
 # ----------------------------------------- Conditional imports ---------------------------------------
-try:
-    from memory_profiler import profile
-
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
-
-try:
-    from numba import jit
-
-    numbaexists = True
-except ImportError:
-    numbaexists = False
-numbaexists = False
-
-try:
-    import nibabel as nib
-
-    nibabelexists = True
-except ImportError:
-    nibabelexists = False
-
-donotusenumba = False
-
-try:
-    import pyfftw
+memprofilerexists = tide_lazy.moduleexists('memory_profiler')
+profile = tide_lazy.lazyname('memory_profiler', 'profile')
 
-    pyfftwexists = True
-    fftpack = pyfftw.interfaces.scipy_fftpack
-    pyfftw.interfaces.cache.enable()
-except ImportError:
-    pyfftwexists = False
+nibabelexists = tide_lazy.moduleexists('nibabel')
+nib = tide_lazy.lazymodule('nibabel')
 
 
 def checkimports(optiondict):
@@ -76,17 +53,15 @@ def checkimports(optiondict):
     optiondict['blas_opt'] = get_info('blas_opt')
     optiondict['lapack_opt'] = get_info('lapack_opt')
 
-    if pyfftwexists:
-        print('monkey patched scipy.fftpack to use pyfftw')
-    else:
-        print('using standard scipy.fftpack')
-    optiondict['pyfftwexists'] = pyfftwexists
+    print('using', tide_fft.getfftbackend(), 'for FFTs, with', tide_fft.getfftthreads(), 'thread(s) per transform')
+    optiondict['pyfftwexists'] = tide_fft.pyfftwexists
+    optiondict['fftbackend'] = tide_fft.getfftbackend()
 
-    if numbaexists:
+    if tide_accel.numbaexists:
         print('numba exists')
     else:
         print('numba does not exist')
-    optiondict['numbaexists'] = numbaexists
+    optiondict['numbaexists'] = tide_accel.numbaexists
 
     if memprofilerexists:
         print('memprofiler exists')
@@ -106,35 +81,15 @@ def checkimports(optiondict):
         print('aggressive optimization')
     optiondict['donotbeaggressive'] = donotbeaggressive
 
-    global donotusenumba
-    if donotusenumba:
+    if not tide_accel.accelenabled():
         print('will not use numba even if present')
     else:
         print('using numba if present')
-    optiondict['donotusenumba'] = donotusenumba
-
-
-def conditionaljit():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba:
-            return f
-        return jit(f, nopython=False)
-
-    return resdec
-
-
-def conditionaljit2():
-    def resdec(f):
-        if (not numbaexists) or donotusenumba or donotbeaggressive:
-            return f
-        return jit(f, nopython=False)
-
-    return resdec
+    optiondict['donotusenumba'] = not tide_accel.accelenabled()
 
 
 def disablenumba():
-    global donotusenumba
-    donotusenumba = True
+    tide_accel.disableaccel()
 
 
 # --------------------------- Utility functions -------------------------------------------------
@@ -22,10 +22,6 @@
 #
 from __future__ import print_function, division
 
-#import matplotlib
-#matplotlib.use('pdf')
-from matplotlib.pyplot import plot, scatter, show, figure
-
 import time
 import sys
 import os
@@ -46,10 +42,10 @@ import rapidtide.correlate as tide_corr
 import rapidtide.multiproc as tide_multiproc
 import rapidtide.glmpass as tide_glmpass
 import rapidtide.helper_classes as tide_classes
+import rapidtide.lazyimport as tide_lazy
 
 from scipy.signal import welch, savgol_filter
-from scipy.stats import kurtosis, skew
-from statsmodels.robust import mad
+from scipy.sparse import csr_matrix
 import copy
 
 import warnings
@@ -63,13 +59,19 @@ try:
 except ImportError:
     mklexists = False
 
-try:
-    import rapidtide.dlfilter as tide_dlfilt
-
-    dlfilterexists = True
+#import matplotlib
+#matplotlib.use('pdf')
+plot = tide_lazy.lazyname('matplotlib.pyplot', 'plot')
+scatter = tide_lazy.lazyname('matplotlib.pyplot', 'scatter')
+show = tide_lazy.lazyname('matplotlib.pyplot', 'show')
+figure = tide_lazy.lazyname('matplotlib.pyplot', 'figure')
+mad = tide_lazy.lazyname('statsmodels.robust', 'mad')
+
+# the deep learning filter (and keras) is only imported if it is used
+dlfilterexists = tide_lazy.moduleexists('keras')
+if dlfilterexists:
     print('dlfilter exists')
-except ImportError:
-    dlfilterexists = False
+else:
     print('dlfilter does not exist')
 
 
@@ -249,42 +251,41 @@ def physiofromimage(normdata_byslice,
 
     # make slice means
     print('making slice means...')
-    hirestc = np.zeros((timepoints * numsteps), dtype=np.float64)
-    cycleaverage = np.zeros((numsteps), dtype=np.float64)
-    sliceavs = np.zeros((numslices, timepoints), dtype=np.float64)
-    slicenorms = np.zeros((numslices), dtype=np.float64)
     if not verbose:
         print('averaging slices...')
     if fliparteries:
         thismask_byslice = appflips_byslice.astype(np.int64) * mask_byslice
     else:
         thismask_byslice = mask_byslice
-    for theslice in range(numslices):
-        if verbose:
-            print('averaging slice', theslice)
-        if usemask:
-            validvoxels = np.where(np.abs(thismask_byslice[:, theslice]) > 0)[0]
-        else:
-            validvoxels = np.where(np.abs(thismask_byslice[:, theslice] >= 0))[0]
-        if len(validvoxels) > 0:
-            if madnorm:
-                sliceavs[theslice, :], slicenorms[theslice] = tide_math.madnormalize(np.mean(
-                    normdata_byslice[validvoxels, theslice, :] * thismask_byslice[validvoxels, theslice, np.newaxis],
-                    axis=0), returnnormfac=True)
-            else:
-                sliceavs[theslice, :] = np.mean(
-                    normdata_byslice[validvoxels, theslice, :] * thismask_byslice[validvoxels, theslice, np.newaxis],
-                    axis=0)
-                slicenorms[theslice] = 1.0
-            for t in range(timepoints):
-                hirestc[numsteps * t + sliceoffsets[theslice]] += sliceavs[theslice, t]
-    for i in range(numsteps):
-        cycleaverage[i] = np.mean(hirestc[i:-1:numsteps])
-    for t in range(len(hirestc)):
-        if multiplicative:
-            hirestc[t] /= (cycleaverage[t % numsteps] + 1.0)
-        else:
-            hirestc[t] -= cycleaverage[t % numsteps]
+    if usemask:
+        validweights = np.where(np.abs(thismask_byslice) > 0, 1.0, 0.0)
+    else:
+        validweights = np.where(thismask_byslice >= 0, 1.0, 0.0)
+    numvalid = np.sum(validweights, axis=0)
+    validslices = np.where(numvalid > 0)[0]
+    sliceavs = np.zeros((numslices, timepoints), dtype=np.float64)
+    slicenorms = np.zeros((numslices), dtype=np.float64)
+    sliceavs[validslices, :] = np.einsum('vs,vst->st',
+                                         validweights[:, validslices] * thismask_byslice[:, validslices],
+                                         normdata_byslice[:, validslices, :]) / numvalid[validslices, None]
+    if madnorm:
+        sliceavs[validslices, :] -= np.median(sliceavs[validslices, :], axis=1)[:, None]
+        slicenorms[validslices] = mad(sliceavs[validslices, :], axis=1)
+        scaledslices = validslices[np.where(slicenorms[validslices] > 0.0)[0]]
+        sliceavs[scaledslices, :] /= slicenorms[scaledslices, None]
+    else:
+        slicenorms[validslices] = 1.0
+
+    # interleave the slice averages into a timecourse at the slice sample rate, then remove the average
+    # signal variation over each TR
+    hirestc = np.zeros((timepoints * numsteps), dtype=np.float64)
+    hirestc_bystep = hirestc.reshape((timepoints, numsteps))
+    np.add.at(hirestc_bystep, (slice(None), sliceoffsets[validslices]), sliceavs[validslices, :].T)
+    cycleaverage = np.mean(hirestc_bystep, axis=0)
+    if multiplicative:
+        hirestc_bystep /= (cycleaverage[None, :] + 1.0)
+    else:
+        hirestc_bystep -= cycleaverage[None, :]
     if not verbose:
         print('done')
     slicesamplerate = 1.0 * numsteps / tr
@@ -356,20 +357,20 @@ def getcardcoeffs(cardiacwaveform, slicesamplerate, minhr=40.0, maxhr=140.0, smo
     return peakfreq
 
 
-def normalizevoxels(fmri_data, detrendorder, validvoxels, time, timings, showprogressbar=False):
+def normalizevoxels(fmri_data, detrendorder, validvoxels, time, timings, showprogressbar=False, slabsize=10000):
     print('normalizing voxels...')
     normdata = fmri_data * 0.0
     demeandata = fmri_data * 0.0
     starttime = time.time()
     # detrend if we are going to
     numspatiallocs = fmri_data.shape[0]
-    reportstep = int(numspatiallocs // 100)
     if detrendorder > 0:
         print('detrending to order', detrendorder, '...')
-        for idx, thevox in enumerate(validvoxels):
-            if ((idx % reportstep == 0) or (idx == len(validvoxels) - 1)) and showprogressbar:
-                tide_util.progressbar(idx + 1, len(validvoxels), label='Percent complete')
-            fmri_data[thevox, :] = tide_fit.detrend(fmri_data[thevox, :], order=detrendorder, demean=False)
+        for slabstart in range(0, len(validvoxels), slabsize):
+            slabvoxels = validvoxels[slabstart:slabstart + slabsize]
+            if showprogressbar:
+                tide_util.progressbar(slabstart + len(slabvoxels), len(validvoxels), label='Percent complete')
+            fmri_data[slabvoxels, :] = tide_fit.detrend(fmri_data[slabvoxels, :], order=detrendorder, demean=False)
         timings.append(['Detrending finished', time.time(), numspatiallocs, 'voxels'])
         print(' done')
 
@@ -475,20 +476,6 @@ def findbadpts(thewaveform, nameroot, outputroot, samplerate, infodict,
     return thebadpts
 
 
-def approximateentropy(waveform, m, r):
-    def _maxdist(x_i, x_j):
-        return max([abs(ua - va) for ua, va in zip(x_i, x_j)])
-
-    def _phi(m):
-        x = [[waveform[j] for j in range(i, i + m - 1 + 1)] for i in range(N - m + 1)]
-        C = [len([1 for x_j in x if _maxdist(x_i, x_j) <= r]) / (N - m + 1.0) for x_i in x]
-        return (N - m + 1.0) ** (-1) * sum(np.log(C))
-
-    N = len(waveform)
-
-    return abs(_phi(m + 1) - _phi(m))
-
-
 def entropy(waveform):
     return -np.sum(np.square(waveform) * np.nan_to_num(np.log2(np.square(waveform))))
 
@@ -545,34 +532,18 @@ def calcplethquality(waveform, Fs, infodict, suffix, outputroot, S_windowsecs=5.
     # calculate S_sqi and K_sqi over a sliding window.  Window size should be an odd number of points.
     S_windowpts = int(np.round(S_windowsecs * Fs, 0))
     S_windowpts += 1 - S_windowpts % 2
-    S_waveform = dt_waveform * 0.0
     K_windowpts = int(np.round(K_windowsecs * Fs, 0))
     K_windowpts += 1 - K_windowpts % 2
-    K_waveform = dt_waveform * 0.0
     E_windowpts = int(np.round(E_windowsecs * Fs, 0))
     E_windowpts += 1 - E_windowpts % 2
-    E_waveform = dt_waveform * 0.0
 
     if debug:
         print('S_windowsecs, S_windowpts:', S_windowsecs, S_windowpts)
         print('K_windowsecs, K_windowpts:', K_windowsecs, K_windowpts)
         print('E_windowsecs, E_windowpts:', E_windowsecs, E_windowpts)
-    for i in range(0, len(dt_waveform)):
-        startpt = np.max([0, i - S_windowpts // 2])
-        endpt = np.min([i + S_windowpts // 2, len(dt_waveform)])
-        S_waveform[i] = skew(dt_waveform[startpt:endpt + 1], nan_policy='omit')
-
-        startpt = np.max([0, i - K_windowpts // 2])
-        endpt = np.min([i + K_windowpts // 2, len(dt_waveform)])
-        K_waveform[i] = kurtosis(dt_waveform[startpt:endpt + 1], fisher=False)
-
-        startpt = np.max([0, i - E_windowpts // 2])
-        endpt = np.min([i + E_windowpts // 2, len(dt_waveform)])
-        # E_waveform[i] = entropy(dt_waveform[startpt:endpt + 1])
-        r = 0.2 * np.std(dt_waveform[startpt:endpt + 1])
-        E_waveform[i] = approximateentropy(dt_waveform[startpt:endpt + 1], 2, r)
-        if debug:
-            print(i, startpt, endpt, endpt - startpt + 1, S_waveform[i], K_waveform[i], E_waveform[i])
+    S_waveform = tide_stats.windowedskewness(dt_waveform, S_windowpts)
+    K_waveform = tide_stats.windowedkurtosis(dt_waveform, K_windowpts, fisher=False)
+    E_waveform = tide_stats.windowedapproximateentropy(dt_waveform, E_windowpts, m=2, rfac=0.2)
 
     S_sqi_mean = np.mean(S_waveform)
     S_sqi_std = np.std(S_waveform)
@@ -740,19 +711,16 @@ def cardiaccycleaverage(sourcephases,
                         gridkernel,
                         centric,
                         cyclic=True):
-    rawapp_bypoint = np.zeros(len(destinationphases), dtype=np.float64)
-    weight_bypoint = np.zeros(len(destinationphases), dtype=np.float64)
-    for t in procpoints:
-        thevals, theweights, theindices = tide_resample.congrid(destinationphases,
-                                                                tide_math.phasemod(sourcephases[t],
-                                                                                   centric=centric),
-                                                                1.0,
-                                                                congridbins,
-                                                                kernel=gridkernel,
-                                                                cyclic=cyclic)
-        for i in range(len(theindices)):
-            weight_bypoint[theindices[i]] += theweights[i]
-            rawapp_bypoint[theindices[i]] += theweights[i] * waveform[t]
+    procpoints = np.asarray(procpoints, dtype=int)
+    thevals, theweights, theindices = tide_resample.congrid_batch(destinationphases,
+                                                                  tide_math.phasemod(sourcephases[procpoints],
+                                                                                     centric=centric),
+                                                                  waveform[procpoints],
+                                                                  congridbins,
+                                                                  kernel=gridkernel,
+                                                                  cyclic=cyclic)
+    weight_bypoint = np.bincount(theindices.ravel(), weights=theweights.ravel(), minlength=len(destinationphases))
+    rawapp_bypoint = np.bincount(theindices.ravel(), weights=thevals.ravel(), minlength=len(destinationphases))
     rawapp_bypoint = np.where(weight_bypoint > np.max(weight_bypoint) / 50.0,
                                                       np.nan_to_num(rawapp_bypoint / weight_bypoint),
                                                       0.0)
@@ -763,9 +731,61 @@ def cardiaccycleaverage(sourcephases,
     return rawapp_bypoint
 
 
+def phaseprojectslice(theslice,
+                      validlocs,
+                      phasevals,
+                      outphases,
+                      proctrs,
+                      demeandata_byslice,
+                      fmri_data_byslice,
+                      weight_byslice,
+                      rawapp_byslice,
+                      cine_byslice,
+                      congridbins,
+                      gridkernel):
+    # the gridding weights depend only on the slice phases, so build them once as a sparse
+    # (timepoint x phase bin) matrix and project all of the voxels in the slice with one matrix product
+    if len(validlocs) == 0:
+        rawapp_byslice[:, theslice, :] = 0.0
+        cine_byslice[:, theslice, :] = 0.0
+        return theslice
+    proctrs = np.asarray(proctrs, dtype=int)
+    destpoints = len(outphases)
+    thevals, theweights, theindices = tide_resample.congrid_batch(outphases,
+                                                                  phasevals[theslice, proctrs],
+                                                                  1.0,
+                                                                  congridbins,
+                                                                  kernel=gridkernel,
+                                                                  cyclic=True)
+    projmatrix = csr_matrix((theweights.ravel(),
+                             (np.repeat(np.arange(len(proctrs)), theweights.shape[1]),
+                              theindices.ravel())),
+                            shape=(len(proctrs), destpoints))
+    binweights = np.asarray(projmatrix.sum(axis=0)).ravel()
+    binweights[np.where(binweights == 0.0)] = 1.0
+    weight_byslice[validlocs, theslice, :] = binweights[None, :]
+    rawapp_byslice[validlocs, theslice, :] = \
+        np.nan_to_num((projmatrix.T @ -demeandata_byslice[validlocs, theslice, :][:, proctrs].T).T
+                      / binweights[None, :])
+    cine_byslice[validlocs, theslice, :] = \
+        np.nan_to_num((projmatrix.T @ fmri_data_byslice[validlocs, theslice, :][:, proctrs].T).T
+                      / binweights[None, :])
+    return theslice
+
+
+def cardiacnoisefromapp(thelocs, rawapp2d, projmask2d, phaseindices_byslicetime, numslices):
+    # look up the projected waveform value at every timepoint's phase bin for a block of voxels
+    theslices = thelocs % numslices
+    cardiacnoise = rawapp2d[thelocs[:, None], phaseindices_byslicetime[theslices, :]]
+    cardiacnoise[np.where(projmask2d[thelocs] <= 0)[0], :] = 0.0
+    return cardiacnoise
+
+
 def circularderivs(timecourse):
-    firstderiv = np.diff(timecourse, append=[timecourse[0]])
-    return np.max(firstderiv), np.argmax(firstderiv), np.min(firstderiv), np.argmin(firstderiv)
+    # works on a single timecourse or on a block of timecourses along the last axis
+    firstderiv = np.diff(timecourse, axis=-1, append=timecourse[..., :1])
+    return np.max(firstderiv, axis=-1), np.argmax(firstderiv, axis=-1), \
+           np.min(firstderiv, axis=-1), np.argmin(firstderiv, axis=-1)
 
 
 def findphasecuts(phases):
@@ -812,6 +832,7 @@ def happy_main(thearguments):
     mklthreads = 1
     spatialglmdenoise = True
     savecardiacnoise = True
+    glmslabsize = 10000
     forcedhr = None
     usemaskcardfromfmri = True
     censorbadpts = True
@@ -1429,6 +1450,7 @@ def happy_main(thearguments):
                 if mpfix:
                     print('performing super dangerous openmp workaround')
                     os.environ['KMP_DUPLICATE_LIB_OK'] = "TRUE"
+                import rapidtide.dlfilter as tide_dlfilt
                 modelpath = os.path.join(os.path.split(os.path.split(os.path.split(__file__)[0])[0])[0], 'rapidtide',
                                          'data',
                                          'models')
@@ -1794,63 +1816,88 @@ def happy_main(thearguments):
 
         # now project the data
         fmri_data_byslice = input_data.byslice()
+        if nprocs > 1:
+            # the sparse products release the GIL, so slices can be projected in threads sharing the output arrays
+            def phaseproject_consumer(inQ, outQ):
+                while True:
+                    try:
+                        # get a new message
+                        val = inQ.get()
+
+                        # this is the 'TERM' signal
+                        if val is None:
+                            break
+
+                        # process and send the data
+                        outQ.put(phaseprojectslice(val,
+                                                   np.where(projmask_byslice[:, val] > 0)[0],
+                                                   phasevals,
+                                                   outphases,
+                                                   proctrs,
+                                                   demeandata_byslice,
+                                                   fmri_data_byslice,
+                                                   weight_byslice,
+                                                   rawapp_byslice,
+                                                   cine_byslice,
+                                                   congridbins,
+                                                   gridkernel))
+                    except Exception as e:
+                        print("error!", e)
+                        break
+
+            tide_multiproc.run_multithread(phaseproject_consumer,
+                                           (numslices, timepoints),
+                                           None,
+                                           nprocs=nprocs,
+                                           showprogressbar=showprogressbar,
+                                           chunksize=numslices)
+        else:
+            for theslice in range(numslices):
+                if showprogressbar:
+                    tide_util.progressbar(theslice + 1, numslices, label='Percent complete')
+                if verbose:
+                    print('phase projecting for slice', theslice)
+                phaseprojectslice(theslice,
+                                  np.where(projmask_byslice[:, theslice] > 0)[0],
+                                  phasevals,
+                                  outphases,
+                                  proctrs,
+                                  demeandata_byslice,
+                                  fmri_data_byslice,
+                                  weight_byslice,
+                                  rawapp_byslice,
+                                  cine_byslice,
+                                  congridbins,
+                                  gridkernel)
         for theslice in range(numslices):
-            if showprogressbar:
-                tide_util.progressbar(theslice + 1, numslices, label='Percent complete')
-            if verbose:
-                print('phase projecting for slice', theslice)
             validlocs = np.where(projmask_byslice[:, theslice] > 0)[0]
-            #indexlist = range(0, len(phasevals[theslice, :]))
-            if len(validlocs) > 0:
-                for t in proctrs:
-                    filteredmr = -demeandata_byslice[validlocs, theslice, t]
-                    cinemr = fmri_data_byslice[validlocs, theslice, t]
-                    thevals, theweights, theindices = tide_resample.congrid(outphases,
-                                                                            phasevals[theslice, t],
-                                                                            1.0,
-                                                                            congridbins,
-                                                                            kernel=gridkernel,
-                                                                            cyclic=True)
-                    for i in range(len(theindices)):
-                        weight_byslice[validlocs, theslice, theindices[i]] += theweights[i]
-                        rawapp_byslice[validlocs, theslice, theindices[i]] += theweights[i] * filteredmr
-                        cine_byslice[validlocs, theslice, theindices[i]] += theweights[i] * cinemr
-                for d in range(destpoints):
-                    if weight_byslice[validlocs[0], theslice, d] == 0.0:
-                        weight_byslice[validlocs, theslice, d] = 1.0
-                rawapp_byslice[validlocs, theslice, :] = \
-                    np.nan_to_num(rawapp_byslice[validlocs, theslice, :] / weight_byslice[validlocs, theslice, :])
-                cine_byslice[validlocs, theslice, :] = \
-                    np.nan_to_num(cine_byslice[validlocs, theslice, :] / weight_byslice[validlocs, theslice, :])
-            else:
-                rawapp_byslice[:, theslice, :] = 0.0
-                cine_byslice[:, theslice, :] = 0.0
 
             # smooth the projected data along the time dimension
-            if smoothapp:
-                for loc in validlocs:
-                    rawapp_byslice[loc, theslice, :] = appsmoothingfilter.apply(phaseFs, rawapp_byslice[loc, theslice, :])
-                    derivatives_byslice[loc, theslice, :] = circularderivs(rawapp_byslice[loc, theslice, :])
+            if smoothapp and len(validlocs) > 0:
+                rawapp_byslice[validlocs, theslice, :] = appsmoothingfilter.apply(phaseFs,
+                                                                                  rawapp_byslice[validlocs, theslice, :])
+                derivatives_byslice[validlocs, theslice, :] = np.stack(
+                    circularderivs(rawapp_byslice[validlocs, theslice, :]), axis=-1)
             appflips_byslice = np.where(-derivatives_byslice[:, :, 2] > derivatives_byslice[:, :, 0], -1.0, 1.0)
             timecoursemean = np.mean(rawapp_byslice[validlocs, theslice, :], axis=1).reshape((-1, 1))
             if fliparteries:
                 corrected_rawapp_byslice[validlocs, theslice, :] = (rawapp_byslice[validlocs, theslice, :] - timecoursemean) \
                                                                   * appflips_byslice[validlocs, theslice, None] + timecoursemean
                 if doaliasedcorrelation and (thispass == numpasses - 1):
-                    for theloc in validlocs:
-                        thecorrfunc_byslice[theloc, theslice, :] = thecorrelator.apply(
-                            -appflips_byslice[theloc, theslice] * demeandata_byslice[theloc, theslice, :], -thetimes[theslice][0])
-                        maxloc = np.argmax(thecorrfunc_byslice[theloc, theslice, :])
-                        wavedelay_byslice[theloc, theslice] = corrsearchvals[maxloc]
-                        waveamp_byslice[theloc, theslice] = thecorrfunc_byslice[theloc, theslice, maxloc]
+                    thecorrfunc_byslice[validlocs, theslice, :] = thecorrelator.apply_batch(
+                        -appflips_byslice[validlocs, theslice, None] * demeandata_byslice[validlocs, theslice, :],
+                        -thetimes[theslice][0])
+                    maxlocs = np.argmax(thecorrfunc_byslice[validlocs, theslice, :], axis=1)
+                    wavedelay_byslice[validlocs, theslice] = corrsearchvals[maxlocs]
+                    waveamp_byslice[validlocs, theslice] = thecorrfunc_byslice[validlocs, theslice, maxlocs]
             else:
                 corrected_rawapp_byslice[validlocs, theslice, :] = rawapp_byslice[validlocs, theslice, :]
                 if doaliasedcorrelation and (thispass == numpasses - 1):
-                    for theloc in validlocs:
-                        thecorrfunc_byslice[theloc, theslice, :] = thecorrelator.apply(-demeandata_byslice[theloc,theslice, :], -thetimes[theslice][0])
-                        maxloc = np.argmax(np.abs(thecorrfunc_byslice[theloc, theslice, :]))
-                        wavedelay_byslice[theloc, theslice] = corrsearchvals[maxloc]
-                        waveamp_byslice[theloc, theslice] = thecorrfunc_byslice[theloc, theslice, maxloc]
+                    thecorrfunc_byslice[validlocs, theslice, :] = thecorrelator.apply_batch(
+                        -demeandata_byslice[validlocs, theslice, :], -thetimes[theslice][0])
+                    maxlocs = np.argmax(np.abs(thecorrfunc_byslice[validlocs, theslice, :]), axis=1)
+                    wavedelay_byslice[validlocs, theslice] = corrsearchvals[maxlocs]
+                    waveamp_byslice[validlocs, theslice] = thecorrfunc_byslice[validlocs, theslice, maxlocs]
             timecoursemin = np.min(corrected_rawapp_byslice[validlocs, theslice, :], axis=1).reshape((-1, 1))
             app_byslice[validlocs, theslice, :] = corrected_rawapp_byslice[validlocs, theslice, :] - timecoursemin
             normapp_byslice[validlocs, theslice, :] = np.nan_to_num(app_byslice[validlocs, theslice, :] / means_byslice[validlocs, theslice, None])
@@ -1957,60 +2004,62 @@ def happy_main(thearguments):
         timings.append(['Cardiac signal regression started', time.time(), None, None])
         tide_util.logmem('before cardiac regression', file=memfile)
         print('generating cardiac regressors')
-        cardiacnoise = fmri_data * 0.0
-        cardiacnoise_byslice = cardiacnoise.reshape((xsize * ysize, numslices, timepoints))
-        phaseindices = (cardiacnoise * 0.0).astype(np.int16)
-        phaseindices_byslice = phaseindices.reshape((xsize * ysize, numslices, timepoints))
-        for theslice in range(numslices):
-            print('calculating cardiac noise for slice', theslice)
-            validlocs = np.where(projmask_byslice[:, theslice] > 0)[0]
-            for t in range(timepoints):
-                phaseindices_byslice[validlocs, theslice, t] = \
-                    tide_util.valtoindex(outphases, phasevals[theslice, t])
-                cardiacnoise_byslice[validlocs, theslice, t] = \
-                    rawapp_byslice[validlocs, theslice, phaseindices_byslice[validlocs, theslice, t]]
-        theheader = copy.deepcopy(nim_hdr)
-        timings.append(['Cardiac signal generated', time.time(), None, None])
+        # every voxel in a slice shares the same phase at each timepoint, so the phase bin indices are per slice
+        phaseindices_byslicetime = np.round((np.clip(phasevals, outphases[0], outphases[-1]) - outphases[0])
+                                            / phasestep, 0).astype(np.int16)
+        rawapp2d = rawapp.reshape((numspatiallocs, destpoints))
+        projmask2d = projmask_byslice.reshape(numspatiallocs)
         if savecardiacnoise:
+            cardiacnoise = fmri_data * 0.0
+            phaseindices = np.zeros((numspatiallocs, timepoints), dtype=np.int16)
+            for slabstart in range(0, numspatiallocs, glmslabsize):
+                slablocs = np.arange(slabstart, np.min([slabstart + glmslabsize, numspatiallocs]))
+                cardiacnoise[slablocs, :] = cardiacnoisefromapp(slablocs, rawapp2d, projmask2d,
+                                                                phaseindices_byslicetime, numslices)
+                phaseindices[slablocs, :] = np.where(projmask2d[slablocs, None] > 0,
+                                                     phaseindices_byslicetime[slablocs % numslices, :], 0)
+            theheader = copy.deepcopy(nim_hdr)
             tide_io.savetonifti(cardiacnoise.reshape((xsize, ysize, numslices, timepoints)), theheader,
                                 outputroot + '_cardiacnoise')
             tide_io.savetonifti(phaseindices.reshape((xsize, ysize, numslices, timepoints)), theheader,
                                 outputroot + '_phaseindices')
+            del phaseindices
             timings.append(['Cardiac signal saved', time.time(), None, None])
+        timings.append(['Cardiac signal generated', time.time(), None, None])
 
         # now remove them
         tide_util.logmem('before cardiac removal', file=memfile)
         print('removing cardiac signal with GLM')
-        filtereddata = 0.0 * fmri_data
+        filtereddata = fmri_data + 0.0
         datatoremove = 0.0 * fmri_data
         validlocs = np.where(mask > 0)[0]
         numvalidspatiallocs = len(validlocs)
-        threshval = 0.0
+        slabs = [validlocs[slabstart:slabstart + glmslabsize]
+                 for slabstart in range(0, numvalidspatiallocs, glmslabsize)]
         if spatialglmdenoise:
-            meanvals = np.zeros(timepoints, dtype=np.float64)
-            rvals = np.zeros(timepoints, dtype=np.float64)
-            r2vals = np.zeros(timepoints, dtype=np.float64)
-            fitcoffs = np.zeros(timepoints, dtype=np.float64)
-            fitNorm = np.zeros(timepoints, dtype=np.float64)
             print('running glm on', timepoints, 'timepoints')
-            tide_glmpass.glmpass(timepoints,
-                                 fmri_data[validlocs, :],
-                                 threshval,
-                                 cardiacnoise[validlocs, :],
-                                 meanvals,
-                                 rvals,
-                                 r2vals,
-                                 fitcoffs,
-                                 fitNorm,
-                                 datatoremove[validlocs, :],
-                                 filtereddata[validlocs, :],
-                                 reportstep=(timepoints // 100),
-                                 mp_chunksize=10,
-                                 procbyvoxel=False,
-                                 nprocs=nprocs
-                                 )
-            datatoremove[validlocs, :] = np.multiply(cardiacnoise[validlocs, :], fitcoffs[None, :])
-            filtereddata = fmri_data - datatoremove
+            # accumulate the fit sums across voxel slabs, then fit every timepoint at once
+            moments = None
+            for slablocs in slabs:
+                if savecardiacnoise:
+                    slabnoise = cardiacnoise[slablocs, :]
+                else:
+                    slabnoise = cardiacnoisefromapp(slablocs, rawapp2d, projmask2d, phaseindices_byslicetime,
+                                                    numslices)
+                slabmoments = tide_glmpass.linfitmoments(fmri_data[slablocs, :], slabnoise, procbyvoxel=False)
+                if moments is None:
+                    moments = slabmoments
+                else:
+                    moments = [moments[i] + slabmoments[i] for i in range(len(moments))]
+            meanvals, rvals, r2vals, fitcoffs, fitNorm = tide_glmpass.linfitfrommoments(moments)
+            for slablocs in slabs:
+                if savecardiacnoise:
+                    slabnoise = cardiacnoise[slablocs, :]
+                else:
+                    slabnoise = cardiacnoisefromapp(slablocs, rawapp2d, projmask2d, phaseindices_byslicetime,
+                                                    numslices)
+                datatoremove[slablocs, :] = slabnoise * fitcoffs[None, :]
+                filtereddata[slablocs, :] -= datatoremove[slablocs, :]
             timings.append(['Cardiac signal regression finished', time.time(), timepoints, 'timepoints'])
             tide_io.writevec(fitcoffs, outputroot + '_fitcoff.txt')
             tide_io.writevec(meanvals, outputroot + '_fitmean.txt')
@@ -2022,22 +2071,17 @@ def happy_main(thearguments):
             fitcoffs = np.zeros(numspatiallocs, dtype=np.float64)
             fitNorm = np.zeros(numspatiallocs, dtype=np.float64)
             print('running glm on', numvalidspatiallocs, 'voxels')
-            tide_glmpass.glmpass(numvalidspatiallocs,
-                                 fmri_data[validlocs, :],
-                                 threshval,
-                                 cardiacnoise[validlocs, :],
-                                 meanvals[validlocs],
-                                 rvals[validlocs],
-                                 r2vals[validlocs],
-                                 fitcoffs[validlocs],
-                                 fitNorm[validlocs],
-                                 datatoremove[validlocs, :],
-                                 filtereddata[validlocs, :],
-                                 procbyvoxel=True,
-                                 nprocs=nprocs
-                                 )
-            datatoremove[validlocs, :] = np.multiply(cardiacnoise[validlocs, :], fitcoffs[:, None])
-            filtereddata = fmri_data - datatoremove
+            for slablocs in slabs:
+                if savecardiacnoise:
+                    slabnoise = cardiacnoise[slablocs, :]
+                else:
+                    slabnoise = cardiacnoisefromapp(slablocs, rawapp2d, projmask2d, phaseindices_byslicetime,
+                                                    numslices)
+                meanvals[slablocs], rvals[slablocs], r2vals[slablocs], fitcoffs[slablocs], fitNorm[slablocs] = \
+                    tide_glmpass.linfitfrommoments(tide_glmpass.linfitmoments(fmri_data[slablocs, :], slabnoise,
+                                                                              procbyvoxel=True))
+                datatoremove[slablocs, :] = slabnoise * fitcoffs[slablocs, None]
+                filtereddata[slablocs, :] -= datatoremove[slablocs, :]
             timings.append(['Cardiac signal regression finished', time.time(), numspatiallocs, 'voxels'])
             theheader = copy.deepcopy(nim_hdr)
             theheader['dim'][4] = 1
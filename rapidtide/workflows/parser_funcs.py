@@ -3,6 +3,8 @@ Functions for parsers.
 """
 import os.path as op
 
+import rapidtide.memplan as tide_memplan
+
 
 def is_valid_file(parser, arg):
     """
@@ -52,3 +54,15 @@ def is_range(parser, arg):
         parser.error('Argument min must be lower than max.')
 
     return arg
+
+
+def is_memsize(parser, arg):
+    """
+    Check if argument is a memory size, like 16G or 512M, and convert it to bytes.
+    """
+    try:
+        arg = tide_memplan.parsememsize(arg)
+    except ValueError:
+        parser.error('Value {0} is not a memory size (e.g. 16G or 512M)'.format(arg))
+
+    return arg
@@ -33,14 +33,20 @@ import sys
 import numpy as np
 from scipy import ndimage
 
+import rapidtide.checkpoint as tide_checkpoint
 import rapidtide.correlate as tide_corr
 import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
 import rapidtide.io as tide_io
+import rapidtide.memplan as tide_memplan
+import rapidtide.fftbackend as tide_fft
 import rapidtide.miscmath as tide_math
 import rapidtide.multiproc as tide_multiproc
+import rapidtide.outofcore as tide_ooc
 import rapidtide.resample as tide_resample
+import rapidtide.stagecache as tide_stagecache
 import rapidtide.stats as tide_stats
+import rapidtide.telemetry as tide_telemetry
 import rapidtide.util as tide_util
 
 import rapidtide.nullcorrpassx as tide_nullcorr
@@ -50,12 +56,11 @@ import rapidtide.refine as tide_refine
 import rapidtide.glmpass as tide_glmpass
 import rapidtide.helper_classes as tide_classes
 import rapidtide.wiener as tide_wiener
-
-import nibabel as nib
+import rapidtide.lazyimport as tide_lazy
 
 import copy
 
-from .parser_funcs import (is_valid_file, invert_float, is_float)
+from .parser_funcs import (is_valid_file, invert_float, is_float, is_memsize)
 
 try:
     import mkl
@@ -64,12 +69,10 @@ try:
 except ImportError:
     mklexists = False
 
-try:
-    from memory_profiler import profile
+nib = tide_lazy.lazymodule('nibabel')
 
-    memprofilerexists = True
-except ImportError:
-    memprofilerexists = False
+memprofilerexists = tide_lazy.moduleexists('memory_profiler')
+profile = tide_lazy.lazyname('memory_profiler', 'profile')
 
 
 def conditionalprofile():
@@ -156,6 +159,7 @@ def numpy2shared(inarray, thetype):
         inarray_shared = mp.RawArray('d', inarray.reshape(thesize))
     else:
         inarray_shared = mp.RawArray('f', inarray.reshape(thesize))
+    tide_telemetry.addsharedmem(inarray_shared)
     inarray = np.frombuffer(inarray_shared, dtype=thetype, count=thesize)
     inarray.shape = theshape
     return inarray, inarray_shared, theshape
@@ -169,11 +173,36 @@ def allocshared(theshape, thetype):
         outarray_shared = mp.RawArray('d', thesize)
     else:
         outarray_shared = mp.RawArray('f', thesize)
+    tide_telemetry.addsharedmem(outarray_shared)
     outarray = np.frombuffer(outarray_shared, dtype=thetype, count=thesize)
     outarray.shape = theshape
     return outarray, outarray_shared, theshape
 
 
+
+def voxelslabs(numvoxels, optiondict):
+    # out of core runs go through the voxels a slab at a time - otherwise do them all at once
+    if optiondict['outofcore']:
+        return tide_ooc.slabranges(numvoxels, optiondict['slabsize'])
+    else:
+        return [(0, numvoxels)]
+
+
+def readfmridata(thefilename, optiondict, thetype):
+    # out of core runs read nifti data into a scratch file a few timepoints at a time
+    if optiondict['outofcore'] and not optiondict['isgrayordinate']:
+        nim = tide_io.loadnifti(thefilename, keepopen=True)
+        nim_hdr = nim.header.copy()
+        thedims = nim_hdr['dim'].copy()
+        thesizes = nim_hdr['pixdim'].copy()
+        xsize, ysize, numslices, timepoints = tide_io.parseniftidims(thedims)
+        nim_data = tide_ooc.allocarray((int(xsize) * int(ysize) * int(numslices), int(timepoints)), thetype,
+                                       'fmri_data')
+        tide_ooc.readniftitoarray(nim, nim_data)
+        return nim, nim_data.reshape((xsize, ysize, numslices, timepoints)), nim_hdr, thedims, thesizes
+    else:
+        return tide_io.readfromnifti(thefilename)
+
 def readamask(maskfilename, nim_hdr, xsize, istext=False, valslist=None, maskname='the', verbose=False):
     if verbose:
         print('readamask called with filename:', maskfilename, 'vals:', valslist)
@@ -199,12 +228,52 @@ def readamask(maskfilename, nim_hdr, xsize, istext=False, valslist=None, masknam
     return maskarray
 
 
-def getglobalsignal(indata, optiondict, includemask=None, excludemask=None):
+def _getslabrows(theslab, optiondict):
+    # the rows of one slab of voxels that go into the global signal, mean scaled if requested
+    if optiondict['meanscaleglobal']:
+        themeans = np.mean(theslab, axis=1)
+        thenonzero = np.where(themeans != 0.0)[0]
+        return theslab[thenonzero, :] / themeans[thenonzero, None]
+    else:
+        return theslab
+
+
+def _firstcomponent(indata, themask, optiondict, slabsize=10000, numvecs=8, numiters=4):
+    # randomized subspace iteration on the (time x time) covariance of the masked voxels, accumulated slab by slab
+    # so neither the masked data nor its covariance matrix is ever formed
+    numtimepoints = indata.shape[1]
+    rng = np.random.RandomState(0)
+    numvecs = np.min([numvecs, numtimepoints])
+
+    def _covtimes(thevecs):
+        theproduct = np.zeros((numtimepoints, thevecs.shape[1]), dtype=np.float64)
+        for slabstart in range(0, indata.shape[0], slabsize):
+            slabvoxels = np.where(themask[slabstart:slabstart + slabsize] > 0)[0] + slabstart
+            if len(slabvoxels) > 0:
+                therows = _getslabrows(indata[slabvoxels, :], optiondict)
+                therows = therows - np.mean(therows, axis=1, keepdims=True)
+                theproduct += np.dot(therows.T, np.dot(therows, thevecs))
+        return theproduct
+
+    thebasis, dummy = np.linalg.qr(rng.normal(size=(numtimepoints, numvecs)))
+    for theiter in range(numiters):
+        thebasis, dummy = np.linalg.qr(_covtimes(thebasis))
+    theevals, theevecs = np.linalg.eigh(np.dot(thebasis.T, _covtimes(thebasis)))
+    return np.dot(thebasis, theevecs[:, -1])
+
+
+def getglobalsignal(indata, optiondict, includemask=None, excludemask=None, slabsize=10000):
+    # indata is only read a slab of voxels at a time, so it can be a memory mapped array
+    numspatiallocs, numtimepoints = indata.shape
+
     # mask to interesting voxels
-    if optiondict['globalmaskmethod'] == 'mean':
-        themask = tide_stats.makemask(np.mean(indata, axis=1), optiondict['corrmaskthreshpct'])
-    elif optiondict['globalmaskmethod'] == 'variance':
-        themask = tide_stats.makemask(np.var(indata, axis=1), optiondict['corrmaskthreshpct'])
+    themaskvals = np.zeros(numspatiallocs, dtype=np.float64)
+    for slabstart in range(0, numspatiallocs, slabsize):
+        if optiondict['globalmaskmethod'] == 'mean':
+            themaskvals[slabstart:slabstart + slabsize] = np.mean(indata[slabstart:slabstart + slabsize, :], axis=1)
+        elif optiondict['globalmaskmethod'] == 'variance':
+            themaskvals[slabstart:slabstart + slabsize] = np.var(indata[slabstart:slabstart + slabsize, :], axis=1)
+    themask = tide_stats.makemask(themaskvals, optiondict['corrmaskthreshpct'])
     if optiondict['nothresh']:
         themask *= 0
         themask += 1
@@ -214,21 +283,103 @@ def getglobalsignal(indata, optiondict, includemask=None, excludemask=None):
         themask = themask * (1 - excludemask)
 
     # add up all the voxels
-    globalmean = rt_floatset(indata[0, :])
-    thesize = np.shape(themask)
+    globalmean = np.zeros(numtimepoints, dtype=np.float64)
     numvoxelsused = 0
-    for vox in range(0, thesize[0]):
-        if themask[vox] > 0.0:
-            numvoxelsused += 1
-            if optiondict['meanscaleglobal']:
-                themean = np.mean(indata[vox, :])
-                if themean != 0.0:
-                    globalmean = globalmean + indata[vox, :] / themean - 1.0
-            else:
-                globalmean = globalmean + indata[vox, :]
+    for slabstart in range(0, numspatiallocs, slabsize):
+        slabvoxels = np.where(themask[slabstart:slabstart + slabsize] > 0.0)[0] + slabstart
+        if len(slabvoxels) > 0:
+            numvoxelsused += len(slabvoxels)
+            globalmean += np.sum(_getslabrows(indata[slabvoxels, :], optiondict), axis=0, dtype=np.float64)
     print()
     print('used ', numvoxelsused, ' voxels to calculate global mean signal')
-    return tide_math.stdnormalize(globalmean), themask
+
+    if optiondict['globalsignalmethod'] == 'pca':
+        # use the first principal component, signed to agree with the global mean
+        globalsignal = _firstcomponent(indata, themask, optiondict, slabsize=slabsize)
+        if np.dot(globalsignal, globalmean - np.mean(globalmean)) < 0.0:
+            globalsignal *= -1.0
+        print('using the first principal component of the voxels as the global signal')
+        return tide_math.stdnormalize(rt_floatset(globalsignal)), themask
+    else:
+        return tide_math.stdnormalize(rt_floatset(globalmean)), themask
+
+
+def _prepprobe(inputvec, inputfreq, inputstarttime, os_fmri_x, theprefilter, optiondict):
+    # put an additional probe regressor through the same preparation as the main regressor
+    reference_x = np.arange(0.0, len(inputvec)) * (1.0 / inputfreq) - (inputstarttime + optiondict['offsettime'])
+    if optiondict['invertregressor']:
+        invertfac = -1.0
+    else:
+        invertfac = 1.0
+    if optiondict['detrendorder'] > 0:
+        reference_y = invertfac * tide_fit.detrend(inputvec, order=optiondict['detrendorder'],
+                                                   demean=optiondict['dodemean'])
+    else:
+        reference_y = invertfac * (inputvec - np.mean(inputvec))
+    reference_y = theprefilter.apply(inputfreq, reference_y)
+    if optiondict['antialias']:
+        reference_y = rt_floatset(tide_filt.dolptrapfftfilt(inputfreq, 0.25 * optiondict['fmrifreq'],
+                                                            0.5 * optiondict['fmrifreq'], reference_y,
+                                                            padlen=int(inputfreq * optiondict['padseconds'])).real)
+    resampref_y = tide_resample.doresample(reference_x, reference_y, os_fmri_x, method=optiondict['interptype'])
+    if optiondict['detrendorder'] > 0:
+        resampref_y = tide_fit.detrend(resampref_y, order=optiondict['detrendorder'], demean=optiondict['dodemean'])
+    return reference_x, reference_y, resampref_y
+
+
+def _fitparcels(theparcellator, fmri_data, referencetc, thecorrelator, thefitter, genlagtc,
+                initial_fmri_x, os_fmri_x, trimmedcorrscale, lagmininpts, lagmaxinpts, optiondict):
+    # estimate the delay of every parcel averaged timecourse using the full search range
+    numparcels = theparcellator.numparcels
+    corroutlen = len(trimmedcorrscale)
+    parcelcorrout = np.zeros((numparcels, corroutlen), dtype=rt_floattype)
+    parcelmeanval = np.zeros(numparcels, dtype=rt_floattype)
+    tide_corrpass.correlationpass(theparcellator.average(fmri_data),
+                                  referencetc,
+                                  thecorrelator,
+                                  initial_fmri_x,
+                                  os_fmri_x,
+                                  thecorrelator.corrorigin,
+                                  lagmininpts,
+                                  lagmaxinpts,
+                                  parcelcorrout,
+                                  parcelmeanval,
+                                  nprocs=optiondict['nprocs'],
+                                  oversampfactor=optiondict['oversampfactor'],
+                                  interptype=optiondict['interptype'],
+                                  coarsetofine=optiondict['coarsetofine'],
+                                  showprogressbar=optiondict['showprogressbar'],
+                                  chunksize=optiondict['mp_chunksize'],
+                                  rt_floatset=rt_floatset,
+                                  rt_floattype=rt_floattype)
+    parcellagmask = np.zeros(numparcels, dtype='uint16')
+    parcellagtimes = np.zeros(numparcels, dtype=rt_floattype)
+    tide_corrfit.fitcorrx(genlagtc,
+                          initial_fmri_x,
+                          np.zeros((numparcels, len(initial_fmri_x)), dtype=rt_floattype),
+                          trimmedcorrscale,
+                          thefitter,
+                          parcelcorrout,
+                          parcellagmask,
+                          np.zeros(numparcels, dtype='uint16'),
+                          parcellagtimes,
+                          np.zeros(numparcels, dtype=rt_floattype),
+                          np.zeros(numparcels, dtype=rt_floattype),
+                          np.zeros((numparcels, corroutlen), dtype=rt_floattype),
+                          np.zeros((numparcels, corroutlen), dtype=rt_floattype),
+                          np.zeros(numparcels, dtype=rt_floattype),
+                          nprocs=optiondict['nprocs'],
+                          fixdelay=optiondict['fixdelay'],
+                          showprogressbar=optiondict['showprogressbar'],
+                          chunksize=optiondict['mp_chunksize'],
+                          despeckle_thresh=optiondict['despeckle_thresh'],
+                          rt_floatset=rt_floatset,
+                          rt_floattype=rt_floattype)
+
+    # voxels in parcels without a good fit get no starting lag
+    return np.where(theparcellator.expand(parcellagmask) > 0,
+                    theparcellator.expand(parcellagtimes),
+                    -1000000.0)
 
 
 
@@ -456,6 +607,14 @@ def _get_parser():
                        help=('Select whether to use timecourse mean (default) or variance to mask voxels prior to generating global mean. '),
                        default='mean')
 
+    preproc.add_argument('--globalsignalmethod',
+                         dest='globalsignalmethod',
+                         action='store',
+                         type=str,
+                         choices=['sum', 'pca'],
+                         help=('Use the (optionally mean scaled) sum of the masked voxels (default), or their first '
+                               'principal component, as the global signal. '),
+                         default='sum')
     preproc.add_argument('--globalmeaninclude',
                          dest='globalmeanincludespec',
                          metavar='MASK[:VALSPEC]',
@@ -537,6 +696,15 @@ def _get_parser():
                       help=('Oversample the fMRI data by the following '
                             'integral factor.  Set to -1 for automatic selection (default). '),
                       default=-1)
+    corr.add_argument('--coarsetofine',
+                      dest='coarsetofine',
+                      action='store_true',
+                      help=('Correlate at the native TR and sinc interpolate '
+                            'the correlation function to the oversampled lag '
+                            'axis, rather than correlating the oversampled '
+                            'data.  Much faster, with the same peak location '
+                            'for band limited data. '),
+                      default=False)
     corr.add_argument('--regressor',
                       dest='regressorfile',
                       action='store',
@@ -568,6 +736,19 @@ def _get_parser():
                                  'are two ways to specify the same thing. '),
                            default='auto')
 
+    corr.add_argument('--extraprobes',
+                      dest='extraprobefiles',
+                      action='store',
+                      nargs='+',
+                      type=lambda x: is_valid_file(parser, x),
+                      metavar='FILE',
+                      help=('In the final pass, also correlate the data with '
+                            'the probe regressors in FILE(s), sharing the '
+                            'voxel preprocessing with the main regressor, and '
+                            'save lag, strength, and sigma maps for each '
+                            '(OUTPUTNAME_probeN_*).  The files must have the '
+                            'same sample rate and start time as --regressor. '),
+                      default=None)
     corr.add_argument('--regressorstart',
                       dest='inputstarttime',
                       action='store',
@@ -676,6 +857,30 @@ def _get_parser():
                           help=('Refit correlation if median discontinuity '
                                 'magnitude exceeds VAL (default is 5.0s). '),
                           default=5.0)
+    corr_fit.add_argument('--multires',
+                          dest='multiresfactor',
+                          action='store',
+                          type=int,
+                          metavar='FACTOR',
+                          help=('Estimate delays on the data averaged over '
+                                'FACTORxFACTORxFACTOR voxel blocks first, and '
+                                'use them as starting points for the full '
+                                'resolution fit (NIFTI input only).  The full '
+                                'resolution correlation is still calculated over '
+                                'the whole lag range - add --coarsetofine to make '
+                                'that step cheaper. '),
+                          default=1)
+    corr_fit.add_argument('--multireswidth',
+                          dest='multireswidth',
+                          action='store',
+                          type=float,
+                          metavar='WIDTH',
+                          help=('When using --multires, search for the full '
+                                'resolution peak within WIDTH seconds of the '
+                                'block delay (default is 5.0s).  Voxels where '
+                                'the peak is not found are refit over the full '
+                                'lag range. '),
+                          default=5.0)
 
     # Regressor refinement options
     reg_ref = parser.add_argument_group('Regressor refinement options')
@@ -854,8 +1059,32 @@ def _get_parser():
     misc.add_argument('--checkpoint',
                       dest='checkpoint',
                       action='store_true',
-                      help='Enable run checkpoints. ',
+                      help=('Enable run checkpoints.  The state of the analysis is saved after each major stage, '
+                            'so that an interrupted run can be continued with --resume. '),
                       default=False)
+    misc.add_argument('--resume',
+                      dest='resume',
+                      action='store_true',
+                      help=('Continue an interrupted run from its last checkpoint.  The input files and options '
+                            'must be the same as in the original run.  Implies --checkpoint. '),
+                      default=False)
+    misc.add_argument('--cachedir',
+                      dest='cachedir',
+                      action='store',
+                      type=str,
+                      metavar='DIR',
+                      help=('Keep the results of the expensive early stages (the prepared voxel data, the null '
+                            'correlation distributions, and the correlations) in DIR, and reuse them in later runs '
+                            'whose inputs and options for those stages are the same. '),
+                      default=None)
+    misc.add_argument('--cachesize',
+                      dest='cachesize',
+                      action='store',
+                      type=lambda x: is_memsize(parser, x),
+                      metavar='SIZE',
+                      help=('Limit the size of the --cachedir directory to SIZE bytes (K, M, G, and T suffixes '
+                            'are allowed).  The least recently used results are removed first.  Default is 10G. '),
+                      default=None)
     misc.add_argument('--wiener',
                       dest='dodeconv',
                       action='store_true',
@@ -906,6 +1135,38 @@ def _get_parser():
                       help=('Disable use of shared memory for large array '
                             'storage. '),
                       default=True)
+    misc.add_argument('--memlimit',
+                      dest='memlimit',
+                      action='store',
+                      type=lambda x: is_memsize(parser, x),
+                      metavar='LIMIT',
+                      help=('Plan the memory use of the run to fit in LIMIT bytes (K, M, G, and T '
+                            'suffixes are allowed, e.g. 16G), rather than in the memory that is '
+                            'currently available.  If it will not fit, cheaper settings are chosen '
+                            'automatically, or the run stops before doing any work. '),
+                      default=None)
+    misc.add_argument('--outofcore',
+                      dest='outofcore',
+                      action='store_true',
+                      help=('Keep the fmri data and the large result arrays in memory mapped files, '
+                            'and process the voxels a slab at a time, so that datasets larger than '
+                            'memory can be analyzed. '),
+                      default=False)
+    misc.add_argument('--scratchdir',
+                      dest='scratchdir',
+                      action='store',
+                      type=str,
+                      metavar='DIR',
+                      help=('Put the memory mapped files for --outofcore in DIR (default is a '
+                            'directory next to the output files).  It is removed at the end of the run. '),
+                      default=None)
+    misc.add_argument('--telemetry',
+                      dest='telemetry',
+                      action='store_true',
+                      help=('Record nested timing, throughput, memory, and worker utilization '
+                            'for each pass and stage, and save it as JSON (_telemetry.json) and '
+                            'as a Chrome trace (_trace.json). '),
+                      default=False)
     misc.add_argument('--memprofile',
                       dest='memprofile',
                       action='store_true',
@@ -919,6 +1180,15 @@ def _get_parser():
                       metavar='MKLTHREADS',
                       help=('Use no more than MKLTHREADS worker threads in accelerated numpy calls. '),
                       default=1)
+    misc.add_argument('--fftthreads',
+                      dest='fftthreads',
+                      action='store',
+                      type=int,
+                      metavar='FFTTHREADS',
+                      help=('Use FFTTHREADS threads within each FFT.  This is independent of NPROCS, '
+                            'so the total number of threads is NPROCS * FFTTHREADS.  Setting FFTTHREADS '
+                            'to less than 1 uses all of the cpus. '),
+                      default=1)
     misc.add_argument('--nprocs',
                       dest='nprocs',
                       action='store',
@@ -1005,7 +1275,9 @@ def rapidtide_workflow(in_file, outputname, venousrefine=False, nirs=False,
                        preservefiltering=False, showprogressbar=True,
                        dodeconv=False, internalprecision='double',
                        isgrayordinate=False, fakerun=False, displayplots=False,
-                       nonumba=False, sharedmem=True, memprofile=False,
+                       nonumba=False, sharedmem=True, memlimit=None, outofcore=False, scratchdir=None, resume=False,
+                       cachedir=None, cachesize=None,
+                       memprofile=False, telemetry=False,
                        nprocs=1, debug=False, cleanrefined=False,
                        dodispersioncalc=False, fix_autocorrelation=False,
                        tmaskname=None,
@@ -1049,6 +1321,8 @@ def process_args():
     args['findmaxtype'] = 'gauss'  # if set to 'gauss', use old gaussian fitting, if set to 'quad' use parabolic
     args['searchfrac'] = 0.5  # The fraction of the main peak over which points are included in the peak
     args['mp_chunksize'] = 50000
+    args['streamresults'] = False  # unpack worker results one chunk at a time (turned on by the memory planner)
+    args['slabsize'] = 10000  # number of voxels read at once by the stages that stream through the data
 
     # significance estimation
     args['sighistlen'] = 1000
@@ -1240,6 +1514,9 @@ def process_args():
         args['pickleft'] = True
         args['doglmfilt'] = False
 
+    if args['resume']:
+        args['checkpoint'] = True
+
     if args['denoising']:
         args['despecklepasses'] = 0
         args['lagmin'] = -15.0
@@ -1272,6 +1549,10 @@ def rapidtide_main():
     optiondict['dispersioncalc_step'] = np.max(
         [(optiondict['dispersioncalc_upper'] - optiondict['dispersioncalc_lower']) / 25, 0.50])
     timings.append(['Argument parsing done', time.time(), None, None])
+    if optiondict['telemetry']:
+        tide_telemetry.enable()
+        tide_telemetry.startspan('rapidtideX', category='run',
+                                 args={'nprocs': optiondict['nprocs'], 'passes': optiondict['passes']})
 
     # don't use shared memory if there is only one process
     if optiondict['nprocs'] == 1:
@@ -1282,27 +1563,6 @@ def rapidtide_main():
     if optiondict['nonumba']:
         tide_util.disablenumba()
 
-    # set the internal precision
-    global rt_floatset, rt_floattype
-    if optiondict['internalprecision'] == 'double':
-        print('setting internal precision to double')
-        rt_floattype = 'float64'
-        rt_floatset = np.float64
-    else:
-        print('setting internal precision to single')
-        rt_floattype = 'float32'
-        rt_floatset = np.float32
-
-    # set the output precision
-    if optiondict['outputprecision'] == 'double':
-        print('setting output precision to double')
-        rt_outfloattype = 'float64'
-        rt_outfloatset = np.float64
-    else:
-        print('setting output precision to single')
-        rt_outfloattype = 'float32'
-        rt_outfloatset = np.float32
-
     # set set the number of worker processes if multiprocessing
     if optiondict['nprocs'] < 1:
         optiondict['nprocs'] = tide_multiproc.maxcpus()
@@ -1311,12 +1571,15 @@ def rapidtide_main():
     if mklexists:
         mkl.set_num_threads(optiondict['mklthreads'])
 
+    # set the number of threads used within each FFT
+    tide_fft.setfftthreads(optiondict['fftthreads'])
+
     # open up the memory usage file
     if not optiondict['memprofile']:
         memfile = open(outputname + '_memusage.csv', 'w')
         tide_util.logmem(None, file=memfile)
 
-    # open the fmri datafile
+    # open the fmri datafile - for nifti files, only the header is read until the memory use has been planned
     tide_util.logmem('before reading in fmri data', file=memfile)
     if tide_io.checkiftext(fmrifilename):
         print('input file is text - all I/O will be to text files')
@@ -1339,13 +1602,13 @@ def rapidtide_main():
         numspatiallocs = int(xsize)
         slicesize = numspatiallocs
     else:
-        nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename)
+        nim_hdr, thedims, thesizes = tide_io.readniftiheader(fmrifilename)
         if nim_hdr['intent_code'] == 3002:
             print('input file is CIFTI')
             optiondict['isgrayordinate'] = True
             fileiscifti = True
-            timepoints = nim_data.shape[4]
-            numspatiallocs = nim_data.shape[5]
+            timepoints = int(thedims[5])
+            numspatiallocs = int(thedims[6])
             slicesize = numspatiallocs
             outsuffix3d = '.dscalar'
             outsuffix4d = '.dtseries'
@@ -1358,7 +1621,6 @@ def rapidtide_main():
             outsuffix3d = ''
             outsuffix4d = ''
         xdim, ydim, slicethickness, tr = tide_io.parseniftisizes(thesizes)
-    tide_util.logmem('after reading in fmri data', file=memfile)
 
     # correct some fields if necessary
     if optiondict['isgrayordinate']:
@@ -1385,33 +1647,123 @@ def rapidtide_main():
     if optiondict['verbose']:
         print('fmri data: ', timepoints, ' timepoints, tr = ', fmritr, ', oversamptr =', oversamptr)
     print(numspatiallocs, ' spatial locations, ', timepoints, ' timepoints')
-    timings.append(['Finish reading fmrifile', time.time(), None, None])
 
     # if the user has specified start and stop points, limit check, then use these numbers
     validstart, validend = tide_util.startendcheck(timepoints, optiondict['startpoint'], optiondict['endpoint'])
-    if abs(optiondict['lagmin']) > (validend - validstart + 1) * fmritr / 2.0:
-        print('magnitude of lagmin exceeds', (validend - validstart + 1) * fmritr / 2.0, ' - invalid')
+    validtimepoints = validend - validstart + 1
+    if abs(optiondict['lagmin']) > validtimepoints * fmritr / 2.0:
+        print('magnitude of lagmin exceeds', validtimepoints * fmritr / 2.0, ' - invalid')
         sys.exit()
-    if abs(optiondict['lagmax']) > (validend - validstart + 1) * fmritr / 2.0:
-        print('magnitude of lagmax exceeds', (validend - validstart + 1) * fmritr / 2.0, ' - invalid')
+    if abs(optiondict['lagmax']) > validtimepoints * fmritr / 2.0:
+        print('magnitude of lagmax exceeds', validtimepoints * fmritr / 2.0, ' - invalid')
         sys.exit()
-    if optiondict['gausssigma'] > 0.0:
-        print('applying gaussian spatial filter to timepoints ', validstart, ' to ', validend)
-        reportstep = 10
-        for i in range(validstart, validend + 1):
-            if (i % reportstep == 0 or i == validend) and optiondict['showprogressbar']:
-                tide_util.progressbar(i - validstart + 1, timepoints, label='Percent complete')
-            nim_data[:, :, :, i] = tide_filt.ssmooth(xdim, ydim, slicethickness, optiondict['gausssigma'],
-                                                     nim_data[:, :, :, i])
-        timings.append(['End 3D smoothing', time.time(), None, None])
-        print()
 
-    # reshape the data and trim to a time range, if specified.  Check for special case of no trimming to save RAM
-    if (validstart == 0) and (validend == timepoints):
-        fmri_data = nim_data.reshape((numspatiallocs, timepoints))
+    # the checkpoint hash is of the options as they were given, since the memory planner's changes depend on the
+    # free memory
+    useroptions = dict(optiondict)
+    if optiondict['checkpoint']:
+        inputhash = tide_checkpoint.hashinputs(optiondict)
+
+    # make sure the run will fit in memory before doing any real work
+    estcorroutlen = int((-optiondict['lagmin'] / oversamptr) - 0.5) + int((optiondict['lagmax'] / oversamptr) + 0.5) + 1
+    memfits, memplan, memchanges = tide_memplan.planmemory(numspatiallocs, timepoints, validtimepoints,
+                                                           estcorroutlen, optiondict,
+                                                           memlimit=optiondict['memlimit'])
+    if not memfits:
+        print('ERROR: the estimated peak memory use of', tide_memplan.formatmemsize(memplan['peak']),
+              'is over the budget - exiting')
+        print('reduce the problem size, or use --memlimit to set a larger budget')
+        sys.exit()
+    tide_multiproc.setstreamresults(optiondict['streamresults'])
+    if optiondict['outofcore']:
+        if optiondict['scratchdir'] is None:
+            optiondict['scratchdir'] = outputname + '_scratch'
+        print('running out of core - large arrays will be kept in', optiondict['scratchdir'])
+        tide_ooc.setscratchdir(optiondict['scratchdir'])
+        optiondict['sharedmem'] = False
+
+    # set up checkpointing, and find the last completed stage if resuming
+    if optiondict['checkpoint']:
+        thecheckpointer = tide_checkpoint.checkpointer(outputname, inputhash, optiondict['passes'])
+        if optiondict['resume']:
+            checkpointstatus = thecheckpointer.load()
+            if checkpointstatus == 'missing':
+                print('no checkpoint found - starting from the beginning')
+            elif checkpointstatus == 'mismatch':
+                print('ERROR: the input files or options are not the same as those of the checkpointed run - exiting')
+                sys.exit()
+            else:
+                print('resuming after the', thecheckpointer.laststage, 'stage of pass', thecheckpointer.lastpass)
+        thecheckpointer.setplannedoptions(optiondict, useroptions)
+        if thecheckpointer.resumed and (len(thecheckpointer.plannedoptions) > 0):
+            print('using the memory plan of the checkpointed run:', thecheckpointer.plannedoptions)
     else:
-        fmri_data = nim_data.reshape((numspatiallocs, timepoints))[:, validstart:validend + 1]
-        validtimepoints = validend - validstart + 1
+        thecheckpointer = tide_checkpoint.checkpointer(outputname, None, optiondict['passes'], enabled=False)
+
+    # set up the stage cache
+    if optiondict['cachedir'] is not None:
+        print('caching stage results in', optiondict['cachedir'])
+        tide_stagecache.setcachedir(optiondict['cachedir'], maxsize=optiondict['cachesize'])
+
+    # set the internal precision
+    global rt_floatset, rt_floattype
+    if optiondict['internalprecision'] == 'double':
+        print('setting internal precision to double')
+        rt_floattype = 'float64'
+        rt_floatset = np.float64
+    else:
+        print('setting internal precision to single')
+        rt_floattype = 'float32'
+        rt_floatset = np.float32
+
+    # set the output precision
+    if optiondict['outputprecision'] == 'double':
+        print('setting output precision to double')
+        rt_outfloattype = 'float64'
+        rt_outfloatset = np.float64
+    else:
+        print('setting output precision to single')
+        rt_outfloattype = 'float32'
+        rt_outfloatset = np.float32
+
+    # see if the prepared voxel data (smoothed, masked, and motion filtered) is in the stage cache
+    voxelskey = None
+    voxelscache = None
+    if tide_stagecache.isenabled():
+        # out of core runs keep the voxel data at the internal precision, in core runs as it was read
+        if optiondict['outofcore']:
+            validdatatype = rt_floattype
+        else:
+            validdatatype = 'float64'
+        voxelskey = tide_stagecache.stagekey('voxels', optiondict, options=tide_stagecache.voxelsoptions,
+                                             filenames=[fmrifilename, optiondict['corrmaskname'],
+                                                        optiondict['motionfilename']],
+                                             values=[validstart, validend, validdatatype])
+        voxelscache = tide_stagecache.load(voxelskey)
+        if voxelscache is not None:
+            print('using the prepared voxel data from the stage cache')
+
+    # now read the fmri data
+    if voxelscache is None:
+        if not optiondict['textio']:
+            nim, nim_data, nim_hdr, thedims, thesizes = readfmridata(fmrifilename, optiondict, rt_floattype)
+        tide_util.logmem('after reading in fmri data', file=memfile)
+        timings.append(['Finish reading fmrifile', time.time(), None, None])
+
+        if optiondict['gausssigma'] > 0.0:
+            print('applying gaussian spatial filter to timepoints ', validstart, ' to ', validend)
+            tide_filt.ssmooth4d(xdim, ydim, slicethickness, optiondict['gausssigma'], nim_data,
+                                startpoint=validstart,
+                                endpoint=validend,
+                                nprocs=optiondict['nprocs'],
+                                showprogressbar=optiondict['showprogressbar'])
+            timings.append(['End 3D smoothing', time.time(), None, None])
+
+        # reshape the data and trim to a time range, if specified.  Check for special case of no trimming to save RAM
+        if (validstart == 0) and (validend == timepoints):
+            fmri_data = nim_data.reshape((numspatiallocs, timepoints))
+        else:
+            fmri_data = nim_data.reshape((numspatiallocs, timepoints))[:, validstart:validend + 1]
 
     # read in the optional masks
     tide_util.logmem('before setting masks', file=memfile)
@@ -1473,25 +1825,36 @@ def rapidtide_main():
 
     # read or make a mask of where to calculate the correlations
     tide_util.logmem('before selecting valid voxels', file=memfile)
-    threshval = tide_stats.getfracvals(fmri_data[:, optiondict['addedskip']:], [0.98])[0] / 25.0
-    print('constructing correlation mask')
-    if optiondict['corrmaskname'] is not None:
-        thecorrmask = readamask(optiondict['corrmaskname'], nim_hdr, xsize,
-                                             istext=optiondict['textio'],
-                                             valslist=optiondict['corrmaskvals'],
-                                             maskname='correlation')
-
-        corrmask = np.uint16(np.where(thecorrmask > 0, 1, 0).reshape(numspatiallocs))
+    if voxelscache is not None:
+        corrmask = np.array(voxelscache['corrmask'])
+        threshval = float(voxelscache['threshval'])
     else:
-        # check to see if the data has been demeaned
-        meanim = np.mean(fmri_data[:, optiondict['addedskip']:], axis=1)
-        stdim = np.std(fmri_data[:, optiondict['addedskip']:], axis=1)
-        if np.mean(stdim) < np.mean(meanim):
-            print('generating correlation mask from mean image')
-            corrmask = np.uint16(tide_stats.makemask(meanim, threshpct=optiondict['corrmaskthreshpct']))
+        if optiondict['outofcore']:
+            threshval = tide_stats.getfracvals(fmri_data[:, optiondict['addedskip']:], [0.98],
+                                               slabsize=optiondict['slabsize'])[0] / 25.0
+        else:
+            threshval = tide_stats.getfracvals(fmri_data[:, optiondict['addedskip']:], [0.98])[0] / 25.0
+        print('constructing correlation mask')
+        if optiondict['corrmaskname'] is not None:
+            thecorrmask = readamask(optiondict['corrmaskname'], nim_hdr, xsize,
+                                                 istext=optiondict['textio'],
+                                                 valslist=optiondict['corrmaskvals'],
+                                                 maskname='correlation')
+
+            corrmask = np.uint16(np.where(thecorrmask > 0, 1, 0).reshape(numspatiallocs))
         else:
-            print('generating correlation mask from std image')
-            corrmask = np.uint16(tide_stats.makemask(stdim, threshpct=optiondict['corrmaskthreshpct']))
+            # check to see if the data has been demeaned
+            meanim = np.zeros(numspatiallocs, dtype=np.float64)
+            stdim = np.zeros(numspatiallocs, dtype=np.float64)
+            for slabstart, slabend in voxelslabs(numspatiallocs, optiondict):
+                meanim[slabstart:slabend] = np.mean(fmri_data[slabstart:slabend, optiondict['addedskip']:], axis=1)
+                stdim[slabstart:slabend] = np.std(fmri_data[slabstart:slabend, optiondict['addedskip']:], axis=1)
+            if np.mean(stdim) < np.mean(meanim):
+                print('generating correlation mask from mean image')
+                corrmask = np.uint16(tide_stats.makemask(meanim, threshpct=optiondict['corrmaskthreshpct']))
+            else:
+                print('generating correlation mask from std image')
+                corrmask = np.uint16(tide_stats.makemask(stdim, threshpct=optiondict['corrmaskthreshpct']))
     if tide_stats.getmasksize(corrmask) == 0:
         print('ERROR: there are no voxels in the correlation mask - exiting')
         sys.exit()
@@ -1528,8 +1891,17 @@ def rapidtide_main():
     validvoxels = np.where(corrmask > 0)[0]
     numvalidspatiallocs = np.shape(validvoxels)[0]
     print('validvoxels shape =', numvalidspatiallocs)
-    fmri_data_valid = fmri_data[validvoxels, :] + 0.0
-    print('original size =', np.shape(fmri_data), ', trimmed size =', np.shape(fmri_data_valid))
+    if voxelscache is not None:
+        fmri_data_valid = tide_ooc.toscratch(voxelscache['fmri_data_valid'], 'fmri_data_valid',
+                                             slabsize=optiondict['slabsize'])
+        print('trimmed size =', np.shape(fmri_data_valid))
+    else:
+        if optiondict['outofcore']:
+            fmri_data_valid = tide_ooc.toscratch(fmri_data, 'fmri_data_valid', thetype=rt_floattype,
+                                                 rows=validvoxels, slabsize=optiondict['slabsize'])
+        else:
+            fmri_data_valid = fmri_data[validvoxels, :] + 0.0
+        print('original size =', np.shape(fmri_data), ', trimmed size =', np.shape(fmri_data_valid))
     if internalglobalmeanincludemask is not None:
         internalglobalmeanincludemask_valid = 1.0 * internalglobalmeanincludemask[validvoxels]
         del internalglobalmeanincludemask
@@ -1570,8 +1942,15 @@ def rapidtide_main():
 
     # get rid of memory we aren't using
     tide_util.logmem('before purging full sized fmri data', file=memfile)
-    del fmri_data
-    del nim_data
+    if voxelscache is None:
+        del fmri_data
+        del nim_data
+        if not optiondict['textio']:
+            # the image object keeps its own reference to the data
+            del nim
+    elif optiondict['textio']:
+        # text data is read along with the header
+        del nim_data
     tide_util.logmem('after purging full sized fmri data', file=memfile)
 
     # filter out motion regressors here
@@ -1579,15 +1958,22 @@ def rapidtide_main():
         print('regressing out motion')
 
         timings.append(['Motion filtering start', time.time(), None, None])
-        motionregressors, fmri_data_valid = tide_glmpass.motionregress(optiondict['motionfilename'],
-                                                                    fmri_data_valid,
-                                                                    tr,
-                                                                    motstart=validstart,
-                                                                    motend=validend + 1,
-                                                                    position=optiondict['mot_pos'],
-                                                                    deriv=optiondict['mot_deriv'],
-                                                                    derivdelayed=optiondict['mot_delayderiv'])
-
+        if voxelscache is not None:
+            # the cached voxel data has already been motion filtered
+            motionregressors = np.array(voxelscache['motionregressors'])
+        else:
+            motionregressors, fmri_data_valid = tide_glmpass.motionregress(optiondict['motionfilename'],
+                                                                        fmri_data_valid,
+                                                                        tr,
+                                                                        motstart=validstart,
+                                                                        motend=validend + 1,
+                                                                        position=optiondict['mot_pos'],
+                                                                        deriv=optiondict['mot_deriv'],
+                                                                        derivdelayed=optiondict['mot_delayderiv'])
+
+            if optiondict['outofcore']:
+                fmri_data_valid = tide_ooc.toscratch(fmri_data_valid, 'fmri_data_valid', thetype=rt_floattype,
+                                                     slabsize=optiondict['slabsize'])
         timings.append(['Motion filtering end', time.time(), fmri_data_valid.shape[0], 'voxels'])
         tide_io.writenpvecs(motionregressors, outputname + '_orthogonalizedmotion.txt')
         if optiondict['memprofile']:
@@ -1596,7 +1982,7 @@ def rapidtide_main():
             tide_util.logmem('after motion glm filter', file=memfile)
 
         if optiondict['savemotionfiltered']:
-            outfmriarray = np.zeros((numspatiallocs, validtimepoints), dtype=rt_floattype)
+            outfmriarray = tide_ooc.allocarray((numspatiallocs, validtimepoints), rt_floattype, 'outfmriarray')
             outfmriarray[validvoxels, :] = fmri_data_valid[:, :]
             if optiondict['textio']:
                 tide_io.writenpvecs(outfmriarray.reshape((numspatiallocs, validtimepoints)),
@@ -1605,9 +1991,18 @@ def rapidtide_main():
                 tide_io.savetonifti(outfmriarray.reshape((xsize, ysize, numslices, validtimepoints)), nim_hdr,
                                 outputname + '_motionfiltered' + '')
 
+    if (voxelskey is not None) and (voxelscache is None):
+        thevoxelresult = {'fmri_data_valid': fmri_data_valid, 'corrmask': corrmask, 'threshval': threshval}
+        if optiondict['motionfilename'] is not None:
+            thevoxelresult['motionregressors'] = motionregressors
+        tide_stagecache.save(voxelskey, thevoxelresult)
+        del thevoxelresult
+    del voxelscache
 
     # read in the timecourse to resample
     timings.append(['Start of reference prep', time.time(), None, None])
+    tide_telemetry.startspan('Reference prep')
+    probefreq, probestarttime = optiondict['inputfreq'], optiondict['inputstarttime']
     if filename is None:
         print('no regressor file specified - will use the global mean regressor')
         optiondict['useglobalref'] = True
@@ -1618,7 +2013,8 @@ def rapidtide_main():
         inputstarttime = 0.0
         inputvec, meanmask = getglobalsignal(fmri_data_valid, optiondict,
                                              includemask=internalglobalmeanincludemask_valid,
-                                             excludemask=internalglobalmeanexcludemask_valid)
+                                             excludemask=internalglobalmeanexcludemask_valid,
+                                             slabsize=optiondict['slabsize'])
         fullmeanmask = np.zeros((numspatiallocs), dtype=rt_floattype)
         fullmeanmask[validvoxels] = meanmask[:]
         theheader = copy.deepcopy(nim_hdr)
@@ -1751,7 +2147,15 @@ def rapidtide_main():
 
     tide_io.writenpvecs(tide_math.stdnormalize(resampnonosref_y), outputname + nonosrefname)
     tide_io.writenpvecs(tide_math.stdnormalize(resampref_y), outputname + osrefname)
+    checkpointstate = {'resampref_y': resampref_y,
+                       'resampnonosref_y': resampnonosref_y,
+                       'genlagtc_x': reference_x,
+                       'genlagtc_y': reference_y}
+    checkpointarrays = {}
+    carriedarrays = {}
+    thecheckpointer.save('refprep', 0, optiondict, state=checkpointstate)
     timings.append(['End of reference prep', time.time(), None, None])
+    tide_telemetry.endspan()
 
     corrtr = oversamptr
     if optiondict['verbose']:
@@ -1826,10 +2230,10 @@ def rapidtide_main():
         windowout, dummy, dummy = allocshared(internalvalidcorrshape, rt_floatset)
         outcorrarray, dummy, dummy = allocshared(internalcorrshape, rt_floatset)
     else:
-        corrout = np.zeros(internalvalidcorrshape, dtype=rt_floattype)
-        gaussout = np.zeros(internalvalidcorrshape, dtype=rt_floattype)
-        windowout = np.zeros(internalvalidcorrshape, dtype=rt_floattype)
-        outcorrarray = np.zeros(internalcorrshape, dtype=rt_floattype)
+        corrout = tide_ooc.allocarray(internalvalidcorrshape, rt_floattype, 'corrout')
+        gaussout = tide_ooc.allocarray(internalvalidcorrshape, rt_floattype, 'gaussout')
+        windowout = tide_ooc.allocarray(internalvalidcorrshape, rt_floattype, 'windowout')
+        outcorrarray = tide_ooc.allocarray(internalcorrshape, rt_floattype, 'outcorrarray')
     tide_util.logmem('after correlation array allocation', file=memfile)
 
     if optiondict['textio']:
@@ -1841,7 +2245,7 @@ def rapidtide_main():
             nativefmrishape = (xsize, ysize, numslices, np.shape(initial_fmri_x)[0])
     internalfmrishape = (numspatiallocs, np.shape(initial_fmri_x)[0])
     internalvalidfmrishape = (numvalidspatiallocs, np.shape(initial_fmri_x)[0])
-    lagtc = np.zeros(internalvalidfmrishape, dtype=rt_floattype)
+    lagtc = tide_ooc.allocarray(internalvalidfmrishape, rt_floattype, 'lagtc')
     tide_util.logmem('after lagtc array allocation', file=memfile)
 
     if optiondict['passes'] > 1:
@@ -1849,13 +2253,9 @@ def rapidtide_main():
             shiftedtcs, dummy, dummy = allocshared(internalvalidfmrishape, rt_floatset)
             weights, dummy, dummy = allocshared(internalvalidfmrishape, rt_floatset)
         else:
-            shiftedtcs = np.zeros(internalvalidfmrishape, dtype=rt_floattype)
-            weights = np.zeros(internalvalidfmrishape, dtype=rt_floattype)
+            shiftedtcs = tide_ooc.allocarray(internalvalidfmrishape, rt_floattype, 'shiftedtcs')
+            weights = tide_ooc.allocarray(internalvalidfmrishape, rt_floattype, 'weights')
         tide_util.logmem('after refinement array allocation', file=memfile)
-    if optiondict['sharedmem']:
-        outfmriarray, dummy, dummy = allocshared(internalfmrishape, rt_floatset)
-    else:
-        outfmriarray = np.zeros(internalfmrishape, dtype=rt_floattype)
 
     # prepare for fast resampling
     padvalue = max((-optiondict['lagmin'], optiondict['lagmax'])) + 30.0
@@ -1864,6 +2264,34 @@ def rapidtide_main():
     padvalue = fmritr * numpadtrs
     genlagtc = tide_resample.fastresampler(reference_x, reference_y, padvalue=padvalue)
 
+    # prepare any additional probe regressors
+    if optiondict['extraprobefiles'] is not None:
+        numprobes = len(optiondict['extraprobefiles'])
+        probegenlagtcs = []
+        probereferencetcs = []
+        for probefile in optiondict['extraprobefiles']:
+            print('preparing probe regressor', probefile)
+            probe_x, probe_y, proberesamp_y = _prepprobe(tide_io.readvec(probefile), probefreq, probestarttime,
+                                                         os_fmri_x, theprefilter, optiondict)
+            probegenlagtcs.append(tide_resample.fastresampler(probe_x, probe_y, padvalue=padvalue))
+            probereferencetcs.append(tide_math.corrnormalize(proberesamp_y,
+                                                             prewindow=optiondict['usewindowfunc'],
+                                                             detrendorder=optiondict['detrendorder'],
+                                                             windowfunc=optiondict['windowfunc']))
+        themulticorrelator = tide_classes.multicorrelator(Fs=oversampfreq,
+                                                          ncprefilter=theprefilter,
+                                                          detrendorder=optiondict['detrendorder'],
+                                                          windowfunc=optiondict['windowfunc'],
+                                                          corrweighting=optiondict['corrweighting'])
+        probecorrout = tide_ooc.allocarray((numvalidspatiallocs, numprobes, corroutlen), rt_floattype,
+                                           'probecorrout')
+        probelagtimes = np.zeros((numprobes, numvalidspatiallocs), dtype=rt_floattype)
+        probelagstrengths = np.zeros((numprobes, numvalidspatiallocs), dtype=rt_floattype)
+        probelagsigma = np.zeros((numprobes, numvalidspatiallocs), dtype=rt_floattype)
+        probelagmask = np.zeros((numprobes, numvalidspatiallocs), dtype='uint16')
+        probefailimage = np.zeros((numprobes, numvalidspatiallocs), dtype='uint16')
+        probeR2 = np.zeros((numprobes, numvalidspatiallocs), dtype=rt_floattype)
+
     # cycle over all voxels
     refine = True
     if optiondict['verbose']:
@@ -1889,8 +2317,44 @@ def rapidtide_main():
                                              enforcethresh=optiondict['enforcethresh'],
                                              hardlimit=optiondict['hardlimit'])
 
+    # set up multiresolution initialization
+    if optiondict['multiresfactor'] > 1:
+        if optiondict['textio'] or fileiscifti:
+            print('multiresolution initialization requires NIFTI input - disabling')
+            optiondict['multiresfactor'] = 1
+        else:
+            theparcellator = tide_classes.parcellator(nativespaceshape, validvoxels,
+                                                      factor=optiondict['multiresfactor'])
+            print('multiresolution initialization using', theparcellator.numparcels, 'parcels')
+
+    # pick up where the checkpointed run left off
+    if thecheckpointer.resumed:
+        print('restoring the state at the end of the', thecheckpointer.laststage, 'stage')
+        thecheckpointer.restoreoptions(optiondict)
+        checkpointstate = dict(thecheckpointer.state)
+        resampref_y = checkpointstate['resampref_y']
+        resampnonosref_y = checkpointstate['resampnonosref_y']
+        genlagtc = tide_resample.fastresampler(checkpointstate['genlagtc_x'], checkpointstate['genlagtc_y'],
+                                               padvalue=padvalue)
+        if 'refinemask' in checkpointstate:
+            refinemask = checkpointstate['refinemask']
+        if 'shiftedtcs' in thecheckpointer.arraynames:
+            thecheckpointer.restorearray('shiftedtcs', shiftedtcs, slabsize=optiondict['slabsize'])
+            carriedarrays = {'shiftedtcs': shiftedtcs}
+
+    # calculate percentiles for the crosscorrelation from the distribution data
+    thepercentiles = np.array([0.95, 0.99, 0.995, 0.999])
+    thepvalnames = []
+    for thispercentile in thepercentiles:
+        thepvalnames.append("{:.3f}".format(1.0 - thispercentile).replace('.', 'p'))
+
     for thepass in range(1, optiondict['passes'] + 1):
+        if (thepass < optiondict['passes']) and thecheckpointer.isdone('refinement', thepass):
+            print('pass', thepass, 'was completed before the checkpoint - skipping')
+            continue
+
         # initialize the pass
+        tide_telemetry.startspan('pass ' + str(thepass), category='pass')
         if optiondict['passes'] > 1:
             print('\n\n*********************')
             print('Pass number ', thepass)
@@ -1998,8 +2462,14 @@ def rapidtide_main():
             cleaned_referencetc = 1.0 * referencetc
 
         # Step 0 - estimate significance
-        if optiondict['numestreps'] > 0:
+        if (optiondict['numestreps'] > 0) and thecheckpointer.isdone('significance', thepass):
+            print('\n\nSignificance estimation, pass ' + str(thepass) + ', was completed before the checkpoint')
+            pcts = checkpointstate.get('pcts')
+            pcts_fit = checkpointstate.get('pcts_fit')
+            sigfit = checkpointstate.get('sigfit')
+        elif optiondict['numestreps'] > 0:
             timings.append(['Significance estimation start, pass ' + str(thepass), time.time(), None, None])
+            tide_telemetry.startspan('Significance estimation')
             print('\n\nSignificance estimation, pass ' + str(thepass))
             if optiondict['verbose']:
                 print('calling getNullDistributionData with args:', oversampfreq, fmritr, corrorigin, lagmininpts,
@@ -2014,9 +2484,6 @@ def rapidtide_main():
                 tide_io.writenpvecs(cleaned_resampref_y,
                                     outputname + '_cleanedresampref_y_pass' + str(thepass) + '.txt')
 
-                plot(cleaned_resampref_y)
-                plot(cleaned_referencetc)
-                show()
                 if optiondict['saveoptionsasjson']:
                     tide_io.writedicttojson(optiondict, outputname + '_options_pregetnull_pass' + str(thepass) + '.json')
                 else:
@@ -2025,27 +2492,35 @@ def rapidtide_main():
             thecorrelator.setreftc(cleaned_resampref_y)
             dummy, trimmedcorrscale, dummy = thecorrelator.getcorrelation()
             thefitter.setcorrtimeaxis(trimmedcorrscale)
-            corrdistdata = getNullDistributionData_func(cleaned_resampref_y,
-                                                         oversampfreq,
-                                                         thecorrelator,
-                                                         thefitter,
-                                                         numestreps=optiondict['numestreps'],
-                                                         nprocs=optiondict['nprocs'],
-                                                         showprogressbar=optiondict['showprogressbar'],
-                                                         chunksize=optiondict['mp_chunksize'],
-                                                         permutationmethod=optiondict['permutationmethod'],
-                                                         fixdelay=optiondict['fixdelay'],
-                                                         fixeddelayvalue=optiondict['fixeddelayvalue'],
-                                                         rt_floatset=np.float64,
-                                                         rt_floattype='float64')
+            nullcache = None
+            if tide_stagecache.isenabled():
+                nullkey = tide_stagecache.stagekey('significance', optiondict,
+                                                   ignore=tide_stagecache.significanceignore,
+                                                   parents=[voxelskey], arrays=[cleaned_resampref_y],
+                                                   values=[oversampfreq, lagmininpts, lagmaxinpts])
+                nullcache = tide_stagecache.load(nullkey)
+            if nullcache is not None:
+                print('using the null correlation distribution from the stage cache')
+                corrdistdata = np.array(nullcache['corrdistdata'])
+                del nullcache
+            else:
+                corrdistdata = getNullDistributionData_func(cleaned_resampref_y,
+                                                             oversampfreq,
+                                                             thecorrelator,
+                                                             thefitter,
+                                                             numestreps=optiondict['numestreps'],
+                                                             nprocs=optiondict['nprocs'],
+                                                             showprogressbar=optiondict['showprogressbar'],
+                                                             chunksize=optiondict['mp_chunksize'],
+                                                             permutationmethod=optiondict['permutationmethod'],
+                                                             fixdelay=optiondict['fixdelay'],
+                                                             fixeddelayvalue=optiondict['fixeddelayvalue'],
+                                                             rt_floatset=np.float64,
+                                                             rt_floattype='float64')
+                if tide_stagecache.isenabled():
+                    tide_stagecache.save(nullkey, {'corrdistdata': corrdistdata})
             tide_io.writenpvecs(corrdistdata, outputname + '_corrdistdata_pass' + str(thepass) + '.txt')
 
-            # calculate percentiles for the crosscorrelation from the distribution data
-            thepercentiles = np.array([0.95, 0.99, 0.995, 0.999])
-            thepvalnames = []
-            for thispercentile in thepercentiles:
-                thepvalnames.append("{:.3f}".format(1.0 - thispercentile).replace('.', 'p'))
-
             pcts, pcts_fit, sigfit = tide_stats.sigFromDistributionData(corrdistdata, optiondict['sighistlen'],
                                                                         thepercentiles, twotail=optiondict['bipolar'],
                                                                         displayplots=optiondict['displayplots'],
@@ -2067,120 +2542,268 @@ def rapidtide_main():
                     print('leaving ampthresh unchanged')
 
             del corrdistdata
+            checkpointstate.update({'pcts': pcts, 'pcts_fit': pcts_fit, 'sigfit': sigfit})
+            thecheckpointer.save('significance', thepass, optiondict, state=checkpointstate)
             timings.append(['Significance estimation end, pass ' + str(thepass), time.time(), optiondict['numestreps'],
                             'repetitions'])
+            tide_telemetry.endspan(numitems=optiondict['numestreps'], unit='repetitions')
 
         # Step 1 - Correlation step
-        print('\n\nCorrelation calculation, pass ' + str(thepass))
-        timings.append(['Correlation calculation start, pass ' + str(thepass), time.time(), None, None])
-        correlationpass_func = addmemprofiling(tide_corrpass.correlationpass,
-                                               optiondict['memprofile'],
-                                               memfile,
-                                               'before correlationpass')
-
-        thecorrelator.setlimits(lagmininpts, lagmaxinpts)
-        voxelsprocessed_cp, theglobalmaxlist, trimmedcorrscale = correlationpass_func(fmri_data_valid[:,optiondict['addedskip']:],
-                                                               cleaned_referencetc,
-                                                               thecorrelator,
-                                                               initial_fmri_x,
-                                                               os_fmri_x,
-                                                               corrorigin,
-                                                               lagmininpts,
-                                                               lagmaxinpts,
-                                                               corrout,
-                                                               meanval,
-                                                               nprocs=optiondict['nprocs'],
-                                                               oversampfactor=optiondict['oversampfactor'],
-                                                               interptype=optiondict['interptype'],
-                                                               showprogressbar=optiondict['showprogressbar'],
-                                                               chunksize=optiondict['mp_chunksize'],
-                                                               rt_floatset=rt_floatset,
-                                                               rt_floattype=rt_floattype)
-
-        for i in range(len(theglobalmaxlist)):
-            theglobalmaxlist[i] = corrscale[theglobalmaxlist[i]]
-        tide_stats.makeandsavehistogram(np.asarray(theglobalmaxlist), len(corrscale), 0,
-                                        outputname + '_globallaghist_pass' + str(thepass),
-                                        displaytitle='lagtime histogram', displayplots=optiondict['displayplots'],
-                                        therange=(corrscale[0], corrscale[-1]), refine=False)
-
-        if optiondict['checkpoint']:
-            outcorrarray[:, :] = 0.0
-            outcorrarray[validvoxels, :] = corrout[:, :]
-            if optiondict['textio']:
-                tide_io.writenpvecs(outcorrarray.reshape(nativecorrshape),
-                                    outputname + '_corrout_prefit_pass' + str(thepass) + outsuffix4d + '.txt')
+        if thecheckpointer.isdone('correlation', thepass):
+            print('\n\nCorrelation calculation, pass ' + str(thepass) + ', was completed before the checkpoint')
+            thecheckpointer.restorearray('corrout', corrout, slabsize=optiondict['slabsize'])
+            checkpointarrays = dict(carriedarrays, corrout=corrout)
+            if (optiondict['extraprobefiles'] is not None) and (thepass == optiondict['passes']):
+                thecheckpointer.restorearray('probecorrout', probecorrout, slabsize=optiondict['slabsize'])
+                checkpointarrays['probecorrout'] = probecorrout
+            meanval[:] = checkpointstate['meanval']
+            checkpointstate['meanval'] = meanval
+            trimmedcorrscale = checkpointstate['trimmedcorrscale']
+        else:
+            print('\n\nCorrelation calculation, pass ' + str(thepass))
+            timings.append(['Correlation calculation start, pass ' + str(thepass), time.time(), None, None])
+            tide_telemetry.startspan('Correlation calculation')
+            correlationpass_func = addmemprofiling(tide_corrpass.correlationpass,
+                                                   optiondict['memprofile'],
+                                                   memfile,
+                                                   'before correlationpass')
+
+            if (optiondict['extraprobefiles'] is not None) and (thepass == optiondict['passes']):
+                # correlate with the main regressor and the extra probes at the same time.  The main regressor's
+                # correlations go straight into corrout.
+                thepasscorrelator = themulticorrelator
+                thepassreferencetc = np.vstack([cleaned_referencetc] + probereferencetcs)
+                thepassprobecorrout = probecorrout
+            else:
+                thepasscorrelator = thecorrelator
+                thepassreferencetc = cleaned_referencetc
+                thepassprobecorrout = None
+            thepasscorrelator.setlimits(lagmininpts, lagmaxinpts)
+            corrcache = None
+            if tide_stagecache.isenabled():
+                corrkey = tide_stagecache.stagekey('correlation', optiondict,
+                                                   ignore=tide_stagecache.correlationignore,
+                                                   parents=[voxelskey], arrays=[thepassreferencetc],
+                                                   values=[rt_floattype, lagmininpts, lagmaxinpts])
+                corrcache = tide_stagecache.load(corrkey)
+            voxelsprocessed_cp = 0
+            if corrcache is not None:
+                print('using the correlations from the stage cache')
+                for slabstart, slabend in voxelslabs(numvalidspatiallocs, optiondict):
+                    corrout[slabstart:slabend] = corrcache['corrout'][slabstart:slabend]
+                    if thepassprobecorrout is not None:
+                        probecorrout[slabstart:slabend] = corrcache['probecorrout'][slabstart:slabend]
+                meanval[:] = corrcache['meanval']
+                trimmedcorrscale = np.array(corrcache['trimmedcorrscale'])
+                theglobalmaxlist = list(np.array(corrcache['globalmaxlist']))
+                del corrcache
             else:
-                tide_io.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
-                                    outputname + '_corrout_prefit_pass' + str(thepass)+ outsuffix4d)
+                theglobalmaxlist = []
+                for slabstart, slabend in voxelslabs(numvalidspatiallocs, optiondict):
+                    slabvoxelsprocessed, slabglobalmaxlist, trimmedcorrscale = correlationpass_func(
+                        fmri_data_valid[slabstart:slabend, optiondict['addedskip']:],
+                        thepassreferencetc,
+                        thepasscorrelator,
+                        initial_fmri_x,
+                        os_fmri_x,
+                        corrorigin,
+                        lagmininpts,
+                        lagmaxinpts,
+                        corrout[slabstart:slabend],
+                        meanval[slabstart:slabend],
+                        nprocs=optiondict['nprocs'],
+                        oversampfactor=optiondict['oversampfactor'],
+                        interptype=optiondict['interptype'],
+                        coarsetofine=optiondict['coarsetofine'],
+                        probecorrout=(None if thepassprobecorrout is None
+                                      else thepassprobecorrout[slabstart:slabend]),
+                        showprogressbar=optiondict['showprogressbar'],
+                        chunksize=optiondict['mp_chunksize'],
+                        rt_floatset=rt_floatset,
+                        rt_floattype=rt_floattype)
+                    voxelsprocessed_cp += slabvoxelsprocessed
+                    theglobalmaxlist += slabglobalmaxlist
+                if tide_stagecache.isenabled():
+                    corrresult = {'corrout': corrout, 'meanval': meanval, 'trimmedcorrscale': trimmedcorrscale,
+                                  'globalmaxlist': np.asarray(theglobalmaxlist)}
+                    if thepassprobecorrout is not None:
+                        corrresult['probecorrout'] = probecorrout
+                    tide_stagecache.save(corrkey, corrresult)
+                    del corrresult
+            if thepassprobecorrout is not None:
+                theglobalmaxlist = [theglobalmax[0] for theglobalmax in theglobalmaxlist]
+
+            for i in range(len(theglobalmaxlist)):
+                theglobalmaxlist[i] = corrscale[theglobalmaxlist[i]]
+            tide_stats.makeandsavehistogram(np.asarray(theglobalmaxlist), len(corrscale), 0,
+                                            outputname + '_globallaghist_pass' + str(thepass),
+                                            displaytitle='lagtime histogram', displayplots=optiondict['displayplots'],
+                                            therange=(corrscale[0], corrscale[-1]), refine=False)
 
-        timings.append(['Correlation calculation end, pass ' + str(thepass), time.time(), voxelsprocessed_cp, 'voxels'])
+            if optiondict['checkpoint']:
+                outcorrarray[:, :] = 0.0
+                outcorrarray[validvoxels, :] = corrout[:, :]
+                if optiondict['textio']:
+                    tide_io.writenpvecs(outcorrarray.reshape(nativecorrshape),
+                                        outputname + '_corrout_prefit_pass' + str(thepass) + outsuffix4d + '.txt')
+                else:
+                    tide_io.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
+                                        outputname + '_corrout_prefit_pass' + str(thepass)+ outsuffix4d)
+
+            checkpointstate.update({'meanval': meanval, 'trimmedcorrscale': trimmedcorrscale})
+            checkpointarrays = dict(carriedarrays, corrout=corrout)
+            if thepassprobecorrout is not None:
+                checkpointarrays['probecorrout'] = probecorrout
+            thecheckpointer.save('correlation', thepass, optiondict, state=checkpointstate, arrays=checkpointarrays,
+                                 changed=['corrout', 'probecorrout'])
+            timings.append(['Correlation calculation end, pass ' + str(thepass), time.time(), voxelsprocessed_cp,
+                            'voxels'])
+            tide_telemetry.endspan(numitems=voxelsprocessed_cp, unit='voxels')
 
         # Step 2 - correlation fitting and time lag estimation
-        print('\n\nTime lag estimation pass ' + str(thepass))
-        timings.append(['Time lag estimation start, pass ' + str(thepass), time.time(), None, None])
-        fitcorr_func = addmemprofiling(tide_corrfit.fitcorrx,
-                                       optiondict['memprofile'],
-                                       memfile,
-                                       'before fitcorr')
-        thefitter.setcorrtimeaxis(trimmedcorrscale)
-        voxelsprocessed_fc = fitcorr_func(genlagtc,
-                                          initial_fmri_x,
-                                          lagtc,
-                                          trimmedcorrscale,
-                                          thefitter,
-                                          corrout,
-                                          lagmask, failimage, lagtimes, lagstrengths, lagsigma,
-                                          gaussout, windowout, R2,
-                                          nprocs=optiondict['nprocs'],
-                                          fixdelay=optiondict['fixdelay'],
-                                          showprogressbar=optiondict['showprogressbar'],
-                                          chunksize=optiondict['mp_chunksize'],
-                                          despeckle_thresh=optiondict['despeckle_thresh'],
-                                          rt_floatset=rt_floatset,
-                                          rt_floattype=rt_floattype
-                                          )
-
-        timings.append(['Time lag estimation end, pass ' + str(thepass), time.time(), voxelsprocessed_fc, 'voxels'])
+        if thecheckpointer.isdone('fit', thepass):
+            print('\n\nTime lag estimation, pass ' + str(thepass) + ', was completed before the checkpoint')
+            thefitter.setcorrtimeaxis(trimmedcorrscale)
+            for arrayname, thearray in [('lagtc', lagtc), ('gaussout', gaussout), ('windowout', windowout)]:
+                thecheckpointer.restorearray(arrayname, thearray, slabsize=optiondict['slabsize'])
+                checkpointarrays[arrayname] = thearray
+            for mapname, themap in [('lagtimes', lagtimes), ('lagstrengths', lagstrengths), ('lagsigma', lagsigma),
+                                    ('lagmask', lagmask), ('failimage', failimage), ('R2', R2)]:
+                themap[:] = checkpointstate[mapname]
+                checkpointstate[mapname] = themap
+        else:
+            print('\n\nTime lag estimation pass ' + str(thepass))
+            timings.append(['Time lag estimation start, pass ' + str(thepass), time.time(), None, None])
+            tide_telemetry.startspan('Time lag estimation')
+            fitcorr_func = addmemprofiling(tide_corrfit.fitcorrx,
+                                           optiondict['memprofile'],
+                                           memfile,
+                                           'before fitcorr')
+            thefitter.setcorrtimeaxis(trimmedcorrscale)
+            if optiondict['multiresfactor'] > 1:
+                # fit the parcel averaged data first, and only search near the parcel lag at full resolution
+                print('estimating parcel delays')
+                multireslags = _fitparcels(theparcellator, fmri_data_valid[:, optiondict['addedskip']:],
+                                           cleaned_referencetc, thecorrelator, thefitter, genlagtc,
+                                           initial_fmri_x, os_fmri_x, trimmedcorrscale, lagmininpts, lagmaxinpts,
+                                           optiondict)
+            else:
+                multireslags = None
+            voxelsprocessed_fc = 0
+            for slabstart, slabend in voxelslabs(numvalidspatiallocs, optiondict):
+                voxelsprocessed_fc += fitcorr_func(genlagtc,
+                                                   initial_fmri_x,
+                                                   lagtc[slabstart:slabend],
+                                                   trimmedcorrscale,
+                                                   thefitter,
+                                                   corrout[slabstart:slabend],
+                                                   lagmask[slabstart:slabend],
+                                                   failimage[slabstart:slabend],
+                                                   lagtimes[slabstart:slabend],
+                                                   lagstrengths[slabstart:slabend],
+                                                   lagsigma[slabstart:slabend],
+                                                   gaussout[slabstart:slabend],
+                                                   windowout[slabstart:slabend],
+                                                   R2[slabstart:slabend],
+                                                   nprocs=optiondict['nprocs'],
+                                                   fixdelay=optiondict['fixdelay'],
+                                                   showprogressbar=optiondict['showprogressbar'],
+                                                   chunksize=optiondict['mp_chunksize'],
+                                                   despeckle_thresh=optiondict['despeckle_thresh'],
+                                                   initiallags=(None if multireslags is None
+                                                                else multireslags[slabstart:slabend]),
+                                                   searchwidth=optiondict['multireswidth'],
+                                                   rt_floatset=rt_floatset,
+                                                   rt_floattype=rt_floattype
+                                                   )
+            if multireslags is not None:
+                # use the full search range where the parcel fit failed, the voxel fit failed, or the peak was at the
+                # edge of the narrowed search window
+                hasparcellag = multireslags > -1000000.0
+                badfit = (lagmask == 0) | (np.fabs(lagtimes - multireslags) >= optiondict['multireswidth'] - corrtr)
+                lagwindows = tide_corrpass.makelagwindows(multireslags, trimmedcorrscale, optiondict['multireswidth'])
+                for slabstart, slabend in voxelslabs(numvalidspatiallocs, optiondict):
+                    badfit[slabstart:slabend] |= tide_corrpass.windowedgepeaks(corrout[slabstart:slabend],
+                                                                               lagwindows[slabstart:slabend],
+                                                                               bipolar=optiondict['bipolar'])
+                del lagwindows
+                fullsearchmask = np.where((~hasparcellag) | badfit, 1, 0)
+                print(np.sum(fullsearchmask), 'voxels refit with the full search range')
+                for slabstart, slabend in voxelslabs(numvalidspatiallocs, optiondict):
+                    if np.sum(fullsearchmask[slabstart:slabend]) == 0:
+                        continue
+                    voxelsprocessed_fc += fitcorr_func(genlagtc,
+                                                       initial_fmri_x,
+                                                       lagtc[slabstart:slabend],
+                                                       trimmedcorrscale,
+                                                       thefitter,
+                                                       corrout[slabstart:slabend],
+                                                       lagmask[slabstart:slabend],
+                                                       failimage[slabstart:slabend],
+                                                       lagtimes[slabstart:slabend],
+                                                       lagstrengths[slabstart:slabend],
+                                                       lagsigma[slabstart:slabend],
+                                                       gaussout[slabstart:slabend],
+                                                       windowout[slabstart:slabend],
+                                                       R2[slabstart:slabend],
+                                                       nprocs=optiondict['nprocs'],
+                                                       fixdelay=optiondict['fixdelay'],
+                                                       showprogressbar=optiondict['showprogressbar'],
+                                                       chunksize=optiondict['mp_chunksize'],
+                                                       despeckle_thresh=optiondict['despeckle_thresh'],
+                                                       fitmask=fullsearchmask[slabstart:slabend],
+                                                       rt_floatset=rt_floatset,
+                                                       rt_floattype=rt_floattype
+                                                       )
+
+            checkpointstate.update({'lagtimes': lagtimes, 'lagstrengths': lagstrengths, 'lagsigma': lagsigma,
+                                    'lagmask': lagmask, 'failimage': failimage, 'R2': R2})
+            checkpointarrays.update({'lagtc': lagtc, 'gaussout': gaussout, 'windowout': windowout})
+            thecheckpointer.save('fit', thepass, optiondict, state=checkpointstate, arrays=checkpointarrays,
+                                 changed=['lagtc', 'gaussout', 'windowout'])
+            timings.append(['Time lag estimation end, pass ' + str(thepass), time.time(), voxelsprocessed_fc,
+                            'voxels'])
+            tide_telemetry.endspan(numitems=voxelsprocessed_fc, unit='voxels')
 
         # Step 2b - Correlation time despeckle
-        if optiondict['despeckle_passes'] > 0:
+        if (optiondict['despeckle_passes'] > 0) and thecheckpointer.isdone('despeckle', thepass):
+            print('\n\nCorrelation despeckling, pass ' + str(thepass) + ', was completed before the checkpoint')
+        elif optiondict['despeckle_passes'] > 0:
             print('\n\nCorrelation despeckling pass ' + str(thepass))
             print('\tUsing despeckle_thresh =' + str(optiondict['despeckle_thresh']))
             timings.append(['Correlation despeckle start, pass ' + str(thepass), time.time(), None, None])
+            tide_telemetry.startspan('Correlation despeckle')
 
             # find lags that are very different from their neighbors, and refit starting at the median lag for the point
             voxelsprocessed_fc_ds = 0
             despecklingdone = False
+            thedespeckler = tide_classes.despeckler(nativespaceshape, validvoxels,
+                                                    despeckle_thresh=optiondict['despeckle_thresh'],
+                                                    rt_floattype=rt_floattype)
             for despecklepass in range(optiondict['despeckle_passes']):
                 print('\n\nCorrelation despeckling subpass ' + str(despecklepass + 1))
-                outmaparray *= 0.0
-                outmaparray[validvoxels] = eval('lagtimes')[:]
-                medianlags = ndimage.median_filter(outmaparray.reshape(nativespaceshape), 3).reshape(numspatiallocs)
-                initlags = \
-                    np.where(np.abs(outmaparray - medianlags) > optiondict['despeckle_thresh'], medianlags, -1000000.0)[
-                        validvoxels]
-                if len(initlags) > 0:
-                    if len(np.where(initlags != -1000000.0)[0]) > 0:
-                        voxelsprocessed_fc_ds += fitcorr_func(genlagtc,
-                                                              initial_fmri_x,
-                                                              lagtc,
-                                                              trimmedcorrscale,
-                                                              thefitter,
-                                                              corrout,
-                                                              lagmask, failimage, lagtimes, lagstrengths, lagsigma,
-                                                              gaussout, windowout, R2,
-                                                              nprocs=optiondict['nprocs'],
-                                                              fixdelay=optiondict['fixdelay'],
-                                                              showprogressbar=optiondict['showprogressbar'],
-                                                              chunksize=optiondict['mp_chunksize'],
-                                                              despeckle_thresh=optiondict['despeckle_thresh'],
-                                                              initiallags=initlags,
-                                                              rt_floatset=rt_floatset,
-                                                              rt_floattype=rt_floattype
-                                                              )
-                    else:
-                        despecklingdone = True
+                refitvoxels, refitlags = thedespeckler.getinitlags(lagtimes)
+                print(len(refitvoxels), 'voxels to refit')
+                if len(refitvoxels) > 0:
+                    initlags = np.zeros(numvalidspatiallocs, dtype=rt_floattype) - 1000000.0
+                    initlags[refitvoxels] = refitlags
+                    voxelsprocessed_fc_ds += fitcorr_func(genlagtc,
+                                                          initial_fmri_x,
+                                                          lagtc,
+                                                          trimmedcorrscale,
+                                                          thefitter,
+                                                          corrout,
+                                                          lagmask, failimage, lagtimes, lagstrengths, lagsigma,
+                                                          gaussout, windowout, R2,
+                                                          nprocs=optiondict['nprocs'],
+                                                          fixdelay=optiondict['fixdelay'],
+                                                          showprogressbar=optiondict['showprogressbar'],
+                                                          chunksize=optiondict['mp_chunksize'],
+                                                          despeckle_thresh=optiondict['despeckle_thresh'],
+                                                          initiallags=initlags,
+                                                          rt_floatset=rt_floatset,
+                                                          rt_floattype=rt_floattype
+                                                          )
                 else:
                     despecklingdone = True
                 if despecklingdone:
@@ -2194,16 +2817,49 @@ def rapidtide_main():
                 else:
                     theheader['dim'][0] = 3
                     theheader['dim'][4] = 1
-                tide_io.savetonifti((np.where(np.abs(outmaparray - medianlags) > optiondict['despeckle_thresh'], medianlags, 0.0)).reshape(nativespaceshape), theheader,
+                tide_io.savetonifti(thedespeckler.getmask().reshape(nativespaceshape), theheader,
                                  outputname + '_despecklemask_pass' + str(thepass))
             print('\n\n', voxelsprocessed_fc_ds, 'voxels despeckled in', optiondict['despeckle_passes'], 'passes')
+            thecheckpointer.save('despeckle', thepass, optiondict, state=checkpointstate, arrays=checkpointarrays,
+                                 changed=['lagtc', 'gaussout', 'windowout'])
             timings.append(
                 ['Correlation despeckle end, pass ' + str(thepass), time.time(), voxelsprocessed_fc_ds, 'voxels'])
+            tide_telemetry.endspan(numitems=voxelsprocessed_fc_ds, unit='voxels')
+
+        # Step 2c - fit the correlations with the extra probes
+        if (optiondict['extraprobefiles'] is not None) and (thepass == optiondict['passes']):
+            timings.append(['Extra probe fitting start', time.time(), None, None])
+            tide_telemetry.startspan('Extra probe fitting')
+            probelagtc = tide_ooc.allocarray(internalvalidfmrishape, rt_floattype, 'probelagtc')
+            probegaussout = tide_ooc.allocarray(internalvalidcorrshape, rt_floattype, 'probegaussout')
+            probewindowout = tide_ooc.allocarray(internalvalidcorrshape, rt_floattype, 'probewindowout')
+            for theprobe in range(numprobes):
+                print('\n\nTime lag estimation, probe ' + str(theprobe + 1))
+                fitcorr_func(probegenlagtcs[theprobe],
+                             initial_fmri_x,
+                             probelagtc,
+                             trimmedcorrscale,
+                             thefitter,
+                             probecorrout[:, theprobe, :],
+                             probelagmask[theprobe, :], probefailimage[theprobe, :], probelagtimes[theprobe, :],
+                             probelagstrengths[theprobe, :], probelagsigma[theprobe, :],
+                             probegaussout, probewindowout, probeR2[theprobe, :],
+                             nprocs=optiondict['nprocs'],
+                             fixdelay=optiondict['fixdelay'],
+                             showprogressbar=optiondict['showprogressbar'],
+                             chunksize=optiondict['mp_chunksize'],
+                             despeckle_thresh=optiondict['despeckle_thresh'],
+                             rt_floatset=rt_floatset,
+                             rt_floattype=rt_floattype)
+            del probelagtc, probegaussout, probewindowout
+            timings.append(['Extra probe fitting end', time.time(), numprobes * numvalidspatiallocs, 'voxels'])
+            tide_telemetry.endspan(numitems=numprobes * numvalidspatiallocs, unit='voxels')
 
         # Step 3 - regressor refinement for next pass
         if thepass < optiondict['passes']:
             print('\n\nRegressor refinement, pass' + str(thepass))
             timings.append(['Regressor refinement start, pass ' + str(thepass), time.time(), None, None])
+            tide_telemetry.startspan('Regressor refinement')
             if optiondict['refineoffset']:
                 peaklag, peakheight, peakwidth = tide_stats.gethistprops(lagtimes[np.where(lagmask > 0)],
                                                                          optiondict['histlen'],
@@ -2232,6 +2888,7 @@ def rapidtide_main():
                 padtrs=numpadtrs,
                 includemask=internalrefineincludemask_valid,
                 excludemask=internalrefineexcludemask_valid,
+                slabsize=(optiondict['slabsize'] if optiondict['outofcore'] else None),
                 rt_floatset=rt_floatset,
                 rt_floattype=rt_floattype)
             normoutputdata = tide_math.stdnormalize(theprefilter.apply(fmrifreq, outputdata))
@@ -2275,12 +2932,24 @@ def rapidtide_main():
             osrefname = '_reference_resampres_pass' + str(thepass + 1) + '.txt'
             tide_io.writenpvecs(tide_math.stdnormalize(resampnonosref_y), outputname + nonosrefname)
             tide_io.writenpvecs(tide_math.stdnormalize(resampref_y), outputname + osrefname)
+            checkpointstate.update({'resampref_y': resampref_y,
+                                    'resampnonosref_y': resampnonosref_y,
+                                    'genlagtc_x': initial_fmri_x,
+                                    'genlagtc_y': normoutputdata,
+                                    'refinemask': refinemask})
+            if optiondict['savelagregressors']:
+                carriedarrays = {'shiftedtcs': shiftedtcs}
+            checkpointarrays = dict(carriedarrays)
+            thecheckpointer.save('refinement', thepass, optiondict, state=checkpointstate, arrays=checkpointarrays)
             timings.append(
                 ['Regressor refinement end, pass ' + str(thepass), time.time(), voxelsprocessed_rr, 'voxels'])
+            tide_telemetry.endspan(numitems=voxelsprocessed_rr, unit='voxels')
+        tide_telemetry.endspan()
 
     # Post refinement step 0 - Wiener deconvolution
     if optiondict['dodeconv']:
         timings.append(['Wiener deconvolution start', time.time(), None, None])
+        tide_telemetry.startspan('Wiener deconvolution')
         print('\n\nWiener deconvolution')
         reportstep = 1000
 
@@ -2304,10 +2973,24 @@ def rapidtide_main():
                                                  rt_floattype=rt_floattype
                                                  )
         timings.append(['Wiener deconvolution end', time.time(), voxelsprocessed_wiener, 'voxels'])
+        tide_telemetry.endspan(numitems=voxelsprocessed_wiener, unit='voxels')
 
     # Post refinement step 1 - GLM fitting to remove moving signal
-    if optiondict['doglmfilt']:
+    if optiondict['doglmfilt'] and thecheckpointer.isdone('glm', 0):
+        print('\n\nGLM filtering was completed before the checkpoint')
+        meanvalue = checkpointstate['meanvalue']
+        rvalue = checkpointstate['rvalue']
+        r2value = checkpointstate['r2value']
+        fitNorm = checkpointstate['fitNorm']
+        fitcoff = checkpointstate['fitcoff']
+        datatoremove = tide_ooc.allocarray(internalvalidfmrishape, rt_outfloattype, 'datatoremove')
+        filtereddata = tide_ooc.allocarray(internalvalidfmrishape, rt_outfloattype, 'filtereddata')
+        thecheckpointer.restorearray('datatoremove', datatoremove, slabsize=optiondict['slabsize'])
+        thecheckpointer.restorearray('filtereddata', filtereddata, slabsize=optiondict['slabsize'])
+        del fmri_data_valid
+    elif optiondict['doglmfilt']:
         timings.append(['GLM filtering start', time.time(), None, None])
+        tide_telemetry.startspan('GLM filtering')
         print('\n\nGLM filtering')
         reportstep = 1000
         if (optiondict['gausssigma'] > 0.0) or (optiondict['glmsourcefile'] is not None):
@@ -2316,15 +2999,21 @@ def rapidtide_main():
                 if optiondict['textio']:
                     nim_data = tide_io.readvecs(optiondict['glmsourcefile'])
                 else:
-                    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(optiondict['glmsourcefile'])
+                    nim, nim_data, nim_hdr, thedims, thesizes = readfmridata(optiondict['glmsourcefile'], optiondict,
+                                                                             rt_floattype)
             else:
                 print('rereading', fmrifilename, ' for GLM filter, please wait')
                 if optiondict['textio']:
                     nim_data = tide_io.readvecs(fmrifilename)
                 else:
-                    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename)
-            fmri_data_valid = (nim_data.reshape((numspatiallocs, timepoints))[:, validstart:validend + 1])[validvoxels,
-                              :] + 0.0
+                    nim, nim_data, nim_hdr, thedims, thesizes = readfmridata(fmrifilename, optiondict, rt_floattype)
+            if optiondict['outofcore']:
+                fmri_data_valid = tide_ooc.toscratch(
+                    nim_data.reshape((numspatiallocs, timepoints))[:, validstart:validend + 1], 'fmri_data_valid',
+                    thetype=rt_floattype, rows=validvoxels, slabsize=optiondict['slabsize'])
+            else:
+                fmri_data_valid = (nim_data.reshape((numspatiallocs, timepoints))[:, validstart:validend + 1])[
+                                  validvoxels, :] + 0.0
 
             # move fmri_data_valid into shared memory
             if optiondict['sharedmem']:
@@ -2349,8 +3038,8 @@ def rapidtide_main():
             datatoremove, dummy, dummy = allocshared(internalvalidfmrishape, rt_outfloatset)
             filtereddata, dummy, dummy = allocshared(internalvalidfmrishape, rt_outfloatset)
         else:
-            datatoremove = np.zeros(internalvalidfmrishape, dtype=rt_outfloattype)
-            filtereddata = np.zeros(internalvalidfmrishape, dtype=rt_outfloattype)
+            datatoremove = tide_ooc.allocarray(internalvalidfmrishape, rt_outfloattype, 'datatoremove')
+            filtereddata = tide_ooc.allocarray(internalvalidfmrishape, rt_outfloattype, 'filtereddata')
 
         if optiondict['memprofile']:
             memcheckpoint('about to start glm noise removal...')
@@ -2358,34 +3047,50 @@ def rapidtide_main():
             tide_util.logmem('before glm', file=memfile)
 
         if optiondict['preservefiltering']:
-            for i in range(len(validvoxels)):
-                fmri_data_valid[i] = theprefilter.apply(optiondict['fmrifreq'], fmri_data_valid[i])
+            for i in range(0, len(validvoxels), optiondict['mp_chunksize']):
+                fmri_data_valid[i:i + optiondict['mp_chunksize']] = \
+                    theprefilter.apply(optiondict['fmrifreq'], fmri_data_valid[i:i + optiondict['mp_chunksize']])
         glmpass_func = addmemprofiling(tide_glmpass.glmpass,
                                        optiondict['memprofile'],
                                        memfile,
                                        'before glmpass')
-        voxelsprocessed_glm = glmpass_func(numvalidspatiallocs,
-                                           fmri_data_valid,
-                                           threshval,
-                                           lagtc,
-                                           meanvalue,
-                                           rvalue,
-                                           r2value,
-                                           fitcoff,
-                                           fitNorm,
-                                           datatoremove,
-                                           filtereddata,
-                                           reportstep=reportstep,
-                                           nprocs=optiondict['nprocs'],
-                                           showprogressbar=optiondict['showprogressbar'],
-                                           addedskip=optiondict['addedskip'],
-                                           mp_chunksize=optiondict['mp_chunksize'],
-                                           rt_floatset=rt_floatset,
-                                           rt_floattype=rt_floattype
-                                           )
+        if optiondict['outofcore']:
+            # the voxel selection depends on the whole dataset, so make it before splitting into slabs
+            glmmask = tide_glmpass.makeglmmask(fmri_data_valid, threshval, slabsize=optiondict['slabsize'])
+        else:
+            glmmask = None
+        voxelsprocessed_glm = 0
+        for slabstart, slabend in voxelslabs(numvalidspatiallocs, optiondict):
+            voxelsprocessed_glm += glmpass_func(slabend - slabstart,
+                                                fmri_data_valid[slabstart:slabend],
+                                                threshval,
+                                                lagtc[slabstart:slabend],
+                                                meanvalue[slabstart:slabend],
+                                                rvalue[slabstart:slabend],
+                                                r2value[slabstart:slabend],
+                                                fitcoff[slabstart:slabend],
+                                                fitNorm[slabstart:slabend],
+                                                datatoremove[slabstart:slabend],
+                                                filtereddata[slabstart:slabend],
+                                                reportstep=reportstep,
+                                                nprocs=optiondict['nprocs'],
+                                                showprogressbar=optiondict['showprogressbar'],
+                                                addedskip=optiondict['addedskip'],
+                                                mp_chunksize=optiondict['mp_chunksize'],
+                                                themask=(None if glmmask is None
+                                                         else glmmask[slabstart:slabend]),
+                                                rt_floatset=rt_floatset,
+                                                rt_floattype=rt_floattype
+                                                )
         del fmri_data_valid
+        checkpointstate.update({'meanvalue': meanvalue, 'rvalue': rvalue, 'r2value': r2value, 'fitNorm': fitNorm,
+                                'fitcoff': fitcoff})
+        checkpointarrays.update({'datatoremove': datatoremove, 'filtereddata': filtereddata})
+        thecheckpointer.save('glm', 0, optiondict, state=checkpointstate, arrays=checkpointarrays,
+                             changed=['datatoremove', 'filtereddata'])
 
         timings.append(['GLM filtering end, pass ' + str(thepass), time.time(), voxelsprocessed_glm, 'voxels'])
+        tide_telemetry.endspan(numitems=voxelsprocessed_glm, unit='voxels')
         if optiondict['memprofile']:
             memcheckpoint('...done')
         else:
@@ -2397,9 +3102,11 @@ def rapidtide_main():
         if optiondict['textio']:
             nim_data = tide_io.readvecs(fmrifilename)
         else:
-            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename)
+            nim, nim_data, nim_hdr, thedims, thesizes = readfmridata(fmrifilename, optiondict, rt_floattype)
         fmri_data = nim_data.reshape((numspatiallocs, timepoints))[:, validstart:validend + 1]
-        meanvalue = np.mean(fmri_data, axis=1)
+        meanvalue = np.zeros(numspatiallocs, dtype=np.float64)
+        for slabstart, slabend in voxelslabs(numspatiallocs, optiondict):
+            meanvalue[slabstart:slabend] = np.mean(fmri_data[slabstart:slabend], axis=1)
 
 
     # Post refinement step 2 - make and save interesting histograms
@@ -2429,6 +3136,7 @@ def rapidtide_main():
 
     # do ones with one time point first
     timings.append(['Start saving maps', time.time(), None, None])
+    tide_telemetry.startspan('Saving maps')
     if not optiondict['textio']:
         theheader = copy.deepcopy(nim_hdr)
         if fileiscifti:
@@ -2456,6 +3164,19 @@ def rapidtide_main():
             tide_io.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
                                 outputname + '_' + mapname + outsuffix3d)
 
+    if optiondict['extraprobefiles'] is not None:
+        for theprobe in range(numprobes):
+            probename = outputname + '_probe' + str(theprobe + 1)
+            for mapname in ['lagtimes', 'lagstrengths', 'R2', 'lagsigma', 'lagmask', 'failimage']:
+                outmaparray[:] = 0.0
+                outmaparray[validvoxels] = eval('probe' + mapname)[theprobe, :]
+                if optiondict['textio']:
+                    tide_io.writenpvecs(outmaparray.reshape(nativespaceshape, 1),
+                                        probename + '_' + mapname + outsuffix3d + '.txt')
+                else:
+                    tide_io.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
+                                        probename + '_' + mapname + outsuffix3d)
+
     if optiondict['doglmfilt']:
         for mapname, mapsuffix in [('rvalue', 'fitR'), ('r2value', 'fitR2'), ('meanvalue', 'mean'),
                                    ('fitcoff', 'fitcoff'), ('fitNorm', 'fitNorm')]:
@@ -2511,8 +3232,8 @@ def rapidtide_main():
         outmaparray[:] = 0.0
         outmaparray[validvoxels] = refinemask[:]
         if optiondict['textio']:
-            tide_io.writenpvecs(outfmriarray.reshape(nativefmrishape),
-                                outputname + '_lagregressor' + outsuffix4d + '.txt')
+            tide_io.writenpvecs(outmaparray.reshape(nativespaceshape),
+                                outputname + '_refinemask' + outsuffix3d + '.txt')
         else:
             tide_io.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
                                 outputname + '_refinemask' + outsuffix3d)
@@ -2561,6 +3282,11 @@ def rapidtide_main():
         tide_io.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
                             outputname + '_corrout' + outsuffix4d)
     del corrout
+    del outcorrarray
+
+    # the 4D output array is only allocated once the correlation arrays are gone
+    if optiondict['savelagregressors'] or (optiondict['doglmfilt'] and optiondict['saveglmfiltered']):
+        outfmriarray = tide_ooc.allocarray(internalfmrishape, rt_floattype, 'outfmriarray')
 
     if not optiondict['textio']:
         theheader = copy.deepcopy(nim_hdr)
@@ -2612,7 +3338,11 @@ def rapidtide_main():
         del filtereddata
 
     timings.append(['Finished saving maps', time.time(), None, None])
+    tide_telemetry.endspan()
     memfile.close()
+    if optiondict['outofcore']:
+        tide_ooc.cleanup()
+    thecheckpointer.remove()
     print('done')
 
     if optiondict['displayplots']:
@@ -2623,5 +3353,13 @@ def rapidtide_main():
     nodeline = 'Processed on ' + platform.node()
     tide_util.proctiminginfo(timings, outputfile=outputname + '_runtimings.txt', extraheader=nodeline)
 
+    # save the telemetry
+    if optiondict['telemetry']:
+        tide_telemetry.endspan()
+        print()
+        tide_telemetry.proctelemetry()
+        tide_telemetry.writejson(outputname + '_telemetry.json')
+        tide_telemetry.writechrometrace(outputname + '_trace.json')
+
 if __name__ == '__main__':
     rapidtide_main()
@@ -24,11 +24,9 @@ from __future__ import print_function, division
 import argparse
 import scipy as sp
 from scipy import pi
-from scipy.stats.stats import pearsonr
 import numpy as np
 from numpy import r_, argmax, zeros
 from numpy.random import permutation
-import matplotlib.pyplot as plt
 
 import rapidtide.miscmath as tide_math
 import rapidtide.stats as tide_stats
@@ -36,8 +34,12 @@ import rapidtide.io as tide_io
 import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
 import rapidtide.correlate as tide_corr
+import rapidtide.lazyimport as tide_lazy
 from rapidtide.workflows.parser_funcs import is_valid_file, is_float
 
+plt = tide_lazy.lazymodule('matplotlib.pyplot')
+pearsonr = tide_lazy.lazyname('scipy.stats', 'pearsonr')
+
 
 def _get_null_distribution(indata, xcorr_x, thefilter, prewindow, detrendorder,
                            searchstart, searchend, Fs, dofftcorr,
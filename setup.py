@@ -30,6 +30,9 @@ with open(path.join(here, 'README.rst'), encoding='utf-8') as f:
 addtidepool = True
 
 modules_list = ['rapidtide/miscmath',
+                'rapidtide/lazyimport',
+                'rapidtide/fftbackend',
+                'rapidtide/accel',
                 'rapidtide/correlate',
                 'rapidtide/filter',
                 'rapidtide/fit',
@@ -38,6 +41,11 @@ modules_list = ['rapidtide/miscmath',
                 'rapidtide/stats',
                 'rapidtide/util',
                 'rapidtide/multiproc',
+                'rapidtide/telemetry',
+                'rapidtide/memplan',
+                'rapidtide/outofcore',
+                'rapidtide/checkpoint',
+                'rapidtide/stagecache',
                 'rapidtide/nullcorrpass',
                 'rapidtide/nullcorrpassx',
                 'rapidtide/corrpass',
@@ -93,6 +101,7 @@ script_list = ['rapidtide/scripts/rapidtide2',
                'rapidtide/scripts/tcfrom3col',
                'rapidtide/scripts/physiofreq',
                'rapidtide/scripts/rapidtide_dispatcher',
+               'rapidtide/scripts/rapidtide_warmup',
                # 'rapidtide/scripts/endtidalproc',
                'rapidtide/scripts/showhist',
                'rapidtide/scripts/rapidtide_dispatcher']